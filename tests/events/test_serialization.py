@@ -1,6 +1,7 @@
-from django.core.cache import cache
+from unittest.mock import patch
 from django.test import TestCase, override_settings
-from zentral.contrib.inventory.models import MachineSnapshotCommit
+from zentral.contrib.inventory.cache import machine_info_cache
+from zentral.contrib.inventory.models import MachineSnapshotCommit, MetaMachine
 from zentral.core.events.base import EventMetadata, EventRequest, BaseEvent, register_event_type
 
 
@@ -66,14 +67,15 @@ class EventSerializationTestCase(TestCase):
         self.assertEqual(source_machine["groups"][0]["reference"], "grp1")
         self.assertEqual(source_machine["os_version"], "OS X 10.11.1")
         # cached info
-        cache_key = f"mm-si_{self.ms.serial_number}"
-        machine = cache.get(cache_key)
+        with patch.object(MetaMachine, "get_serialized_info_for_event") as get_serialized_info_for_event:
+            machine = MetaMachine(self.ms.serial_number).cached_serialized_info_for_event
+            get_serialized_info_for_event.assert_not_called()
         self.assertEqual(machine["meta_business_units"][0]["id"],
                          self.ms.business_unit.meta_business_unit.pk)
         source_machine = machine["zentral-tests"]
         self.assertEqual(source_machine["groups"][0]["reference"], "grp1")
         self.assertEqual(source_machine["os_version"], "OS X 10.11.1")
-        cache.delete(cache_key)
+        machine_info_cache.bump_machines([self.ms.serial_number])
 
     def test_event_with_msn_without_machine_metadata(self):
         event = make_event(with_msn=True)
@@ -90,18 +92,18 @@ class EventSerializationTestCase(TestCase):
         metadata = d["_zentral"]
         self.assertEqual(metadata["request"], {"ip": "10.1.2.3"})
         event = make_event(ua="YO! ua")
-        cache.delete(f"mm-si_{self.ms.serial_number}")
+        machine_info_cache.bump_machines([self.ms.serial_number])
         d = event.serialize()
         metadata = d["_zentral"]
         self.assertEqual(metadata["request"], {"user_agent": "YO! ua"})
-        cache.delete(f"mm-si_{self.ms.serial_number}")
+        machine_info_cache.bump_machines([self.ms.serial_number])
 
     def test_event_without_request(self):
         event = make_event()
         d = event.serialize()
         metadata = d["_zentral"]
         self.assertNotIn("request", metadata)
-        cache.delete(f"mm-si_{self.ms.serial_number}")
+        machine_info_cache.bump_machines([self.ms.serial_number])
 
     def test_event_routing_key(self):
         event = make_event(routing_key="yolo123")
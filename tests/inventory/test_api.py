@@ -92,13 +92,15 @@ class InventoryAPITests(APITestCase):
                                     {"yolo": "fomo"}, format="json")
         self.assertEqual(response.status_code, 400)
 
-    def test_archive_machines(self):
+    @patch("zentral.contrib.inventory.api_views.machine_info_cache")
+    def test_archive_machines(self, machine_info_cache):
         serial_number = self.commit_machine_snapshot()
         serial_number2 = self.commit_machine_snapshot()
         self._set_permissions("inventory.change_machinesnapshot")
         response = self.client.post(reverse('inventory_api:archive_machines'),
                                     {"serial_numbers": [serial_number]}, format="json")
         self.assertEqual(response.status_code, 200)
+        machine_info_cache.bump_machines.assert_called_once_with([serial_number])
         self.assertEqual(response.data,
                          {"current_machine_snapshots": 1})
         self.assertEqual(
@@ -123,7 +125,8 @@ class InventoryAPITests(APITestCase):
                                     {"yolo": "fomo"}, format="json")
         self.assertEqual(response.status_code, 400)
 
-    def test_prune_machines(self):
+    @patch("zentral.contrib.inventory.api_views.machine_info_cache")
+    def test_prune_machines(self, machine_info_cache):
         serial_number = self.commit_machine_snapshot()
         self.commit_machine_snapshot(serial_number)
         serial_number2 = self.commit_machine_snapshot()
@@ -131,6 +134,7 @@ class InventoryAPITests(APITestCase):
         response = self.client.post(reverse('inventory_api:prune_machines'),
                                     {"serial_numbers": [serial_number]}, format="json")
         self.assertEqual(response.status_code, 200)
+        machine_info_cache.bump_machines.assert_called_once_with([serial_number])
         self.assertEqual(response.data,
                          {"current_machine_snapshots": 1,
                           "machine_snapshot_commits": 2,
@@ -338,7 +342,7 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.post(reverse('inventory_api:meta_business_units'), data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         mbus = list(MetaBusinessUnit.objects.filter(name=name))
         self.assertEqual(len(mbus), 1)
         meta_business_unit = mbus[0]
@@ -445,7 +449,7 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.put(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 4)
         prev_updated_at = meta_business_unit.updated_at
         meta_business_unit.refresh_from_db()
         self.assertEqual(meta_business_unit.name, updated_name)
@@ -543,7 +547,7 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.delete(url)
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertEqual(MetaBusinessUnit.objects.filter(pk=meta_business_unit.pk).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
@@ -623,7 +627,7 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.post(reverse('inventory_api:tags'), data, format='json')
         self.assertEqual(response.status_code, status.HTTP_201_CREATED)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         tag = Tag.objects.get(name=name)
         self.assertEqual(tag.meta_business_unit, meta_business_unit)
         self.assertEqual(tag.name, name)
@@ -721,7 +725,7 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.put(url, data, format='json')
         self.assertEqual(response.status_code, status.HTTP_200_OK)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         tag.refresh_from_db()
         self.assertEqual(tag.name, updated_name)
         event = post_event.call_args_list[0].args[0]
@@ -798,7 +802,7 @@ class InventoryAPITests(APITestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.client.delete(reverse('inventory_api:tag', args=(tag.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertEqual(Tag.objects.filter(pk=tag.pk).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
@@ -1,11 +1,15 @@
+import copy
 from datetime import datetime
+from unittest.mock import patch
 import uuid
 from django.test import TestCase
 from django.utils.crypto import get_random_string
 from zentral.core.compliance_checks.models import MachineStatus, Status
 from zentral.contrib.inventory.events import JMESPathCheckStatusUpdated
 from zentral.contrib.inventory.models import MachineTag, Tag
-from zentral.contrib.inventory.compliance_checks import jmespath_checks_cache
+from zentral.contrib.inventory.compliance_checks import JMESPathChecksCache, jmespath_checks_cache
+from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
+from zentral.core.exceptions import ImproperlyConfigured
 from .utils import force_jmespath_check
 
 
@@ -181,3 +185,124 @@ class InventoryComplianceChecksTestCase(TestCase):
         # missmatch, no status
         ms_qs = MachineStatus.objects.filter(compliance_check=jmespath_check_non_matching_tags.compliance_check)
         self.assertEqual(ms_qs.count(), 0)
+
+    def test_same_mt_hash_same_last_seen_no_update(self):
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        jmespath_check = force_jmespath_check(source_name, profile_uuid)
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        last_seen = datetime.utcnow()
+        mt_hash = get_random_string(40)
+        events0 = list(jmespath_checks_cache.process_tree(tree, last_seen, mt_hash))
+        self.assertEqual(len(events0), 1)
+        with patch("zentral.contrib.inventory.compliance_checks.update_machine_statuses") as update_machine_statuses:
+            events1 = list(jmespath_checks_cache.process_tree(tree, last_seen, mt_hash))
+            update_machine_statuses.assert_not_called()
+        self.assertEqual(len(events1), 0)
+        ms = MachineStatus.objects.get(compliance_check=jmespath_check.compliance_check)
+        self.assertEqual(ms.status, Status.OK.value)
+        self.assertEqual(ms.status_time, last_seen)
+
+    def test_same_mt_hash_memoized_result(self):
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        jmespath_check = force_jmespath_check(source_name, profile_uuid)
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        mt_hash = get_random_string(40)
+        events0 = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow(), mt_hash))
+        self.assertEqual(len(events0), 1)
+        # same mt_hash → the tree is not evaluated again
+        failed_tree = self._build_tree(source_name, str(uuid.uuid4()), serial_number)
+        last_seen = datetime.utcnow()
+        events1 = list(jmespath_checks_cache.process_tree(failed_tree, last_seen, mt_hash))
+        self.assertEqual(len(events1), 0)
+        ms = MachineStatus.objects.get(compliance_check=jmespath_check.compliance_check)
+        self.assertEqual(ms.status, Status.OK.value)
+        self.assertEqual(ms.previous_status, Status.OK.value)
+        self.assertEqual(ms.status_time, last_seen)  # status time updated
+        # different mt_hash → the tree is evaluated
+        events2 = list(jmespath_checks_cache.process_tree(failed_tree, datetime.utcnow(), get_random_string(40)))
+        self.assertEqual(len(events2), 1)
+        ms.refresh_from_db()
+        self.assertEqual(ms.status, Status.FAILED.value)
+        self.assertEqual(ms.previous_status, Status.OK.value)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_commit_tree_without_last_seen_status_time_refreshed(self, post_event):
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        jmespath_check = force_jmespath_check(source_name, profile_uuid)
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        commit_machine_snapshot_and_trigger_events(copy.deepcopy(tree))
+        ms = MachineStatus.objects.get(compliance_check=jmespath_check.compliance_check)
+        self.assertEqual(ms.status, Status.OK.value)
+        first_status_time = ms.status_time
+        post_event.reset_mock()
+        # same tree, without last seen → new last seen, same results
+        with patch("zentral.contrib.inventory.compliance_checks.update_machine_statuses") as update_machine_statuses:
+            commit_machine_snapshot_and_trigger_events(copy.deepcopy(tree))
+            update_machine_statuses.assert_not_called()
+        self.assertFalse(any(isinstance(call.args[0], JMESPathCheckStatusUpdated)
+                             for call in post_event.call_args_list))
+        ms.refresh_from_db()
+        self.assertEqual(ms.status, Status.OK.value)
+        self.assertEqual(ms.previous_status, Status.OK.value)
+        self.assertTrue(ms.status_time > first_status_time)  # status time refreshed
+
+    def test_same_results_out_of_sync_statuses_updated(self):
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        jmespath_check = force_jmespath_check(source_name, profile_uuid)
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        mt_hash = get_random_string(40)
+        events0 = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow(), mt_hash))
+        self.assertEqual(len(events0), 1)
+        # status updated elsewhere
+        MachineStatus.objects.filter(compliance_check=jmespath_check.compliance_check).update(
+            status=Status.FAILED.value
+        )
+        last_seen = datetime.utcnow()
+        events1 = list(jmespath_checks_cache.process_tree(tree, last_seen, mt_hash))
+        self.assertEqual(len(events1), 1)
+        ms = MachineStatus.objects.get(compliance_check=jmespath_check.compliance_check)
+        self.assertEqual(ms.status, Status.OK.value)
+        self.assertEqual(ms.previous_status, Status.FAILED.value)
+        self.assertEqual(ms.status_time, last_seen)
+
+    def test_memoization_disabled(self):
+        profile_uuid = str(uuid.uuid4())
+        source_name = get_random_string(12)
+        serial_number = get_random_string(12)
+        tree = self._build_tree(source_name, profile_uuid, serial_number)
+        force_jmespath_check(source_name, profile_uuid)
+        jmespath_checks_cache._last_fetched_time = None  # force refresh
+        mt_hash = get_random_string(40)
+        with patch.object(jmespath_checks_cache, "max_machine_results", 0):
+            events0 = list(jmespath_checks_cache.process_tree(tree, datetime.utcnow(), mt_hash))
+            self.assertEqual(len(events0), 1)
+            # same mt_hash, but no memoized result → the tree is evaluated
+            failed_tree = self._build_tree(source_name, str(uuid.uuid4()), serial_number)
+            events1 = list(jmespath_checks_cache.process_tree(failed_tree, datetime.utcnow(), mt_hash))
+        self.assertEqual(len(events1), 1)
+
+    @patch("zentral.contrib.inventory.compliance_checks.settings",
+           {"apps": {"zentral.contrib.inventory": {"jmespath_checks_cache": {"ttl": 1000000,
+                                                                             "max_machine_results": -1}}}})
+    def test_cache_config_clamped(self):
+        cache = JMESPathChecksCache()
+        self.assertEqual(cache.ttl, 86400)
+        self.assertEqual(cache.max_machine_results, 0)
+
+    @patch("zentral.contrib.inventory.compliance_checks.settings",
+           {"apps": {"zentral.contrib.inventory": {"jmespath_checks_cache": {"max_machine_results": "yolo"}}}})
+    def test_cache_config_invalid(self):
+        with self.assertRaises(ImproperlyConfigured):
+            JMESPathChecksCache()
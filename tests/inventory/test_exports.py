@@ -1,20 +1,28 @@
 import csv
+import io
 import json
+import os
+import time
+import tracemalloc
+from unittest import skipUnless
+from unittest.mock import patch
 import zipfile
 from django.core.files.storage import default_storage
+from django.db import connection
 from django.test import TestCase
 from django.utils.crypto import get_random_string
 from zentral.contrib.inventory.models import MachineSnapshotCommit
-from zentral.contrib.inventory.utils import export_machine_macos_app_instances, export_machine_snapshots
+from zentral.contrib.inventory.utils import (MSQuery, export_machine_macos_app_instances,
+                                             export_machine_snapshots)
 
 
 class InventoryExportsTests(TestCase):
     # utils
 
-    def commit_machine_snapshot(self, serial_number=None):
+    def commit_machine_snapshot(self, serial_number=None, source_name="Zentral Tests"):
         if serial_number is None:
             serial_number = get_random_string(12)
-        source = {"module": "tests.zentral.io", "name": "Zentral Tests"}
+        source = {"module": "tests.zentral.io", "name": source_name}
         tree = {
             "source": source,
             "business_unit": {"name": "yo bu",
@@ -85,3 +93,69 @@ class InventoryExportsTests(TestCase):
                  'source_name': 'Zentral Tests'}
             )
         default_storage.delete(result["filepath"])
+
+    def test_export_machine_snapshots_all_sources(self):
+        serial_number1 = self.commit_machine_snapshot()
+        serial_number2 = self.commit_machine_snapshot()
+        serial_number3 = self.commit_machine_snapshot(source_name="Zentral Tests 2")
+        result = export_machine_snapshots()
+        with default_storage.open(result["filepath"]) as f:
+            with zipfile.ZipFile(f) as zf:
+                self.assertEqual(zf.namelist(), ["zentral-tests.jsonl", "zentral-tests-2.jsonl"])
+                for filename, serial_numbers in (("zentral-tests.jsonl", {serial_number1, serial_number2}),
+                                                 ("zentral-tests-2.jsonl", {serial_number3})):
+                    with zf.open(filename) as jl:
+                        self.assertEqual(
+                            set(json.loads(line)["serial_number"] for line in jl.read().decode("utf-8").splitlines()),
+                            serial_numbers
+                        )
+        default_storage.delete(result["filepath"])
+
+    def test_export_machine_macos_app_instances_all_sources(self):
+        serial_number1 = self.commit_machine_snapshot()
+        serial_number2 = self.commit_machine_snapshot(source_name="Zentral Tests 2")
+        result = export_machine_macos_app_instances()
+        with default_storage.open(result["filepath"]) as f:
+            with zipfile.ZipFile(f) as zf:
+                self.assertEqual(zf.namelist(), ["zentral-tests.csv", "zentral-tests-2.csv"])
+                for filename, serial_number in (("zentral-tests.csv", serial_number1),
+                                                ("zentral-tests-2.csv", serial_number2)):
+                    with zf.open(filename) as csv_f:
+                        rows = list(csv.DictReader(csv_f.read().decode("utf-8").splitlines()))
+                        self.assertEqual(len(rows), 1)
+                        self.assertEqual(rows[0]["serial_number"], serial_number)
+                        self.assertEqual(rows[0]["bundle_id"], "io.zentral.baller")
+        default_storage.delete(result["filepath"])
+
+    def test_msquery_fetch_client_side_cursor(self):
+        serial_number = self.commit_machine_snapshot()
+        # the ES exporters stream the machines over the network → no transaction kept open
+        with patch.object(connection, "chunked_cursor", wraps=connection.chunked_cursor) as chunked_cursor:
+            self.assertEqual([sn for sn, _ in MSQuery().fetch(paginate=False, for_filtering=True)], [serial_number])
+        chunked_cursor.assert_not_called()
+
+    def test_msquery_export_server_side_cursor(self):
+        serial_number = self.commit_machine_snapshot()
+        with patch.object(connection, "chunked_cursor", wraps=connection.chunked_cursor) as chunked_cursor:
+            _, _, rows = next(MSQuery().export_sheets_data())
+            self.assertEqual([row[2] for row in rows], [serial_number])
+        chunked_cursor.assert_called_once_with()
+
+    @skipUnless(os.environ.get("ZENTRAL_BENCHMARKS"), "set ZENTRAL_BENCHMARKS to run the benchmarks")
+    def test_exports_benchmark(self):
+        machine_count = 5000
+        for _ in range(machine_count):
+            self.commit_machine_snapshot()
+        for label, export in (("machine snapshots", lambda: export_machine_snapshots()["filepath"]),
+                              ("macOS app instances", lambda: export_machine_macos_app_instances()["filepath"]),
+                              ("inventory XLSX", lambda: MSQuery().export_xlsx(io.BytesIO()))):
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            filepath = export()
+            duration = time.perf_counter() - t0
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if filepath:
+                default_storage.delete(filepath)
+            print(f"\nExport {label}: {machine_count} machines, {duration:.2f}s, "
+                  f"{machine_count / duration:.0f} machines/s, peak memory {peak / 2**20:.1f} MiB")
@@ -1,6 +1,21 @@
+from datetime import datetime
+from unittest.mock import Mock, patch
 from django.test import SimpleTestCase
 from zentral.conf import settings
-from zentral.contrib.inventory.workers import get_workers
+from zentral.contrib.inventory.clients.base import BaseInventory
+from zentral.contrib.inventory.workers import get_workers, InventoryWorker
+
+
+class FakeInventoryClient(BaseInventory):
+    name = "fake"
+
+    def __init__(self, config_d, machines):
+        super().__init__(config_d)
+        self.machines = machines
+
+    def get_machines(self):
+        for machine_d in self.machines:
+            yield dict(machine_d)
 
 
 class InventoryClientsTestCase(SimpleTestCase):
@@ -13,3 +28,74 @@ class InventoryClientsTestCase(SimpleTestCase):
             worker_count,
             len(settings.get('apps', {}).get('zentral.contrib.inventory', {}).get('clients', []))
         )
+
+    def test_worker_config_attributes_not_in_source(self):
+        client = FakeInventoryClient({"backend": "yolo", "host": "fomo", "max_workers": 8, "min_sleep": 60}, [])
+        self.assertEqual(client.source["config"], {"host": "fomo"})
+        self.assertEqual(client.max_workers, 8)
+        self.assertEqual(client.min_sleep, 60)
+        self.assertEqual(client.max_sleep, 300)
+
+    def test_iter_concurrently(self):
+        client = FakeInventoryClient({"max_workers": 3}, [])
+        self.assertEqual(list(client.iter_concurrently(lambda i: 2 * i, range(10))),
+                         [2 * i for i in range(10)])
+
+    @patch("zentral.contrib.inventory.clients.base.machine_info_cache")
+    @patch("zentral.contrib.inventory.clients.base.CurrentMachineSnapshot")
+    @patch("zentral.contrib.inventory.clients.base.commit_machine_snapshot_and_trigger_events")
+    def test_sync_change_detection(self, commit, cms, machine_info_cache):
+        cms.objects.filter.return_value.exclude.return_value.values_list.return_value = []
+        cms.objects.filter.return_value.exclude.return_value.delete.return_value = (0, {})
+        last_seen = datetime(2023, 1, 1)
+        client = FakeInventoryClient(
+            {},
+            [{"serial_number": "1", "last_seen": last_seen, "system_info": {"computer_name": "yolo"}},
+             {"serial_number": "2", "system_info": {"computer_name": "fomo"}}]
+        )
+        self.assertEqual(client.sync(), {"committed": 2, "unchanged": 0, "error": 0, "removed": 0})
+        self.assertEqual(commit.call_count, 2)
+        # machine 1 has not changed, machine 2 has no last_seen value
+        self.assertEqual(client.sync(), {"committed": 1, "unchanged": 1, "error": 0, "removed": 0})
+        self.assertEqual(commit.call_count, 3)
+        self.assertEqual(commit.call_args.args[0]["serial_number"], "2")
+        # machine 1 has changed
+        client.machines[0]["last_seen"] = datetime(2023, 1, 2)
+        self.assertEqual(client.sync(), {"committed": 2, "unchanged": 0, "error": 0, "removed": 0})
+        # the unseen machines are still removed
+        cms.objects.filter.return_value.exclude.assert_called_with(serial_number__in=["1", "2"])
+
+    @patch("zentral.contrib.inventory.clients.base.machine_info_cache")
+    @patch("zentral.contrib.inventory.clients.base.CurrentMachineSnapshot")
+    @patch("zentral.contrib.inventory.clients.base.commit_machine_snapshot_and_trigger_events")
+    def test_sync_removed_machines_cache_bumped(self, commit, cms, machine_info_cache):
+        cms.objects.filter.return_value.exclude.return_value.values_list.return_value = ["3"]
+        cms.objects.filter.return_value.exclude.return_value.delete.return_value = (1, {})
+        client = FakeInventoryClient({}, [{"serial_number": "1", "last_seen": datetime(2023, 1, 1)}])
+        self.assertEqual(client.sync(), {"committed": 1, "unchanged": 0, "error": 0, "removed": 1})
+        machine_info_cache.bump_machines.assert_called_once_with(["3"])
+
+    @patch("zentral.contrib.inventory.clients.base.CurrentMachineSnapshot")
+    @patch("zentral.contrib.inventory.clients.base.commit_machine_snapshot_and_trigger_events")
+    def test_sync_commit_error_retried(self, commit, cms):
+        commit.return_value = None
+        client = FakeInventoryClient({}, [{"serial_number": "1", "last_seen": datetime(2023, 1, 1)}])
+        self.assertEqual(client.sync(), {"committed": 0, "unchanged": 0, "error": 1, "removed": 0})
+        self.assertEqual(client.sync(), {"committed": 0, "unchanged": 0, "error": 1, "removed": 0})
+        self.assertEqual(commit.call_count, 2)
+        cms.objects.filter.assert_not_called()
+
+    def test_worker_adaptive_sleep(self):
+        client = FakeInventoryClient({"min_sleep": 10, "max_sleep": 35}, [])
+        client.sync = Mock(return_value={"committed": 0, "unchanged": 1, "error": 0, "removed": 0})
+        worker = InventoryWorker(client)
+        metrics_exporter = Mock()
+        worker.run(metrics_exporter, only_once=True)
+        self.assertEqual(worker.sleep, 20)
+        worker.run_once()
+        self.assertEqual(worker.sleep, 35)
+        client.sync.return_value = {"committed": 1, "unchanged": 0, "error": 0, "removed": 0}
+        worker.run_once()
+        self.assertEqual(worker.sleep, 10)
+        metrics_exporter.inc.assert_any_call("inventory_client_machines", "fake", "unchanged", amount=1)
+        metrics_exporter.inc.assert_any_call("inventory_client_syncs", "fake", "success")
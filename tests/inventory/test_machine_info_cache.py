@@ -0,0 +1,41 @@
+from unittest.mock import patch
+from django.test import SimpleTestCase
+from zentral.contrib.inventory.cache import MachineInfoCache
+from zentral.core.exceptions import ImproperlyConfigured
+
+
+class MachineInfoCacheTestCase(SimpleTestCase):
+    @patch("zentral.contrib.inventory.cache.settings",
+           {"apps": {"zentral.contrib.inventory": {}}})
+    def test_default_config(self):
+        cache = MachineInfoCache()
+        self.assertEqual(cache.ttl, 86400)
+        self.assertEqual(cache.l1_max_size, 1000)
+
+    @patch("zentral.contrib.inventory.cache.settings",
+           {"apps": {"zentral.contrib.inventory": {"machine_info_cache": {"ttl": 0,
+                                                                          "l1_max_size": 10000000}}}})
+    def test_config_clamped_min_ttl_max_l1_max_size(self):
+        cache = MachineInfoCache()
+        self.assertEqual(cache.ttl, 60)
+        self.assertEqual(cache.l1_max_size, 1000000)
+
+    @patch("zentral.contrib.inventory.cache.settings",
+           {"apps": {"zentral.contrib.inventory": {"machine_info_cache": {"ttl": 100000000,
+                                                                          "l1_max_size": -1}}}})
+    def test_config_clamped_max_ttl_min_l1_max_size(self):
+        cache = MachineInfoCache()
+        self.assertEqual(cache.ttl, 2592000)
+        self.assertEqual(cache.l1_max_size, 0)
+
+    @patch("zentral.contrib.inventory.cache.settings",
+           {"apps": {"zentral.contrib.inventory": {"machine_info_cache": {"ttl": "yolo"}}}})
+    def test_config_invalid_ttl(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MachineInfoCache()
+
+    @patch("zentral.contrib.inventory.cache.settings",
+           {"apps": {"zentral.contrib.inventory": {"machine_info_cache": {"l1_max_size": None}}}})
+    def test_config_invalid_l1_max_size(self):
+        with self.assertRaises(ImproperlyConfigured):
+            MachineInfoCache()
@@ -1,7 +1,7 @@
 import copy
 from datetime import datetime, timedelta
+from unittest.mock import patch
 from dateutil import parser
-from django.core.cache import cache
 from django.test import TestCase, override_settings
 from django.utils.crypto import get_random_string
 from django.utils.timezone import is_aware, make_naive
@@ -399,8 +399,21 @@ class MachineSnapshotTestCase(TestCase):
         mm = MetaMachine(self.serial_number)
         self.assertEqual((MACOS, None, {self.meta_business_unit.id}, {tag1.id, tag2.id}),
                          mm.cached_probe_filtering_values)
-        self.assertEqual((MACOS, None, {self.meta_business_unit.id}, {tag1.id, tag2.id}),
-                         cache.get("mm-probe-fvs_{}".format(mm.get_urlsafe_serial_number())))
+        with patch.object(MetaMachine, "get_probe_filtering_values") as get_probe_filtering_values:
+            mm = MetaMachine(self.serial_number)
+            self.assertEqual((MACOS, None, {self.meta_business_unit.id}, {tag1.id, tag2.id}),
+                             mm.cached_probe_filtering_values)
+            get_probe_filtering_values.assert_not_called()
+        # cache invalidated by machine tag change
+        MachineTag.objects.filter(tag=tag1, serial_number=self.serial_number).delete()
+        mm = MetaMachine(self.serial_number)
+        self.assertEqual((MACOS, None, {self.meta_business_unit.id}, {tag2.id}),
+                         mm.cached_probe_filtering_values)
+        # cache invalidated by meta business unit tag change
+        MetaBusinessUnitTag.objects.filter(tag=tag2, meta_business_unit=self.meta_business_unit).delete()
+        mm = MetaMachine(self.serial_number)
+        self.assertEqual((MACOS, None, {self.meta_business_unit.id}, set()),
+                         mm.cached_probe_filtering_values)
 
         # get_serialized_info_for_event
         mm = MetaMachine(self.serial_number)
@@ -86,7 +86,7 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "inventory/mbu_machines.html")
         self.assertContains(response, name)
         meta_business_unit = response.context["object"]
@@ -165,7 +165,7 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "inventory/mbu_machines.html")
         self.assertContains(response, updated_name)
         meta_business_unit = response.context["object"]
@@ -268,7 +268,7 @@ class InventorySetupViewsTestCase(TestCase):
             response = self.client.post(reverse("inventory:delete_mbu", args=(meta_business_unit.pk,)),
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "inventory/mbu_list.html")
         self.assertNotContains(response, meta_business_unit.name)
         event = post_event.call_args_list[0].args[0]
@@ -357,7 +357,7 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "inventory/tag_index.html")
         self.assertContains(response, name)
         tag = response.context["tag_list"][0]
@@ -433,7 +433,7 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "inventory/tag_index.html")
         self.assertContains(response, updated_name)
         tag = response.context["tag_list"][0]
@@ -514,7 +514,7 @@ class InventorySetupViewsTestCase(TestCase):
                 follow=True
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "inventory/tag_index.html")
         self.assertNotContains(response, tag.name)
         event = post_event.call_args_list[0].args[0]
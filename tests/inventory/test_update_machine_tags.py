@@ -1,13 +1,16 @@
 from functools import reduce
 import json
 import operator
+from unittest.mock import patch
 from django.contrib.auth.models import Group, Permission
 from django.db.models import Q
 from django.test import TestCase
 from django.urls import reverse
 from django.utils.crypto import get_random_string
 from accounts.models import APIToken, User
+from zentral.contrib.inventory.events import MachineTagsUpdated
 from zentral.contrib.inventory.models import MachineSnapshotCommit, MachineTag, Tag, Taxonomy
+from zentral.contrib.inventory.utils import update_machine_tags
 
 
 class InventoryAPITests(TestCase):
@@ -206,7 +209,8 @@ class InventoryAPITests(TestCase):
             0
         )
 
-    def test_post_set_add_one_tag(self):
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_post_set_add_one_tag(self, post_event):
         self._set_required_permission()
         # non matching machine
         self._force_machine()
@@ -230,7 +234,8 @@ class InventoryAPITests(TestCase):
             1
         )
 
-    def test_post_set_add_one_remove_three(self):
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_post_set_add_one_remove_three(self, post_event):
         self._set_required_permission()
         # non matching machine
         self._force_machine()
@@ -271,7 +276,8 @@ class InventoryAPITests(TestCase):
             0
         )
 
-    def test_post_set_multiple_add_one(self):
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_post_set_multiple_add_one(self, post_event):
         self._set_required_permission()
         # 3 matching machines
         serial_number0, _, principal_name0 = self._force_machine()
@@ -294,7 +300,8 @@ class InventoryAPITests(TestCase):
             {serial_number0, serial_number1, serial_number2}
         )
 
-    def test_post_add_three_tags(self):
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_post_add_three_tags(self, post_event):
         self._set_required_permission()
         serial_number, _, principal_name = self._force_machine()
         self.assertEqual(MachineTag.objects.filter(serial_number=serial_number).count(), 0)
@@ -322,7 +329,8 @@ class InventoryAPITests(TestCase):
             set(Tag.objects.get(taxonomy__name=taxonomy_name_3, name=name) for name in (tag_name_3,))
         )
 
-    def test_post_remove_one_tag(self):
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_post_remove_one_tag(self, post_event):
         self._set_required_permission()
         serial_number, _, _ = self._force_machine()
         taxonomy_name, (tag_name_1, tag_name_2) = self._force_machine_tags(serial_number, 2)
@@ -336,3 +344,54 @@ class InventoryAPITests(TestCase):
         )
         self.assertEqual(MachineTag.objects.filter(serial_number=serial_number, tag__name=tag_name_1).count(), 0)
         self.assertEqual(MachineTag.objects.filter(serial_number=serial_number, tag__name=tag_name_2).count(), 1)
+
+    def test_post_add_and_remove_same_tag(self):
+        self._set_required_permission()
+        serial_number, _, _ = self._force_machine()
+        tag_name = get_random_string(12)
+        response = self._post_json_data({
+            "operations": [{"kind": "ADD", "names": [tag_name]},
+                           {"kind": "REMOVE", "names": [tag_name]}],
+            "serial_numbers": [serial_number],
+        })
+        self.assertEqual(
+            response.json(),
+            {"machines": {"found": 1}, "tags": {"added": 0, "removed": 0}}
+        )
+        self.assertEqual(MachineTag.objects.filter(serial_number=serial_number).count(), 0)
+
+    @patch("zentral.contrib.inventory.utils.machine_info_cache")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_update_machine_tags_events_and_cache(self, post_event, machine_info_cache):
+        serial_numbers = [get_random_string(12) for _ in range(3)]
+        taxonomy_name, (tag_name,) = self._force_machine_tags(serial_numbers[0], 1)
+        new_tag_name = get_random_string(12)
+        removed, added = update_machine_tags(
+            serial_numbers,
+            [{"kind": "SET", "taxonomy": taxonomy_name, "names": [new_tag_name]}]
+        )
+        self.assertEqual((removed, added), (1, 3))
+        self.assertEqual(
+            set(MachineTag.objects.filter(tag__name=new_tag_name).values_list("serial_number", flat=True)),
+            set(serial_numbers)
+        )
+        self.assertEqual(
+            set(MachineTag.objects.filter(serial_number=serial_numbers[0]).values_list("tag__name", flat=True)),
+            {new_tag_name}
+        )
+        # cache invalidated in one call
+        machine_info_cache.bump_machines.assert_called_once()
+        self.assertEqual(set(machine_info_cache.bump_machines.call_args.args[0]), set(serial_numbers))
+        # one event for the batch of machines
+        self.assertEqual(len(post_event.call_args_list), 1)
+        event = post_event.call_args_list[0].args[0]
+        self.assertIsInstance(event, MachineTagsUpdated)
+        self.assertEqual(len(event.payload["machines"]), 3)
+        machine_d = [d for d in event.payload["machines"] if d["serial_number"] == serial_numbers[0]][0]
+        self.assertEqual([t["name"] for t in machine_d["removed"]], [tag_name])
+        self.assertEqual([t["name"] for t in machine_d["added"]], [new_tag_name])
+
+    def test_update_machine_tags_no_changes(self):
+        serial_number = get_random_string(12)
+        self.assertEqual(update_machine_tags([serial_number], [{"kind": "REMOVE", "names": ["yolo"]}]), (0, 0))
+        self.assertEqual(update_machine_tags([], [{"kind": "ADD", "names": ["yolo"]}]), (0, 0))
@@ -183,7 +183,7 @@ class MDMArtifactsAPIViewsTestCase(TestCase):
                                   "type": "Profile",
                                   "channel": "Device"})
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         artifact = Artifact.objects.get(name=name)
         self.assertEqual(
             response.json(),
@@ -269,7 +269,7 @@ class MDMArtifactsAPIViewsTestCase(TestCase):
                                  "reinstall_on_os_update": "Patch",
                                  })
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 3)
         artifact.refresh_from_db()
         self.assertEqual(artifact.name, new_name)
         self.assertEqual(artifact.type, "Store App")
@@ -354,7 +354,7 @@ class MDMArtifactsAPIViewsTestCase(TestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.delete(reverse("mdm_api:artifact", args=(artifact.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertEqual(Artifact.objects.filter(name=artifact.name).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
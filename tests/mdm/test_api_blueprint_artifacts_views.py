@@ -190,7 +190,7 @@ class MDMBlueprintArtifactsAPIViewsTestCase(TestCase):
                                   "default_shard": 0,
                                   "tag_shards": [{"tag": shard_tag.pk, "shard": 5}]})
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 3)
         blueprint_artifact = BlueprintArtifact.objects.get(blueprint=blueprint, artifact=artifact)
         self.assertEqual(
             response.json(),
@@ -295,7 +295,7 @@ class MDMBlueprintArtifactsAPIViewsTestCase(TestCase):
                                  "default_shard": 0,
                                  "tag_shards": [{"tag": shard_tag.pk, "shard": 5}]})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 3)
         blueprint_artifact.refresh_from_db()
         self.assertEqual(blueprint_artifact.macos_min_version, "13.3.1")
         self.assertEqual(blueprint_artifact.shard_modulo, 10)
@@ -388,7 +388,7 @@ class MDMBlueprintArtifactsAPIViewsTestCase(TestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.delete(reverse("mdm_api:blueprint_artifact", args=(blueprint_artifact.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 3)
         self.assertEqual(BlueprintArtifact.objects.filter(pk=blueprint_artifact.pk).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
@@ -185,7 +185,7 @@ class MDMBlueprintsAPIViewsTestCase(TestCase):
             response = self.post(reverse("mdm_api:blueprints"),
                                  {"name": name})
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         blueprint = Blueprint.objects.get(name=name)
         self.assertEqual(
             response.json(),
@@ -260,7 +260,7 @@ class MDMBlueprintsAPIViewsTestCase(TestCase):
                                  "recovery_password_config": recovery_password_config.pk,
                                  "software_update_enforcements": [sue.pk]})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         blueprint.refresh_from_db()
         self.assertEqual(blueprint.name, new_name)
         self.assertEqual(blueprint.inventory_interval, 86401)
@@ -342,7 +342,7 @@ class MDMBlueprintsAPIViewsTestCase(TestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.delete(reverse("mdm_api:blueprint", args=(blueprint.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertEqual(Blueprint.objects.filter(name=blueprint.name).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
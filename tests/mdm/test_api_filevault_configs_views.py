@@ -177,7 +177,7 @@ class MDMFileVaultConfigsAPIViewsTestCase(TestCase):
                                  {"name": name,
                                   "escrow_location_display_name": escrow_name})
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         fv_config = FileVaultConfig.objects.get(name=name)
         self.assertEqual(
             response.json(),
@@ -274,7 +274,7 @@ class MDMFileVaultConfigsAPIViewsTestCase(TestCase):
                                  "destroy_key_on_standby": True,
                                  "prk_rotation_interval_days": 90})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         fv_config.refresh_from_db()
         self.assertEqual(fv_config.name, new_name)
         self.assertEqual(fv_config.escrow_location_display_name, new_escrow_name)
@@ -351,7 +351,7 @@ class MDMFileVaultConfigsAPIViewsTestCase(TestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.delete(reverse("mdm_api:filevault_config", args=(fv_config.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertEqual(FileVaultConfig.objects.filter(name=fv_config.name).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
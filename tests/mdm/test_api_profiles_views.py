@@ -159,7 +159,7 @@ class MDMProfilesAPIViewsTestCase(TestCase):
                                        "tag_shards": [{"tag": shard_tag.pk, "shard": 5}],
                                        "version": 17})
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 3)
         data = response.json()
         data.pop("source")
         profile_av = artifact.artifactversion_set.all().order_by("-created_at").first()
@@ -324,7 +324,7 @@ class MDMProfilesAPIViewsTestCase(TestCase):
                                       "tag_shards": [{"tag": shard_tag.pk, "shard": 5}],
                                       "version": 17})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 3)
         data = response.json()
         data.pop("source")
         profile_av.refresh_from_db()
@@ -441,7 +441,7 @@ class MDMProfilesAPIViewsTestCase(TestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.delete(reverse("mdm_api:profile", args=(profile_av.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 3)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
         self.assertEqual(
@@ -173,7 +173,7 @@ class MDMRecoveryPasswordConfigsAPIViewsTestCase(TestCase):
                                   "dynamic_password": False,
                                   "static_password": "12345678"})
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         rp_config = RecoveryPasswordConfig.objects.get(name=name)
         self.assertEqual(rp_config.get_static_password(), "12345678")
         self.assertEqual(
@@ -285,7 +285,7 @@ class MDMRecoveryPasswordConfigsAPIViewsTestCase(TestCase):
                                  "rotation_interval_days": 17,
                                  "rotate_firmware_password": True})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         rp_config.refresh_from_db()
         self.assertEqual(rp_config.name, new_name)
         self.assertTrue(rp_config.dynamic_password)
@@ -354,7 +354,7 @@ class MDMRecoveryPasswordConfigsAPIViewsTestCase(TestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.delete(reverse("mdm_api:recovery_password_config", args=(rp_config.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertEqual(RecoveryPasswordConfig.objects.filter(name=rp_config.name).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
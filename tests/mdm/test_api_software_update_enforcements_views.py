@@ -255,7 +255,7 @@ class MDMSoftwareUpdateEnforcementsAPIViewsTestCase(TestCase):
                                   "platforms": ["macOS"],
                                   "max_os_version": "15"})
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         sue = SoftwareUpdateEnforcement.objects.get(name=name)
         self.assertEqual(sue.name, name)
         self.assertEqual(sue.platforms, ["macOS"])
@@ -318,7 +318,7 @@ class MDMSoftwareUpdateEnforcementsAPIViewsTestCase(TestCase):
                                   "os_version": "14.1.1",
                                   "local_datetime": "2023-11-28T09:30"})
         self.assertEqual(response.status_code, 201)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         sue = SoftwareUpdateEnforcement.objects.get(name=name)
         self.assertEqual(sue.name, name)
         self.assertEqual(sue.details_url, "")
@@ -403,7 +403,7 @@ class MDMSoftwareUpdateEnforcementsAPIViewsTestCase(TestCase):
                                  "delay_days": 3,
                                  "local_time": "11:11"})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         sue.refresh_from_db()
         self.assertEqual(sue.name, new_name)
         self.assertEqual(sue.details_url, "https://www.example.com")
@@ -475,7 +475,7 @@ class MDMSoftwareUpdateEnforcementsAPIViewsTestCase(TestCase):
                                  "build_version": "29B12",
                                  "local_datetime": "2028-12-12T11:11"})
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         sue.refresh_from_db()
         self.assertEqual(sue.name, new_name)
         self.assertEqual(sue.details_url, "")
@@ -557,7 +557,7 @@ class MDMSoftwareUpdateEnforcementsAPIViewsTestCase(TestCase):
         with self.captureOnCommitCallbacks(execute=True) as callbacks:
             response = self.delete(reverse("mdm_api:software_update_enforcement", args=(sue.pk,)))
         self.assertEqual(response.status_code, 204)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertEqual(SoftwareUpdateEnforcement.objects.filter(name=sue.name).count(), 0)
         event = post_event.call_args_list[0].args[0]
         self.assertIsInstance(event, AuditEvent)
@@ -1,16 +1,37 @@
 from datetime import datetime, timedelta
+import json
 from unittest.mock import patch, Mock
 from django.test import TestCase
 from django.utils.crypto import get_random_string
 import httpx
 from zentral.contrib.inventory.models import MetaBusinessUnit
-from zentral.contrib.mdm.apns import (apns_client_cache, APNSClient,
-                                      send_enrolled_device_notification, send_enrolled_user_notification)
+from zentral.contrib.mdm.apns import (apns_client_cache, APNSBulkSender, APNSClient, APNSTarget, AsyncAPNSClient,
+                                      send_enrolled_device_notification, send_enrolled_device_notifications,
+                                      send_enrolled_user_notification)
 from zentral.contrib.mdm.events import MDMDeviceNotificationEvent
 from .utils import force_dep_enrollment_session, force_enrolled_user, force_push_certificate
 
 
 class MDMAPNSTestCase(TestCase):
+    # utility methods
+
+    def _apns_stand_in(self, *statuses_and_headers):
+        # local APNS stand-in, returning the responses in order, and 200 after
+        requests = []
+        responses = list(statuses_and_headers)
+
+        async def handler(request):
+            requests.append(request)
+            if responses:
+                status_code, headers = responses.pop(0)
+            else:
+                status_code, headers = 200, {}
+            return httpx.Response(status_code, headers=headers)
+
+        return httpx.MockTransport(handler), requests
+
+    # tests
+
     @classmethod
     def setUpTestData(cls):
         cls.mbu = MetaBusinessUnit.objects.create(name=get_random_string(12))
@@ -202,3 +223,94 @@ class MDMAPNSTestCase(TestCase):
         self.assertEqual(event.metadata.machine_serial_number, session.enrolled_device.serial_number)
         self.assertEqual(event.payload["status"], "success")
         self.assertEqual(event.payload["user_id"], enrolled_user.user_id)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_apns_bulk_send_enrolled_device_notifications_ok(self, post_event):
+        transport, requests = self._apns_stand_in()
+        enrolled_devices = []
+        for _ in range(3):
+            session, _, _ = force_dep_enrollment_session(
+                self.mbu, authenticated=True, completed=True, push_certificate=self.push_certificate
+            )
+            enrolled_devices.append(session.enrolled_device)
+        # cannot be poked
+        session, _, _ = force_dep_enrollment_session(
+            self.mbu, authenticated=True, push_certificate=self.push_certificate
+        )
+        session.refresh_from_db()  # push certificate dates from the DB
+        enrolled_devices.append(session.enrolled_device)
+        results = list(send_enrolled_device_notifications(enrolled_devices, transport=transport))
+        self.assertEqual(results, [(enrolled_device, True) for enrolled_device in enrolled_devices[:3]])
+        self.assertEqual(len(requests), 3)
+        request = requests[0]
+        self.assertEqual(request.url.path, f"/3/device/{enrolled_devices[0].token.hex()}")
+        self.assertEqual(request.headers["apns-topic"], self.push_certificate.topic)
+        self.assertEqual(request.headers["apns-push-type"], "mdm")
+        self.assertEqual(json.loads(request.content), {"mdm": enrolled_devices[0].push_magic})
+        self.assertEqual(len(post_event.call_args_list), 3)
+        event = post_event.call_args_list[0].args[0]
+        self.assertIsInstance(event, MDMDeviceNotificationEvent)
+        self.assertEqual(event.metadata.machine_serial_number, enrolled_devices[0].serial_number)
+        self.assertEqual(event.payload["status"], "success")
+
+    @patch("zentral.contrib.mdm.apns.asyncio.sleep")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_apns_bulk_send_retry_after(self, post_event, sleep):
+        transport, requests = self._apns_stand_in((429, {"Retry-After": "7"}), (503, {}))
+        session, _, _ = force_dep_enrollment_session(
+            self.mbu, authenticated=True, completed=True, push_certificate=self.push_certificate
+        )
+        results = list(send_enrolled_device_notifications([session.enrolled_device], transport=transport))
+        self.assertEqual(results, [(session.enrolled_device, True)])
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(sleep.await_count, 2)
+        self.assertEqual(sleep.await_args_list[0].args[0], 7)
+        self.assertEqual(post_event.call_args_list[0].args[0].payload["status"], "success")
+
+    @patch("zentral.contrib.mdm.apns.asyncio.sleep")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_apns_bulk_send_no_retries_failure(self, post_event, sleep):
+        transport, requests = self._apns_stand_in((400, {}))
+        session, _, _ = force_dep_enrollment_session(
+            self.mbu, authenticated=True, completed=True, push_certificate=self.push_certificate
+        )
+        results = list(send_enrolled_device_notifications([session.enrolled_device], transport=transport))
+        self.assertEqual(results, [(session.enrolled_device, False)])
+        self.assertEqual(len(requests), 1)
+        sleep.assert_not_awaited()
+        self.assertEqual(post_event.call_args_list[0].args[0].payload["status"], "failure")
+
+    @patch("zentral.contrib.mdm.apns.asyncio.sleep")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_apns_bulk_send_retries_failure(self, post_event, sleep):
+        transport, requests = self._apns_stand_in(*((500, {}) for _ in range(AsyncAPNSClient.max_retries + 1)))
+        session, _, _ = force_dep_enrollment_session(
+            self.mbu, authenticated=True, completed=True, push_certificate=self.push_certificate
+        )
+        results = list(send_enrolled_device_notifications([session.enrolled_device], transport=transport))
+        self.assertEqual(results, [(session.enrolled_device, False)])
+        self.assertEqual(len(requests), AsyncAPNSClient.max_retries + 1)
+        self.assertEqual(sleep.await_count, AsyncAPNSClient.max_retries)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_apns_bulk_sender_batches(self, post_event):
+        transport, requests = self._apns_stand_in()
+        enrolled_devices = []
+        for _ in range(3):
+            session, _, _ = force_dep_enrollment_session(
+                self.mbu, authenticated=True, completed=True, push_certificate=self.push_certificate
+            )
+            enrolled_devices.append(session.enrolled_device)
+        sender = APNSBulkSender(transport=transport)
+        sender.batch_size = 2
+        results = sender.send(
+            APNSTarget(ed, ed.serial_number, ed.udid, None, ed.token, ed.push_magic, ed.push_certificate)
+            for ed in enrolled_devices
+        )
+        # first batch
+        next(results)
+        self.assertEqual(len(requests), 2)
+        self.assertEqual(len(post_event.call_args_list), 2)
+        self.assertEqual(len(list(results)), 2)
+        self.assertEqual(len(requests), 3)
+        self.assertEqual(len(post_event.call_args_list), 3)
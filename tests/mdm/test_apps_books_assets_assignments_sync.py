@@ -1,22 +1,29 @@
 from unittest.mock import patch, Mock
 import uuid
+from django.core.cache import cache
 from django.test import TestCase
 from django.utils.crypto import get_random_string
-from zentral.contrib.mdm.apps_books import (_sync_asset_d,
+from zentral.contrib.inventory.models import MetaBusinessUnit
+from zentral.contrib.mdm.apps_books import (AppsBooksAssetsSync,
+                                            _sync_asset_d,
                                             _update_assignments,
                                             _update_or_create_asset,
                                             _update_or_create_location_asset,
                                             _update_location_asset_counts,
                                             associate_location_asset,
                                             disassociate_location_asset,
+                                            FetchedDataUpdatedError,
                                             sync_asset, sync_assets,
                                             update_location_asset_counts)
 from zentral.contrib.mdm.events import (AssetCreatedEvent, AssetUpdatedEvent,
                                         DeviceAssignmentCreatedEvent, DeviceAssignmentDeletedEvent,
                                         LocationAssetCreatedEvent, LocationAssetUpdatedEvent)
+from zentral.contrib.mdm.artifacts import Target
 from zentral.contrib.mdm.models import Asset, DeviceAssignment, LocationAsset
+from zentral.contrib.mdm.next_action import next_action_cache
+from zentral.core.exceptions import ImproperlyConfigured
 from zentral.core.incidents.models import Severity
-from .utils import force_asset, force_location
+from .utils import force_asset, force_dep_enrollment_session, force_location
 
 
 class MDMAppsBooksAssetsAssignmentsSyncTestCase(TestCase):
@@ -406,6 +413,68 @@ class MDMAppsBooksAssetsAssignmentsSyncTestCase(TestCase):
                 1
             )
 
+    def test_update_assignments_next_action_cache_bumped(self):
+        asset = force_asset()
+        location = force_location()
+        location_asset = LocationAsset.objects.create(
+            location=location,
+            asset=asset,
+            assigned_count=1,
+            available_count=9,
+            retired_count=0,
+            total_count=10
+        )
+        session, _, _ = force_dep_enrollment_session(MetaBusinessUnit.objects.create(name=get_random_string(12)),
+                                                     completed=True)
+        enrolled_device = session.enrolled_device
+        DeviceAssignment.objects.create(location_asset=location_asset, serial_number=get_random_string(12))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            list(
+                _update_assignments(
+                    location,
+                    {enrolled_device.serial_number},
+                    None,
+                    {"asset": asset,
+                     "location_asset": location_asset}
+                )
+            )
+            self.assertTrue(next_action_cache.has_pending_bump(Target(enrolled_device)))
+        self.assertEqual(len(callbacks), 1)
+
+    def test_update_assignments_set_based_queries(self):
+        asset = force_asset()
+        location = force_location()
+        location_asset = LocationAsset.objects.create(
+            location=location,
+            asset=asset,
+            assigned_count=3,
+            available_count=7,
+            retired_count=0,
+            total_count=10
+        )
+        kept_serial_numbers = set(get_random_string(12) for _ in range(100))
+        DeviceAssignment.objects.bulk_create(
+            DeviceAssignment(location_asset=location_asset, serial_number=serial_number)
+            for serial_number in kept_serial_numbers | {"REMOVED"}
+        )
+        serial_numbers = kept_serial_numbers | set(get_random_string(12) for _ in range(1000))
+        # 2 set-based queries + 1 query to find the enrolled devices to invalidate
+        with self.assertNumQueries(3):
+            events = list(
+                _update_assignments(
+                    location,
+                    serial_numbers,
+                    None,
+                    {"asset": asset,
+                     "location_asset": location_asset}
+                )
+            )
+        self.assertEqual(len(events), 1001)
+        self.assertEqual(
+            set(location_asset.deviceassignment_set.values_list("serial_number", flat=True)),
+            serial_numbers
+        )
+
     # _sync_asset_d
 
     def test_sync_asset_d(self):
@@ -506,6 +575,97 @@ class MDMAppsBooksAssetsAssignmentsSyncTestCase(TestCase):
         sync_assets(location)
         self.assertEqual(len(post_event.call_args_list), 3)
 
+    def _build_asset_d(self, adam_id):
+        return {"adamId": adam_id,
+                "assignedCount": 1,
+                "availableCount": 9,
+                "deviceAssignable": True,
+                "pricingParam": "STDQ",
+                "productType": "App",
+                "retiredCount": 0,
+                "revocable": True,
+                "supportedPlatforms": ["iOS"],
+                "totalCount": 10}
+
+    @patch("zentral.contrib.mdm.apps_books.AppsBooksClient")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_sync_assets_concurrent_fetch(self, post_event, AppsBooksClient):
+        location = force_location()
+        client = Mock()
+        AppsBooksClient.from_location.return_value = client
+        adam_ids = [str(i) for i in range(20)]
+        client.iter_assets.return_value = [self._build_asset_d(adam_id) for adam_id in adam_ids]
+        client.get_asset_metadata.return_value = None
+        client.iter_asset_device_assignments.side_effect = lambda adam_id, _: [f"SN{adam_id}"]
+        stats = sync_assets(location)
+        self.assertEqual(stats, {"total": 20, "skipped": 0, "synced": 20})
+        self.assertEqual(post_event.call_count, 60)
+        # all the fetched assignments are applied to the right assets
+        self.assertEqual(
+            set(DeviceAssignment.objects.filter(location_asset__location=location)
+                                        .values_list("location_asset__asset__adam_id", "serial_number")),
+            set((adam_id, f"SN{adam_id}") for adam_id in adam_ids)
+        )
+        # one client for the asset pages, one per worker
+        self.assertEqual(AppsBooksClient.from_location.call_count, 5)
+        self.assertIsNone(cache.get(f"mdm-apps-books-sync_{location.pk}"))
+
+    @patch("zentral.contrib.mdm.apps_books.AppsBooksClient")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_sync_assets_resume(self, post_event, AppsBooksClient):
+        location = force_location()
+        client = Mock()
+        AppsBooksClient.from_location.return_value = client
+        client.iter_assets.return_value = [self._build_asset_d(adam_id) for adam_id in ("1", "2", "3")]
+        client.get_asset_metadata.return_value = None
+
+        def iter_asset_device_assignments(adam_id, pricing_param):
+            if adam_id == "2":
+                raise FetchedDataUpdatedError
+            return [f"SN{adam_id}"]
+
+        client.iter_asset_device_assignments.side_effect = iter_asset_device_assignments
+        with self.assertRaises(FetchedDataUpdatedError):
+            sync_assets(location)
+        self.assertEqual(cache.get(f"mdm-apps-books-sync_{location.pk}"), ["1/STDQ"])
+        # resume
+        client.iter_asset_device_assignments.reset_mock()
+        client.iter_asset_device_assignments.side_effect = lambda adam_id, _: [f"SN{adam_id}"]
+        stats = sync_assets(location)
+        self.assertEqual(stats, {"total": 3, "skipped": 1, "synced": 2})
+        self.assertEqual(
+            sorted(c.args[0] for c in client.iter_asset_device_assignments.call_args_list),
+            ["2", "3"]
+        )
+        self.assertIsNone(cache.get(f"mdm-apps-books-sync_{location.pk}"))
+
+    @patch("zentral.contrib.mdm.apps_books.AppsBooksClient")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_sync_assets_restart(self, post_event, AppsBooksClient):
+        location = force_location()
+        cache.set(f"mdm-apps-books-sync_{location.pk}", ["1/STDQ"])
+        client = Mock()
+        AppsBooksClient.from_location.return_value = client
+        client.iter_assets.return_value = [self._build_asset_d("1")]
+        client.get_asset_metadata.return_value = None
+        client.iter_asset_device_assignments.return_value = []
+        stats = sync_assets(location, resume=False)
+        self.assertEqual(stats, {"total": 1, "skipped": 0, "synced": 1})
+
+    @patch("zentral.contrib.mdm.apps_books.settings",
+           {"apps": {"zentral.contrib.mdm": {"apps_books": {"sync": {"max_workers": 1000, "rate": "yolo"}}}}})
+    def test_sync_assets_improperly_configured(self):
+        with self.assertRaises(ImproperlyConfigured):
+            AppsBooksAssetsSync(force_location())
+
+    @patch("zentral.contrib.mdm.apps_books.settings",
+           {"apps": {"zentral.contrib.mdm": {"apps_books": {"sync": {"max_workers": 1000, "rate": 0}}}}})
+    def test_sync_assets_config_clamped(self):
+        assets_sync = AppsBooksAssetsSync(force_location())
+        self.assertEqual(assets_sync.max_workers, 32)
+        self.assertEqual(assets_sync.rate, 0.1)
+        self.assertEqual(assets_sync.checkpoint_ttl, 86400)
+
     # _update_location_asset_counts
 
     def test_update_location_asset_counts_noop(self):
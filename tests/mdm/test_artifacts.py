@@ -5,10 +5,11 @@ import plistlib
 from unittest.mock import patch
 import uuid
 from datetime import date, datetime, timedelta, time
+from django.core.cache import cache
 from django.test import TestCase
 from django.utils.crypto import get_random_string
 from zentral.contrib.inventory.models import MachineTag, MetaBusinessUnit, Tag
-from zentral.contrib.mdm.artifacts import Target, update_blueprint_serialized_artifacts
+from zentral.contrib.mdm.artifacts import Target, blueprint_plan_cache, update_blueprint_serialized_artifacts
 from zentral.contrib.mdm.models import (Asset, Artifact, ArtifactVersion, ArtifactVersionTag,
                                         Blueprint, BlueprintArtifact,
                                         Channel, DeviceArtifact,
@@ -113,6 +114,10 @@ class TestMDMArtifacts(TestCase):
             unlock_token=get_random_string(32).encode("utf-8")
         )
 
+    def setUp(self):
+        # software update index & declarations cache
+        cache.clear()
+
     def _force_artifact(
         self,
         version_count=1,
@@ -263,6 +268,31 @@ class TestMDMArtifacts(TestCase):
         )
         self.assertEqual(set(artifact.platforms), set(Platform.values))
 
+    # blueprint plan
+
+    def test_blueprint_plan_cached_per_blueprint_version(self):
+        self._force_blueprint_artifact()
+        plan = blueprint_plan_cache.get(self.blueprint1)
+        self.assertIs(blueprint_plan_cache.get(self.blueprint1), plan)
+        self._force_blueprint_artifact()
+        new_plan = blueprint_plan_cache.get(self.blueprint1)
+        self.assertIsNot(new_plan, plan)
+        self.assertEqual(len(plan.artifacts), 1)
+        self.assertEqual(len(new_plan.artifacts), 2)
+
+    def test_blueprint_plan_required_artifacts_first(self):
+        required_artifact, _ = self._force_artifact()
+        required_artifact2, _ = self._force_artifact(requires=required_artifact)
+        _, artifact, _ = self._force_blueprint_artifact(requires=[required_artifact2, required_artifact])
+        plan = blueprint_plan_cache.get(self.blueprint1)
+        self.assertEqual([pa.artifact["pk"] for pa in plan.ordered_artifacts],
+                         [str(required_artifact.pk), str(required_artifact2.pk), str(artifact.pk)])
+        self.assertEqual([pa.level for pa in plan.ordered_artifacts], [0, 1, 2])
+        self.assertEqual(plan.artifacts[str(artifact.pk)].required_closure,
+                         {str(required_artifact.pk), str(required_artifact2.pk), str(artifact.pk)})
+        self.assertEqual([pa.artifact["pk"] for pa in plan.channel_roots[Channel.DEVICE]], [str(artifact.pk)])
+        self.assertEqual(plan.channel_roots[Channel.USER], [])
+
     # next_to_install
 
     def test_no_blueprint_nothing_to_install(self):
@@ -0,0 +1,203 @@
+import io
+from unittest.mock import patch, Mock
+from django.core.management import call_command
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MachineTag, MetaBusinessUnit, Tag
+from zentral.contrib.mdm.artifacts import update_blueprint_serialized_artifacts
+from zentral.contrib.mdm.fan_out import BlueprintNotificationFanOut, get_serial_numbers_tag_ids
+from zentral.contrib.mdm.models import Platform
+from .utils import force_artifact, force_blueprint_artifact, force_dep_enrollment_session, force_push_certificate
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MDMBlueprintFanOutTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.mbu = MetaBusinessUnit.objects.create(name=get_random_string(12))
+        cls.mbu.create_enrollment_business_unit()
+        cls.push_certificate = force_push_certificate(with_material=True, reduced_key_size=False)
+        cls.blueprint_artifact, cls.artifact, _ = force_blueprint_artifact()
+        cls.blueprint = cls.blueprint_artifact.blueprint
+        cls.enrolled_devices = []
+        for _ in range(3):
+            session, _, _ = force_dep_enrollment_session(
+                cls.mbu, authenticated=True, completed=True, push_certificate=cls.push_certificate
+            )
+            enrolled_device = session.enrolled_device
+            enrolled_device.blueprint = cls.blueprint
+            enrolled_device.platform = Platform.MACOS
+            enrolled_device.os_version = "14.1"
+            enrolled_device.save()
+            cls.enrolled_devices.append(enrolled_device)
+        # not in the blueprint
+        force_dep_enrollment_session(
+            cls.mbu, authenticated=True, completed=True, push_certificate=cls.push_certificate
+        )
+
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+
+    # utility methods
+
+    def _mocked_response(self, status_code=200):
+        mocked_response = Mock()
+        mocked_response.status_code = status_code
+        mocked_response.headers = {}
+        return mocked_response
+
+    # tests
+
+    def test_get_serial_numbers_tag_ids(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        serial_number = self.enrolled_devices[0].serial_number
+        MachineTag.objects.create(serial_number=serial_number, tag=tag)
+        self.assertEqual(
+            get_serial_numbers_tag_ids({serial_number, "yolo"}),
+            {serial_number: {tag.pk}, "yolo": set()}
+        )
+
+    @patch("zentral.contrib.mdm.tasks.fan_out_blueprint_notifications_wave_task.apply_async")
+    def test_dry_run(self, apply_async):
+        result = BlueprintNotificationFanOut(self.blueprint, dry_run=True).start()
+        self.assertEqual(result["devices"], {"total": 3, "success": 0, "failure": 0})
+        self.assertEqual(result["waves"], 1)
+        self.assertTrue(result["dry_run"])
+        apply_async.assert_not_called()
+        self.assertIsNone(BlueprintNotificationFanOut.get_progress(self.blueprint.pk))
+
+    @patch("zentral.contrib.mdm.tasks.fan_out_blueprint_notifications_wave_task.apply_async")
+    def test_start_schedules_waves(self, apply_async):
+        fan_out = BlueprintNotificationFanOut(self.blueprint, window=60)
+        fan_out.wave_size = 2
+        result = fan_out.start()
+        self.assertEqual(result["waves"], 2)
+        self.assertEqual(result["devices"], {"total": 3, "success": 0, "failure": 0})
+        self.assertEqual(apply_async.call_count, 2)
+        wave_args = [c.args[0] for c in apply_async.call_args_list]
+        self.assertEqual([(a[0], a[1], a[2]) for a in wave_args],
+                         [(self.blueprint.pk, result["id"], 1), (self.blueprint.pk, result["id"], 2)])
+        self.assertEqual(set(pk for a in wave_args for pk in a[3]), set(ed.pk for ed in self.enrolled_devices))
+        # first wave immediately, second wave delayed
+        self.assertEqual(apply_async.call_args_list[0].kwargs["countdown"], 0)
+        self.assertTrue(15 <= apply_async.call_args_list[1].kwargs["countdown"] <= 45)
+        progress = BlueprintNotificationFanOut.get_progress(self.blueprint.pk)
+        self.assertEqual(progress["id"], result["id"])
+        self.assertEqual(progress["sent_waves"], 0)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    @patch("zentral.contrib.mdm.apns.httpx.AsyncClient.post")
+    @patch("zentral.contrib.mdm.tasks.fan_out_blueprint_notifications_wave_task.apply_async")
+    def test_run_waves(self, apply_async, post, post_event):
+        post.return_value = self._mocked_response()
+        fan_out = BlueprintNotificationFanOut(self.blueprint, window=60)
+        fan_out.wave_size = 2
+        result = fan_out.start()
+        wave_results = [BlueprintNotificationFanOut.run_wave(*c.args[0]) for c in apply_async.call_args_list]
+        self.assertEqual([wr["devices"] for wr in wave_results],
+                         [{"success": 2, "failure": 0}, {"success": 1, "failure": 0}])
+        self.assertEqual(post.call_count, 3)
+        self.assertEqual(post_event.call_count, 3)
+        progress = BlueprintNotificationFanOut.get_progress(self.blueprint.pk)
+        self.assertEqual(progress["id"], result["id"])
+        self.assertEqual(progress["sent_waves"], 2)
+        self.assertEqual(progress["devices"], {"total": 3, "success": 3, "failure": 0})
+
+    @patch("zentral.contrib.mdm.apns.httpx.AsyncClient.post")
+    @patch("zentral.contrib.mdm.tasks.fan_out_blueprint_notifications_wave_task.apply_async")
+    def test_replaced_fan_out_wave_skipped(self, apply_async, post):
+        first_result = BlueprintNotificationFanOut(self.blueprint, artifact_pks=[self.artifact.pk]).start()
+        first_wave_args = apply_async.call_args_list[0].args[0]
+        # newer fan out, with the devices of the pending one
+        fan_out = BlueprintNotificationFanOut(self.blueprint, artifact_pks=["yolo"])
+        second_result = fan_out.start()
+        self.assertEqual(fan_out.artifact_pks, sorted([str(self.artifact.pk), "yolo"]))
+        self.assertEqual(second_result["devices"]["total"], 3)
+        self.assertNotEqual(first_result["id"], second_result["id"])
+        self.assertIsNone(BlueprintNotificationFanOut.run_wave(*first_wave_args))
+        post.assert_not_called()
+        # newer fan out, for all the devices
+        fan_out = BlueprintNotificationFanOut(self.blueprint, artifact_pks=None)
+        fan_out.start()
+        self.assertIsNone(fan_out.artifact_pks)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    @patch("zentral.contrib.mdm.apns.httpx.AsyncClient.post")
+    @patch("zentral.contrib.mdm.tasks.fan_out_blueprint_notifications_wave_task.apply_async")
+    def test_completed_fan_out_not_included(self, apply_async, post, post_event):
+        post.return_value = self._mocked_response()
+        BlueprintNotificationFanOut(self.blueprint, artifact_pks=[self.artifact.pk]).start()
+        BlueprintNotificationFanOut.run_wave(*apply_async.call_args_list[0].args[0])
+        fan_out = BlueprintNotificationFanOut(self.blueprint, artifact_pks=["yolo"])
+        result = fan_out.start()
+        self.assertEqual(fan_out.artifact_pks, ["yolo"])
+        self.assertEqual(result["waves"], 0)
+
+    def test_artifact_excluded_tag_scope(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        self.blueprint_artifact.excluded_tags.add(tag)
+        update_blueprint_serialized_artifacts(self.blueprint)
+        MachineTag.objects.create(serial_number=self.enrolled_devices[0].serial_number, tag=tag)
+        fan_out = BlueprintNotificationFanOut(self.blueprint, artifact_pks=[self.artifact.pk], dry_run=True)
+        self.assertEqual(
+            set(ed.pk for ed in fan_out.iter_enrolled_devices()),
+            set(ed.pk for ed in self.enrolled_devices[1:])
+        )
+        # all the devices without artifact filter
+        fan_out = BlueprintNotificationFanOut(self.blueprint, dry_run=True)
+        self.assertEqual(len(list(fan_out.iter_enrolled_devices())), 3)
+
+    def test_required_artifact_scope(self):
+        required_artifact, _ = force_artifact()
+        self.artifact.requires.add(required_artifact)
+        # required artifact not in scope for the first device, because of the requiring artifact
+        tag = Tag.objects.create(name=get_random_string(12))
+        self.blueprint_artifact.excluded_tags.add(tag)
+        update_blueprint_serialized_artifacts(self.blueprint)
+        MachineTag.objects.create(serial_number=self.enrolled_devices[0].serial_number, tag=tag)
+        fan_out = BlueprintNotificationFanOut(self.blueprint, artifact_pks=[required_artifact.pk], dry_run=True)
+        self.assertEqual(
+            set(ed.pk for ed in fan_out.iter_enrolled_devices()),
+            set(ed.pk for ed in self.enrolled_devices[1:])
+        )
+        # required artifact not in scope for the OS version
+        required_artifact.artifactversion_set.update(macos_min_version="15")
+        update_blueprint_serialized_artifacts(self.blueprint)
+        fan_out = BlueprintNotificationFanOut(self.blueprint, artifact_pks=[required_artifact.pk], dry_run=True)
+        self.assertEqual(len(list(fan_out.iter_enrolled_devices())), 0)
+
+    @patch("zentral.contrib.mdm.tasks.fan_out_blueprint_notifications_task.apply_async")
+    def test_blueprint_change_no_fan_out_by_default(self, apply_async):
+        self.blueprint_artifact.excluded_tags.add(Tag.objects.create(name=get_random_string(12)))
+        with self.captureOnCommitCallbacks(execute=True):
+            update_blueprint_serialized_artifacts(self.blueprint)
+        apply_async.assert_not_called()
+
+    @patch("zentral.contrib.mdm.artifacts.settings",
+           {"apps": {"zentral.contrib.mdm": {"apns": {"fan_out": {"on_blueprint_change": True}}}}})
+    @patch("zentral.contrib.mdm.tasks.fan_out_blueprint_notifications_task.apply_async")
+    def test_blueprint_change_fan_out(self, apply_async):
+        # no changes
+        with self.captureOnCommitCallbacks(execute=True):
+            update_blueprint_serialized_artifacts(self.blueprint)
+        apply_async.assert_not_called()
+        # changes
+        self.blueprint_artifact.excluded_tags.add(Tag.objects.create(name=get_random_string(12)))
+        with self.captureOnCommitCallbacks(execute=True):
+            update_blueprint_serialized_artifacts(self.blueprint)
+        apply_async.assert_called_once_with((self.blueprint.pk, [str(self.artifact.pk)]))
+
+    def test_fan_out_command_dry_run(self):
+        out = io.StringIO()
+        call_command("fan_out_blueprint_notifications", str(self.blueprint.pk), "--dry-run", stdout=out)
+        self.assertEqual(out.getvalue(), "3 device(s), 1 wave(s) over 1800s\n")
+
+    @patch("zentral.contrib.mdm.tasks.fan_out_blueprint_notifications_wave_task.apply_async")
+    def test_fan_out_command(self, apply_async):
+        out = io.StringIO()
+        call_command("fan_out_blueprint_notifications", str(self.blueprint.pk), "--window", "60", stdout=out)
+        progress = BlueprintNotificationFanOut.get_progress(self.blueprint.pk)
+        self.assertEqual(out.getvalue(), f"3 device(s), 1 wave(s) over 60s\nFan out {progress['id']} scheduled\n")
+        apply_async.assert_called_once()
@@ -0,0 +1,110 @@
+import time
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MetaBusinessUnit
+from zentral.contrib.mdm.artifacts import Target, update_blueprint_serialized_artifacts
+from zentral.contrib.mdm.declarations_cache import DeclarationsCache, declarations_cache
+from zentral.contrib.mdm.models import Artifact, EnrolledDevice, TargetArtifact
+from .utils import force_blueprint_artifact, force_dep_enrollment_session
+
+
+class MDMDeclarationsCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.mbu = MetaBusinessUnit.objects.create(name=get_random_string(12))
+        cls.mbu.create_enrollment_business_unit()
+        cls.session, _, _ = force_dep_enrollment_session(cls.mbu, authenticated=True, completed=True)
+        cls.blueprint_artifact, cls.profile_a, (cls.profile_av,) = force_blueprint_artifact()
+        cls.blueprint = cls.blueprint_artifact.blueprint
+        cls.enrolled_device = cls.session.enrolled_device
+        cls.enrolled_device.blueprint = cls.blueprint
+        cls.enrolled_device.os_version = "14.1"
+        cls.enrolled_device.save()
+
+    def setUp(self):
+        cache.clear()
+
+    # utility methods
+
+    def _get_target(self):
+        return Target(EnrolledDevice.objects.select_related("blueprint").get(pk=self.enrolled_device.pk))
+
+    def _get_configuration_server_tokens(self, target):
+        return {c["Identifier"]: c["ServerToken"] for c in target.declaration_items["Declarations"]["Configurations"]}
+
+    # tests
+
+    def test_cached_declarations(self):
+        declaration_items = self._get_target().declaration_items
+        target = self._get_target()
+        with self.assertNumQueries(0):
+            tokens_response, declarations_token = target.sync_tokens
+            activation = target.activation
+        self.assertEqual(target.declaration_items, declaration_items)
+        self.assertEqual(declarations_token, declaration_items["DeclarationsToken"])
+        self.assertEqual(tokens_response["SyncTokens"]["DeclarationsToken"], declarations_token)
+        self.assertIn(f"zentral.legacy-profile.{self.profile_a.pk}", activation["Payload"]["StandardConfigurations"])
+
+    def test_target_artifact_change_invalidation(self):
+        target = self._get_target()
+        _, declarations_token = target.sync_tokens
+        _, ea_a, (ea_av,) = force_blueprint_artifact(artifact_type=Artifact.Type.ENTERPRISE_APP,
+                                                     blueprint=self.blueprint)
+        _, profile_a, _ = force_blueprint_artifact(requires=ea_a, blueprint=self.blueprint)
+        # blueprint change
+        target = self._get_target()
+        self.assertNotIn(f"zentral.legacy-profile.{profile_a.pk}", self._get_configuration_server_tokens(target))
+        self.assertEqual(target.sync_tokens[1], declarations_token)
+        # target artifact change
+        target.update_target_artifact(ea_av, TargetArtifact.Status.INSTALLED)
+        target = self._get_target()
+        self.assertIn(f"zentral.legacy-profile.{profile_a.pk}", self._get_configuration_server_tokens(target))
+        self.assertNotEqual(target.sync_tokens[1], declarations_token)
+
+    def test_os_version_change_invalidation(self):
+        self.profile_a.reinstall_on_os_update = Artifact.ReinstallOnOSUpdate.MINOR
+        self.profile_a.save()
+        update_blueprint_serialized_artifacts(self.blueprint)
+        identifier = f"zentral.legacy-profile.{self.profile_a.pk}"
+        self.assertEqual(self._get_configuration_server_tokens(self._get_target())[identifier],
+                         f"{self.profile_av.pk}.ov-14.1")
+        self.enrolled_device.os_version = "14.2"
+        self.enrolled_device.save()
+        self.assertEqual(self._get_configuration_server_tokens(self._get_target())[identifier],
+                         f"{self.profile_av.pk}.ov-14.2")
+
+    def test_declarations_token_update_no_invalidation(self):
+        target = self._get_target()
+        _, declarations_token = target.sync_tokens
+        target.update_declarations_token(declarations_token)
+        target = self._get_target()
+        with self.assertNumQueries(0):
+            target.sync_tokens
+
+    def test_reinstall_interval_ttl(self):
+        self.profile_a.reinstall_interval = 3600
+        self.profile_a.save()
+        update_blueprint_serialized_artifacts(self.blueprint)
+        target = self._get_target()
+        target.sync_tokens
+        ttl = DeclarationsCache()._get_ttl(target)
+        self.assertTrue(0 < ttl <= 3600)
+        # expiry
+        with patch("zentral.contrib.mdm.declarations_cache.time.time", return_value=time.time() + ttl + 1):
+            with CaptureQueriesContext(connection) as ctx:
+                self._get_target().sync_tokens
+        self.assertTrue(len(ctx.captured_queries) > 0)
+
+    def test_disabled(self):
+        with patch.object(declarations_cache, "max_ttl", 0):
+            self._get_target().sync_tokens
+        self.assertIsNone(cache.get(f"mdm-ddm_d{self.enrolled_device.pk}"))
+
+    @patch("zentral.contrib.mdm.declarations_cache.settings",
+           {"apps": {"zentral.contrib.mdm": {"declarations_cache": {"max_ttl": 1000000}}}})
+    def test_max_ttl_clamped(self):
+        self.assertEqual(DeclarationsCache().max_ttl, 86400)
@@ -1,5 +1,6 @@
 import json
 import plistlib
+from django.core.cache import cache
 from django.test import TestCase
 from django.utils.crypto import get_random_string
 from zentral.contrib.inventory.models import MetaBusinessUnit
@@ -28,6 +29,10 @@ class DeclarativeManagementCommandTestCase(TestCase):
         cls.enrolled_device.blueprint = cls.blueprint
         cls.enrolled_device.save()
 
+    def setUp(self):
+        # declarations cache
+        cache.clear()
+
     # verify_channel_and_device
 
     def test_scope(self):
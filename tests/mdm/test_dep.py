@@ -1,15 +1,64 @@
 from datetime import datetime
+import os
+import time
+from unittest import skipUnless
 from unittest.mock import Mock, patch
 import uuid
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.crypto import get_random_string
 from zentral.contrib.inventory.models import MetaBusinessUnit
 from zentral.contrib.mdm.dep import sync_dep_virtual_server_devices
-from zentral.contrib.mdm.dep_client import CursorIterator
+from zentral.contrib.mdm.dep_client import CursorIterator, DEPClient
+from zentral.contrib.mdm.models import DEPDevice
 from .utils import force_dep_enrollment, force_dep_virtual_server
 
 
+class DEPAPIStandIn:
+    """Minimal stand-in for the DEP fetch & sync device endpoints"""
+
+    def __init__(self, devices):
+        self.devices = devices
+        self.requests = []
+
+    def send_request(self, endpoint, method="GET", json=None, **params):
+        self.requests.append((endpoint, method, json))
+        offset = int(json.get("cursor") or 0)
+        limit = json["limit"]
+        devices = self.devices[offset:offset + limit]
+        return {"devices": devices,
+                "cursor": str(offset + len(devices)),
+                "more_to_follow": offset + len(devices) < len(self.devices)}
+
+
+def build_dep_device(serial_number, op_type="added", op_date="2023-06-17T15:41:06Z", color="SPACE GRAY"):
+    return {'color': color,
+            'description': 'IPHONE X SPACE GRAY 64GB-ZDD',
+            'device_assigned_by': 'support@zentral.com',
+            'device_assigned_date': '2023-01-10T19:09:22Z',
+            'device_family': 'iPhone',
+            'model': 'iPhone X',
+            'op_date': op_date,
+            'op_type': op_type,
+            'os': 'iOS',
+            'profile_status': 'empty',
+            'serial_number': serial_number}
+
+
 class TestDEPEnrollment(TestCase):
+    # utility methods
+
+    def _sync_with_stand_in(self, server, devices, **kwargs):
+        stand_in = DEPAPIStandIn(devices)
+        with patch("zentral.contrib.mdm.dep.DEPClient.from_dep_token") as from_dep_token:
+            from_dep_token.return_value = DEPClient("ck", "cs", "at", "as", batch_request_limit=500)
+            with patch.object(DEPClient, "send_request", stand_in.send_request):
+                results = list(sync_dep_virtual_server_devices(server, **kwargs))
+        return stand_in, results
+
+    # tests
+
     @patch("zentral.contrib.mdm.dep.DEPClient.from_dep_token")
     def test_sync_dep_virtual_server_devices_fetch(self, from_dep_token):
         client = Mock()
@@ -194,3 +243,112 @@ class TestDEPEnrollment(TestCase):
         self.assertIsNone(device.profile_uuid)
         self.assertIsNone(device.enrollment)
         self.assertEqual(device.profile_status, "empty")
+
+    def test_sync_dep_virtual_server_devices_sync_op_date_ordering(self):
+        server = force_dep_virtual_server()
+        serial_number = get_random_string(10).upper()
+        serial_number2 = get_random_string(10).upper()
+        devices = [
+            build_dep_device(serial_number, "added", "2023-06-17T15:41:06Z", "RED"),
+            build_dep_device(serial_number2, "added", "2023-06-17T15:41:06Z", "RED"),
+            build_dep_device(serial_number, "modified", "2023-06-18T15:41:06Z", "BLUE"),
+            # stalled operation
+            build_dep_device(serial_number, "modified", "2023-06-16T15:41:06Z", "GREEN"),
+        ]
+        for page_size in (1, 1000):
+            DEPDevice.objects.all().delete()
+            server.token.sync_cursor = "0"  # → sync
+            server.token.save()
+            _, results = self._sync_with_stand_in(server, devices, page_size=page_size)
+            self.assertEqual(
+                [(d.serial_number, created) for d, created in results],
+                [(serial_number, True), (serial_number2, True), (serial_number, False)]
+            )
+            device = DEPDevice.objects.get(serial_number=serial_number)
+            self.assertEqual(device.color, "BLUE")
+            self.assertEqual(device.last_op_type, "modified")
+            self.assertEqual(device.last_op_date, datetime(2023, 6, 18, 15, 41, 6))
+
+    def test_sync_dep_virtual_server_devices_fetch_keeps_last_operation(self):
+        server = force_dep_virtual_server()
+        serial_number = get_random_string(10).upper()
+        server.token.sync_cursor = "0"  # → sync
+        server.token.save()
+        self._sync_with_stand_in(server, [build_dep_device(serial_number, "modified")])
+        _, results = self._sync_with_stand_in(server, [build_dep_device(serial_number, color="RED")],
+                                              force_fetch=True)
+        self.assertEqual(len(results), 1)
+        device, created = results[0]
+        self.assertFalse(created)
+        device.refresh_from_db()
+        self.assertEqual(device.color, "RED")
+        self.assertEqual(device.last_op_type, "modified")
+        self.assertEqual(device.last_op_date, datetime(2023, 6, 17, 15, 41, 6))
+
+    def test_sync_dep_virtual_server_devices_partial_device_update(self):
+        server = force_dep_virtual_server()
+        serial_number = get_random_string(10).upper()
+        serial_number2 = get_random_string(10).upper()
+        server.token.sync_cursor = "0"  # → sync
+        server.token.save()
+        self._sync_with_stand_in(server, [build_dep_device(serial_number)])
+        partial_device = build_dep_device(serial_number, "modified", "2023-06-18T15:41:06Z", "RED")
+        partial_device.pop("device_assigned_by")
+        partial_device.pop("device_assigned_date")
+        server.token.sync_cursor = "0"  # → sync
+        server.token.save()
+        _, results = self._sync_with_stand_in(server, [partial_device, build_dep_device(serial_number2)])
+        self.assertEqual([(d.serial_number, created) for d, created in results],
+                         [(serial_number, False), (serial_number2, True)])
+        device = DEPDevice.objects.get(serial_number=serial_number)
+        self.assertEqual(device.color, "RED")
+        self.assertEqual(device.last_op_type, "modified")
+        self.assertEqual(device.device_assigned_by, "support@zentral.com")
+        self.assertEqual(device.device_assigned_date, datetime(2023, 1, 10, 19, 9, 22))
+
+    def test_sync_dep_virtual_server_devices_same_page_operations_merged(self):
+        server = force_dep_virtual_server()
+        serial_number = get_random_string(10).upper()
+        partial_device = build_dep_device(serial_number, "modified", "2023-06-18T15:41:06Z", "BLUE")
+        partial_device.pop("device_assigned_by")
+        partial_device.pop("device_assigned_date")
+        server.token.sync_cursor = "0"  # → sync
+        server.token.save()
+        _, results = self._sync_with_stand_in(server, [build_dep_device(serial_number, color="RED"), partial_device])
+        self.assertEqual([(d.serial_number, created) for d, created in results],
+                         [(serial_number, True), (serial_number, False)])
+        # each result is built from its own operation
+        self.assertEqual([(d.color, d.last_op_type) for d, _ in results],
+                         [("RED", "added"), ("BLUE", "modified")])
+        # the attributes missing from the partial operation are kept
+        device = DEPDevice.objects.get(serial_number=serial_number)
+        self.assertEqual(device.color, "BLUE")
+        self.assertEqual(device.last_op_type, "modified")
+        self.assertEqual(device.device_assigned_by, "support@zentral.com")
+        self.assertEqual(device.device_assigned_date, datetime(2023, 1, 10, 19, 9, 22))
+
+    def test_sync_dep_virtual_server_devices_fetch_query_count(self):
+        server = force_dep_virtual_server()
+        devices = [build_dep_device(get_random_string(12)) for _ in range(2500)]
+        with CaptureQueriesContext(connection) as ctx:
+            stand_in, results = self._sync_with_stand_in(server, devices)
+        self.assertEqual(len(stand_in.requests), 5)
+        self.assertEqual(len(results), 2500)
+        self.assertTrue(all(created for _, created in results))
+        self.assertEqual(DEPDevice.objects.filter(virtual_server=server).count(), 2500)
+        # 3 pages of 1000 devices, instead of 2 queries per device
+        self.assertTrue(len(ctx.captured_queries) < 10)
+
+    @skipUnless(os.environ.get("ZENTRAL_BENCHMARKS"), "set ZENTRAL_BENCHMARKS to run the benchmarks")
+    def test_sync_dep_virtual_server_devices_benchmark(self):
+        server = force_dep_virtual_server()
+        device_count = 20000
+        devices = [build_dep_device(get_random_string(12)) for _ in range(device_count)]
+        for label, kwargs in (("initial fetch", {}),
+                              ("full fetch, all existing", {"force_fetch": True})):
+            with CaptureQueriesContext(connection) as ctx:
+                t0 = time.perf_counter()
+                self._sync_with_stand_in(server, devices, **kwargs)
+                duration = time.perf_counter() - t0
+            print(f"\nDEP {label}: {device_count} devices, {duration:.2f}s, "
+                  f"{len(ctx.captured_queries)} queries")
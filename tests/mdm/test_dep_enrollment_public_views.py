@@ -3,6 +3,7 @@ import datetime
 import plistlib
 from unittest.mock import Mock, patch
 import uuid
+from django.core.cache import cache
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils.crypto import get_random_string
@@ -22,6 +23,10 @@ class MDMDEPEnrollmentPublicViewsTestCase(TestCase):
         cls.mbu = MetaBusinessUnit.objects.create(name=get_random_string(12))
         cls.mbu.create_enrollment_business_unit()
 
+    def setUp(self):
+        # software update index
+        cache.clear()
+
     def assertAbort(self, post_event, reason, **kwargs):
         last_event = post_event.call_args.args[0]
         self.assertIsInstance(last_event, DEPEnrollmentRequestEvent)
@@ -118,7 +118,7 @@ class BlueprintManagementViewsTestCase(TestCase):
                                          "collect_profiles": 0},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/blueprint_detail.html")
         blueprint = response.context["object"]
         self.assertEqual(blueprint.name, name)
@@ -256,7 +256,7 @@ class BlueprintManagementViewsTestCase(TestCase):
                                          "collect_profiles": 2},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/blueprint_detail.html")
         blueprint2 = response.context["object"]
         self.assertEqual(blueprint2, blueprint)
@@ -328,7 +328,7 @@ class BlueprintManagementViewsTestCase(TestCase):
             response = self.client.post(reverse("mdm:delete_blueprint", args=(blueprint.pk,)),
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/blueprint_list.html")
         self.assertNotContains(response, blueprint.name)
         event = post_event.call_args_list[0].args[0]
@@ -46,7 +46,7 @@ class MDMManagementCommandsTest(TestCase):
             f"Sync apps & books for location {location1.pk} yolo\n"
         )
         sync_assets.assert_has_calls([
-            call(location2), call(location1)
+            call(location2, resume=True), call(location1, resume=True)
         ])
 
     @patch("zentral.contrib.mdm.management.commands.sync_apps_books.sync_assets")
@@ -73,7 +73,14 @@ class MDMManagementCommandsTest(TestCase):
             out.getvalue(),
             f"Sync apps & books for location {location.pk} fomo\n"
         )
-        sync_assets.assert_called_once_with(location)
+        sync_assets.assert_called_once_with(location, resume=True)
+
+    @patch("zentral.contrib.mdm.management.commands.sync_apps_books.sync_assets")
+    def test_sync_apps_books_restart(self, sync_assets):
+        location = self._force_location(name="yolo")
+        out = StringIO()
+        call_command('sync_apps_books', '--location', str(location.pk), '--restart', stdout=out)
+        sync_assets.assert_called_once_with(location, resume=False)
 
     # sync_dep_devices
 
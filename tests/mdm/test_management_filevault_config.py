@@ -141,7 +141,7 @@ class FileVaultConfigManagementViewsTestCase(TestCase):
                                          "prk_rotation_interval_days": 90},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/filevaultconfig_detail.html")
         fv_config = response.context["object"]
         self.assertEqual(fv_config.name, name)
@@ -261,7 +261,7 @@ class FileVaultConfigManagementViewsTestCase(TestCase):
                                          "prk_rotation_interval_days": 90},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/filevaultconfig_detail.html")
         fv_config2 = response.context["object"]
         self.assertEqual(fv_config2, fv_config)
@@ -336,7 +336,7 @@ class FileVaultConfigManagementViewsTestCase(TestCase):
             response = self.client.post(reverse("mdm:delete_filevault_config", args=(fv_config.pk,)),
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/filevaultconfig_list.html")
         self.assertNotContains(response, fv_config.name)
         event = post_event.call_args_list[0].args[0]
@@ -180,7 +180,7 @@ class RecoveryPasswordConfigManagementViewsTestCase(TestCase):
                                          "rotate_firmware_password": True},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/recoverypasswordconfig_detail.html")
         rp_config = response.context["object"]
         self.assertEqual(rp_config.name, name)
@@ -291,7 +291,7 @@ class RecoveryPasswordConfigManagementViewsTestCase(TestCase):
                                          "rotate_firmware_password": False},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/recoverypasswordconfig_detail.html")
         rp_config2 = response.context["object"]
         self.assertEqual(rp_config2, rp_config)
@@ -361,7 +361,7 @@ class RecoveryPasswordConfigManagementViewsTestCase(TestCase):
             response = self.client.post(reverse("mdm:delete_recovery_password_config", args=(rp_config.pk,)),
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/recoverypasswordconfig_list.html")
         self.assertNotContains(response, rp_config.name)
         event = post_event.call_args_list[0].args[0]
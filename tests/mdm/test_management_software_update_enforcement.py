@@ -176,7 +176,7 @@ class SoftwareUpdateEnforcementViewsTestCase(TestCase):
                                          "local_time": "9:30"},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/softwareupdateenforcement_detail.html")
         sue = response.context["object"]
         self.assertEqual(sue.name, name)
@@ -232,7 +232,7 @@ class SoftwareUpdateEnforcementViewsTestCase(TestCase):
                                          "local_datetime": "2023-11-10 09:30"},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/softwareupdateenforcement_detail.html")
         sue = response.context["object"]
         self.assertEqual(sue.name, name)
@@ -356,7 +356,7 @@ class SoftwareUpdateEnforcementViewsTestCase(TestCase):
                                          "local_datetime": "2023-11-10 09:30"},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/softwareupdateenforcement_detail.html")
         sue2 = response.context["object"]
         self.assertEqual(sue2, sue)
@@ -433,7 +433,7 @@ class SoftwareUpdateEnforcementViewsTestCase(TestCase):
             response = self.client.post(reverse("mdm:delete_software_update_enforcement", args=(sue.pk,)),
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
         self.assertTemplateUsed(response, "mdm/softwareupdateenforcement_list.html")
         self.assertNotContains(response, sue.name)
         event = post_event.call_args_list[0].args[0]
@@ -11,6 +11,7 @@ from cryptography import x509
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import padding, rsa
 from cryptography.x509.oid import NameOID
+from django.core.cache import cache
 from django.test import TestCase, override_settings
 from django.urls import reverse
 from django.utils.crypto import get_random_string
@@ -43,6 +44,10 @@ class MDMViewsTestCase(TestCase):
         cls.mbu = MetaBusinessUnit.objects.create(name=get_random_string(12))
         cls.mbu.create_enrollment_business_unit()
 
+    def setUp(self):
+        # software update index & declarations cache
+        cache.clear()
+
     # utility methods
 
     def _call(self, method, url, payload, session=None, serial_number=None, sign_message=False, bad_signature=False):
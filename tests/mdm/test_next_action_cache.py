@@ -0,0 +1,269 @@
+import os
+import statistics
+import time
+from datetime import datetime, timedelta
+from unittest import skipUnless
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import transaction
+from django.test import TestCase
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MachineTag, MetaBusinessUnit, Tag
+from zentral.contrib.mdm.artifacts import Target, update_blueprint_serialized_artifacts
+from zentral.contrib.mdm.commands import DeviceInformation
+from zentral.contrib.mdm.commands.scheduling import (REENROLLMENT_CERT_EXPIRY_MARGIN,
+                                                     _get_idle_state_ttl, get_next_command_response)
+from zentral.contrib.mdm.models import Blueprint, DeviceArtifact, EnrolledDevice, RequestStatus, TargetArtifact
+from zentral.contrib.mdm.next_action import NextActionCache, next_action_cache
+from .utils import force_blueprint_artifact, force_dep_enrollment_session
+
+
+class MDMNextActionCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # the versions are bumped when the changes are committed
+        with cls.captureOnCommitCallbacks(execute=True):
+            cls.mbu = MetaBusinessUnit.objects.create(name=get_random_string(12))
+            cls.mbu.create_enrollment_business_unit()
+            cls.session, _, _ = force_dep_enrollment_session(cls.mbu, authenticated=True, completed=True)
+            cls.blueprint = Blueprint.objects.create(name=get_random_string(12))
+            cls.enrolled_device = cls.session.enrolled_device
+            cls.enrolled_device.blueprint = cls.blueprint
+            now = datetime.utcnow()
+            cls.enrolled_device.device_information_updated_at = now
+            cls.enrolled_device.security_info_updated_at = now
+            cls.enrolled_device.save()
+
+    def setUp(self):
+        cache.clear()
+
+    # utility methods
+
+    def _get_target(self):
+        return Target(EnrolledDevice.objects.select_related("blueprint").get(pk=self.enrolled_device.pk))
+
+    def _connect(self, status=RequestStatus.IDLE):
+        with self.captureOnCommitCallbacks(execute=True):
+            return get_next_command_response(self._get_target(), self.session, status)
+
+    def _commit(self):
+        # the changes are committed when the block exits
+        return self.captureOnCommitCallbacks(execute=True)
+
+    def _assertIdle(self, target, status=RequestStatus.IDLE):
+        idle, token = next_action_cache.check(target, status)
+        self.assertTrue(idle)
+        self.assertIsNone(token)
+
+    def _assertNotIdle(self, target, status=RequestStatus.IDLE):
+        idle, token = next_action_cache.check(target, status)
+        self.assertFalse(idle)
+        self.assertIsNotNone(token)
+
+    # tests
+
+    def test_idle_state_recorded(self):
+        target = self._get_target()
+        self._assertNotIdle(target)
+        response = self._connect()
+        self.assertEqual(response.content, b"")
+        self._assertIdle(target)
+
+    def test_idle_connect_no_queries(self):
+        self._connect()
+        target = self._get_target()
+        with self.assertNumQueries(0):
+            response = get_next_command_response(target, self.session, RequestStatus.IDLE)
+        self.assertEqual(response.content, b"")
+
+    def test_other_status_not_idle(self):
+        self._connect()
+        self._assertNotIdle(self._get_target(), RequestStatus.NOT_NOW)
+
+    def test_queued_command_invalidation(self):
+        self._connect()
+        with self._commit():
+            command = DeviceInformation.create_for_device(self.enrolled_device, queue=True)
+        self._assertNotIdle(self._get_target())
+        response = self._connect()
+        self.assertIn(str(command.uuid).upper().encode("utf-8"), response.content)
+
+    def test_enrolled_device_change_invalidation(self):
+        self._connect()
+        with self._commit():
+            self.enrolled_device.device_information_updated_at = None
+            self.enrolled_device.save()
+        self._assertNotIdle(self._get_target())
+        response = self._connect()
+        self.assertIn(b"DeviceInformation", response.content)
+
+    def test_last_seen_at_no_invalidation(self):
+        self._connect()
+        target = self._get_target()
+        with self._commit() as callbacks:
+            target.update_last_seen()
+        self.assertEqual(len(callbacks), 0)
+        self._assertIdle(target)
+
+    def test_blueprint_change_invalidation(self):
+        self._connect()
+        with self._commit():
+            self.blueprint.collect_apps = Blueprint.InventoryItemCollectionOption.ALL
+            self.blueprint.save()
+        self._assertNotIdle(self._get_target())
+        response = self._connect()
+        self.assertIn(b"InstalledApplicationList", response.content)
+
+    def test_machine_tag_change_invalidation(self):
+        self._connect()
+        with self._commit():
+            MachineTag.objects.create(serial_number=self.enrolled_device.serial_number,
+                                      tag=Tag.objects.create(name=get_random_string(12)))
+        self._assertNotIdle(self._get_target())
+
+    def test_pending_bump_not_idle(self):
+        self._connect()
+        with self._commit() as callbacks:
+            DeviceInformation.create_for_device(self.enrolled_device, queue=True)
+            # not committed yet → not idle, and not recorded
+            self.assertEqual(next_action_cache.check(self._get_target(), RequestStatus.IDLE), (False, None))
+        self.assertEqual(len(callbacks), 1)
+        self._assertNotIdle(self._get_target())
+
+    def test_one_bump_per_transaction(self):
+        self._connect()
+        with self._commit() as callbacks:
+            for _ in range(3):
+                DeviceInformation.create_for_device(self.enrolled_device, queue=True)
+            self.enrolled_device.device_information_updated_at = None
+            self.enrolled_device.save()
+            self.blueprint.save()
+        self.assertEqual(len(callbacks), 1)
+        self._assertNotIdle(self._get_target())
+
+    def test_rolled_back_savepoint_bump_discarded(self):
+        self._connect()
+        with self._commit() as callbacks:
+            try:
+                with transaction.atomic():
+                    DeviceInformation.create_for_device(self.enrolled_device, queue=True)
+                    self.assertTrue(next_action_cache.has_pending_bump(self._get_target()))
+                    raise ValueError
+            except ValueError:
+                pass
+            self.assertFalse(next_action_cache.has_pending_bump(self._get_target()))
+        self.assertEqual(len(callbacks), 0)
+        self._assertIdle(self._get_target())
+
+    def test_autocommit_bump(self):
+        target = self._get_target()
+        _, token = next_action_cache.check(target, RequestStatus.IDLE)
+        with patch("zentral.contrib.mdm.next_action.transaction.get_connection") as get_connection:
+            get_connection.return_value.in_atomic_block = False
+            next_action_cache.bump_device(self.enrolled_device.pk)
+        next_action_cache.record_idle(token, 900)
+        self._assertNotIdle(target)
+
+    def test_idle_state_expiry(self):
+        self._connect()
+        with patch("zentral.contrib.mdm.next_action.time.time", return_value=time.time() + 901):
+            self._assertNotIdle(self._get_target())
+
+    def test_idle_state_ttl_inventory_interval(self):
+        self.enrolled_device.device_information_updated_at = (
+            datetime.utcnow() - timedelta(seconds=self.blueprint.inventory_interval - 120)
+        )
+        self.enrolled_device.save()
+        ttl = _get_idle_state_ttl(self._get_target(), RequestStatus.IDLE)
+        self.assertTrue(100 < ttl <= 120)
+
+    def test_idle_state_ttl_reenrollment(self):
+        self.enrolled_device.cert_not_valid_after = (
+            datetime.utcnow() + REENROLLMENT_CERT_EXPIRY_MARGIN + timedelta(seconds=120)
+        )
+        self.enrolled_device.save()
+        ttl = _get_idle_state_ttl(self._get_target(), RequestStatus.IDLE)
+        self.assertTrue(100 < ttl <= 120)
+
+    def test_idle_state_ttl_delayed_command(self):
+        DeviceInformation.create_for_device(self.enrolled_device, queue=True, delay=60)
+        ttl = _get_idle_state_ttl(self._get_target(), RequestStatus.NOT_NOW)
+        self.assertTrue(50 < ttl <= 60)
+
+    def test_idle_state_ttl_artifact_reinstall_interval(self):
+        self.enrolled_device.os_version = "14.1"
+        self.enrolled_device.save()
+        _, artifact, (artifact_version,) = force_blueprint_artifact(blueprint=self.blueprint)
+        artifact.reinstall_interval = 2  # days
+        artifact.save()
+        update_blueprint_serialized_artifacts(self.blueprint)
+        DeviceArtifact.objects.create(
+            enrolled_device=self.enrolled_device,
+            artifact_version=artifact_version,
+            status=TargetArtifact.Status.INSTALLED,
+            installed_at=datetime.utcnow() - timedelta(days=2) + timedelta(seconds=120),
+        )
+        ttl = _get_idle_state_ttl(self._get_target(), RequestStatus.IDLE)
+        self.assertTrue(100 < ttl <= 120)
+
+    def test_idle_state_ttl_declarations_token(self):
+        self.enrolled_device.os_version = "14.1"
+        self.enrolled_device.declarative_management = True
+        self.enrolled_device.save()
+        _, artifact, _ = force_blueprint_artifact(blueprint=self.blueprint)
+        artifact.reinstall_interval = 3600  # seconds for the declarations
+        artifact.save()
+        update_blueprint_serialized_artifacts(self.blueprint)
+        target = self._get_target()
+        ttl = _get_idle_state_ttl(target, RequestStatus.IDLE)
+        self.assertTrue(0 < ttl <= 3600)
+        # no time based rule for the profiles installed with the MDM commands
+        self.enrolled_device.declarative_management = False
+        self.enrolled_device.save()
+        self.assertTrue(_get_idle_state_ttl(self._get_target(), RequestStatus.IDLE) > 3600)
+
+    def test_idle_state_not_recorded_when_due(self):
+        with self._commit():
+            self.enrolled_device.cert_not_valid_after = datetime.utcnow() + timedelta(days=1)
+            self.enrolled_device.save()
+        self.assertTrue(_get_idle_state_ttl(self._get_target(), RequestStatus.IDLE) < 0)
+        target = self._get_target()
+        _, token = next_action_cache.check(target, RequestStatus.IDLE)
+        next_action_cache.record_idle(token, _get_idle_state_ttl(target, RequestStatus.IDLE))
+        self._assertNotIdle(target)
+
+    def test_awaiting_configuration_not_cached(self):
+        self.enrolled_device.awaiting_configuration = True
+        self.enrolled_device.save()
+        self.assertEqual(next_action_cache.check(self._get_target(), RequestStatus.IDLE), (False, None))
+
+    @patch("zentral.contrib.mdm.next_action.settings",
+           {"apps": {"zentral.contrib.mdm": {"next_action_cache": {"max_ttl": 0}}}})
+    def test_disabled(self):
+        disabled_cache = NextActionCache()
+        self.assertEqual(disabled_cache.check(self._get_target(), RequestStatus.IDLE), (False, None))
+
+    # benchmark
+
+    @skipUnless(os.environ.get("ZENTRAL_BENCHMARKS"), "set ZENTRAL_BENCHMARKS to run the benchmarks")
+    def test_idle_checkin_latency_benchmark(self):
+        iterations = 200
+        results = {}
+        for label, max_ttl in (("full pass", 0), ("idle state", 900)):
+            with patch.object(next_action_cache, "max_ttl", max_ttl):
+                self._connect()  # warm up
+                durations = []
+                for _ in range(iterations):
+                    target = self._get_target()
+                    t0 = time.perf_counter()
+                    get_next_command_response(target, self.session, RequestStatus.IDLE)
+                    durations.append((time.perf_counter() - t0) * 1000)
+            results[label] = durations
+        print()
+        for label, durations in results.items():
+            durations.sort()
+            print(f"Idle check-in {label}: "
+                  f"mean {statistics.mean(durations):.3f}ms, "
+                  f"p50 {durations[len(durations) // 2]:.3f}ms, "
+                  f"p95 {durations[int(len(durations) * 0.95)]:.3f}ms")
+        self.assertLess(statistics.mean(results["idle state"]), statistics.mean(results["full pass"]))
@@ -14,7 +14,7 @@ class MDMSendDeviceNotificationTestCase(TestCase):
         cls.mbu.create_enrollment_business_unit()
         cls.push_certificate = force_push_certificate(with_material=True, reduced_key_size=False)
 
-    @patch("zentral.contrib.mdm.apns.httpx.Client.post")
+    @patch("zentral.contrib.mdm.apns.httpx.AsyncClient.post")
     def test_send_device_notification_ok(self, post):
         mocked_response = Mock()
         mocked_response.status_code = 200
@@ -34,7 +34,7 @@ class MDMSendDeviceNotificationTestCase(TestCase):
         call_command('send_device_notification', stdout=out)
         self.assertEqual(out.getvalue(), f"Device {serial_number} {device_udid} Skipped\n")
 
-    @patch("zentral.contrib.mdm.apns.httpx.Client.post")
+    @patch("zentral.contrib.mdm.apns.httpx.AsyncClient.post")
     def test_send_device_notification_failure(self, post):
         mocked_response = Mock()
         mocked_response.status_code = 400
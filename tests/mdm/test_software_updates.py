@@ -4,6 +4,7 @@ import os.path
 import datetime
 from psycopg2.extras import DateRange
 from unittest.mock import patch, Mock
+from django.core.cache import cache
 from django.core.management import call_command
 from django.test import TestCase
 from django.utils.crypto import get_random_string
@@ -11,6 +12,7 @@ from zentral.contrib.inventory.models import MetaBusinessUnit
 from zentral.contrib.mdm.models import Platform, SoftwareUpdate, SoftwareUpdateDeviceID
 from zentral.contrib.mdm.software_updates import (best_available_software_updates,
                                                   best_available_software_update_for_device_id_and_build,
+                                                  iter_available_software_updates_for_device_id_and_build,
                                                   sync_software_updates)
 from zentral.core.events.base import AuditEvent
 from .utils import force_ota_enrollment_session, force_software_update
@@ -28,6 +30,10 @@ class MDMSoftwareUpdateTestCase(TestCase):
                  "rb")
         )
 
+    def setUp(self):
+        # software update index
+        cache.clear()
+
     # utils
 
     def _force_enrolled_device(
@@ -488,6 +494,80 @@ class MDMSoftwareUpdateTestCase(TestCase):
         b_su = best_available_software_update_for_device_id_and_build("J413AP", "123456")
         self.assertEqual(su, b_su)
 
+    # software update index
+
+    def test_software_update_index_no_queries(self):
+        su = force_software_update(
+            device_id="J413AP",
+            version="14.4.0",
+            posting_date=datetime.date(2024, 3, 7),
+        )
+        self.assertEqual(best_available_software_update_for_device_id_and_build("J413AP", "123456"), su)
+        with self.assertNumQueries(0):
+            self.assertEqual(best_available_software_update_for_device_id_and_build("J413AP", "123456"), su)
+            self.assertIsNone(best_available_software_update_for_device_id_and_build("J314AP", "123456"))
+
+    def test_software_update_index_invalidation(self):
+        force_software_update(
+            device_id="J413AP",
+            version="14.4.0",
+            posting_date=datetime.date(2024, 3, 7),
+        )
+        best_available_software_update_for_device_id_and_build("J413AP", "123456")
+        su = force_software_update(
+            device_id="J413AP",
+            version="14.5.0",
+            posting_date=datetime.date(2024, 5, 13),
+        )
+        self.assertEqual(best_available_software_update_for_device_id_and_build("J413AP", "123456"), su)
+        su.delete()
+        self.assertEqual(
+            best_available_software_update_for_device_id_and_build("J413AP", "123456").comparable_os_version,
+            (14, 4, 0)
+        )
+
+    def test_software_update_index_max_os_version_prerequisite_build_and_date(self):
+        force_software_update(device_id="J413AP", version="15.0.0", posting_date=datetime.date(2024, 9, 16))
+        su_14_6 = force_software_update(device_id="J413AP", version="14.6.0",
+                                        posting_date=datetime.date(2024, 7, 29),
+                                        expiration_date=datetime.date(2024, 12, 31))
+        su_14_5 = force_software_update(device_id="J413AP", version="14.5.0",
+                                        posting_date=datetime.date(2024, 5, 13))
+        su_rsr = force_software_update(device_id="J413AP", version="14.5.0", version_extra="(a)",
+                                       prerequisite_build="23F79", public=True,
+                                       posting_date=datetime.date(2024, 6, 1))
+        # public, not an RSR → never available
+        force_software_update(device_id="J413AP", version="14.5.1", public=True,
+                              posting_date=datetime.date(2024, 6, 1))
+        self.assertEqual(
+            list(iter_available_software_updates_for_device_id_and_build(
+                "J413AP", "23F79", date=datetime.date(2024, 10, 1), max_os_version="15"
+            )),
+            [su_14_6, su_rsr, su_14_5]
+        )
+        # other build, after the 14.6 expiration
+        self.assertEqual(
+            list(iter_available_software_updates_for_device_id_and_build(
+                "J413AP", "23F80", date=datetime.date(2025, 1, 1), max_os_version="15"
+            )),
+            [su_14_5]
+        )
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    @patch("zentral.contrib.mdm.software_updates.requests.get")
+    def test_software_update_index_sync_invalidation(self, get, post_event):
+        response_json = Mock()
+        response_json.return_value = self.fake_response
+        response = Mock()
+        response.json = response_json
+        get.return_value = response
+        self.assertIsNone(best_available_software_update_for_device_id_and_build("J413AP", "123456"))
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("sync_software_updates")
+        self.assertIsNotNone(
+            best_available_software_update_for_device_id_and_build("J413AP", "123456", date=datetime.date(2023, 1, 15))
+        )
+
     # management command
 
     @patch("zentral.contrib.mdm.software_updates.requests.get")
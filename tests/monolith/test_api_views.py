@@ -426,9 +426,10 @@ class MonolithAPIViewsTestCase(TestCase):
              ]}
         )
 
+    @patch("zentral.contrib.monolith.tasks.refresh_manifest_pkginfo_closure_task.apply_async")
     @patch("base.notifier.Notifier.send_notification")
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
-    def test_update_s3_repository(self, post_event, send_notification):
+    def test_update_s3_repository(self, post_event, send_notification, refresh_apply_async):
         repository = force_repository()
         manifest = force_manifest(mbu=self.mbu)
         self.assertEqual(manifest.version, 1)
@@ -460,7 +461,8 @@ class MonolithAPIViewsTestCase(TestCase):
                  },
             )
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
+        refresh_apply_async.assert_called_once_with((manifest.pk,))
         repository2 = Repository.objects.get(name=new_name)
         self.assertEqual(repository, repository2)
         repository.refresh_from_db()
@@ -611,8 +613,10 @@ class MonolithAPIViewsTestCase(TestCase):
     @patch("zentral.contrib.monolith.repository_backends.s3.S3Repository.get_all_catalog_content")
     @patch("zentral.contrib.monolith.repository_backends.s3.S3Repository.get_icon_hashes_content")
     @patch("zentral.contrib.monolith.repository_backends.s3.S3Repository.iter_client_resources")
+    @patch("zentral.contrib.monolith.repository_backends.s3.S3Repository.get_fingerprint")
     def test_sync_repository(
         self,
+        get_fingerprint,
         iter_client_resources,
         get_icon_hashes_content,
         get_all_catalog_content,
@@ -621,6 +625,7 @@ class MonolithAPIViewsTestCase(TestCase):
         repository = force_repository()
         catalog_name = get_random_string(12)
         pkg_info_name = get_random_string(12)
+        get_fingerprint.return_value = None
         iter_client_resources.return_value = ["site_default.zip",]
         get_icon_hashes_content.return_value = plistlib.dumps({
             f"{pkg_info_name}.png": "a" * 64
@@ -669,6 +674,27 @@ class MonolithAPIViewsTestCase(TestCase):
                          str(PkgInfo.objects.get(name__name=pkg_info_name,
                                                  version="1.0").pk))
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    @patch("zentral.contrib.monolith.repository_backends.s3.S3Repository.sync_catalogs")
+    def test_sync_repository_default_not_forced(self, sync_catalogs, post_event):
+        repository = force_repository()
+        self._set_permissions("monolith.sync_repository")
+        response = self._post_json_data(reverse("monolith_api:sync_repository", args=(repository.pk,)), {})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"status": 0})
+        self.assertFalse(sync_catalogs.call_args.kwargs["force"])
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    @patch("zentral.contrib.monolith.repository_backends.s3.S3Repository.sync_catalogs")
+    def test_sync_repository_forced(self, sync_catalogs, post_event):
+        repository = force_repository()
+        self._set_permissions("monolith.sync_repository")
+        response = self._post_json_data(reverse("monolith_api:sync_repository", args=(repository.pk,)),
+                                        {"force": True})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {"status": 0})
+        self.assertTrue(sync_catalogs.call_args.kwargs["force"])
+
     # update cache server
 
     def test_update_cache_server_unauthorized(self):
@@ -0,0 +1,88 @@
+import os
+import plistlib
+import statistics
+import time
+from unittest import skipUnless
+from django.test import SimpleTestCase
+from zentral.contrib.monolith.utils import build_filtered_catalog, serialize_catalog_fragments
+from zentral.contrib.monolith.utils import test_pkginfo_catalog_inclusion as pkginfo_catalog_inclusion
+
+
+def filter_catalog(catalog_data, serial_number, tag_names):
+    # reference implementation
+    return plistlib.dumps([pkginfo for pkginfo in catalog_data
+                           if pkginfo_catalog_inclusion(pkginfo, serial_number, tag_names)])
+
+
+def build_catalog_data(count, conditional_every=10):
+    catalog_data = []
+    for i in range(count):
+        pkginfo = {
+            "name": f"package{i}",
+            "version": "1.2.3",
+            "description": "Description & <notes>",
+            "installs": [{"CFBundleShortVersionString": "1.2.3",
+                          "path": f"/Applications/Package{i}.app",
+                          "type": "application"}],
+            "installer_item_location": f"package{i}-1.2.3.pkg",
+            "minimum_os_version": "10.15",
+            "receipts": [{"installed_size": 1234, "packageid": f"com.example.package{i}", "version": "1.2.3"}],
+        }
+        if i % conditional_every == 1:
+            pkginfo["zentral_monolith"] = {"excluded_tags": ["EXCL"]}
+        elif i % conditional_every == 2:
+            pkginfo["zentral_monolith"] = {"shards": {"default": 50, "tags": {"INCL": 100}}}
+        elif i % conditional_every == 3:
+            pkginfo["zentral_monolith"] = {}
+        catalog_data.append(pkginfo)
+    return catalog_data
+
+
+class MonolithCatalogFragmentsTestCase(SimpleTestCase):
+    def test_empty_catalog(self):
+        self.assertEqual(serialize_catalog_fragments([]), [])
+        self.assertEqual(build_filtered_catalog([], "12345678", []), plistlib.dumps([]))
+
+    def test_invariant_pkginfos_merged(self):
+        fragments = serialize_catalog_fragments(build_catalog_data(10))
+        self.assertEqual([isinstance(f, bytes) for f in fragments],
+                         [True, False, False, True])
+
+    def test_same_output_as_plistlib(self):
+        catalog_data = build_catalog_data(50, conditional_every=4)
+        fragments = serialize_catalog_fragments(catalog_data)
+        for serial_number in ("12345678", "87654321", "YOLOFOMO"):
+            for tag_names in ([], ["EXCL"], ["INCL"], ["EXCL", "INCL"]):
+                self.assertEqual(build_filtered_catalog(fragments, serial_number, tag_names),
+                                 filter_catalog(catalog_data, serial_number, tag_names))
+
+    def test_all_pkginfos_filtered_out(self):
+        catalog_data = [{"name": "excluded", "version": "1.0", "zentral_monolith": {"excluded_tags": ["EXCL"]}}]
+        fragments = serialize_catalog_fragments(catalog_data)
+        self.assertEqual(plistlib.loads(build_filtered_catalog(fragments, "12345678", ["EXCL"])), [])
+        self.assertEqual(plistlib.loads(build_filtered_catalog(fragments, "12345678", [])), catalog_data)
+
+    # benchmark
+
+    @skipUnless(os.environ.get("ZENTRAL_BENCHMARKS"), "set ZENTRAL_BENCHMARKS to run the benchmarks")
+    def test_filtered_catalog_cpu_benchmark(self):
+        iterations = 50
+        catalog_data = build_catalog_data(3000)
+        fragments = serialize_catalog_fragments(catalog_data)
+        results = {}
+        for label, func, args in (("filter & dumps", filter_catalog, catalog_data),
+                                  ("fragments", build_filtered_catalog, fragments)):
+            durations = []
+            for _ in range(iterations):
+                t0 = time.process_time()
+                func(args, "12345678", ["INCL"])
+                durations.append((time.process_time() - t0) * 1000)
+            results[label] = durations
+        print()
+        for label, durations in results.items():
+            durations.sort()
+            print(f"Catalog {label}: "
+                  f"mean {statistics.mean(durations):.3f}ms, "
+                  f"p50 {durations[len(durations) // 2]:.3f}ms, "
+                  f"p95 {durations[int(len(durations) * 0.95)]:.3f}ms")
+        self.assertLess(statistics.mean(results["fragments"]), statistics.mean(results["filter & dumps"]))
@@ -0,0 +1,140 @@
+import plistlib
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import Tag
+from zentral.contrib.monolith.manifest_cache import ManifestCache, manifest_cache
+from zentral.contrib.monolith.models import Manifest
+from zentral.contrib.monolith.utils import build_filtered_catalog
+from .utils import force_catalog, force_manifest, force_pkg_info
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MonolithManifestCacheTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.manifest = force_manifest()
+        cls.catalog = force_catalog(manifest=cls.manifest)
+        cls.pkg_info = force_pkg_info(catalog=cls.catalog)
+        cls.tag = Tag.objects.create(name=get_random_string(12))
+
+    def setUp(self):
+        cache.clear()
+
+    # utility methods
+
+    def _get_manifest(self):
+        return Manifest.objects.get(pk=self.manifest.pk)
+
+    def _bump_manifest(self):
+        manifest = self._get_manifest()
+        manifest.bump_version()
+        return self._get_manifest()
+
+    def _lock(self, manifest, model, tags):
+        cache_key = ManifestCache.get_cache_key(manifest.pk, sorted(t.pk for t in tags), model, manifest.pk)
+        cache.add(f"{cache_key}.lock", "yolo")
+
+    # tests
+
+    def test_catalog_miss_then_hit(self):
+        manifest = self._get_manifest()
+        cache_key, catalog_fragments, hit = manifest_cache.get_catalog(manifest, [self.tag])
+        self.assertEqual(cache_key, f"monolith-mc.{manifest.pk}.{self.tag.pk}.manifest_catalog.{manifest.pk}")
+        self.assertFalse(hit)
+        catalog = plistlib.loads(build_filtered_catalog(catalog_fragments, get_random_string(12), [self.tag.name]))
+        self.assertEqual(catalog[0]["name"], self.pkg_info.name.name)
+        with self.assertNumQueries(0):
+            cache_key2, catalog_fragments2, hit = manifest_cache.get_catalog(manifest, [self.tag])
+        self.assertTrue(hit)
+        self.assertEqual(cache_key2, cache_key)
+        self.assertEqual(catalog_fragments2, catalog_fragments)
+
+    def test_new_version_rebuilt(self):
+        manifest_cache.get_manifest(self._get_manifest(), [])
+        manifest = self._bump_manifest()
+        _, _, hit = manifest_cache.get_manifest(manifest, [])
+        self.assertFalse(hit)
+        with self.assertNumQueries(0):
+            _, _, hit = manifest_cache.get_manifest(manifest, [])
+        self.assertTrue(hit)
+
+    def test_previous_version_served_while_building(self):
+        _, catalog_fragments, _ = manifest_cache.get_catalog(self._get_manifest(), [])
+        manifest = self._bump_manifest()
+        self._lock(manifest, "manifest_catalog", [])
+        with self.assertNumQueries(0):
+            _, stale_catalog_fragments, hit = manifest_cache.get_catalog(manifest, [])
+        self.assertTrue(hit)
+        self.assertEqual(stale_catalog_fragments, catalog_fragments)
+
+    def test_first_build_wait(self):
+        manifest = self._get_manifest()
+        self._lock(manifest, "manifest", [])
+        cache_key = ManifestCache.get_cache_key(manifest.pk, [], "manifest", manifest.pk)
+
+        def build_elsewhere(_):
+            cache.set(cache_key, (manifest.version, b"YOLO"))
+
+        with patch("zentral.contrib.monolith.manifest_cache.time.sleep", side_effect=build_elsewhere):
+            with self.assertNumQueries(0):
+                _, manifest_data, hit = manifest_cache.get_manifest(manifest, [])
+        self.assertTrue(hit)
+        self.assertEqual(manifest_data, b"YOLO")
+
+    def test_first_build_wait_timeout(self):
+        manifest = self._get_manifest()
+        self._lock(manifest, "manifest", [])
+        with patch.object(manifest_cache, "lock_wait", 0):
+            _, manifest_data, hit = manifest_cache.get_manifest(manifest, [])
+        self.assertFalse(hit)
+        self.assertEqual(manifest_data, manifest.serialize([]))
+
+    def test_prewarm(self):
+        manifest_cache.get_catalog(self._get_manifest(), [self.tag])
+        manifest = self._bump_manifest()
+        result = manifest_cache.prewarm_manifest(manifest)
+        self.assertEqual(result, {"manifest": {"pk": manifest.pk, "version": 2},
+                                  "pkginfo_closure": True,
+                                  "tag_sets": 1,
+                                  "built": 2})
+        with self.assertNumQueries(0):
+            _, _, catalog_hit = manifest_cache.get_catalog(manifest, [self.tag])
+            _, _, manifest_hit = manifest_cache.get_manifest(manifest, [self.tag])
+        self.assertTrue(catalog_hit)
+        self.assertTrue(manifest_hit)
+
+    def test_prewarm_deleted_tag(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        manifest_cache.get_catalog(self._get_manifest(), [tag])
+        tag.delete()
+        result = manifest_cache.prewarm_manifest(self._bump_manifest())
+        self.assertEqual(result["tag_sets"], 0)
+        self.assertEqual(result["built"], 0)
+
+    @patch("zentral.contrib.monolith.tasks.refresh_manifest_pkginfo_closure_task.apply_async")
+    @patch("zentral.contrib.monolith.tasks.prewarm_manifest_cache_task.apply_async")
+    def test_no_prewarm_by_default(self, prewarm_apply_async, refresh_apply_async):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self._bump_manifest()
+        self.assertEqual(len(callbacks), 1)
+        prewarm_apply_async.assert_not_called()
+        # the closure is always refreshed in a background task
+        refresh_apply_async.assert_called_once_with((self.manifest.pk,))
+
+    @patch("zentral.contrib.monolith.tasks.prewarm_manifest_cache_task.apply_async")
+    def test_prewarm_scheduled(self, apply_async):
+        with patch.object(manifest_cache, "prewarm", True):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                self._bump_manifest()
+        self.assertEqual(len(callbacks), 1)
+        apply_async.assert_called_once_with((self.manifest.pk,))
+
+    @patch("zentral.contrib.monolith.manifest_cache.settings",
+           {"apps": {"zentral.contrib.monolith": {"manifest_cache": {"lock_timeout": 0, "lock_wait": 1000}}}})
+    def test_config_clamped(self):
+        mc = ManifestCache()
+        self.assertEqual(mc.lock_timeout, 1)
+        self.assertEqual(mc.lock_wait, 60)
+        self.assertFalse(mc.prewarm)
@@ -0,0 +1,125 @@
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import Tag
+from zentral.contrib.monolith.models import (Manifest, ManifestPkgInfoClosure, ManifestPkgInfoClosureItem,
+                                             ManifestSubManifest)
+from zentral.contrib.monolith.tasks import refresh_manifest_pkginfo_closure_task
+from .utils import force_catalog, force_manifest, force_name, force_pkg_info, force_sub_manifest
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MonolithManifestPkgInfoClosureTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.manifest = force_manifest()
+        cls.catalog = force_catalog(manifest=cls.manifest)
+        cls.tag = Tag.objects.create(name=get_random_string(12))
+        cls.tagged_catalog = force_catalog(repository=cls.catalog.repository, manifest=cls.manifest, tags=[cls.tag])
+        cls.sub_manifest = force_sub_manifest(manifest=cls.manifest)
+        # root pkginfo, in the sub manifest
+        cls.root_pkg_info = force_pkg_info(catalog=cls.catalog, sub_manifest=cls.sub_manifest)
+        # required by the root pkginfo
+        cls.required_pkg_info = force_pkg_info(catalog=cls.catalog)
+        cls.root_pkg_info.requires.add(cls.required_pkg_info.name)
+        # update for the root pkginfo, only in the tagged catalog
+        cls.update_pkg_info = force_pkg_info(catalog=cls.tagged_catalog)
+        cls.update_pkg_info.update_for.add(cls.root_pkg_info.name)
+        # not linked to the manifest
+        cls.other_pkg_info = force_pkg_info(catalog=cls.catalog)
+
+    def setUp(self):
+        cache.clear()
+
+    # utility methods
+
+    def _get_manifest(self):
+        return Manifest.objects.get(pk=self.manifest.pk)
+
+    def _get_pkginfo_pks(self, tags):
+        return sorted(cpi.pk for cpi in self._get_manifest()._pkginfos_with_deps_and_updates(tags))
+
+    # tests
+
+    def test_closure(self):
+        self.assertEqual(self._get_pkginfo_pks([]),
+                         sorted([self.root_pkg_info.pk, self.required_pkg_info.pk]))
+        self.assertEqual(self._get_pkginfo_pks([self.tag]),
+                         sorted([self.root_pkg_info.pk, self.required_pkg_info.pk, self.update_pkg_info.pk]))
+
+    def test_tagged_sub_manifest(self):
+        sub_manifest = force_sub_manifest()
+        msm = ManifestSubManifest.objects.create(manifest=self.manifest, sub_manifest=sub_manifest)
+        msm.tags.set([self.tag])
+        pkg_info = force_pkg_info(catalog=self.catalog, sub_manifest=sub_manifest)
+        self.assertNotIn(pkg_info.pk, self._get_pkginfo_pks([]))
+        self.assertIn(pkg_info.pk, self._get_pkginfo_pks([self.tag]))
+
+    def test_get_pkginfo_for_cache(self):
+        manifest = self._get_manifest()
+        manifest.refresh_pkginfo_closure()
+        with self.assertNumQueries(2):
+            cached_pkginfo = manifest.get_pkginfo_for_cache([], self.required_pkg_info.pk)
+        self.assertEqual(cached_pkginfo.pk, self.required_pkg_info.pk)
+        self.assertEqual(cached_pkginfo.name, self.required_pkg_info.name.name)
+        self.assertIsNone(manifest.get_pkginfo_for_cache([], self.update_pkg_info.pk))
+        self.assertEqual(manifest.get_pkginfo_for_cache([self.tag], self.update_pkg_info.pk).pk,
+                         self.update_pkg_info.pk)
+        self.assertIsNone(manifest.get_pkginfo_for_cache([self.tag], self.other_pkg_info.pk))
+
+    def test_closure_built_once_per_version(self):
+        manifest = self._get_manifest()
+        self.assertTrue(manifest.refresh_pkginfo_closure())
+        self.assertFalse(manifest.refresh_pkginfo_closure())
+        self.assertTrue(manifest.refresh_pkginfo_closure(force=True))
+        closure = ManifestPkgInfoClosure.objects.get(manifest=manifest)
+        self.assertEqual(closure.manifest_version, 1)
+        self.assertEqual(ManifestPkgInfoClosureItem.objects.filter(manifest=manifest).count(), 3)
+
+    @patch("zentral.contrib.monolith.tasks.refresh_manifest_pkginfo_closure_task.apply_async")
+    def test_closure_rebuilt_on_version_bump(self, apply_async):
+        self._get_manifest().refresh_pkginfo_closure()
+        pkg_info_name = force_name()
+        self.required_pkg_info.requires.add(pkg_info_name)
+        pkg_info = force_pkg_info(catalog=self.catalog)
+        pkg_info.name = pkg_info_name
+        pkg_info.save()
+        self.assertNotIn(pkg_info.pk, self._get_pkginfo_pks([]))
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self._get_manifest().bump_version()
+        self.assertEqual(len(callbacks), 1)
+        apply_async.assert_called_once_with((self.manifest.pk,))
+        # stale closure → live query
+        self.assertIn(pkg_info.pk, self._get_pkginfo_pks([]))
+        self.assertEqual(ManifestPkgInfoClosure.objects.get(manifest=self.manifest).manifest_version, 1)
+        # task
+        self.assertEqual(refresh_manifest_pkginfo_closure_task(self.manifest.pk),
+                         {"manifest": {"pk": self.manifest.pk, "version": 2},
+                          "pkginfo_closure": True})
+        self.assertEqual(ManifestPkgInfoClosure.objects.get(manifest=self.manifest).manifest_version, 2)
+        self.assertIn(pkg_info.pk, self._get_pkginfo_pks([]))
+
+    @patch("zentral.contrib.monolith.tasks.refresh_manifest_pkginfo_closure_task.apply_async")
+    def test_stale_closure_not_built_in_request(self, apply_async):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            self.assertEqual(self._get_pkginfo_pks([]),
+                             sorted([self.root_pkg_info.pk, self.required_pkg_info.pk]))
+            self.assertEqual(self._get_pkginfo_pks([self.tag]),
+                             sorted([self.root_pkg_info.pk, self.required_pkg_info.pk, self.update_pkg_info.pk]))
+        self.assertFalse(ManifestPkgInfoClosure.objects.filter(manifest=self.manifest).exists())
+        # refresh scheduled once
+        self.assertEqual(len(callbacks), 1)
+        apply_async.assert_called_once_with((self.manifest.pk,))
+
+    def test_manifest_sub_manifest_deletion(self):
+        self._get_manifest().refresh_pkginfo_closure()
+        ManifestSubManifest.objects.filter(manifest=self.manifest).delete()
+        self.assertEqual(ManifestPkgInfoClosureItem.objects.filter(manifest=self.manifest).count(), 0)
+
+    @patch("zentral.contrib.monolith.models.manifest_pkginfo_closure_build_seconds")
+    def test_build_time_metric(self, build_seconds):
+        manifest = self._get_manifest()
+        manifest.refresh_pkginfo_closure()
+        manifest.refresh_pkginfo_closure()
+        build_seconds.observe.assert_called_once()
@@ -1,9 +1,13 @@
 from datetime import datetime
 import plistlib
 from unittest.mock import call, Mock
+from botocore.exceptions import ClientError
+from django.db import connection
 from django.db.models.expressions import CombinedExpression
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.utils.crypto import get_random_string
+from zentral.contrib.monolith.exceptions import RepositoryError
 from zentral.contrib.monolith.models import PkgInfo, PkgInfoCategory, PkgInfoName
 from zentral.contrib.monolith.repository_backends import load_repository_backend
 from zentral.core.events.base import AuditEvent
@@ -18,8 +22,12 @@ class MonolithRepositoriesTestCase(TestCase):
     def _build_plist(self, data):
         return plistlib.dumps(data)
 
-    def _load_repository(self, db_repository, return_value):
+    def _load_repository(self, db_repository, return_value, fingerprint=None):
         repository = load_repository_backend(db_repository)
+        repository.get_fingerprint = Mock(
+            name="get_fingerprint",
+            return_value=fingerprint
+        )
         repository.get_icon_hashes_content = Mock(
             name="get_icon_hashes_content",
             return_value=self._build_plist({})
@@ -189,3 +197,196 @@ class MonolithRepositoriesTestCase(TestCase):
             [call(pkg_info_to_unarchive, AuditEvent.Action.UPDATED, prev_value),
              call(manifest, AuditEvent.Action.UPDATED, manifest_prev_value)]
         )
+
+    def test_sync_catalogs_no_changes(self):
+        db_repository = force_repository()
+        manifest = force_manifest()
+        catalog = force_catalog(repository=db_repository, manifest=manifest)
+        category_name = get_random_string(12)
+        repository = self._load_repository(
+            db_repository,
+            [{"catalogs": [catalog.name],
+              "name": get_random_string(12),
+              "category": category_name,
+              "requires": [get_random_string(12)],
+              "update_for": [get_random_string(12)],
+              "version": f"{i}.0"} for i in range(50)]
+        )
+        repository.sync_catalogs()
+        manifest.refresh_from_db()
+        self.assertEqual(manifest.version, 2)
+        audit_callback = Mock()
+        with self.assertNumQueries(9):
+            repository.sync_catalogs(audit_callback)
+        self.assertEqual(len(audit_callback.call_args_list), 0)
+        manifest.refresh_from_db()
+        self.assertEqual(manifest.version, 2)
+
+    def test_sync_catalogs_bulk_queries(self):
+        query_counts = []
+        for count in (10, 100):
+            db_repository = force_repository()
+            repository = self._load_repository(
+                db_repository,
+                [{"catalogs": [get_random_string(12)],
+                  "name": get_random_string(12),
+                  "category": get_random_string(12),
+                  "requires": [get_random_string(12)],
+                  "update_for": [get_random_string(12)],
+                  "version": "1.0"} for _ in range(count)]
+            )
+            with CaptureQueriesContext(connection) as ctx:
+                repository.sync_catalogs()
+            query_counts.append(len(ctx.captured_queries))
+            self.assertEqual(PkgInfo.objects.filter(repository=db_repository).count(), count)
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_sync_catalogs_only_changed_manifests_bumped(self):
+        db_repository = force_repository()
+        manifest1 = force_manifest()
+        catalog1 = force_catalog(repository=db_repository, manifest=manifest1)
+        manifest2 = force_manifest()
+        catalog2 = force_catalog(repository=db_repository, manifest=manifest2)
+        name1 = get_random_string(12)
+        name2 = get_random_string(12)
+        pkg_infos_data = [{"catalogs": [catalog1.name], "name": name1, "version": "1.0"},
+                          {"catalogs": [catalog2.name], "name": name2, "version": "1.0"}]
+        repository = self._load_repository(db_repository, pkg_infos_data)
+        repository.sync_catalogs()
+        pkg_infos_data[0]["version"] = "2.0"
+        repository = self._load_repository(db_repository, pkg_infos_data)
+        audit_callback = Mock()
+        repository.sync_catalogs(audit_callback)
+        pkg_info_1 = PkgInfo.objects.get(name__name=name1, version="1.0")
+        pkg_info_2 = PkgInfo.objects.get(name__name=name1, version="2.0")
+        self.assertEqual(
+            [(c.args[0], c.args[1]) for c in audit_callback.call_args_list],
+            [(pkg_info_2, AuditEvent.Action.CREATED),
+             (pkg_info_1, AuditEvent.Action.UPDATED),
+             (manifest1, AuditEvent.Action.UPDATED)]
+        )
+        self.assertIsNotNone(pkg_info_1.archived_at)
+        manifest1.refresh_from_db()
+        self.assertEqual(manifest1.version, 3)
+        manifest2.refresh_from_db()
+        self.assertEqual(manifest2.version, 2)
+
+    def test_sync_catalogs_other_repository_pkg_info_not_archived(self):
+        other_pkg_info = force_pkg_info(local=False)
+        db_repository = force_repository()
+        catalog = force_catalog(repository=db_repository)
+        repository = self._load_repository(
+            db_repository,
+            [{"catalogs": [catalog.name], "name": get_random_string(12), "version": "1.0"}]
+        )
+        repository.sync_catalogs()
+        other_pkg_info.refresh_from_db()
+        self.assertIsNone(other_pkg_info.archived_at)
+
+    # fingerprint
+
+    def test_sync_catalogs_fingerprint_stored(self):
+        db_repository = force_repository()
+        repository = self._load_repository(db_repository, [], fingerprint="a" * 64)
+        self.assertTrue(repository.sync_catalogs())
+        db_repository.refresh_from_db()
+        self.assertEqual(db_repository.fingerprint, "a" * 64)
+
+    def test_sync_catalogs_same_fingerprint_skipped(self):
+        db_repository = force_repository()
+        manifest = force_manifest()
+        catalog = force_catalog(repository=db_repository, manifest=manifest)
+        repository = self._load_repository(
+            db_repository,
+            [{"catalogs": [catalog.name], "name": get_random_string(12), "version": "1.0"}],
+            fingerprint="a" * 64
+        )
+        self.assertTrue(repository.sync_catalogs())
+        manifest.refresh_from_db()
+        self.assertEqual(manifest.version, 2)
+        last_synced_at = db_repository.last_synced_at
+        audit_callback = Mock()
+        with self.assertNumQueries(1):
+            self.assertFalse(repository.sync_catalogs(audit_callback))
+        repository.get_all_catalog_content.assert_called_once()
+        self.assertEqual(len(audit_callback.call_args_list), 0)
+        db_repository.refresh_from_db()
+        self.assertTrue(db_repository.last_synced_at > last_synced_at)
+        manifest.refresh_from_db()
+        self.assertEqual(manifest.version, 2)
+
+    def test_sync_catalogs_same_fingerprint_forced(self):
+        db_repository = force_repository()
+        catalog = force_catalog(repository=db_repository)
+        repository = self._load_repository(
+            db_repository,
+            [{"catalogs": [catalog.name], "name": get_random_string(12), "version": "1.0"}],
+            fingerprint="a" * 64
+        )
+        repository.sync_catalogs()
+        self.assertTrue(repository.sync_catalogs(force=True))
+        self.assertEqual(len(repository.get_all_catalog_content.call_args_list), 2)
+
+    def test_sync_catalogs_new_fingerprint(self):
+        db_repository = force_repository()
+        catalog = force_catalog(repository=db_repository)
+        repository = self._load_repository(
+            db_repository,
+            [{"catalogs": [catalog.name], "name": get_random_string(12), "version": "1.0"}],
+            fingerprint="a" * 64
+        )
+        repository.sync_catalogs()
+        repository.get_fingerprint.return_value = "b" * 64
+        self.assertTrue(repository.sync_catalogs())
+        self.assertEqual(len(repository.get_all_catalog_content.call_args_list), 2)
+        db_repository.refresh_from_db()
+        self.assertEqual(db_repository.fingerprint, "b" * 64)
+
+    def test_sync_catalogs_no_fingerprint_never_skipped(self):
+        db_repository = force_repository()
+        repository = self._load_repository(db_repository, [])
+        self.assertTrue(repository.sync_catalogs())
+        self.assertTrue(repository.sync_catalogs())
+        db_repository.refresh_from_db()
+        self.assertIsNone(db_repository.fingerprint)
+
+    def _get_s3_repository_with_client(self, client_resources_etags, icon_hashes_etag='"icons"'):
+        repository = load_repository_backend(force_repository())
+        client = Mock()
+
+        def head_object(Bucket, Key):
+            if Key.endswith("catalogs/all"):
+                return {"ETag": '"all"'}
+            if icon_hashes_etag is None:
+                raise ClientError({"Error": {"Code": "404"}}, "HeadObject")
+            return {"ETag": icon_hashes_etag}
+
+        client.head_object.side_effect = head_object
+        client.get_paginator.return_value.paginate.return_value = [
+            {"Contents": [{"Key": f"munki_repo/client_resources/{key}", "ETag": etag}
+                          for key, etag in client_resources_etags]}
+        ]
+        repository._client = client
+        return repository
+
+    def test_s3_fingerprint(self):
+        fingerprint = self._get_s3_repository_with_client([("site_default.zip", '"1"')]).get_fingerprint()
+        self.assertEqual(len(fingerprint), 64)
+        self.assertEqual(
+            self._get_s3_repository_with_client([("site_default.zip", '"1"')]).get_fingerprint(),
+            fingerprint
+        )
+        for client_resources_etags, icon_hashes_etag in (([("site_default.zip", '"2"')], '"icons"'),
+                                                         ([("site_default.zip", '"1"')], '"icons2"'),
+                                                         ([("site_default.zip", '"1"')], None),
+                                                         ([], '"icons"')):
+            self.assertNotEqual(
+                self._get_s3_repository_with_client(client_resources_etags, icon_hashes_etag).get_fingerprint(),
+                fingerprint
+            )
+
+    def test_s3_fingerprint_missing_all_catalog(self):
+        repository = self._get_s3_repository_with_client([])
+        repository._client.head_object.side_effect = ClientError({"Error": {"Code": "404"}}, "HeadObject")
+        with self.assertRaises(RepositoryError):
+            repository.get_fingerprint()
@@ -352,9 +352,10 @@ class MonolithSetupViewsTestCase(TestCase):
             f"Repository linked to manifest '{manifest}' which has a different business unit."
         )
 
+    @patch("zentral.contrib.monolith.tasks.refresh_manifest_pkginfo_closure_task.apply_async")
     @patch("base.notifier.Notifier.send_notification")
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
-    def test_update_s3_repository(self, post_event, send_notification):
+    def test_update_s3_repository(self, post_event, send_notification, refresh_apply_async):
         repository = force_repository()
         manifest = force_manifest(mbu=self.mbu)
         self.assertEqual(manifest.version, 1)
@@ -383,7 +384,8 @@ class MonolithSetupViewsTestCase(TestCase):
                                          "s3-cloudfront_privkey_pem": CLOUDFRONT_PRIVKEY_PEM},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
+        refresh_apply_async.assert_called_once_with((manifest.pk,))
         self.assertTemplateUsed(response, "monolith/repository_detail.html")
         self.assertContains(response, new_name)
         repository = response.context["object"]
@@ -1480,8 +1482,9 @@ class MonolithSetupViewsTestCase(TestCase):
         response = self.client.get(reverse("monolith:update_condition", args=(condition.pk,)))
         self.assertEqual(response.status_code, 403)
 
+    @patch("zentral.contrib.monolith.tasks.refresh_manifest_pkginfo_closure_task.apply_async")
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
-    def test_update_condition(self, post_event):
+    def test_update_condition(self, post_event, refresh_apply_async):
         condition = Condition.objects.create(name=get_random_string(12), predicate='machine_type == "laptop"')
         prev_value = condition.serialize_for_event()
         manifest = force_manifest()
@@ -1496,7 +1499,8 @@ class MonolithSetupViewsTestCase(TestCase):
                                         {"name": new_name, "predicate": new_predicate},
                                         follow=True)
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
+        refresh_apply_async.assert_called_once_with((manifest.pk,))
         self.assertTemplateUsed(response, "monolith/condition_detail.html")
         self.assertEqual(condition, response.context["object"])
         condition.refresh_from_db()
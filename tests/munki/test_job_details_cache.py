@@ -0,0 +1,138 @@
+from datetime import datetime
+from unittest.mock import patch
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import MachineTag, Tag
+from zentral.contrib.munki.job_details_cache import JobDetailsCache, job_details_cache
+from zentral.core.incidents.models import Incident, MachineIncident, Severity, Status
+from .utils import force_script_check
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class MunkiJobDetailsCacheTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.serial_number = get_random_string(12)
+
+    # utility methods
+
+    def _get_script_checks(self, tag_pks=None):
+        return job_details_cache.get_script_checks((14, 1, 0), False, True, tag_pks or [])
+
+    def _force_machine_incident(self, status=Status.OPEN):
+        incident = Incident.objects.create(
+            incident_type=get_random_string(12),
+            key={"un": get_random_string(12)},
+            status=status.value,
+            status_time=datetime.utcnow(),
+            severity=Severity.MAJOR.value
+        )
+        return MachineIncident.objects.create(
+            incident=incident,
+            serial_number=self.serial_number,
+            status=status.value,
+            status_time=datetime.utcnow()
+        )
+
+    # machine info
+
+    def test_machine_info_hit(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        MachineTag.objects.create(serial_number=self.serial_number, tag=tag)
+        machine_info = job_details_cache.get_machine_info(self.serial_number)
+        self.assertEqual(machine_info, {"incidents": [], "tag_pks_and_names": [(tag.pk, tag.name)]})
+        with self.assertNumQueries(0):
+            self.assertEqual(job_details_cache.get_machine_info(self.serial_number), machine_info)
+
+    def test_machine_info_machine_tag_invalidation(self):
+        job_details_cache.get_machine_info(self.serial_number)
+        tag = Tag.objects.create(name=get_random_string(12))
+        MachineTag.objects.create(serial_number=self.serial_number, tag=tag)
+        self.assertEqual(job_details_cache.get_machine_info(self.serial_number)["tag_pks_and_names"],
+                         [(tag.pk, tag.name)])
+
+    def test_machine_info_incident_invalidation(self):
+        job_details_cache.get_machine_info(self.serial_number)
+        machine_incident = self._force_machine_incident()
+        self.assertEqual(job_details_cache.get_machine_info(self.serial_number)["incidents"],
+                         [machine_incident.incident.name])
+        machine_incident.status = Status.CLOSED.value
+        machine_incident.save()
+        self.assertEqual(job_details_cache.get_machine_info(self.serial_number)["incidents"], [])
+
+    # script checks
+
+    def test_script_checks_hit(self):
+        sc = force_script_check()
+        in_scope_cc_ids, script_checks = self._get_script_checks()
+        self.assertEqual(in_scope_cc_ids, [sc.compliance_check.pk])
+        self.assertEqual([d["pk"] for d in script_checks], [sc.pk])
+        with self.assertNumQueries(0):
+            self.assertEqual(self._get_script_checks(), (in_scope_cc_ids, script_checks))
+
+    def test_script_checks_scope_key(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        sc = force_script_check(excluded_tags=[tag])
+        self.assertEqual(self._get_script_checks()[0], [sc.compliance_check.pk])
+        self.assertEqual(self._get_script_checks([tag.pk])[0], [])
+
+    def test_script_checks_script_check_invalidation(self):
+        self.assertEqual(self._get_script_checks(), ([], []))
+        sc = force_script_check()
+        self.assertEqual(self._get_script_checks()[0], [sc.compliance_check.pk])
+        sc.compliance_check.version = 2
+        sc.compliance_check.save()
+        self.assertEqual(self._get_script_checks()[1][0]["version"], 2)
+        sc.delete()
+        self.assertEqual(self._get_script_checks(), ([], []))
+
+    def test_script_checks_tags_invalidation(self):
+        sc = force_script_check()
+        tag = Tag.objects.create(name=get_random_string(12))
+        self.assertEqual(self._get_script_checks([tag.pk])[0], [sc.compliance_check.pk])
+        sc.excluded_tags.add(tag)
+        self.assertEqual(self._get_script_checks([tag.pk])[0], [])
+
+    def test_script_checks_deleted_tag_invalidation(self):
+        tag = Tag.objects.create(name=get_random_string(12))
+        sc = force_script_check(tags=[tag])
+        self.assertEqual(self._get_script_checks()[0], [])
+        tag.delete()
+        self.assertEqual(self._get_script_checks()[0], [sc.compliance_check.pk])
+
+    # pruning
+
+    @patch("zentral.contrib.munki.tasks.prune_out_of_scope_machine_statuses_task.apply_async")
+    def test_pruning_scheduled_on_scope_change(self, apply_async):
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            job_details_cache.schedule_pruning(self.serial_number, [2, 1])
+        self.assertEqual(len(callbacks), 1)
+        apply_async.assert_called_once_with((self.serial_number, [2, 1]))
+        job_details_cache.set_pruned_scope(self.serial_number, [2, 1])
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            job_details_cache.schedule_pruning(self.serial_number, [1, 2])
+        self.assertEqual(len(callbacks), 0)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            job_details_cache.schedule_pruning(self.serial_number, [1])
+        self.assertEqual(len(callbacks), 1)
+
+    # config
+
+    @patch("zentral.contrib.munki.job_details_cache.settings",
+           {"apps": {"zentral.contrib.munki": {"job_details_cache": {"ttl": 1000000}}}})
+    def test_config_clamped(self):
+        self.assertEqual(JobDetailsCache().ttl, 86400)
+
+    @patch("zentral.contrib.munki.job_details_cache.settings",
+           {"apps": {"zentral.contrib.munki": {"job_details_cache": {"ttl": 0}}}})
+    def test_disabled(self):
+        jdc = JobDetailsCache()
+        self.assertEqual(jdc.ttl, 0)
+        sc = force_script_check()
+        jdc.get_script_checks((14, 1, 0), False, True, [])
+        jdc.get_machine_info(self.serial_number)
+        with self.assertNumQueries(3):
+            in_scope_cc_ids, _ = jdc.get_script_checks((14, 1, 0), False, True, [])
+            jdc.get_machine_info(self.serial_number)
+        self.assertEqual(in_scope_cc_ids, [sc.compliance_check.pk])
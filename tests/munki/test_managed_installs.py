@@ -3,7 +3,8 @@ from django.utils.crypto import get_random_string
 from django.test import TestCase
 from zentral.contrib.munki.incidents import MunkiInstallFailedIncident, MunkiReinstallIncident
 from zentral.contrib.munki.models import ManagedInstall
-from zentral.contrib.munki.utils import apply_managed_installs, update_managed_install_with_event
+from zentral.contrib.munki.utils import (apply_managed_installs, update_managed_install_with_event,
+                                         ManagedInstallReconciliation)
 from zentral.core.incidents.models import Severity
 from .utils import force_configuration
 
@@ -1708,3 +1709,109 @@ class MunkiSetupViewsTestCase(TestCase):
         self.assertIsNone(mi.failed_at)
         self.assertIsNone(mi.failed_version)
         self.assertFalse(mi.reinstall)
+
+    # ManagedInstallReconciliation
+
+    def test_reconciliation_same_final_state_as_sequential_updates(self):
+        configuration = force_configuration(
+            auto_failed_install_incidents=True,
+            auto_reinstall_incidents=True,
+        )
+        names = [get_random_string(12) for _ in range(3)]
+        events = [
+            (datetime(2023, 1, 1), self._build_install_event(name=names[0], version="1", failed=True)),
+            (datetime(2023, 1, 2), self._build_install_event(name=names[0], version="1")),
+            (datetime(2023, 1, 3), self._build_install_event(name=names[0], version="1")),
+            (datetime(2023, 1, 1), self._build_install_event(name=names[1], version="1")),
+            (datetime(2023, 1, 2), self._build_removal_event(name=names[1])),
+            (datetime(2023, 1, 3), self._build_install_event(name=names[1], version="2", failed=True)),
+            (datetime(2023, 1, 1), self._build_removal_event(name=names[2])),
+        ]
+        # sequential updates
+        sequential_serial_number = get_random_string(12)
+        sequential_incident_updates = []
+        for event_time, event in events:
+            sequential_incident_updates.extend(
+                update_managed_install_with_event(sequential_serial_number, event, event_time, configuration)
+            )
+        # reconciliation
+        serial_number = get_random_string(12)
+        reconciliation = ManagedInstallReconciliation(serial_number, configuration)
+        incident_updates = []
+        for event_time, event in events:
+            incident_updates.extend(reconciliation.apply_event(event, event_time))
+        reconciliation.commit()
+        self.assertEqual(incident_updates, sequential_incident_updates)
+        self.assertEqual(len(incident_updates), 5)
+        attrs = ("name", "display_name", "installed_version", "installed_at",
+                 "failed_version", "failed_at", "reinstall")
+        self.assertEqual(
+            list(ManagedInstall.objects.filter(machine_serial_number=serial_number)
+                                       .order_by("name").values_list(*attrs)),
+            list(ManagedInstall.objects.filter(machine_serial_number=sequential_serial_number)
+                                       .order_by("name").values_list(*attrs)),
+        )
+
+    def test_reconciliation_removal_then_install_new_managed_install(self):
+        configuration = force_configuration()
+        serial_number = get_random_string(12)
+        name = get_random_string(12)
+        old_mi = ManagedInstall.objects.create(
+            machine_serial_number=serial_number,
+            name=name,
+            display_name=name,
+            installed_version="1",
+            installed_at=datetime(2023, 1, 1),
+        )
+        reconciliation = ManagedInstallReconciliation(serial_number, configuration)
+        reconciliation.apply_event(self._build_removal_event(name=name), datetime(2023, 1, 2))
+        reconciliation.apply_event(self._build_install_event(name=name, version="2"), datetime(2023, 1, 3))
+        with self.assertNumQueries(2):
+            reconciliation.commit()
+        mi = ManagedInstall.objects.get(machine_serial_number=serial_number)
+        self.assertNotEqual(mi.pk, old_mi.pk)
+        self.assertEqual(mi.installed_version, "2")
+        self.assertEqual(mi.installed_at, datetime(2023, 1, 3))
+
+    def test_reconciliation_no_events_no_queries(self):
+        reconciliation = ManagedInstallReconciliation(get_random_string(12), force_configuration())
+        with self.assertNumQueries(0):
+            reconciliation.apply_event({"type": "yolo"}, datetime.utcnow())
+            reconciliation.commit()
+
+    def test_reconciliation_query_count_benchmark(self):
+        configuration = force_configuration(
+            auto_failed_install_incidents=True,
+            auto_reinstall_incidents=True,
+        )
+        serial_number = get_random_string(12)
+        for i in range(100):
+            ManagedInstall.objects.create(
+                machine_serial_number=serial_number,
+                name=f"package{i}",
+                display_name=f"Package {i}",
+                installed_version="1",
+                installed_at=datetime(2023, 1, 1),
+            )
+        events = []
+        for i in range(200):
+            event_time = datetime(2023, 1, 2, 0, i // 60, i % 60)
+            if i % 10 == 9:
+                events.append((event_time, self._build_removal_event(name=f"package{i // 2}")))
+            else:
+                events.append((event_time, self._build_install_event(name=f"package{i // 2}",
+                                                                     version=str(i),
+                                                                     failed=i % 7 == 0)))
+        # 1 select for update + 1 delete + 1 upsert, regardless of the number of events
+        with self.assertNumQueries(3):
+            reconciliation = ManagedInstallReconciliation(serial_number, configuration)
+            for event_time, event in events:
+                reconciliation.apply_event(event, event_time)
+            reconciliation.commit()
+        self.assertEqual(ManagedInstall.objects.filter(machine_serial_number=serial_number).count(), 80)
+        # same with the complete list of the managed installs
+        managed_installs = [(f"package{i}", "2", None, "2023-01-03T00:00:00+00:00") for i in range(1, 150)]
+        with self.assertNumQueries(3):
+            incident_updates = list(apply_managed_installs(serial_number, managed_installs, configuration))
+        self.assertTrue(len(incident_updates) > 0)
+        self.assertEqual(ManagedInstall.objects.filter(machine_serial_number=serial_number).count(), 149)
@@ -0,0 +1,202 @@
+from datetime import datetime, timedelta
+import json
+from unittest.mock import patch
+from django.db import OperationalError
+from django.test import TestCase
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+from prometheus_client.parser import text_string_to_metric_families
+from zentral.conf import settings
+from zentral.contrib.inventory.models import MachineSnapshot
+from zentral.contrib.munki.models import ManagedInstall, MunkiState, PostflightPayload
+from zentral.contrib.munki.postflight import PostflightQueue, postflight_queue
+from zentral.contrib.munki.tasks import sweep_postflight_queue_task
+from zentral.core.exceptions import ImproperlyConfigured
+from .utils import force_enrollment, make_enrolled_machine
+
+
+class MunkiPostflightQueueTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.enrollment = force_enrollment()
+        cls.enrolled_machine = make_enrolled_machine(enrollment=cls.enrollment)
+
+    # utility methods
+
+    def _build_payload(self, computer_name=None, install_status=0, event_time="2021-11-15T14:47:37Z"):
+        return {"machine_snapshot": {"serial_number": self.enrolled_machine.serial_number,
+                                     "system_info": {"computer_name": computer_name or get_random_string(12)}},
+                "reports": [{"start_time": "2018-01-01 00:00:00 +0000",
+                             "end_time": "2018-01-01 00:01:00 +0000",
+                             "basename": "report2018",
+                             "run_type": "auto",
+                             "sha1sum": 40 * "0",
+                             "events": [(event_time,
+                                         {"name": "YoloApp",
+                                          "display_name": "Yolo App",
+                                          "version": "1.2.3",
+                                          "status": install_status,
+                                          "type": "install"})]}]}
+
+    def _post_job(self, data):
+        return self.client.post(reverse("munki_public:post_job"),
+                                json.dumps(data),
+                                content_type="application/json",
+                                HTTP_AUTHORIZATION=f"MunkiEnrolledMachine {self.enrolled_machine.token}")
+
+    def _force_payload(self, data, received_at=None):
+        return PostflightPayload.objects.create(
+            serial_number=self.enrolled_machine.serial_number,
+            enrollment=self.enrollment,
+            user_agent="Zentral/mnkpf 0.1",
+            ip="127.0.0.1",
+            data=json.dumps(data),
+            received_at=received_at or datetime.utcnow(),
+        )
+
+    # queue
+
+    @patch("zentral.contrib.munki.tasks.process_postflight_payloads_task.apply_async")
+    def test_post_job_queued(self, apply_async):
+        with patch.object(postflight_queue, "enabled", True):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                response = self._post_job(self._build_payload())
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {})
+        self.assertEqual(len(callbacks), 1)
+        apply_async.assert_called_once_with((self.enrolled_machine.serial_number,), queue="munki_postflight",
+                                            countdown=None)
+        payload = PostflightPayload.objects.get(serial_number=self.enrolled_machine.serial_number)
+        self.assertEqual(payload.enrollment, self.enrollment)
+        self.assertEqual(json.loads(payload.data)["reports"][0]["basename"], "report2018")
+        self.assertFalse(MachineSnapshot.objects.filter(serial_number=self.enrolled_machine.serial_number).exists())
+
+    def test_post_job_queued_null_character(self):
+        data = self._build_payload()
+        data["machine_snapshot"]["extra_facts"] = {"yolo": "\u0000fomo"}
+        with patch.object(postflight_queue, "enabled", True):
+            response = self._post_job(data)
+        self.assertEqual(response.status_code, 200)
+        payload = PostflightPayload.objects.get(serial_number=self.enrolled_machine.serial_number)
+        self.assertEqual(json.loads(payload.data)["machine_snapshot"]["extra_facts"], {"yolo": "\u0000fomo"})
+
+    def test_post_job_queued_invalid_payload(self):
+        data = self._build_payload()
+        data["reports"][0]["start_time"] = "yolo"
+        with patch.object(postflight_queue, "enabled", True):
+            for invalid_data in ([], {"reports": []}, {"machine_snapshot": {"serial_number": "0123"}}, data):
+                response = self._post_job(invalid_data)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(PostflightPayload.objects.count(), 0)
+
+    # processing
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_process_machine_in_order(self, post_event):
+        self._force_payload(self._build_payload(install_status=1), datetime.utcnow() - timedelta(minutes=30))
+        computer_name = get_random_string(12)
+        self._force_payload(self._build_payload(computer_name=computer_name, event_time="2021-11-15T15:47:37Z"))
+        self.assertEqual(postflight_queue.process_group(self.enrolled_machine.serial_number), 2)
+        self.assertEqual(PostflightPayload.objects.count(), 0)
+        ms = MachineSnapshot.objects.current().get(serial_number=self.enrolled_machine.serial_number)
+        self.assertEqual(ms.system_info.computer_name, computer_name)
+        mi = ManagedInstall.objects.get(machine_serial_number=self.enrolled_machine.serial_number)
+        self.assertEqual(mi.installed_version, "1.2.3")
+        self.assertIsNone(mi.failed_version)
+        munki_state = MunkiState.objects.get(machine_serial_number=self.enrolled_machine.serial_number)
+        self.assertEqual(munki_state.user_agent, "Zentral/mnkpf 0.1")
+
+    @patch("zentral.contrib.munki.postflight.logger.exception")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_process_machine_error_does_not_block(self, post_event, logger_exception):
+        payload = self._force_payload({"machine_snapshot": {"serial_number": self.enrolled_machine.serial_number}})
+        self._force_payload(self._build_payload())
+        self.assertEqual(postflight_queue.process_group(self.enrolled_machine.serial_number), 2)
+        logger_exception.assert_called_once_with("Could not process machine %s postflight payload %s",
+                                                 self.enrolled_machine.serial_number, payload.pk)
+        self.assertEqual(PostflightPayload.objects.count(), 0)
+        self.assertTrue(MachineSnapshot.objects.filter(serial_number=self.enrolled_machine.serial_number).exists())
+
+    @patch("zentral.contrib.munki.postflight.process_postflight")
+    def test_process_machine_transient_db_error(self, process_postflight):
+        process_postflight.side_effect = OperationalError("yolo")
+        self._force_payload(self._build_payload())
+        with self.assertRaises(OperationalError):
+            postflight_queue.process_group(self.enrolled_machine.serial_number)
+        self.assertEqual(PostflightPayload.objects.count(), 1)
+
+    def test_process_machine_empty_queue(self):
+        self.assertEqual(postflight_queue.process_group(get_random_string(12)), 0)
+
+    @patch("zentral.contrib.munki.tasks.process_postflight_payloads_task.apply_async")
+    def test_process_machine_older_payload_locked_rescheduled(self, apply_async):
+        older_payload = self._force_payload(self._build_payload())
+        self._force_payload(self._build_payload())
+        # the older payload is locked by another worker
+        with patch.object(postflight_queue, "get_queryset",
+                          return_value=PostflightPayload.objects.exclude(pk=older_payload.pk)):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                self.assertEqual(postflight_queue.process_group(self.enrolled_machine.serial_number), 0)
+        self.assertEqual(len(callbacks), 1)
+        apply_async.assert_called_once_with((self.enrolled_machine.serial_number,), queue="munki_postflight",
+                                            countdown=5)
+        self.assertEqual(PostflightPayload.objects.count(), 2)
+
+    # sweep
+
+    @patch("zentral.contrib.munki.tasks.process_postflight_payloads_task.apply_async")
+    def test_sweep(self, apply_async):
+        for _ in range(2):
+            self._force_payload(self._build_payload(), datetime.utcnow() - timedelta(minutes=10))
+        other_serial_number = get_random_string(12)
+        PostflightPayload.objects.create(
+            serial_number=other_serial_number,
+            enrollment=self.enrollment,
+            user_agent="Zentral/mnkpf 0.1",
+            ip="127.0.0.1",
+            data=json.dumps(self._build_payload()),
+            received_at=datetime.utcnow(),
+        )
+        self.assertEqual(sweep_postflight_queue_task(), {"scheduled": 1})
+        apply_async.assert_called_once_with((self.enrolled_machine.serial_number,), queue="munki_postflight",
+                                            countdown=None)
+
+    @patch("zentral.contrib.munki.tasks.process_postflight_payloads_task.apply_async")
+    def test_sweep_empty_queue(self, apply_async):
+        self._force_payload(self._build_payload())
+        self.assertEqual(postflight_queue.sweep(), 0)
+        apply_async.assert_not_called()
+
+    # metrics
+
+    def test_metrics(self):
+        self._force_payload(self._build_payload(), datetime.utcnow() - timedelta(minutes=10))
+        self._force_payload(self._build_payload())
+        with patch.object(postflight_queue, "enabled", True):
+            response = self.client.get(reverse("munki_metrics:all"),
+                                       HTTP_AUTHORIZATION=f'Bearer {settings["api"]["metrics_bearer_token"]}')
+        self.assertEqual(response.status_code, 200)
+        samples = {family.name: family.samples[0].value
+                   for family in text_string_to_metric_families(response.content.decode("utf-8"))
+                   if family.name.startswith("zentral_munki_postflight_queue")}
+        self.assertEqual(samples["zentral_munki_postflight_queue_depth"], 2)
+        self.assertTrue(600 <= samples["zentral_munki_postflight_queue_lag_seconds"] < 900)
+
+    # config
+
+    @patch("zentral.utils.db_queues.settings",
+           {"apps": {"zentral.contrib.munki": {"postflight_queue": {"enabled": True, "celery_queue": ""}}}})
+    def test_config_invalid_celery_queue(self):
+        with self.assertRaises(ImproperlyConfigured):
+            PostflightQueue()
+
+    @patch("zentral.utils.db_queues.settings",
+           {"apps": {"zentral.contrib.munki": {"postflight_queue": {"sweep_min_age": 1}}}})
+    def test_config_sweep_min_age_clamped(self):
+        self.assertEqual(PostflightQueue().sweep_min_age, 30)
+
+    @patch("zentral.utils.db_queues.settings",
+           {"apps": {"zentral.contrib.munki": {"postflight_queue": {"sweep_min_age": "yolo"}}}})
+    def test_config_invalid_sweep_min_age(self):
+        with self.assertRaises(ImproperlyConfigured):
+            PostflightQueue()
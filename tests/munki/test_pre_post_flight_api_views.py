@@ -12,6 +12,7 @@ from zentral.contrib.munki.events import (MunkiInstallEvent, MunkiInstallFailedE
                                           MunkiRequestEvent, MunkiScriptCheckStatusUpdated)
 from zentral.contrib.munki.incidents import IncidentUpdate, MunkiInstallFailedIncident
 from zentral.contrib.munki.models import EnrolledMachine, ManagedInstall, MunkiState, ScriptCheck
+from zentral.contrib.munki.tasks import prune_out_of_scope_machine_statuses_task
 from zentral.core.compliance_checks.models import MachineStatus
 from zentral.core.incidents.models import Incident, MachineIncident, Severity, Status
 from .utils import force_configuration, force_enrollment, force_script_check, make_enrolled_machine
@@ -270,8 +271,9 @@ class MunkiAPIViewsTestCase(TestCase):
                                       HTTP_AUTHORIZATION="MunkiEnrolledMachine {}".format(enrolled_machine.token))
         self.assertNotIn("script_checks", response.json())
 
+    @patch("zentral.contrib.munki.tasks.prune_out_of_scope_machine_statuses_task.apply_async")
     @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
-    def test_job_details_second_time_script_check(self, post_event):
+    def test_job_details_second_time_script_check(self, post_event, apply_async):
         enrolled_machine = make_enrolled_machine(enrollment=self.enrollment)
         tag = Tag.objects.create(name=get_random_string(12))
         MachineTag.objects.create(serial_number=enrolled_machine.serial_number, tag=tag)
@@ -312,6 +314,14 @@ class MunkiAPIViewsTestCase(TestCase):
             response.json()["script_checks"],
             [{'pk': sc.pk, 'version': 1, 'type': 'ZSH_INT', 'source': 'echo 10', 'expected_result': 10}]
         )
+        # pruning scheduled
+        apply_async.assert_called_once_with((enrolled_machine.serial_number, [sc.compliance_check.pk]))
+        self.assertEqual(MachineStatus.objects.filter(serial_number=enrolled_machine.serial_number).count(), 1)
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            result = prune_out_of_scope_machine_statuses_task(enrolled_machine.serial_number,
+                                                              [sc.compliance_check.pk])
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(result, {"serial_number": enrolled_machine.serial_number, "pruned": 1})
         self.assertEqual(MachineStatus.objects.filter(serial_number=enrolled_machine.serial_number).count(), 0)
         event1, event2 = [cal.args[0] for cal in post_event.call_args_list]
         self.assertIsInstance(event1, MunkiRequestEvent)
@@ -597,7 +607,7 @@ class MunkiAPIViewsTestCase(TestCase):
                                             }]},
                                           HTTP_AUTHORIZATION="MunkiEnrolledMachine {}".format(enrolled_machine.token))
         self.assertEqual(response.status_code, 200)
-        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(len(callbacks), 2)
 
         # check all events
         status_updated_event = None
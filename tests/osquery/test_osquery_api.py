@@ -1,8 +1,12 @@
+import base64
 from datetime import datetime
 import json
+import tempfile
 from unittest.mock import patch
 import uuid
+from django.db import connection, InterfaceError, OperationalError
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse, NoReverseMatch
 from django.utils.crypto import get_random_string
 from django.utils.text import slugify
@@ -11,14 +15,20 @@ from zentral.conf import settings
 from zentral.contrib.inventory.models import EnrollmentSecret, MachineSnapshot, MachineTag, MetaBusinessUnit, Tag
 from zentral.contrib.osquery.compliance_checks import sync_query_compliance_check
 from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME
+from zentral.contrib.osquery.distributed_query_results import (DistributedQueryResultQueue,
+                                                               distributed_query_result_queue)
 from zentral.contrib.osquery.events import (OsqueryEnrollmentEvent, OsqueryRequestEvent, OsqueryResultEvent,
                                             OsqueryCheckStatusUpdated, OsqueryFileCarvingEvent)
 from zentral.contrib.osquery.models import (Configuration, ConfigurationPack,
-                                            DistributedQuery, DistributedQueryMachine, DistributedQueryResult,
+                                            DistributedQuery, DistributedQueryMachine,
+                                            DistributedQueryResult, DistributedQueryResultBatch,
                                             EnrolledMachine, Enrollment, FileCarvingSession,
                                             Query, Pack, PackQuery)
+from zentral.contrib.osquery.file_carving import write_file_carving_block
+from zentral.contrib.osquery.tasks import build_file_carving_session_archive, save_distributed_query_results
 from zentral.contrib.osquery.views.utils import update_tree_with_inventory_query_snapshot
 from zentral.core.compliance_checks.models import MachineStatus, Status
+from zentral.core.exceptions import ImproperlyConfigured
 
 
 INVENTORY_QUERY_SNAPSHOT = [
@@ -853,6 +863,115 @@ class OsqueryAPIViewsTestCase(TestCase):
 
     # log
 
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_distributed_write_bulk_writes(self, post_event):
+        em = self.force_enrolled_machine()
+        dqms = []
+        for i in range(5):
+            dq = DistributedQuery.objects.create(sql="select username from users;",
+                                                 valid_from=datetime.utcnow(),
+                                                 query_version=1)
+            dqms.append(DistributedQueryMachine.objects.create(distributed_query=dq, serial_number=em.serial_number))
+        with CaptureQueriesContext(connection) as ctx:
+            response = self.post_as_json("distributed_write",
+                                         {"node_key": em.node_key,
+                                          "queries": {str(dqm.pk): [{"username": f"godzilla{i}"}
+                                                                    for i in range(3)]
+                                                      for dqm in dqms},
+                                          "statuses": {str(dqm.pk): 0 for dqm in dqms},
+                                          "stats": {str(dqm.pk): {"wall_time_ms": 3} for dqm in dqms}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            len([q for q in ctx.captured_queries
+                 if q["sql"].startswith('UPDATE "osquery_distributedquerymachine"')]),
+            1
+        )
+        self.assertEqual(
+            len([q for q in ctx.captured_queries
+                 if q["sql"].startswith('INSERT INTO "osquery_distributedqueryresult"')]),
+            1
+        )
+        for dqm in dqms:
+            dqm.refresh_from_db()
+            self.assertEqual(dqm.status, 0)
+            self.assertEqual(dqm.wall_time_ms, 3)
+            self.assertTrue(dqm.updated_at > dqm.created_at)
+        self.assertEqual(DistributedQueryResult.objects.filter(serial_number=em.serial_number).count(), 15)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    @patch("zentral.contrib.osquery.tasks.save_distributed_query_results.apply_async")
+    def test_distributed_write_deferred_results(self, apply_async, post_event):
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        dqm = DistributedQueryMachine.objects.create(distributed_query=dq, serial_number=em.serial_number)
+        with patch.object(distributed_query_result_queue, "deferred_threshold", 2):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                response = self.post_as_json("distributed_write",
+                                             {"node_key": em.node_key,
+                                              "queries": {str(dqm.pk): [{"username": "godzilla\u0000"},
+                                                                        {"username": "fomo"}]},
+                                              "statuses": {str(dqm.pk): 0}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(callbacks), 1)
+        # only the serial number is sent to the task, the rows are stored in the database
+        apply_async.assert_called_once_with((em.serial_number,), queue="celery", countdown=None)
+        batch = DistributedQueryResultBatch.objects.get(serial_number=em.serial_number)
+        self.assertEqual(json.loads(batch.data), [[dq.pk, [{"username": "godzilla"}, {"username": "fomo"}]]])
+        dqr_qs = DistributedQueryResult.objects.filter(distributed_query=dq, serial_number=em.serial_number)
+        self.assertEqual(dqr_qs.count(), 0)
+        # task
+        self.assertEqual(save_distributed_query_results(em.serial_number),
+                         {"serial_number": em.serial_number, "processed": 1})
+        self.assertEqual(sorted(dqr.row["username"] for dqr in dqr_qs), ["fomo", "godzilla"])
+        self.assertFalse(DistributedQueryResultBatch.objects.filter(serial_number=em.serial_number).exists())
+
+    def test_save_distributed_query_results_legacy_task_args(self):
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        self.assertEqual(save_distributed_query_results(em.serial_number, [[dq.pk, [{"username": "godzilla"}]]]),
+                         {"serial_number": em.serial_number, "results": 1})
+        self.assertEqual(DistributedQueryResult.objects.filter(distributed_query=dq).count(), 1)
+
+    @patch("zentral.contrib.osquery.distributed_query_results.DistributedQueryResult.objects.bulk_create_from_results")
+    def test_save_distributed_query_results_transient_db_error(self, bulk_create_from_results):
+        bulk_create_from_results.side_effect = OperationalError("yolo")
+        serial_number = get_random_string(12)
+        DistributedQueryResultBatch.objects.create(serial_number=serial_number, data="[]",
+                                                   received_at=datetime.utcnow())
+        with self.assertRaises(OperationalError):
+            distributed_query_result_queue.process_group(serial_number)
+        self.assertEqual(DistributedQueryResultBatch.objects.filter(serial_number=serial_number).count(), 1)
+        self.assertEqual(save_distributed_query_results.autoretry_for, (InterfaceError, OperationalError))
+
+    @patch("zentral.contrib.osquery.distributed_query_results.settings",
+           {"apps": {"zentral.contrib.osquery": {"distributed_query_results": {"deferred_threshold": "yolo"}}}})
+    def test_distributed_query_result_queue_invalid_deferred_threshold(self):
+        with self.assertRaises(ImproperlyConfigured):
+            DistributedQueryResultQueue()
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    @patch("zentral.contrib.osquery.tasks.save_distributed_query_results.apply_async")
+    def test_distributed_write_results_below_deferred_threshold(self, apply_async, post_event):
+        em = self.force_enrolled_machine()
+        dq = DistributedQuery.objects.create(sql="select username from users;",
+                                             valid_from=datetime.utcnow(),
+                                             query_version=1)
+        dqm = DistributedQueryMachine.objects.create(distributed_query=dq, serial_number=em.serial_number)
+        with patch.object(distributed_query_result_queue, "deferred_threshold", 2):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                response = self.post_as_json("distributed_write",
+                                             {"node_key": em.node_key,
+                                              "queries": {str(dqm.pk): [{"username": "godzilla"}]},
+                                              "statuses": {str(dqm.pk): 0}})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(callbacks), 0)
+        apply_async.assert_not_called()
+        self.assertEqual(DistributedQueryResult.objects.filter(distributed_query=dq).count(), 1)
+
     def test_log_405(self):
         response = self.client.get(reverse("osquery_public:log"))
         self.assertEqual(response.status_code, 405)
@@ -1672,6 +1791,82 @@ class OsqueryAPIViewsTestCase(TestCase):
         response = self.post_as_json("carver_continue", post_data)
         self.assertEqual(response.status_code, 400)
 
+    def _force_small_file_carving_session(self):
+        em = self.force_enrolled_machine()
+        _, _, distributed_query = self.force_query(force_distributed_query=True)
+        return FileCarvingSession.objects.create(
+            id=uuid.uuid4(),
+            distributed_query=distributed_query,
+            serial_number=em.serial_number,
+            carve_guid=uuid.uuid4(),
+            carve_size=10,
+            block_size=4,
+            block_count=3
+        )
+
+    def _post_file_carving_block(self, fcs, block_id, data):
+        return self.post_as_json("carver_continue", {"session_id": str(fcs.pk),
+                                                     "block_id": block_id,
+                                                     "data": base64.b64encode(data).decode("ascii")})
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_continue_file_carving_block_id_out_of_range(self, post_event):
+        fcs = self._force_small_file_carving_session()
+        for block_id in (-1, 3):
+            response = self._post_file_carving_block(fcs, block_id, b"yolo")
+            self.assertEqual(response.status_code, 400)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_continue_file_carving_block_data_too_large(self, post_event):
+        fcs = self._force_small_file_carving_session()
+        response = self._post_file_carving_block(fcs, 0, b"yolofomo")
+        self.assertEqual(response.status_code, 400)
+
+    @patch("zentral.contrib.osquery.public_views.build_file_carving_session_archive.apply_async")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_continue_file_carving_blocks_at_offsets(self, post_event, apply_async):
+        fcs = self._force_small_file_carving_session()
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                for block_id, data in ((2, b"42"), (0, b"yolo"), (0, b"yolo"), (1, b"fomo")):
+                    response = self._post_file_carving_block(fcs, block_id, data)
+                    self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(callbacks), 1)
+            apply_async.assert_called_once_with((str(fcs.pk),))
+            self.assertEqual([e.payload["session_finished"] for e in (c.args[0] for c in post_event.call_args_list)
+                              if isinstance(e, OsqueryFileCarvingEvent)],
+                             [False, False, False, True])
+            fcs.refresh_from_db()
+            self.assertEqual(fcs.received_block_count, 3)
+            self.assertEqual(bytes(fcs.received_blocks), b"\x07")
+            self.assertEqual(fcs.filecarvingblock_set.count(), 0)
+            # archive attached, not rebuilt
+            post_event.reset_mock()
+            build_file_carving_session_archive(str(fcs.pk))
+            fcs.refresh_from_db()
+            with fcs.archive.open("rb") as f:
+                self.assertEqual(f.read(), b"yolofomo42")
+        archive_event = post_event.call_args_list[0].args[0]
+        self.assertEqual(archive_event.payload["archive"]["size"], 10)
+        self.assertEqual(archive_event.payload["archive"]["url"],
+                         "{}{}".format(settings["api"]["tls_hostname"],
+                                       reverse("osquery:download_file_carving_session_archive", args=(fcs.pk,))))
+
+    @patch("zentral.contrib.osquery.file_carving.get_local_archive_path")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_file_carving_session_archive_from_block_files(self, post_event, get_local_archive_path):
+        get_local_archive_path.return_value = None
+        fcs = self._force_small_file_carving_session()
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            for block_id, data in ((1, b"fomo"), (0, b"yolo"), (2, b"42")):
+                write_file_carving_block(fcs, block_id, data)
+            self.assertEqual(fcs.filecarvingblock_set.count(), 3)
+            build_file_carving_session_archive(str(fcs.pk))
+            fcs.refresh_from_db()
+            with fcs.archive.open("rb") as f:
+                self.assertEqual(f.read(), b"yolofomo42")
+        self.assertEqual(post_event.call_args_list[0].args[0].payload["archive"]["size"], 10)
+
     def test_legacy_public_urls_are_disabled_on_tests(self):
         routes = ['enroll', 'config', 'carver_start', 'carver_continue', 'distributed_read', 'distributed_write']
 
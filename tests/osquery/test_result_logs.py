@@ -0,0 +1,217 @@
+from datetime import datetime, timedelta
+import json
+from unittest.mock import patch
+from django.core.cache import cache
+from django.db import OperationalError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils.crypto import get_random_string
+from zentral.contrib.inventory.models import (CurrentMachineSnapshot, EnrollmentSecret, MachineSnapshot,
+                                              MachineSnapshotCommit, MetaBusinessUnit)
+from zentral.contrib.osquery.conf import INVENTORY_QUERY_NAME
+from zentral.contrib.osquery.models import Configuration, EnrolledMachine, Enrollment, ResultLogBatch
+from zentral.contrib.osquery.result_logs import (InventorySnapshotDedup, ResultLogQueue,
+                                                 inventory_snapshot_dedup, result_log_queue)
+from zentral.contrib.osquery.tasks import sweep_result_log_queue_task
+from zentral.core.exceptions import ImproperlyConfigured
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class OsqueryResultLogsTestCase(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        configuration = Configuration.objects.create(name=get_random_string(12))
+        meta_business_unit = MetaBusinessUnit.objects.create(name=get_random_string(12))
+        enrollment_secret = EnrollmentSecret.objects.create(meta_business_unit=meta_business_unit)
+        cls.enrollment = Enrollment.objects.create(configuration=configuration, secret=enrollment_secret)
+        cls.enrolled_machine = EnrolledMachine.objects.create(
+            enrollment=cls.enrollment,
+            serial_number=get_random_string(12),
+            node_key=get_random_string(12),
+            osquery_version="5.10.2",
+            platform_mask=21
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    # utility methods
+
+    def _build_inventory_record(self, computer_name="godzilla", uptime=1234):
+        return {"action": "snapshot",
+                "name": INVENTORY_QUERY_NAME,
+                "snapshot": [{"build": "19H1824",
+                              "major": "10",
+                              "minor": "15",
+                              "name": "Mac OS X",
+                              "patch": "7",
+                              "table_name": "os_version"},
+                             {"computer_name": computer_name,
+                              "hardware_model": "MacBookPro5,1",
+                              "hardware_serial": self.enrolled_machine.serial_number,
+                              "table_name": "system_info"},
+                             {"total_seconds": str(uptime),
+                              "table_name": "uptime"}],
+                "unixTime": "1480605737"}
+
+    def _post_log(self, records):
+        return self.client.post(reverse("osquery_public:log"),
+                                json.dumps({"node_key": self.enrolled_machine.node_key,
+                                            "log_type": "result",
+                                            "data": records}),
+                                content_type="application/json")
+
+    def _force_batch(self, records):
+        return ResultLogBatch.objects.create(
+            enrolled_machine=self.enrolled_machine,
+            user_agent="osquery/5.10.2",
+            ip="127.0.0.1",
+            data=json.dumps(records),
+            received_at=datetime.utcnow(),
+        )
+
+    def _commit_count(self):
+        return MachineSnapshotCommit.objects.filter(serial_number=self.enrolled_machine.serial_number).count()
+
+    # queue
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    @patch("zentral.contrib.osquery.tasks.process_result_log_batches_task.apply_async")
+    def test_log_queued(self, apply_async, post_event):
+        with patch.object(result_log_queue, "enabled", True):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                response = self._post_log([self._build_inventory_record()])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {})
+        self.assertEqual(len(callbacks), 1)
+        apply_async.assert_called_once_with((self.enrolled_machine.pk,), queue="osquery_result_logs", countdown=None)
+        batch = ResultLogBatch.objects.get(enrolled_machine=self.enrolled_machine)
+        self.assertEqual(json.loads(batch.data)[0]["name"], INVENTORY_QUERY_NAME)
+        self.assertFalse(MachineSnapshot.objects.filter(serial_number=self.enrolled_machine.serial_number).exists())
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_process_enrolled_machine_in_order(self, post_event):
+        self._force_batch([self._build_inventory_record(computer_name="yolo")])
+        self._force_batch([self._build_inventory_record(computer_name="fomo")])
+        self.assertEqual(result_log_queue.process_group(self.enrolled_machine.pk), 2)
+        self.assertEqual(ResultLogBatch.objects.count(), 0)
+        ms = MachineSnapshot.objects.current().get(serial_number=self.enrolled_machine.serial_number)
+        self.assertEqual(ms.system_info.computer_name, "fomo")
+
+    @patch("zentral.contrib.osquery.result_logs.logger.exception")
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_process_enrolled_machine_error_does_not_block(self, post_event, logger_exception):
+        batch = self._force_batch(["yolo"])
+        self._force_batch([self._build_inventory_record()])
+        self.assertEqual(result_log_queue.process_group(self.enrolled_machine.pk), 2)
+        logger_exception.assert_called_once_with("Could not process enrolled machine %s result log batch %s",
+                                                 self.enrolled_machine.pk, batch.pk)
+        self.assertEqual(ResultLogBatch.objects.count(), 0)
+        self.assertTrue(MachineSnapshot.objects.filter(serial_number=self.enrolled_machine.serial_number).exists())
+
+    @patch("zentral.contrib.osquery.result_logs.process_result_logs")
+    def test_process_enrolled_machine_transient_db_error(self, process_result_logs):
+        process_result_logs.side_effect = OperationalError("yolo")
+        self._force_batch([self._build_inventory_record()])
+        with self.assertRaises(OperationalError):
+            result_log_queue.process_group(self.enrolled_machine.pk)
+        self.assertEqual(ResultLogBatch.objects.count(), 1)
+
+    def test_process_unknown_enrolled_machine(self):
+        self.assertEqual(result_log_queue.process_group(0), 0)
+
+    @patch("zentral.contrib.osquery.tasks.process_result_log_batches_task.apply_async")
+    def test_process_enrolled_machine_older_batch_locked_rescheduled(self, apply_async):
+        older_batch = self._force_batch([self._build_inventory_record()])
+        self._force_batch([self._build_inventory_record()])
+        # the older batch is locked by another worker
+        with patch.object(result_log_queue, "get_queryset",
+                          return_value=ResultLogBatch.objects.exclude(pk=older_batch.pk)):
+            with self.captureOnCommitCallbacks(execute=True) as callbacks:
+                self.assertEqual(result_log_queue.process_group(self.enrolled_machine.pk), 0)
+        self.assertEqual(len(callbacks), 1)
+        apply_async.assert_called_once_with((self.enrolled_machine.pk,), queue="osquery_result_logs", countdown=5)
+        self.assertEqual(ResultLogBatch.objects.count(), 2)
+
+    # sweep
+
+    @patch("zentral.contrib.osquery.tasks.process_result_log_batches_task.apply_async")
+    def test_sweep(self, apply_async):
+        batch = self._force_batch([self._build_inventory_record()])
+        batch.received_at = datetime.utcnow() - timedelta(minutes=10)
+        batch.save()
+        self._force_batch([self._build_inventory_record()])
+        self.assertEqual(sweep_result_log_queue_task(), {"scheduled": 1})
+        apply_async.assert_called_once_with((self.enrolled_machine.pk,), queue="osquery_result_logs", countdown=None)
+
+    @patch("zentral.contrib.osquery.tasks.process_result_log_batches_task.apply_async")
+    def test_sweep_empty_queue(self, apply_async):
+        self._force_batch([self._build_inventory_record()])
+        self.assertEqual(result_log_queue.sweep(), 0)
+        apply_async.assert_not_called()
+
+    # inventory snapshot dedup
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_inventory_snapshot_dedup(self, post_event):
+        for computer_name, uptime, commit_count in (("godzilla", 1, 1),
+                                                    ("godzilla", 2, 1),  # uptime ignored → skipped
+                                                    ("mothra", 3, 2)):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self._post_log([self._build_inventory_record(computer_name, uptime)])
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self._commit_count(), commit_count)
+        ms = MachineSnapshot.objects.current().get(serial_number=self.enrolled_machine.serial_number)
+        self.assertEqual(ms.system_info.computer_name, "mothra")
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_inventory_snapshot_dedup_last_seen_refreshed(self, post_event):
+        with self.captureOnCommitCallbacks(execute=True):
+            self._post_log([self._build_inventory_record()])
+        cms_qs = CurrentMachineSnapshot.objects.filter(serial_number=self.enrolled_machine.serial_number,
+                                                       source__module="zentral.contrib.osquery")
+        last_seen = datetime.utcnow() - timedelta(hours=1)
+        cms_qs.update(last_seen=last_seen)
+        with self.captureOnCommitCallbacks(execute=True):
+            self._post_log([self._build_inventory_record()])
+        self.assertEqual(self._commit_count(), 1)  # skipped
+        self.assertTrue(cms_qs.get().last_seen > last_seen)
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_inventory_snapshot_dedup_ttl(self, post_event):
+        with patch("zentral.contrib.osquery.result_logs.cache.set") as cache_set:
+            with self.captureOnCommitCallbacks(execute=True):
+                self._post_log([self._build_inventory_record()])
+        cache_key = f"osquery-iss_{self.enrolled_machine.node_key}"
+        ttls = [c.args[2] for c in cache_set.call_args_list if c.args[0] == cache_key]
+        # default 1d inventory interval, with a margin of half an interval
+        self.assertEqual(ttls, [129600])
+
+    @patch("zentral.core.queues.backends.kombu.EventQueues.post_event")
+    def test_inventory_snapshot_dedup_disabled(self, post_event):
+        with patch.object(inventory_snapshot_dedup, "max_skipped_snapshots", 0):
+            for _ in range(2):
+                with self.captureOnCommitCallbacks(execute=True):
+                    self._post_log([self._build_inventory_record()])
+        self.assertEqual(self._commit_count(), 2)
+
+    # config
+
+    @patch("zentral.contrib.osquery.result_logs.settings",
+           {"apps": {"zentral.contrib.osquery": {"inventory_snapshot_dedup": {"max_skipped_snapshots": 1000}}}})
+    def test_config_dedup_max_skipped_snapshots_clamped(self):
+        dedup = InventorySnapshotDedup()
+        self.assertEqual(dedup.max_skipped_snapshots, 24)
+        self.assertEqual(dedup.get_ttl(self.enrollment.configuration), 24.5 * 86400)
+
+    @patch("zentral.contrib.osquery.result_logs.settings",
+           {"apps": {"zentral.contrib.osquery": {"inventory_snapshot_dedup": {"max_skipped_snapshots": "yolo"}}}})
+    def test_config_invalid_dedup_max_skipped_snapshots(self):
+        with self.assertRaises(ImproperlyConfigured):
+            InventorySnapshotDedup()
+
+    @patch("zentral.utils.db_queues.settings",
+           {"apps": {"zentral.contrib.osquery": {"result_log_queue": {"enabled": True, "celery_queue": ""}}}})
+    def test_config_invalid_celery_queue(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ResultLogQueue()
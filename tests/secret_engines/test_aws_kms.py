@@ -0,0 +1,164 @@
+import json
+import os
+from unittest.mock import patch
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from django.test import SimpleTestCase
+from zentral.core.exceptions import ImproperlyConfigured
+from zentral.core.secret_engines import (decrypt, decrypt_str, encrypt, encrypt_str, rewrap,
+                                         secret_engines, DecryptionError)
+from zentral.core.secret_engines.backends.aws_kms import SecretEngine
+
+
+class LocalKMSClient:
+    """Local stand-in for the boto3 KMS client, with a random symmetric key"""
+
+    def __init__(self):
+        self._aesgcm = AESGCM(AESGCM.generate_key(bit_length=256))
+        self.encrypt_calls = 0
+        self.decrypt_calls = 0
+
+    @staticmethod
+    def _aad(key_id, encryption_context):
+        return json.dumps([key_id, encryption_context], sort_keys=True).encode("utf-8")
+
+    def encrypt(self, KeyId, Plaintext, EncryptionContext, EncryptionAlgorithm):
+        assert EncryptionAlgorithm == "SYMMETRIC_DEFAULT"
+        self.encrypt_calls += 1
+        nonce = os.urandom(12)
+        return {"KeyId": KeyId,
+                "CiphertextBlob": nonce + self._aesgcm.encrypt(nonce, Plaintext,
+                                                               self._aad(KeyId, EncryptionContext))}
+
+    def decrypt(self, KeyId, CiphertextBlob, EncryptionContext, EncryptionAlgorithm):
+        assert EncryptionAlgorithm == "SYMMETRIC_DEFAULT"
+        self.decrypt_calls += 1
+        return {"KeyId": KeyId,
+                "Plaintext": self._aesgcm.decrypt(CiphertextBlob[:12], CiphertextBlob[12:],
+                                                  self._aad(KeyId, EncryptionContext))}
+
+
+class AWSKMSSecretEngineTestCase(SimpleTestCase):
+    def setUp(self):
+        self.kms_client = LocalKMSClient()
+
+    def tearDown(self):
+        # default config
+        secret_engines.load_config({})
+
+    # utility methods
+
+    def _load_config(self, **kwargs):
+        secret_engines.load_config({
+            "aws": {"backend": "zentral.core.secret_engines.backends.aws_kms",
+                    "region_name": "us-east-1",
+                    "key_id": "yolo",
+                    **kwargs}
+        })
+        secret_engine = secret_engines.get("aws")
+        secret_engine.kms_client = self.kms_client
+        return secret_engine
+
+    # direct encryption
+
+    def test_direct_encrypt_decrypt(self):
+        self._load_config()
+        token = encrypt(b"le temps des cerises", yolo=1)
+        self.assertFalse(token.startswith("aws$e1."))
+        self.assertEqual(decrypt(token, yolo=1), b"le temps des cerises")
+        self.assertEqual(decrypt(token, yolo=1), b"le temps des cerises")
+        self.assertEqual(self.kms_client.encrypt_calls, 1)
+        self.assertEqual(self.kms_client.decrypt_calls, 2)
+
+    # envelope encryption
+
+    def test_envelope_encrypt_str_decrypt_str(self):
+        self._load_config(envelope_encryption=True)
+        token = encrypt_str("le temps des cerises", yolo=1)
+        self.assertTrue(token.startswith("aws$e1."))
+        self.assertEqual(decrypt_str(token, yolo=1), "le temps des cerises")
+
+    def test_envelope_data_key_reuse_and_cache(self):
+        self._load_config(envelope_encryption=True)
+        tokens = [encrypt_str(f"secret {i}", pk=i) for i in range(3)]
+        self.assertEqual(len(set(tokens)), 3)
+        self.assertEqual(self.kms_client.encrypt_calls, 1)
+        # cold start, same KMS key
+        self._load_config(envelope_encryption=True)
+        for _ in range(2):
+            for i, token in enumerate(tokens):
+                self.assertEqual(decrypt_str(token, pk=i), f"secret {i}")
+        self.assertEqual(self.kms_client.decrypt_calls, 1)
+
+    def test_envelope_context_mismatch(self):
+        self._load_config(envelope_encryption=True)
+        token = encrypt(b"le temps des cerises", yolo=1)
+        with self.assertRaises(DecryptionError):
+            decrypt(token, yolo=2)
+
+    def test_envelope_bad_structure(self):
+        self._load_config(envelope_encryption=True)
+        with self.assertRaises(DecryptionError):
+            decrypt("aws$e1.yolo", yolo=1)
+
+    @patch("zentral.core.secret_engines.backends.base.time.monotonic")
+    def test_envelope_data_key_ttl(self, monotonic):
+        monotonic.return_value = 0
+        self._load_config(envelope_encryption=True, data_key_ttl=60)
+        token1 = encrypt(b"un", pk=1)
+        monotonic.return_value = 61
+        token2 = encrypt(b"deux", pk=2)
+        self.assertEqual(self.kms_client.encrypt_calls, 2)
+        self.assertEqual(decrypt(token2, pk=2), b"deux")
+        self.assertEqual(self.kms_client.decrypt_calls, 0)
+        # expired data key
+        self.assertEqual(decrypt(token1, pk=1), b"un")
+        self.assertEqual(self.kms_client.decrypt_calls, 1)
+
+    @patch("zentral.core.secret_engines.backends.base.time.monotonic")
+    def test_envelope_data_key_cache_size(self, monotonic):
+        monotonic.return_value = 0
+        self._load_config(envelope_encryption=True, data_key_ttl=60, data_key_cache_size=1)
+        token1 = encrypt(b"un", pk=1)
+        monotonic.return_value = 61
+        token2 = encrypt(b"deux", pk=2)
+        # data key 2 cached, data key 1 evicted
+        for token, pk, data in ((token2, 2, b"deux"), (token1, 1, b"un"), (token2, 2, b"deux")):
+            self.assertEqual(decrypt(token, pk=pk), data)
+        self.assertEqual(self.kms_client.decrypt_calls, 2)
+
+    def test_envelope_no_data_key_reuse(self):
+        self._load_config(envelope_encryption=True, data_key_ttl=0)
+        token = encrypt(b"un", pk=1)
+        encrypt(b"deux", pk=2)
+        self.assertEqual(self.kms_client.encrypt_calls, 2)
+        decrypt(token, pk=1)
+        decrypt(token, pk=1)
+        self.assertEqual(self.kms_client.decrypt_calls, 2)
+
+    # rewrap
+
+    def test_rewrap_direct_to_envelope_and_back(self):
+        self._load_config()
+        token = encrypt(b"le temps des cerises", yolo=1)
+        self._load_config(envelope_encryption=True)
+        self.assertEqual(decrypt(token, yolo=1), b"le temps des cerises")
+        envelope_token = rewrap(token, yolo=1)
+        self.assertTrue(envelope_token.startswith("aws$e1."))
+        self.assertEqual(decrypt(envelope_token, yolo=1), b"le temps des cerises")
+        self._load_config()
+        direct_token = rewrap(envelope_token, yolo=1)
+        self.assertFalse(direct_token.startswith("aws$e1."))
+        self.assertEqual(decrypt(direct_token, yolo=1), b"le temps des cerises")
+
+    # config
+
+    def test_config_clamped(self):
+        secret_engine = SecretEngine({"secret_engine_name": "aws", "key_id": "yolo",
+                                      "data_key_ttl": 1000000, "data_key_cache_size": 0})
+        self.assertFalse(secret_engine.envelope_encryption)
+        self.assertEqual(secret_engine.data_key_ttl, 86400)
+        self.assertEqual(secret_engine.data_key_cache_size, 1)
+
+    def test_config_invalid_data_key_ttl(self):
+        with self.assertRaises(ImproperlyConfigured):
+            SecretEngine({"secret_engine_name": "aws", "key_id": "yolo", "data_key_ttl": "yolo"})
@@ -10,12 +10,12 @@ from rest_framework.views import APIView
 from zentral.core.events.base import EventRequest
 from zentral.utils.drf import (DefaultDjangoModelPermissions, DjangoPermissionRequired,
                                ListCreateAPIViewWithAudit, RetrieveUpdateDestroyAPIViewWithAudit)
+from .cache import machine_info_cache
 from .events import JMESPathCheckCreated, JMESPathCheckDeleted, JMESPathCheckUpdated
 from .forms import AndroidAppSearchForm, DebPackageSearchForm, IOSAppSearchForm, MacOSAppSearchForm, ProgramsSearchForm
 from .models import (CurrentMachineSnapshot,
                      JMESPathCheck,
                      MachineSnapshot,
-                     MachineTag,
                      MetaBusinessUnit,
                      Tag, Taxonomy)
 from .serializers import (CleanupInventorySerializer,
@@ -33,7 +33,7 @@ from .tasks import (cleanup_inventory,
                     export_machine_ios_apps,
                     export_machine_program_instances,
                     export_machine_snapshots)
-from .utils import MSQuery
+from .utils import MSQuery, update_machine_tags
 
 
 # Machine mass tagging
@@ -44,34 +44,6 @@ class UpdateMachineTags(APIView):
                            "inventory.add_machinetag", "inventory.delete_machinetag")
     permission_classes = [DjangoPermissionRequired]
 
-    def _prepare_taxonomies_and_tags(self):
-        self.tags_to_set = {}
-        self.tags_to_add = []
-        self.tags_to_remove = []
-        self.taxonomies_to_clear = []
-        for operation in self.data["operations"]:
-            kind = operation["kind"]
-            taxonomy_name = operation.get("taxonomy")
-            names = operation["names"]
-            taxonomy = None
-            if taxonomy_name and (kind == "ADD" or (kind == "SET" and names)):
-                taxonomy, _ = Taxonomy.objects.get_or_create(name=taxonomy_name)
-            if kind == "SET":
-                if names:
-                    self.tags_to_set.setdefault(taxonomy, []).extend(
-                        Tag.objects.get_or_create(taxonomy=taxonomy, name=name)[0]
-                        for name in names
-                    )
-                else:
-                    self.taxonomies_to_clear.append(taxonomy_name)
-            elif kind == "ADD":
-                self.tags_to_add.extend(
-                    Tag.objects.get_or_create(taxonomy=taxonomy, name=name)[0]
-                    for name in names
-                )
-            elif kind == "REMOVE":
-                self.tags_to_remove.extend(names)
-
     def _iter_serial_numbers(self):
         # serial numbers
         serial_numbers = self.data.get("serial_numbers")
@@ -101,46 +73,14 @@ class UpdateMachineTags(APIView):
         for t in cursor.fetchall():
             yield t[0]
 
-    def _update_machine_tags(self, serial_number):
-        total_removed = 0
-        total_added = 0
-        if self.taxonomies_to_clear:
-            removed, _ = MachineTag.objects.filter(serial_number=serial_number,
-                                                   tag__taxonomy__name__in=self.taxonomies_to_clear).delete()
-            total_removed += removed
-        for taxonomy, tags in self.tags_to_set.items():
-            removed, _ = (MachineTag.objects.filter(serial_number=serial_number,
-                                                    tag__taxonomy=taxonomy)
-                                            .exclude(tag__in=tags)).delete()
-            total_removed += removed
-            for tag in tags:
-                _, created = MachineTag.objects.get_or_create(serial_number=serial_number, tag=tag)
-                if created:
-                    total_added += 1
-        for tag in self.tags_to_add:
-            _, created = MachineTag.objects.get_or_create(serial_number=serial_number, tag=tag)
-            if created:
-                total_added += 1
-        if self.tags_to_remove:
-            removed, _ = MachineTag.objects.filter(serial_number=serial_number,
-                                                   tag__name__in=self.tags_to_remove).delete()
-            total_removed += removed
-        return total_removed, total_added
-
     def post(self, request, *args, **kwargs):
         serializer = MachineTagsUpdateSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         self.data = serializer.data
-        self._prepare_taxonomies_and_tags()
-        found_machines = 0
-        total_removed = 0
-        total_added = 0
-        for serial_number in self._iter_serial_numbers():
-            found_machines += 1
-            removed, added = self._update_machine_tags(serial_number)
-            total_removed += removed
-            total_added += added
-        return Response({"machines": {"found": found_machines},
+        serial_numbers = set(self._iter_serial_numbers())
+        total_removed, total_added = update_machine_tags(serial_numbers, self.data["operations"],
+                                                         EventRequest.build_from_request(request))
+        return Response({"machines": {"found": len(serial_numbers)},
                          "tags": {"added": total_added,
                                   "removed": total_removed}})
 
@@ -155,7 +95,10 @@ class ArchiveMachines(APIView):
     def post(self, request, *args, **kwargs):
         serializer = MachineSerialNumbersSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        count, _ = CurrentMachineSnapshot.objects.filter(serial_number__in=serializer.data["serial_numbers"]).delete()
+        serial_numbers = serializer.data["serial_numbers"]
+        count, _ = CurrentMachineSnapshot.objects.filter(serial_number__in=serial_numbers).delete()
+        # no signals for the current machine snapshots
+        machine_info_cache.bump_machines(serial_numbers)
         return Response({"current_machine_snapshots": count})
 
 
@@ -166,7 +109,10 @@ class PruneMachines(APIView):
     def post(self, request, *args, **kwargs):
         serializer = MachineSerialNumbersSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
-        _, result = MachineSnapshot.objects.filter(serial_number__in=serializer.data["serial_numbers"]).delete()
+        serial_numbers = serializer.data["serial_numbers"]
+        _, result = MachineSnapshot.objects.filter(serial_number__in=serial_numbers).delete()
+        # no signals for the current machine snapshots
+        machine_info_cache.bump_machines(serial_numbers)
         response = {}
         for model_name, response_attr in (("CurrentMachineSnapshot", "current_machine_snapshots"),
                                           ("MachineSnapshotCommit", "machine_snapshot_commits"),
@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import copy
+import logging
+import threading
+import urllib.parse
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+from prometheus_client import Counter
+from zentral.conf import settings
+from zentral.core.exceptions import ImproperlyConfigured
+
+
+logger = logging.getLogger("zentral.contrib.inventory.cache")
+
+
+machine_info_cache_requests = Counter(
+    "zentral_inventory_machine_info_cache_requests",
+    "Inventory machine info cache requests",
+    ["info", "result"]
+)
+
+
+class MachineInfoCache:
+    """Versioned cache for the machine information
+
+    The cache keys include a global version and a per-machine version.
+    The per-machine version is bumped when the current machine snapshots, the machine tags
+    or the machine incidents change.
+    The global version is bumped when the meta business units, the business units or the tags change.
+    A bounded in-process LRU is used in front of the Django cache. Only the versions are read from the
+    Django cache when the L1 has a value.
+    """
+    global_version_key = "mm-gv"
+    default_ttl = 86400
+    default_l1_max_size = 1000
+
+    def __init__(self):
+        options = settings["apps"]["zentral.contrib.inventory"].get("machine_info_cache", {})
+        try:
+            # cache ttl in seconds. 1d by default (min 1 min, max 30d)
+            self.ttl = min(max(60, int(options.get("ttl", self.default_ttl))), 2592000)
+            # max number of entries in the in-process cache. 1000 by default (min 0 → disabled, max 1000000)
+            self.l1_max_size = min(max(0, int(options.get("l1_max_size", self.default_l1_max_size))), 1000000)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Inventory machine info cache TTL and L1 max size must be integers")
+        self._l1 = OrderedDict()
+        self._lock = threading.Lock()
+
+    # versions
+
+    @staticmethod
+    def _machine_version_key(serial_number):
+        return "mm-v_{}".format(urllib.parse.quote(serial_number, safe=""))
+
+    @staticmethod
+    def _new_version():
+        return uuid.uuid4().hex
+
+    def get_version_keys(self, serial_number):
+        """Return the cache keys of the versions, to be read with other keys in a single round trip"""
+        return self.global_version_key, self._machine_version_key(serial_number)
+
+    def get_versions(self, serial_number, versions=None):
+        global_version_key, machine_version_key = self.get_version_keys(serial_number)
+        if versions is None:
+            versions = cache.get_many([global_version_key, machine_version_key])
+        global_version = versions.get(global_version_key)
+        if global_version is None:
+            cache.add(self.global_version_key, self._new_version(), None)
+            global_version = cache.get(self.global_version_key)
+        machine_version = versions.get(machine_version_key)
+        if machine_version is None:
+            # new random version, so that values cached with an evicted version are never used
+            cache.add(machine_version_key, self._new_version(), self.ttl)
+            machine_version = cache.get(machine_version_key)
+        return global_version, machine_version
+
+    def _bump_machines(self, serial_numbers):
+        cache.set_many({self._machine_version_key(serial_number): self._new_version()
+                        for serial_number in serial_numbers},
+                       self.ttl)
+
+    def bump_machines(self, serial_numbers):
+        """Invalidate the cached info of the machines, in one round trip
+
+        The versions are bumped again once the transaction is committed, in case a concurrent request
+        has cached the previous machine info in the meantime.
+        """
+        serial_numbers = set(serial_numbers)
+        if serial_numbers:
+            self._bump_machines(serial_numbers)
+            transaction.on_commit(lambda: self._bump_machines(serial_numbers))
+
+    def _bump_all(self):
+        cache.set(self.global_version_key, self._new_version(), None)
+
+    def bump_all(self):
+        """Invalidate the cached info of all the machines
+
+        The global version is bumped again once the transaction is committed.
+        """
+        self._bump_all()
+        transaction.on_commit(self._bump_all)
+
+    # values
+
+    def _l1_get(self, key):
+        with self._lock:
+            try:
+                value = self._l1[key]
+            except KeyError:
+                return
+            self._l1.move_to_end(key)
+            return value
+
+    def _l1_set(self, key, value):
+        if self.l1_max_size < 1:
+            return
+        with self._lock:
+            self._l1[key] = value
+            self._l1.move_to_end(key)
+            while len(self._l1) > self.l1_max_size:
+                self._l1.popitem(last=False)
+
+    def get(self, info, serial_number, build_value):
+        global_version, machine_version = self.get_versions(serial_number)
+        key = "mm-{}_{}_{}_{}".format(info, urllib.parse.quote(serial_number, safe=""),
+                                      global_version, machine_version)
+        value = self._l1_get(key)
+        if value is not None:
+            machine_info_cache_requests.labels(info, "l1_hit").inc()
+            # the L1 values are shared
+            return copy.deepcopy(value)
+        value = cache.get(key)
+        if value is None:
+            machine_info_cache_requests.labels(info, "miss").inc()
+            value = build_value()
+            cache.set(key, value, self.ttl)
+        else:
+            machine_info_cache_requests.labels(info, "hit").inc()
+        self._l1_set(key, copy.deepcopy(value))
+        return value
+
+
+machine_info_cache = SimpleLazyObject(lambda: MachineInfoCache())
@@ -1,5 +1,10 @@
+from concurrent.futures import ThreadPoolExecutor
 import copy
+import hashlib
+import json
 import logging
+import time
+from zentral.contrib.inventory.cache import machine_info_cache
 from zentral.contrib.inventory.models import CurrentMachineSnapshot
 from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
 
@@ -14,25 +19,68 @@ class InventoryError(Exception):
 
 class BaseInventory(object):
     source_config_secret_attributes = None
+    # config attributes used to run the client, not part of the inventory source
+    worker_config_attributes = ('max_workers', 'min_sleep', 'max_sleep', 'full_sync_interval')
+    default_max_workers = 4
+    default_min_sleep = 30
+    default_max_sleep = 300
+    default_full_sync_interval = 86400
 
     def __init__(self, config_d):
         if not hasattr(self, 'name'):
             self.name = self.__module__.split('.')[-1]
+        self.max_workers = config_d.get('max_workers', self.default_max_workers)
+        self.min_sleep = config_d.get('min_sleep', self.default_min_sleep)
+        self.max_sleep = max(self.min_sleep, config_d.get('max_sleep', self.default_max_sleep))
+        self.full_sync_interval = config_d.get('full_sync_interval', self.default_full_sync_interval)
         config_d = {k: v for k, v in config_d.items()
                     if (k != "backend" and
+                        k not in self.worker_config_attributes and
                         (not self.source_config_secret_attributes or
                          k not in self.source_config_secret_attributes))}
         self.source = {'module': self.__module__,
                        'name': self.name,
                        'config': config_d}
+        # change detection
+        self._tree_hashes = {}
+        self._last_full_sync = None
+        self._inventory_source = None
 
     def get_machines(self):
         raise NotImplementedError
 
+    def iter_concurrently(self, func, iterable):
+        """Yield func(item) for each item, in order, using a bounded thread pool
+
+        Used by the clients to fetch the per-machine data in parallel.
+        """
+        if self.max_workers < 2:
+            yield from map(func, iterable)
+        else:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                yield from executor.map(func, iterable)
+
+    @staticmethod
+    def _hash_machine_d(machine_d):
+        return hashlib.sha1(json.dumps(machine_d, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
     # inventory API
     def sync(self):
+        """Commit the changed machine snapshots, remove the missing ones
+
+        Only the trees with a last_seen value can be skipped when they have not changed since the last sync.
+        Without a last_seen value, the trees are always committed, to refresh the machine last seen time.
+        All the trees are committed at least once per full_sync_interval.
+
+        Returns a dict with the number of machines per result.
+        """
+        stats = {"committed": 0, "unchanged": 0, "error": 0, "removed": 0}
+        now = time.monotonic()
+        if self._last_full_sync is None or now - self._last_full_sync >= self.full_sync_interval:
+            self._tree_hashes = {}
+            self._last_full_sync = now
+        tree_hashes = {}
         seen_machines = []
-        inventory_source = None
         for machine_d in self.get_machines():
             source = copy.deepcopy(self.source)
             try:
@@ -46,6 +94,14 @@ class BaseInventory(object):
                                self.name, machine_d.get('reference', 'Unknown'))
                 continue
             seen_machines.append(serial_number)
+            # change detection
+            tree_hash = None
+            if machine_d.get('last_seen'):
+                tree_hash = self._hash_machine_d(machine_d)
+                if self._tree_hashes.get(serial_number) == tree_hash:
+                    tree_hashes[serial_number] = tree_hash
+                    stats["unchanged"] += 1
+                    continue
             # source will be modified by mto
             machine_d['source'] = source
             for group_d in machine_d.get('groups', []):
@@ -55,9 +111,20 @@ class BaseInventory(object):
                 business_unit_d['source'] = source
             # save all
             ms = commit_machine_snapshot_and_trigger_events(machine_d)
-            if inventory_source is None and ms:
-                inventory_source = ms.source
-        if seen_machines and inventory_source:
-            (CurrentMachineSnapshot.objects.filter(source=inventory_source)
-                                           .exclude(serial_number__in=seen_machines)
-                                           .delete())
+            if ms:
+                stats["committed"] += 1
+                if tree_hash:
+                    tree_hashes[serial_number] = tree_hash
+                if self._inventory_source is None:
+                    self._inventory_source = ms.source
+            else:
+                stats["error"] += 1
+        self._tree_hashes = tree_hashes
+        if seen_machines and self._inventory_source:
+            removed_qs = (CurrentMachineSnapshot.objects.filter(source=self._inventory_source)
+                                                        .exclude(serial_number__in=seen_machines))
+            removed_serial_numbers = list(removed_qs.values_list("serial_number", flat=True))
+            stats["removed"], _ = removed_qs.delete()
+            # no signals for the current machine snapshots
+            machine_info_cache.bump_machines(removed_serial_numbers)
+        return stats
@@ -101,7 +101,8 @@ class InventoryClient(BaseInventory):
                                      'authorization': self.api_key})
         max_retries = Retry(total=3, backoff_factor=1, status_forcelist=[500, 502, 503, 504])
         self.session.mount(self.base_api_url,
-                           requests.adapters.HTTPAdapter(max_retries=max_retries))
+                           requests.adapters.HTTPAdapter(max_retries=max_retries,
+                                                         pool_maxsize=max(10, self.max_workers)))
 
     def get_machine_query(self):
         r = self.session.get("{}/query/".format(self.base_api_url))
@@ -148,8 +149,26 @@ class InventoryClient(BaseInventory):
         r.raise_for_status()
         return values
 
+    def get_osx_app_instances(self, serial_number):
+        osx_app_instances = []
+        for at in self.execute_machine_apps_query(serial_number):
+            aresult = dict(zip(self.MACHINE_APPS_FIELDS, at))
+            app = {"bundle_name": aresult["name"]}
+            if aresult["product_id"]:
+                app["bundle_id"] = aresult["product_id"]
+            if aresult["short_version"]:
+                app["bundle_version_str"] = aresult["short_version"]
+                if aresult["version"]:
+                    app["bundle_version"] = aresult["version"]
+            elif aresult["version"]:
+                app["bundle_version_str"] = aresult["version"]
+            osx_app_instances.append({"bundle_path": aresult["path"],
+                                      "app": app})
+        return osx_app_instances
+
     def get_machines(self):
         trees = {}
+        osx_serial_numbers = []
         for machine_tuple in self.execute_machine_query():
             result = dict(zip(self.MACHINE_FIELDS, machine_tuple))
             serial_number = result["serial_number"]
@@ -180,22 +199,7 @@ class InventoryClient(BaseInventory):
                 if system_info:
                     tree["system_info"] = system_info
                 if result["os_type"] == "OSX":
-                    osx_app_instances = []
-                    for at in self.execute_machine_apps_query(serial_number):
-                        aresult = dict(zip(self.MACHINE_APPS_FIELDS, at))
-                        app = {"bundle_name": aresult["name"]}
-                        if aresult["product_id"]:
-                            app["bundle_id"] = aresult["product_id"]
-                        if aresult["short_version"]:
-                            app["bundle_version_str"] = aresult["short_version"]
-                            if aresult["version"]:
-                                app["bundle_version"] = aresult["version"]
-                        elif aresult["version"]:
-                            app["bundle_version_str"] = aresult["version"]
-                        osx_app_instances.append({"bundle_path": aresult["path"],
-                                                  "app": app})
-                    if osx_app_instances:
-                        tree["osx_app_instances"] = osx_app_instances
+                    osx_serial_numbers.append(serial_number)
                 trees[serial_number] = tree
             else:
                 tree = trees[serial_number]
@@ -215,4 +219,11 @@ class InventoryClient(BaseInventory):
                 if not last_seen or last_seen < last_check_in:
                     tree['last_seen'] = last_check_in
 
+        # apps, fetched in parallel
+        for serial_number, osx_app_instances in zip(osx_serial_numbers,
+                                                    self.iter_concurrently(self.get_osx_app_instances,
+                                                                           osx_serial_numbers)):
+            if osx_app_instances:
+                trees[serial_number]["osx_app_instances"] = osx_app_instances
+
         yield from trees.values()
@@ -47,6 +47,16 @@ class InventoryClient(BaseInventory):
                  "url": "{}/dashboard/{}/".format(self.base_url, bu_id)}]
 
     def get_machines(self):
+        # the groups and business units are shared between the machines
+        objects = {}
+
+        def get_object(path):
+            try:
+                return objects[path]
+            except KeyError:
+                obj = objects[path] = self._make_get_query(path)
+                return obj
+
         for sal_machine in self._make_get_query('/machines/'):
             machine_id = sal_machine['serial']  # serial number == machine_id in this client
             ct = {'reference': machine_id,
@@ -56,12 +66,12 @@ class InventoryClient(BaseInventory):
             # groups
             sal_group_id = sal_machine.get('machine_group', None)
             if sal_group_id:
-                sal_group = self._make_get_query('/machine_groups/{}/'.format(sal_group_id))
+                sal_group = get_object('/machine_groups/{}/'.format(sal_group_id))
                 ct['groups'] = [{'reference': str(sal_group_id),
                                  'name': sal_group['name'],
                                  'links': self._group_links_from_id(sal_group_id)}]
                 business_unit_id = int(sal_group['business_unit'])
-                business_unit = self._make_get_query('/business_units/{}/'.format(business_unit_id))
+                business_unit = get_object('/business_units/{}/'.format(business_unit_id))
                 ct['business_unit'] = {'reference': str(business_unit_id),
                                        'name': business_unit['name'],
                                        'links': self._bu_links_from_id(business_unit_id)}
@@ -1,12 +1,16 @@
+from collections import OrderedDict
 import logging
 import threading
 import time
 from django.utils.functional import cached_property, SimpleLazyObject
 import jmespath
+from zentral.conf import settings
 from zentral.core.compliance_checks import register_compliance_check_class
 from zentral.core.compliance_checks.compliance_checks import BaseComplianceCheck
 from zentral.core.compliance_checks.models import Status
-from zentral.core.compliance_checks.utils import update_machine_statuses
+from zentral.core.compliance_checks.utils import refresh_machine_status_times, update_machine_statuses
+from zentral.core.exceptions import ImproperlyConfigured
+from .cache import machine_info_cache
 from .events import JMESPathCheckStatusUpdated
 from .models import JMESPathCheck, MachineTag
 
@@ -50,14 +54,26 @@ register_compliance_check_class(InventoryJMESPathCheck)
 
 
 class JMESPathChecksCache:
-    # TODO: hard coded ttl
-    ttl = 300  # cache ttl in seconds
+    default_ttl = 300
+    default_max_machine_results = 10000
 
     def __init__(self):
+        options = settings["apps"]["zentral.contrib.inventory"].get("jmespath_checks_cache", {})
+        try:
+            # checks cache ttl in seconds. 5 min by default (min 0 → no cache, max 1d)
+            self.ttl = min(max(0, int(options.get("ttl", self.default_ttl))), 86400)
+            # max number of machine results to keep in memory. 10000 by default (min 0 → disabled, max 1000000)
+            self.max_machine_results = min(max(0, int(options.get("max_machine_results",
+                                                                  self.default_max_machine_results))),
+                                           1000000)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Inventory JMESPath checks cache TTL and max machine results must be integers")
         self._source_platform_checks = {}
         self._checks = {}
         self._last_fetched_time = None
         self._lock = threading.Lock()
+        # (serial number, source name, platform) → (mt_hash, {(cc pk, cc version): status})
+        self._machine_results = OrderedDict()
 
     def _load(self):
         if self._last_fetched_time is not None and (time.monotonic() - self._last_fetched_time) < self.ttl:
@@ -82,7 +98,35 @@ class JMESPathChecksCache:
             self._load()
             return self._source_platform_checks.get((source_name.lower(), platform), [])
 
-    def process_tree(self, tree, last_seen):
+    def _get_machine_results(self, key, mt_hash):
+        if mt_hash is None:
+            return {}
+        with self._lock:
+            try:
+                results_mt_hash, results = self._machine_results[key]
+            except KeyError:
+                return {}
+            self._machine_results.move_to_end(key)
+        if results_mt_hash != mt_hash:
+            # the results for a different snapshot cannot be reused
+            return {}
+        return results
+
+    def _set_machine_results(self, key, mt_hash, results):
+        if mt_hash is None or not self.max_machine_results:
+            return
+        with self._lock:
+            self._machine_results[key] = (mt_hash, results)
+            self._machine_results.move_to_end(key)
+            while len(self._machine_results) > self.max_machine_results:
+                self._machine_results.popitem(last=False)
+
+    def process_tree(self, tree, last_seen, mt_hash=None):
+        """Evaluate the JMESPath checks for a machine snapshot tree, and yield the status update events
+
+        If the machine snapshot mt_hash is given, the results are memoized for the checks versions.
+        If the statuses are the same as the last ones, only their status times are refreshed, without events.
+        """
         machine_tag_set = None
         compliance_check_statuses = []
         serial_number = tree["serial_number"]
@@ -91,37 +135,54 @@ class JMESPathChecksCache:
         if not platform:
             logger.warning("Cannot process %s %s tree: missing platform", source_name, serial_number)
             return
+        machine_key = (serial_number, source_name.lower(), platform)
+        previous_results = self._get_machine_results(machine_key, mt_hash)
+        results = {}
         for check_tag_set, jmespath_parsed_expr, jmespath_check in self._get_source_platform_checks(
             source_name,
             platform
         ):
             if check_tag_set:
                 if machine_tag_set is None:
-                    # TODO cache?
-                    machine_tag_set = set(
-                        MachineTag.objects.filter(serial_number=serial_number).values_list("tag_id", flat=True)
+                    machine_tag_set = machine_info_cache.get(
+                        "mt", serial_number,
+                        lambda: frozenset(
+                            MachineTag.objects.filter(serial_number=serial_number).values_list("tag_id", flat=True)
+                        )
                     )
                 if not check_tag_set.intersection(machine_tag_set):
                     # tags mismatch
                     continue
-            # default to unknown status
-            status = Status.UNKNOWN
-            try:
-                result = jmespath_parsed_expr.search(tree)
-            except Exception:
-                logger.exception("Could not evaluate JMESPath check %s source name %s serial number %s",
-                                 jmespath_check.pk, source_name, serial_number)
-            else:
-                if result is True:
-                    status = Status.OK
-                elif result is False:
-                    status = Status.FAILED
+            compliance_check = jmespath_check.compliance_check
+            result_key = (compliance_check.pk, compliance_check.version)
+            status = previous_results.get(result_key)
+            if status is None:
+                # default to unknown status
+                status = Status.UNKNOWN
+                try:
+                    result = jmespath_parsed_expr.search(tree)
+                except Exception:
+                    logger.exception("Could not evaluate JMESPath check %s source name %s serial number %s",
+                                     jmespath_check.pk, source_name, serial_number)
                 else:
-                    logger.warning("JMESPath check %s result is not a boolean", jmespath_check.pk)
-            compliance_check_statuses.append((jmespath_check.compliance_check, status, last_seen))
+                    if result is True:
+                        status = Status.OK
+                    elif result is False:
+                        status = Status.FAILED
+                    else:
+                        logger.warning("JMESPath check %s result is not a boolean", jmespath_check.pk)
+            results[result_key] = status
+            compliance_check_statuses.append((compliance_check, status, last_seen))
         if not compliance_check_statuses:
             # nothing to update, no events
             return
+        if results == previous_results:
+            # same snapshot, same checks versions, same statuses → only the status times to refresh, no events
+            refreshed = refresh_machine_status_times(serial_number, compliance_check_statuses)
+            if refreshed == len(compliance_check_statuses):
+                return
+            # the stored statuses have been updated elsewhere
+        self._set_machine_results(machine_key, mt_hash, results)
         status_updates = update_machine_statuses(serial_number, compliance_check_statuses)
         for compliance_check_pk, status_value, previous_status_value in status_updates:
             if status_value == previous_status_value:
@@ -73,6 +73,31 @@ def iter_inventory_events(msn, events):
         yield event_cls(metadata, data)
 
 
+# machine tags
+
+
+class MachineTagsUpdated(BaseEvent):
+    event_type = "machine_tags_updated"
+    namespace = "inventory"
+    tags = ["machine", "machine_tag"]
+
+
+register_event_type(MachineTagsUpdated)
+
+
+def post_machine_tags_updated_events(operations, machine_changes, event_request=None, batch_size=1000):
+    """Post the machine tag changes, in batches of machines"""
+    event_uuid = uuid.uuid4()
+    serial_numbers = sorted(machine_changes.keys())
+    for index, offset in enumerate(range(0, len(serial_numbers), batch_size)):
+        metadata = EventMetadata(uuid=event_uuid, index=index, request=event_request)
+        payload = {"operations": operations,
+                   "machines": [dict(serial_number=serial_number, **machine_changes[serial_number])
+                                for serial_number in serial_numbers[offset:offset + batch_size]]}
+        event = MachineTagsUpdated(metadata, payload)
+        event.post()
+
+
 # enrollment secret
 
 
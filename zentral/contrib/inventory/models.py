@@ -8,12 +8,13 @@ import urllib.parse
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.postgres.fields import ArrayField
-from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.urls import reverse
 from django.core.validators import MaxValueValidator, MinValueValidator
 from django.db import connection, IntegrityError, models, transaction
 from django.db.models import Count, F, Q, Max
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.utils.functional import cached_property
@@ -26,6 +27,7 @@ from zentral.core.incidents.models import MachineIncident, Status
 from zentral.utils.model_extras import find_all_related_objects
 from zentral.utils.mt_models import (prepare_commit_tree,
                                      AbstractMTObject, MTObjectManager, MTOError)
+from .cache import machine_info_cache
 from .conf import (has_deb_packages,
                    os_version_display, os_version_version_display,
                    update_ms_tree_platform, update_ms_tree_type,
@@ -705,6 +707,8 @@ class MachineSnapshotCommitManager(models.Manager):
                                                                 source=source,
                                                                 defaults={'machine_snapshot': machine_snapshot,
                                                                           'last_seen': last_seen})
+                if new_version and (new_parent is None or new_parent.machine_snapshot != machine_snapshot):
+                    machine_info_cache.bump_machines([serial_number])
                 return new_msc, machine_snapshot, last_seen
         except IntegrityError:
             msc = MachineSnapshotCommit.objects.get(serial_number=serial_number,
@@ -923,6 +927,30 @@ class MetaBusinessUnitTag(models.Model):
     tag = models.ForeignKey(Tag, on_delete=models.CASCADE)
 
 
+@receiver(post_delete, sender=MachineTag)
+@receiver(post_save, sender=MachineTag)
+def machine_tag_change_receiver(sender, instance, **kwargs):
+    machine_info_cache.bump_machines([instance.serial_number])
+
+
+@receiver(post_delete, sender=MachineIncident)
+@receiver(post_save, sender=MachineIncident)
+def machine_incident_change_receiver(sender, instance, **kwargs):
+    machine_info_cache.bump_machines([instance.serial_number])
+
+
+@receiver(post_delete, sender=BusinessUnit)
+@receiver(post_save, sender=BusinessUnit)
+@receiver(post_delete, sender=MetaBusinessUnit)
+@receiver(post_save, sender=MetaBusinessUnit)
+@receiver(post_delete, sender=MetaBusinessUnitTag)
+@receiver(post_save, sender=MetaBusinessUnitTag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Tag)
+def machine_info_change_receiver(sender, **kwargs):
+    machine_info_cache.bump_all()
+
+
 class MetaMachine:
     """Simplified access to the ms."""
     def __init__(self, serial_number, snapshots=None):
@@ -1140,6 +1168,7 @@ class MetaMachine:
 
     def archive(self):
         CurrentMachineSnapshot.objects.filter(serial_number=self.serial_number).delete()
+        machine_info_cache.bump_machines([self.serial_number])
 
     def has_recent_source_snapshot(self, source_module, max_age=3600):
         query = (
@@ -1283,12 +1312,7 @@ class MetaMachine:
     @cached_property
     def cached_probe_filtering_values(self):
         """Cached version of get_probe_filtering_values"""
-        cache_key = "mm-probe-fvs_{}".format(self.get_urlsafe_serial_number())
-        filtering_values = cache.get(cache_key)
-        if filtering_values is None:
-            filtering_values = self.get_probe_filtering_values()
-            cache.set(cache_key, filtering_values, 60)  # TODO: Hard coded timeout value
-        return filtering_values
+        return machine_info_cache.get("probe-fvs", self.serial_number, self.get_probe_filtering_values)
 
     def get_legacy_serialized_info_for_event(self):
         """Serialize the machine information to be included in the events.
@@ -1362,12 +1386,7 @@ class MetaMachine:
     @cached_property
     def cached_serialized_info_for_event(self):
         """Cached version of get_serialized_info_for_event"""
-        cache_key = "mm-si_{}".format(self.get_urlsafe_serial_number())
-        serialized_info = cache.get(cache_key)
-        if serialized_info is None:
-            serialized_info = self.get_serialized_info_for_event()
-            cache.set(cache_key, serialized_info, 60)  # TODO: Hard coded timeout value
-        return serialized_info
+        return machine_info_cache.get("si", self.serial_number, self.get_serialized_info_for_event)
 
 
 class MACAddressBlockAssignmentOrganization(models.Model):
@@ -1,8 +1,9 @@
 from collections import OrderedDict
 import csv
 from datetime import datetime, timedelta
+import io
 import ipaddress
-from itertools import chain
+from itertools import chain, groupby
 import json
 import logging
 import os
@@ -18,18 +19,20 @@ from django.db import connection, transaction
 from django.http import QueryDict
 from django.urls import reverse
 from django.utils.text import slugify
+import psycopg2.extras
 import weakref
 import xlsxwriter
 from zentral.core.compliance_checks.models import ComplianceCheck, Status as ComplianceCheckStatus
 from zentral.core.incidents.models import Severity, Status
 from zentral.utils.json import save_dead_letter
 from zentral.utils.text import decode_args, encode_args
+from .cache import machine_info_cache
 from .compliance_checks import jmespath_checks_cache
 from .conf import EC2, os_version_display, os_version_version_display
 from .events import (post_enrollment_secret_verification_failure, post_enrollment_secret_verification_success,
-                     iter_inventory_events)
+                     iter_inventory_events, post_machine_tags_updated_events)
 from .exceptions import EnrollmentSecretVerificationFailed
-from .models import EnrollmentSecret, MachineSnapshotCommit, MetaMachine
+from .models import EnrollmentSecret, MachineSnapshotCommit, MetaMachine, Tag, Taxonomy
 
 logger = logging.getLogger("zentral.contrib.inventory.utils")
 
@@ -1773,24 +1776,98 @@ class MSQuery:
         ).format(query, limit_offset)
         return meta_query, args
 
-    def _make_fetching_query(self, paginate=True):
+    def _make_fetching_query(self, paginate=True, server_side_cursor=False):
         query, args = self._build_fetching_query_with_args(paginate)
-        cursor = connection.cursor()
-        cursor.execute(query, args)
-        columns = [col[0] for col in cursor.description]
-        for rows in iter(lambda: cursor.fetchmany(self.itersize), connection.features.empty_fetchmany_value):
-            for row in rows:
-                yield dict(zip(columns, row))
-
-    def fetch(self, paginate=True, for_filtering=False):
-        for record in self._make_fetching_query(paginate):
+        if paginate or not server_side_cursor:
+            cursor = connection.cursor()
+            cursor.execute(query, args)
+            columns = [col[0] for col in cursor.description]
+            for rows in iter(lambda: cursor.fetchmany(self.itersize), connection.features.empty_fetchmany_value):
+                for row in rows:
+                    yield dict(zip(columns, row))
+        else:
+            # unbounded result set → iter all rows over a server-side cursor.
+            # the transaction stays open until the last row is consumed.
+            with transaction.atomic(), connection.chunked_cursor() as cursor:
+                cursor.itersize = self.itersize
+                cursor.execute(query, args)
+                columns = None
+                for row in cursor:
+                    if columns is None:
+                        columns = [col[0] for col in cursor.description]
+                    yield dict(zip(columns, row))
+
+    def fetch(self, paginate=True, for_filtering=False, server_side_cursor=False):
+        """Yield the serial numbers and machine snapshots
+
+        With paginate=False and server_side_cursor=True, the rows are read over a server-side cursor,
+        in a transaction kept open until the generator is exhausted. Only for the exports, that do not
+        do any network I/O while iterating.
+        """
+        for record in self._make_fetching_query(paginate, server_side_cursor):
             for machine_snapshot in record["machine_snapshots"]:
                 for f in self.filters:
                     f.process_fetched_record(machine_snapshot, for_filtering)
             yield record["serial_number"], record["machine_snapshots"]
 
     # export
+
+    def _iter_machine_export_rows(self, serial_number, machine_snapshots,
+                                  include_max_incident_severity, include_max_compliance_check_status):
+        for machine_snapshot in machine_snapshots:
+            system_info = machine_snapshot.get("system_info", {})
+            meta_business_unit = machine_snapshot.get("meta_business_unit", {})
+            row = [
+                machine_snapshot["source"]["id"],
+                machine_snapshot["source"].get("display_name") or "",
+                serial_number,
+                meta_business_unit.get("id") or "",
+                meta_business_unit.get("name") or "",
+                machine_snapshot.get("type") or "",
+                machine_snapshot.get("platform") or "",
+                system_info.get("computer_name") or "",
+                system_info.get("hardware_model") or ""
+            ]
+            os_version = machine_snapshot.get("os_version")
+            if os_version:
+                os_version_dn = os_version.get("display_name") or ""
+            else:
+                os_version_dn = ""
+            row.append(os_version_dn)
+            principal_user = machine_snapshot.get("principal_user")
+            if principal_user:
+                pu_pn = principal_user.get("principal_name") or ""
+                pu_dn = principal_user.get("display_name") or ""
+            else:
+                pu_pn = pu_dn = ""
+            row.extend([pu_pn, pu_dn])
+            row.append(
+                "|".join(dn for dn in (t.get("display_name") for t in machine_snapshot.get("tags", [])) if dn)
+            )
+            row.append(machine_snapshot.get("last_seen"))
+            if include_max_incident_severity:
+                mis = machine_snapshot.get("max_incident_severity", {})
+                row.extend([mis.get("value") or "", mis.get("keyword") or ""])
+            if include_max_compliance_check_status:
+                mccs = machine_snapshot.get("max_compliance_check_status", {})
+                row.extend([mccs.get("value"), mccs.get("keyword") or ""])
+            for app_versions in machine_snapshot.get("osx_apps", {}).values():
+                if app_versions:
+                    min_app_version = app_versions[0]["display_name"]
+                    max_app_version = app_versions[-1]["display_name"]
+                else:
+                    min_app_version = max_app_version = ""
+                row.extend([min_app_version, max_app_version])
+            for cc_status in machine_snapshot.get("compliance_checks", {}).values():
+                row.extend([cc_status["value"], cc_status["keyword"]])
+            yield row
+
     def export_sheets_data(self):
+        """Yield (title, headers, rows) for each sheet
+
+        The rows of the machines sheet are a generator over a server-side cursor.
+        They must be consumed before the next sheet is requested.
+        """
         title = "Machines"
         headers = [
             "Source ID", "Source",
@@ -1806,71 +1883,32 @@ class MSQuery:
             "Tags",
             "Last seen"
         ]
-        row_idx = 0
-        rows = []
+        records = self.fetch(paginate=False, server_side_cursor=True)
+        first_record = next(records, None)
         include_max_incident_severity = include_max_compliance_check_status = False
-        for serial_number, machine_snapshots in self.fetch(paginate=False):
-            for machine_snapshot in machine_snapshots:
-                if row_idx == 0:
-                    if "max_incident_severity" in machine_snapshot:
-                        include_max_incident_severity = True
-                        headers.extend(["Max incident severity", "Max incident severity display"])
-                    if "max_compliance_check_status" in machine_snapshot:
-                        include_max_compliance_check_status = True
-                        headers.extend(["Max compliance check status", "Max compliance check status display"])
-                    for app_title in machine_snapshot.get("osx_apps", {}):
-                        for suffix in ("min", "max"):
-                            headers.append("{} {}".format(app_title, suffix))
-                    for compliance_check_name in machine_snapshot.get("compliance_checks", {}):
-                        for suffix in ("- status", "- status display"):
-                            headers.append(f"{compliance_check_name} {suffix}")
-                row_idx += 1
-                system_info = machine_snapshot.get("system_info", {})
-                meta_business_unit = machine_snapshot.get("meta_business_unit", {})
-                row = [
-                    machine_snapshot["source"]["id"],
-                    machine_snapshot["source"].get("display_name") or "",
-                    serial_number,
-                    meta_business_unit.get("id") or "",
-                    meta_business_unit.get("name") or "",
-                    machine_snapshot.get("type") or "",
-                    machine_snapshot.get("platform") or "",
-                    system_info.get("computer_name") or "",
-                    system_info.get("hardware_model") or ""
-                ]
-                os_version = machine_snapshot.get("os_version")
-                if os_version:
-                    os_version_dn = os_version.get("display_name") or ""
-                else:
-                    os_version_dn = ""
-                row.append(os_version_dn)
-                principal_user = machine_snapshot.get("principal_user")
-                if principal_user:
-                    pu_pn = principal_user.get("principal_name") or ""
-                    pu_dn = principal_user.get("display_name") or ""
-                else:
-                    pu_pn = pu_dn = ""
-                row.extend([pu_pn, pu_dn])
-                row.append(
-                    "|".join(dn for dn in (t.get("display_name") for t in machine_snapshot.get("tags", [])) if dn)
-                )
-                row.append(machine_snapshot.get("last_seen"))
-                if include_max_incident_severity:
-                    mis = machine_snapshot.get("max_incident_severity", {})
-                    row.extend([mis.get("value") or "", mis.get("keyword") or ""])
-                if include_max_compliance_check_status:
-                    mccs = machine_snapshot.get("max_compliance_check_status", {})
-                    row.extend([mccs.get("value"), mccs.get("keyword") or ""])
-                for app_versions in machine_snapshot.get("osx_apps", {}).values():
-                    if app_versions:
-                        min_app_version = app_versions[0]["display_name"]
-                        max_app_version = app_versions[-1]["display_name"]
-                    else:
-                        min_app_version = max_app_version = ""
-                    row.extend([min_app_version, max_app_version])
-                for cc_status in machine_snapshot.get("compliance_checks", {}).values():
-                    row.extend([cc_status["value"], cc_status["keyword"]])
-                rows.append(row)
+        if first_record:
+            # the optional headers are the same for all the machine snapshots
+            first_machine_snapshot = first_record[1][0]
+            if "max_incident_severity" in first_machine_snapshot:
+                include_max_incident_severity = True
+                headers.extend(["Max incident severity", "Max incident severity display"])
+            if "max_compliance_check_status" in first_machine_snapshot:
+                include_max_compliance_check_status = True
+                headers.extend(["Max compliance check status", "Max compliance check status display"])
+            for app_title in first_machine_snapshot.get("osx_apps", {}):
+                for suffix in ("min", "max"):
+                    headers.append("{} {}".format(app_title, suffix))
+            for compliance_check_name in first_machine_snapshot.get("compliance_checks", {}):
+                for suffix in ("- status", "- status display"):
+                    headers.append(f"{compliance_check_name} {suffix}")
+            records = chain((first_record,), records)
+        rows = (
+            row
+            for serial_number, machine_snapshots in records
+            for row in self._iter_machine_export_rows(serial_number, machine_snapshots,
+                                                      include_max_incident_severity,
+                                                      include_max_compliance_check_status)
+        )
         yield title, headers, rows
 
         # aggregations
@@ -1887,7 +1925,8 @@ class MSQuery:
     def export_xlsx(self, f_obj):
         workbook = xlsxwriter.Workbook(
             f_obj,
-            {'default_date_format': 'yyyy-mm-dd hh:mm:ss',
+            {'constant_memory': True,  # rows are flushed to disk as soon as the next one is written
+             'default_date_format': 'yyyy-mm-dd hh:mm:ss',
              'remove_timezone': True}
         )
         # machines
@@ -1913,16 +1952,11 @@ class MSQuery:
         workbook.close()
 
     def export_zip(self, f_obj):
-        with zipfile.ZipFile(f_obj, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_f:
-            for title, headers, rows in self.export_sheets_data():
-                tmp_file_fh, tmp_file = tempfile.mkstemp()
-                with os.fdopen(tmp_file_fh, mode='w', newline='') as csv_f:
-                    w = csv.writer(csv_f)
-                    w.writerow(headers)
-                    for row in rows:
-                        w.writerow(row)
-                zip_f.write(tmp_file, "{}.csv".format(slugify(title)))
-                os.unlink(tmp_file)
+        _write_export_zip(
+            f_obj,
+            (("{}.csv".format(slugify(title)), _iter_csv_lines(chain((headers,), rows)))
+             for title, headers, rows in self.export_sheets_data())
+        )
 
 
 class AndroidAppFilterForm(forms.Form):
@@ -2333,14 +2367,14 @@ def commit_machine_snapshot_and_trigger_events(tree):
             for event in iter_inventory_events(msc.serial_number, inventory_events_from_machine_snapshot_commit(msc)):
                 event.post()
         # compliance checks
-        for event in jmespath_checks_cache.process_tree(tree, last_seen):
+        for event in jmespath_checks_cache.process_tree(tree, last_seen, machine_snapshot.mt_hash):
             event.post()
         return machine_snapshot
 
 
 def commit_machine_snapshot_and_yield_events(tree):
     try:
-        msc, _, last_seen = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
+        msc, machine_snapshot, last_seen = MachineSnapshotCommit.objects.commit_machine_snapshot_tree(tree)
     except Exception:
         logger.exception("Could not commit machine snapshot")
     else:
@@ -2348,7 +2382,105 @@ def commit_machine_snapshot_and_yield_events(tree):
         if msc:
             yield from iter_inventory_events(msc.serial_number, inventory_events_from_machine_snapshot_commit(msc))
         # compliance checks
-        yield from jmespath_checks_cache.process_tree(tree, last_seen)
+        yield from jmespath_checks_cache.process_tree(tree, last_seen, machine_snapshot.mt_hash)
+
+
+# Machine mass tagging
+
+
+def _prepare_machine_tag_operations(operations):
+    taxonomies_to_clear = set()
+    tags_to_set = {}
+    tags_to_add = set()
+    tag_names_to_remove = set()
+    for operation in operations:
+        kind = operation["kind"]
+        taxonomy_name = operation.get("taxonomy")
+        names = operation["names"]
+        taxonomy = None
+        if taxonomy_name and (kind == "ADD" or (kind == "SET" and names)):
+            taxonomy, _ = Taxonomy.objects.get_or_create(name=taxonomy_name)
+        if kind == "SET":
+            if names:
+                tags_to_set.setdefault(taxonomy.pk, set()).update(
+                    Tag.objects.get_or_create(taxonomy=taxonomy, name=name)[0]
+                    for name in names
+                )
+            else:
+                taxonomies_to_clear.add(taxonomy_name)
+        elif kind == "ADD":
+            tags_to_add.update(
+                Tag.objects.get_or_create(taxonomy=taxonomy, name=name)[0]
+                for name in names
+            )
+        elif kind == "REMOVE":
+            tag_names_to_remove.update(names)
+    taxonomy_ids_to_clear = list(Taxonomy.objects.filter(name__in=taxonomies_to_clear).values_list("pk", flat=True))
+    tags_to_keep = set().union(*tags_to_set.values())
+    # the REMOVE operations win
+    tags_to_add = [tag for tag in tags_to_add | tags_to_keep if tag.name not in tag_names_to_remove]
+    return taxonomy_ids_to_clear, tags_to_set, tags_to_keep, tags_to_add, tag_names_to_remove
+
+
+def update_machine_tags(serial_numbers, operations, event_request=None):
+    """Apply the tag operations to the machines using set-based queries
+
+    The operations have the same format as the /api/inventory/machines/tags/ payload operations.
+    All the machine tags are removed with a single DELETE query, and added with a single INSERT query.
+    The cached machine info is invalidated, and events are posted in batches of machines.
+
+    Returns the number of machine tags removed and added.
+    """
+    serial_numbers = sorted(set(serial_numbers))
+    if not serial_numbers or not operations:
+        return 0, 0
+    (taxonomy_ids_to_clear,
+     tags_to_set, tags_to_keep,
+     tags_to_add, tag_names_to_remove) = _prepare_machine_tag_operations(operations)
+    machine_changes = {}
+    with transaction.atomic(), connection.cursor() as cursor:
+        # single delete
+        removed = []
+        if taxonomy_ids_to_clear or tags_to_set or tag_names_to_remove:
+            cursor.execute(
+                "delete from inventory_machinetag as mt "
+                "using inventory_tag as t "
+                "where mt.tag_id = t.id "
+                "and mt.serial_number = any(%(serial_numbers)s) "
+                "and (t.taxonomy_id = any(%(taxonomy_ids_to_clear)s) "
+                "or (t.taxonomy_id = any(%(taxonomy_ids_to_set)s) and not t.id = any(%(tag_ids_to_keep)s)) "
+                "or t.name = any(%(tag_names_to_remove)s)) "
+                "returning mt.serial_number, t.id, t.name",
+                {"serial_numbers": serial_numbers,
+                 "taxonomy_ids_to_clear": taxonomy_ids_to_clear,
+                 "taxonomy_ids_to_set": list(tags_to_set.keys()),
+                 "tag_ids_to_keep": [tag.pk for tag in tags_to_keep],
+                 "tag_names_to_remove": list(tag_names_to_remove)}
+            )
+            removed = cursor.fetchall()
+            for serial_number, tag_id, tag_name in removed:
+                (machine_changes.setdefault(serial_number, {"added": [], "removed": []})["removed"]
+                                .append({"pk": tag_id, "name": tag_name}))
+        # single upsert
+        added = []
+        if tags_to_add:
+            added = psycopg2.extras.execute_values(
+                cursor,
+                "insert into inventory_machinetag (serial_number, tag_id) values %s "
+                "on conflict (serial_number, tag_id) do nothing "
+                "returning serial_number, tag_id",
+                ((serial_number, tag.pk) for serial_number in serial_numbers for tag in tags_to_add),
+                page_size=1000,
+                fetch=True
+            )
+            tag_names = {tag.pk: tag.name for tag in tags_to_add}
+            for serial_number, tag_id in added:
+                (machine_changes.setdefault(serial_number, {"added": [], "removed": []})["added"]
+                                .append({"pk": tag_id, "name": tag_names[tag_id]}))
+    if machine_changes:
+        machine_info_cache.bump_machines(machine_changes.keys())
+        post_machine_tags_updated_events(operations, machine_changes, event_request)
+    return len(removed), len(added)
 
 
 def verify_enrollment_secret(model, secret,
@@ -2397,48 +2529,63 @@ def clean_ip_address(addr):
 # App export
 
 
-def _export_machine_csv_zip(query, source_name, basename, window_size=5000):
-    columns = None
-    csv_files = []
-    current_source_name = csv_f = csv_w = csv_p = None
+class _LineBuffer:
+    """File-like object returning the written value, to encode the CSV rows one by one"""
 
-    # iter all rows over a server-side cursor
-    query_args = []
-    if source_name:
-        query_args.append(source_name.upper())
+    def write(self, value):
+        return value
+
+
+def _iter_csv_lines(rows):
+    writer = csv.writer(_LineBuffer())
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def _iter_ndjson_lines(objects):
+    for obj in objects:
+        yield json.dumps(obj, cls=DjangoJSONEncoder)
+        yield "\n"
+
+
+def _write_export_zip(f_obj, members):
+    # members is an iterable of (name, lines), written one after the other
+    # without any intermediary file. Sizes are unknown upfront → zip64.
+    with zipfile.ZipFile(f_obj, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_a:
+        for name, lines in members:
+            with zip_a.open(name, mode="w", force_zip64=True) as member_f:
+                with io.TextIOWrapper(member_f, encoding="utf-8", newline="") as text_f:
+                    for line in lines:
+                        text_f.write(line)
+
+
+def _iter_rows_by_source(query, query_args, window_size, source_column, get_source_name=lambda v: v):
+    # iter all rows over a server-side cursor, grouped by source.
+    # the query must be ordered by source name.
     with transaction.atomic(), connection.chunked_cursor() as cursor:
         cursor.itersize = window_size
         cursor.execute(query, query_args)
-        for row in cursor:
+        columns = source_column_idx = None
+
+        def row_source_name(row):
+            nonlocal columns, source_column_idx
             if columns is None:
+                # only available after the first fetch with a server-side cursor
                 columns = [c.name for c in cursor.description]
-            source_name = row[columns.index("source_name")]
-            if source_name != current_source_name:
-                if current_source_name:
-                    csv_f.close()
-                    csv_files.append((current_source_name, csv_p))
-                current_source_name = source_name
-                csv_fh, csv_p = tempfile.mkstemp()
-                csv_f = os.fdopen(csv_fh, mode='w', newline='')
-                csv_w = csv.writer(csv_f)
-                csv_w.writerow(columns)
-            csv_w.writerow(row)
-        if current_source_name:
-            csv_f.close()
-            csv_files.append((current_source_name, csv_p))
-
-    zip_fh, zip_p = tempfile.mkstemp()
-    with zipfile.ZipFile(zip_p, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_a:
-        for source_name, csv_p in csv_files:
-            zip_a.write(csv_p, "{}.csv".format(slugify(source_name)))
-            os.unlink(csv_p)
-
-    filename = "{}_{:%Y-%m-%d_%H-%M-%S}.zip".format(slugify(basename).replace("-", "_"), datetime.utcnow())
+                source_column_idx = columns.index(source_column)
+            return get_source_name(row[source_column_idx])
+
+        for source_name, rows in groupby(cursor, key=row_source_name):
+            yield source_name, columns, rows
+
+
+def _save_export_zip(basename, members):
+    filename = "{}_{:%Y-%m-%d_%H-%M-%S}.zip".format(basename, datetime.utcnow())
     filepath = os.path.join("exports", filename)
-    with os.fdopen(zip_fh, "rb") as zip_f:
+    with tempfile.TemporaryFile() as zip_f:
+        _write_export_zip(zip_f, members)
+        zip_f.seek(0)
         default_storage.save(filepath, zip_f)
-    os.unlink(zip_p)
-
     return {
         "filepath": filepath,
         "headers": {
@@ -2449,6 +2596,17 @@ def _export_machine_csv_zip(query, source_name, basename, window_size=5000):
     }
 
 
+def _export_machine_csv_zip(query, source_name, basename, window_size=5000):
+    query_args = []
+    if source_name:
+        query_args.append(source_name.upper())
+    return _save_export_zip(
+        slugify(basename).replace("-", "_"),
+        (("{}.csv".format(slugify(source_name)), _iter_csv_lines(chain((columns,), rows)))
+         for source_name, columns, rows in _iter_rows_by_source(query, query_args, window_size, "source_name"))
+    )
+
+
 def export_machine_android_apps(source_name=None):
     query = (
         "select cms.serial_number, s.module as source_module, s.name as source_name, cms.last_seen,"
@@ -2610,10 +2768,6 @@ def export_machine_snapshots(source_name=None, window_size=5000):
         "order by s.name, ms.serial_number"
     )
 
-    columns = None
-    json_files = []
-    current_source_name = json_f = json_p = None
-
     def _prepare_machine_snapshot(row_d):
         for k, v in list(row_d.items()):
             if v is None:
@@ -2638,45 +2792,13 @@ def export_machine_snapshots(source_name=None, window_size=5000):
                     del row_d[k]
         return row_d
 
-    # iter all rows over a server-side cursor
-    with transaction.atomic(), connection.chunked_cursor() as cursor:
-        cursor.itersize = window_size
-        cursor.execute(query, args)
-        for row in cursor:
-            if columns is None:
-                columns = [c.name for c in cursor.description]
-            row_d = dict(zip(columns, row))
-            source_name = row_d["source"]["name"]
-            if source_name != current_source_name:
-                if current_source_name:
-                    json_f.close()
-                    json_files.append((current_source_name, json_p))
-                current_source_name = source_name
-                json_fh, json_p = tempfile.mkstemp()
-                json_f = os.fdopen(json_fh, mode='w')
-            json_f.write(json.dumps(_prepare_machine_snapshot(row_d), cls=DjangoJSONEncoder))
-            json_f.write("\n")
-        if current_source_name:
-            json_f.close()
-            json_files.append((current_source_name, json_p))
-
-    zip_fh, zip_p = tempfile.mkstemp()
-    with zipfile.ZipFile(zip_p, mode='w', compression=zipfile.ZIP_DEFLATED) as zip_a:
-        for source_name, json_p in json_files:
-            zip_a.write(json_p, "{}.jsonl".format(slugify(source_name)))
-            os.unlink(json_p)
-
-    filename = "machine_snapshots_{:%Y-%m-%d_%H-%M-%S}.zip".format(datetime.utcnow())
-    filepath = os.path.join("exports", filename)
-    with os.fdopen(zip_fh, "rb") as zip_f:
-        default_storage.save(filepath, zip_f)
-    os.unlink(zip_p)
+    def _iter_machine_snapshots(columns, rows):
+        for row in rows:
+            yield _prepare_machine_snapshot(dict(zip(columns, row)))
 
-    return {
-        "filepath": filepath,
-        "headers": {
-            "Content-Type": "application/zip",
-            "Content-Length": default_storage.size(filepath),
-            "Content-Disposition": f'attachment; filename="{filename}"'
-        }
-    }
+    return _save_export_zip(
+        "machine_snapshots",
+        (("{}.jsonl".format(slugify(source_name)), _iter_ndjson_lines(_iter_machine_snapshots(columns, rows)))
+         for source_name, columns, rows in _iter_rows_by_source(query, args, window_size,
+                                                                "source", lambda source: source["name"]))
+    )
@@ -7,25 +7,67 @@ logger = logging.getLogger("zentral.contrib.inventory.workers")
 
 
 class InventoryWorker:
-    sleep = 30
+    syncs_counter_name = "inventory_client_syncs"
+    machines_counter_name = "inventory_client_machines"
+    last_sync_gauge_name = "inventory_client_last_successful_sync"
+    last_sync_duration_gauge_name = "inventory_client_last_sync_duration_seconds"
 
     def __init__(self, client):
         self.client = client
         self.name = "inventory worker {}".format(client.source["name"])
+        self.sleep = client.min_sleep
 
     def log_info(self, msg):
         logger.info("{} - {}".format(self.name, msg))
 
-    def run(self, metrics_exporter=None):
-        self.log_info("run")
+    def setup_metrics_exporter(self, metrics_exporter):
         self.metrics_exporter = metrics_exporter
         if self.metrics_exporter:
             self.metrics_exporter.start()
+            self.metrics_exporter.add_counter(self.syncs_counter_name, ["client", "status"])
+            self.metrics_exporter.add_counter(self.machines_counter_name, ["client", "result"])
+            self.metrics_exporter.add_gauge(self.last_sync_gauge_name, ["client"])
+            self.metrics_exporter.add_gauge(self.last_sync_duration_gauge_name, ["client"])
+
+    def update_metrics(self, stats, duration):
+        if not self.metrics_exporter:
+            return
+        client_name = self.client.name
+        if stats is None:
+            self.metrics_exporter.inc(self.syncs_counter_name, client_name, "error")
+            return
+        self.metrics_exporter.inc(self.syncs_counter_name, client_name, "success")
+        for result, count in stats.items():
+            self.metrics_exporter.inc(self.machines_counter_name, client_name, result, amount=count)
+        self.metrics_exporter.set(self.last_sync_gauge_name, time.time(), client_name)
+        self.metrics_exporter.set(self.last_sync_duration_gauge_name, duration, client_name)
+
+    def update_sleep(self, stats):
+        # back off when nothing changed or when the sync failed
+        if stats and (stats["committed"] or stats["removed"]):
+            self.sleep = self.client.min_sleep
+        else:
+            self.sleep = min(2 * self.sleep, self.client.max_sleep)
+
+    def run_once(self):
+        start_t = time.monotonic()
+        try:
+            stats = self.client.sync()
+        except InventoryError:
+            logger.exception("Inventory client %s", self.client.name)
+            stats = None
+        else:
+            self.log_info("sync {}".format(", ".join("{} {}".format(v, k) for k, v in stats.items())))
+        self.update_metrics(stats, time.monotonic() - start_t)
+        self.update_sleep(stats)
+
+    def run(self, metrics_exporter=None, only_once=False):
+        self.log_info("run")
+        self.setup_metrics_exporter(metrics_exporter)
         while True:
-            try:
-                self.client.sync()
-            except InventoryError:
-                logger.exception("Inventory client %s", self.client.name)
+            self.run_once()
+            if only_once:
+                break
             self.log_info("sleep %s seconds" % self.sleep)
             time.sleep(self.sleep)
             self.log_info("resuming")
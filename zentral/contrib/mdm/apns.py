@@ -1,9 +1,14 @@
+import asyncio
+from collections import namedtuple
 import logging
 import random
 import time
 import threading
 from django.utils.functional import SimpleLazyObject
 import httpx
+from zentral.conf import settings
+from zentral.core.exceptions import ImproperlyConfigured
+from zentral.utils.leaky_bucket import LeakyBucket
 from zentral.utils.ssl import create_client_ssl_context
 from .events import post_mdm_device_notification_event
 from .models import PushCertificate
@@ -15,11 +20,42 @@ logger = logging.getLogger('zentral.contrib.mdm.apns')
 # client
 
 
-class APNSClient:
+class BaseAPNSClient:
     apns_production_base_url = "https://api.push.apple.com"
     timeout = 5
     max_retries = 2
+    log_tmpl = "Notify topic %s, device %s, priority %d, expiration %ds"
 
+    def _build_notification_request(self, token, push_magic, priority, expiration_seconds):
+        """Return the URL, JSON payload, headers and log args of a notification request"""
+        if isinstance(token, (bytes, memoryview)):
+            token = bytes(token).hex()
+        log_args = (self.topic, token, priority, expiration_seconds)
+        logger.debug(self.log_tmpl, *log_args)
+        url = f"/3/device/{token}"
+        payload = {"mdm": push_magic}
+        headers = {"apns-push-type": "mdm",
+                   "apns-expiration": str(int(time.time()) + expiration_seconds),
+                   "apns-priority": str(priority),
+                   "apns-topic": self.topic}
+        return url, payload, headers, log_args
+
+    def _log_request_error(self, log_args):
+        logger.exception(f"{self.log_tmpl}: error", *log_args)
+
+    def _check_response(self, response, log_args):
+        if response.status_code == httpx.codes.OK:
+            logger.debug(f"{self.log_tmpl}: OK", *log_args)
+            return True
+        logger.error(f"{self.log_tmpl}: status %d", *log_args, response.status_code)
+        return False
+
+    def _log_retry(self, log_args, sleep_time, retry_num):
+        logger.warning(f"{self.log_tmpl}: sleep %.2f seconds before retry %s of %s.",
+                       *log_args, sleep_time, retry_num, self.max_retries)
+
+
+class APNSClient(BaseAPNSClient):
     def __init__(self, topic, not_after, cert, privkey):
         self.topic = topic
         self.not_after = not_after
@@ -41,18 +77,9 @@ class APNSClient:
         )
 
     def send_notification(self, token, push_magic, priority=10, expiration_seconds=3600):
-        if isinstance(token, (bytes, memoryview)):
-            token = token.hex()
-
-        log_tmpl = "Notify topic %s, device %s, priority %d, expiration %ds"
-        logger.debug(log_tmpl, self.topic, token, priority, expiration_seconds)
-
-        url = f"/3/device/{token}"
-        payload = {"mdm": push_magic}
-        headers = {"apns-push-type": "mdm",
-                   "apns-expiration": str(int(time.time()) + expiration_seconds),
-                   "apns-priority": str(priority),
-                   "apns-topic": self.topic}
+        url, payload, headers, log_args = self._build_notification_request(
+            token, push_magic, priority, expiration_seconds
+        )
 
         success = False
 
@@ -60,25 +87,183 @@ class APNSClient:
             try:
                 r = self.client.post(url, json=payload, headers=headers)
             except Exception:
-                logger.exception(f"{log_tmpl}: error", self.topic, token, priority, expiration_seconds)
+                self._log_request_error(log_args)
             else:
-                if r.status_code == httpx.codes.OK:
-                    logger.debug(f"{log_tmpl}: OK", self.topic, token, priority, expiration_seconds)
+                if self._check_response(r, log_args):
                     success = True
                     break
-                logger.error(f"{log_tmpl}: status %d", self.topic, token, priority, expiration_seconds, r.status_code)
                 if r.status_code < 500:
                     # only retry 500s
                     break
             sleep_time = random.random() * 2 ** retry_num
-            logger.warning(f"{log_tmpl}: sleep %.2f seconds before retry %s of %s.",
-                           self.topic, token, priority, expiration_seconds,
-                           sleep_time, retry_num, self.max_retries)
+            self._log_retry(log_args, sleep_time, retry_num)
             time.sleep(sleep_time)
 
         return success
 
 
+# async client
+
+
+class AsyncAPNSClient(BaseAPNSClient):
+    max_retry_after = 60
+
+    def __init__(self, topic, cert, privkey, rate, transport=None):
+        self.topic = topic
+        client_kwargs = {"base_url": self.apns_production_base_url,
+                         "http2": True,
+                         "timeout": self.timeout}
+        if transport is not None:
+            client_kwargs["transport"] = transport
+        else:
+            client_kwargs["verify"] = create_client_ssl_context(cert, privkey)
+        # all the requests are multiplexed over the HTTP/2 connection
+        self.client = httpx.AsyncClient(**client_kwargs)
+        # per topic rate limit, with a 1 second burst
+        self.leaky_bucket = LeakyBucket(rate, rate)
+
+    @classmethod
+    def from_push_certificate(cls, push_certificate, rate, transport=None):
+        return cls(
+            push_certificate.topic,
+            push_certificate.certificate,
+            push_certificate.get_private_key(),
+            rate,
+            transport
+        )
+
+    def _get_retry_after(self, response):
+        try:
+            return min(max(0, int(response.headers.get("retry-after"))), self.max_retry_after)
+        except (TypeError, ValueError):
+            return None
+
+    async def send_notification(self, token, push_magic, priority=10, expiration_seconds=3600):
+        url, payload, headers, log_args = self._build_notification_request(
+            token, push_magic, priority, expiration_seconds
+        )
+
+        for retry_num in range(self.max_retries + 1):
+            await self.leaky_bucket.async_consume()
+            retry_after = None
+            try:
+                r = await self.client.post(url, json=payload, headers=headers)
+            except Exception:
+                self._log_request_error(log_args)
+            else:
+                if self._check_response(r, log_args):
+                    return True
+                if r.status_code < 500 and r.status_code != httpx.codes.TOO_MANY_REQUESTS:
+                    # only retry 500s and 429s
+                    break
+                retry_after = self._get_retry_after(r)
+            if retry_num == self.max_retries:
+                break
+            if retry_after is None:
+                retry_after = random.random() * 2 ** retry_num
+            self._log_retry(log_args, retry_after, retry_num + 1)
+            await asyncio.sleep(retry_after)
+
+        return False
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# bulk sender
+
+
+APNSTarget = namedtuple(
+    "APNSTarget",
+    ["obj", "serial_number", "udid", "user_id", "token", "push_magic", "push_certificate"]
+)
+
+
+class APNSBulkSender:
+    """Send many notifications concurrently
+
+    One async client is used per push certificate topic. The number of in-flight requests is bounded,
+    and each topic is rate limited. The notification events are posted after each batch of targets.
+    """
+    default_max_concurrency = 100
+    default_rate = 500
+    default_batch_size = 1000
+
+    def __init__(self, priority=10, expiration_seconds=3600, transport=None):
+        self.priority = priority
+        self.expiration_seconds = expiration_seconds
+        self.transport = transport
+        bulk_conf = settings["apps"]["zentral.contrib.mdm"].get("apns", {}).get("bulk", {})
+        try:
+            # 100 concurrent requests by default (min 1, max 1000)
+            self.max_concurrency = min(max(1, int(bulk_conf.get("max_concurrency", self.default_max_concurrency))),
+                                       1000)
+            # 500 notifications/s per topic by default (min 0.1/s, max 10000/s)
+            self.rate = min(max(0.1, float(bulk_conf.get("rate", self.default_rate))), 10000)
+            # batches of 1000 targets by default (min 1, max 10000)
+            self.batch_size = min(max(1, int(bulk_conf.get("batch_size", self.default_batch_size))), 10000)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("APNS bulk max concurrency, rate and batch size must be numbers")
+        self._clients = {}
+
+    def _get_client(self, push_certificate):
+        client = self._clients.get(push_certificate.topic)
+        if client is None:
+            client = AsyncAPNSClient.from_push_certificate(push_certificate, self.rate, self.transport)
+            self._clients[push_certificate.topic] = client
+        return client
+
+    async def _send_batch(self, batch):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def send(client, target):
+            async with semaphore:
+                return await client.send_notification(target.token, target.push_magic,
+                                                      self.priority, self.expiration_seconds)
+
+        return await asyncio.gather(*(send(client, target) for client, target in batch))
+
+    async def _close_clients(self):
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients = {}
+
+    def _process_batch(self, loop, batch):
+        # the clients are created outside of the event loop, they need the DB
+        batch = [(self._get_client(target.push_certificate), target) for target in batch]
+        results = loop.run_until_complete(self._send_batch(batch))
+        target_results = [(target, success) for (_, target), success in zip(batch, results)]
+        # post all the events of the batch before yielding the results
+        for target, success in target_results:
+            try:
+                post_mdm_device_notification_event(
+                    target.serial_number, target.udid,
+                    self.priority, self.expiration_seconds,
+                    success, target.user_id
+                )
+            except Exception:
+                # the notifications are already sent
+                logger.exception("Could not post the notification event of %s %s",
+                                 target.serial_number, target.udid)
+        return target_results
+
+    def send(self, targets):
+        """Send the notifications, yield (target, success) tuples"""
+        loop = asyncio.new_event_loop()
+        try:
+            batch = []
+            for target in targets:
+                batch.append(target)
+                if len(batch) >= self.batch_size:
+                    yield from self._process_batch(loop, batch)
+                    batch = []
+            if batch:
+                yield from self._process_batch(loop, batch)
+        finally:
+            loop.run_until_complete(self._close_clients())
+            loop.close()
+
+
 # client cache
 
 
@@ -133,3 +318,18 @@ def send_enrolled_user_notification(enrolled_user):
 
 def send_enrolled_device_notification(enrolled_device):
     return _send_target_notification(enrolled_device, enrolled_device.token)
+
+
+def send_enrolled_device_notifications(enrolled_devices, priority=10, expiration_seconds=3600, transport=None):
+    """Send notifications to many enrolled devices concurrently
+
+    The enrolled devices that cannot be poked are skipped. Yield (enrolled device, success) tuples.
+    """
+    sender = APNSBulkSender(priority, expiration_seconds, transport)
+    for target, success in sender.send(
+        APNSTarget(enrolled_device, enrolled_device.serial_number, enrolled_device.udid, None,
+                   enrolled_device.token, enrolled_device.push_magic, enrolled_device.push_certificate)
+        for enrolled_device in enrolled_devices
+        if enrolled_device.can_be_poked()
+    ):
+        yield target.obj, success
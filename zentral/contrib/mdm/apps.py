@@ -38,3 +38,28 @@ class ZentralMDMAppConfig(ZentralAppConfig):
         from realms.models import realm_tagging_change
         from .inventory import realm_tagging_change_receiver
         realm_tagging_change.connect(realm_tagging_change_receiver)
+        # next action cache invalidation
+        from django.db.models.signals import post_delete, post_save
+        from . import models
+        from .next_action import (configuration_change_receiver,
+                                  device_target_change_receiver,
+                                  user_target_change_receiver)
+        for receiver, model_names in (
+            (device_target_change_receiver,
+             ("DeviceCommand", "DeviceArtifact", "EnrolledDeviceLocationAssetAssociation")),
+            (user_target_change_receiver,
+             ("UserCommand", "UserArtifact")),
+            (configuration_change_receiver,
+             ("Blueprint", "BlueprintArtifact", "Artifact", "ArtifactVersion",
+              "Profile", "EnterpriseApp", "StoreApp",
+              "FileVaultConfig", "RecoveryPasswordConfig",
+              "SoftwareUpdateEnforcement", "SoftwareUpdate")),
+        ):
+            for model_name in model_names:
+                model = getattr(models, model_name)
+                post_save.connect(receiver, sender=model)
+                post_delete.connect(receiver, sender=model)
+        # software update index invalidation
+        from .software_updates import software_update_change_receiver
+        post_save.connect(software_update_change_receiver, sender=models.SoftwareUpdate)
+        post_delete.connect(software_update_change_receiver, sender=models.SoftwareUpdate)
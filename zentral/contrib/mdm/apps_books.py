@@ -1,8 +1,12 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from itertools import islice
 import logging
+import queue
 import threading
-from django.db import transaction
+import time
+from django.core.cache import cache
+from django.db import connection, transaction
 from django.db.models import F
 from django.urls import reverse
 from django.utils.functional import SimpleLazyObject
@@ -13,6 +17,8 @@ from urllib.parse import urljoin
 from base.utils import deployment_info
 from zentral.conf import settings
 from zentral.core.events.base import EventMetadata
+from zentral.core.exceptions import ImproperlyConfigured
+from zentral.utils.leaky_bucket import LeakyBucket
 from .artifacts import Target
 from .commands.install_application import InstallApplication
 from .events import (AssetCreatedEvent, AssetUpdatedEvent,
@@ -22,6 +28,7 @@ from .incidents import MDMAssetAvailabilityIncident
 from .models import (Asset, Artifact, DeviceAssignment,
                      EnrolledDeviceLocationAssetAssociation,
                      Location, LocationAsset)
+from .next_action import next_action_cache
 
 
 logger = logging.getLogger("zentral.contrib.mdm.apps_books")
@@ -71,7 +78,8 @@ class AppsBooksClient:
         mdm_info_id=None,
         location_name=None,
         platform=None,
-        location=None
+        location=None,
+        leaky_bucket=None
     ):
         self.server_token = server_token
         self.session = requests.Session()
@@ -86,14 +94,21 @@ class AppsBooksClient:
         self.platform = platform or "enterprisestore"
         self._service_config = None
         self.location = location
+        # optional rate limit, shared between the clients of a sync
+        self.leaky_bucket = leaky_bucket
 
     @classmethod
-    def from_location(cls, location):
+    def from_location(cls, location, leaky_bucket=None):
         return cls(location.get_server_token(),
                    str(location.mdm_info_id),
                    location.name,
                    location.platform,
-                   location)
+                   location,
+                   leaky_bucket)
+
+    def _wait_for_rate_limit(self):
+        if self.leaky_bucket:
+            self.leaky_bucket.consume()
 
     def close(self):
         self.session.close()
@@ -104,6 +119,7 @@ class AppsBooksClient:
             method = self.session.post
         else:
             method = self.session.get
+        self._wait_for_rate_limit()
         resp = method(url, **kwargs)
         resp.raise_for_status()
         response = resp.json()
@@ -203,6 +219,7 @@ class AppsBooksClient:
         if not url:
             logger.error("Location %s: missing or empty contentMetadataLookup", self.location_name)
             return
+        self._wait_for_rate_limit()
         try:
             resp = requests.get(
                 url,
@@ -482,41 +499,59 @@ def _update_or_create_location_asset(location, defaults, notification_id, collec
 def _update_assignments(location, all_serial_numbers, notification_id, collected_objects):
     asset = collected_objects["asset"]
     location_asset = collected_objects["location_asset"]
-    existing_serial_numbers = set(location_asset.deviceassignment_set.values_list("serial_number", flat=True))
-    if all_serial_numbers == existing_serial_numbers:
+    serial_numbers = list(all_serial_numbers)
+    now = datetime.utcnow()
+    with connection.cursor() as cursor:
+        # prune assignments
+        cursor.execute(
+            "delete from mdm_deviceassignment "
+            "where location_asset_id = %s and not (serial_number = any(%s::text[])) "
+            "returning serial_number",
+            [location_asset.pk, serial_numbers]
+        )
+        removed_serial_numbers = [t[0] for t in cursor.fetchall()]
+        # add missing assignments
+        # only the missing rows are inserted, to avoid burning the sequence values
+        added_serial_numbers = []
+        if serial_numbers:
+            cursor.execute(
+                "insert into mdm_deviceassignment (location_asset_id, serial_number, created_at) "
+                "select %(pk)s, sn, %(now)s "
+                "from unnest(%(serial_numbers)s::text[]) as sn "
+                "where not exists ("
+                "  select 1 from mdm_deviceassignment as da "
+                "  where da.location_asset_id = %(pk)s and da.serial_number = sn"
+                ") "
+                "on conflict (location_asset_id, serial_number) do nothing "
+                "returning serial_number",
+                {"pk": location_asset.pk, "now": now, "serial_numbers": serial_numbers}
+            )
+            added_serial_numbers = [t[0] for t in cursor.fetchall()]
+    if not removed_serial_numbers and not added_serial_numbers:
         return
+    # no signals with the raw SQL queries
+    next_action_cache.bump_serial_numbers(removed_serial_numbers + added_serial_numbers)
 
     # prepare common event payload
     payload = location_asset.serialize_for_event(keys_only=False, location=location, asset=asset)
     if notification_id:
         payload["notification_id"] = notification_id
 
-    # prune assignments
-    removed_serial_numbers = existing_serial_numbers - all_serial_numbers
-    if removed_serial_numbers:
-        DeviceAssignment.objects.filter(location_asset=location_asset,
-                                        serial_number__in=removed_serial_numbers).delete()
-        for serial_number in removed_serial_numbers:
-            yield DeviceAssignmentDeletedEvent(EventMetadata(machine_serial_number=serial_number), payload)
-
-    # add missing assignments
-    added_serial_numbers = all_serial_numbers - existing_serial_numbers
-    if not added_serial_numbers:
-        return
-    batch_size = 1000  # TODO: hard-coded
-    assignments_to_create = (DeviceAssignment(location_asset=location_asset,
-                                              serial_number=serial_number)
-                             for serial_number in added_serial_numbers)
-    while True:
-        batch = list(islice(assignments_to_create, batch_size))
-        if not batch:
-            break
-        DeviceAssignment.objects.bulk_create(batch, batch_size)
+    for serial_number in removed_serial_numbers:
+        yield DeviceAssignmentDeletedEvent(EventMetadata(machine_serial_number=serial_number), payload)
     for serial_number in added_serial_numbers:
         yield DeviceAssignmentCreatedEvent(EventMetadata(machine_serial_number=serial_number), payload)
 
 
-def _sync_asset_d(location, client, asset_d, notification_id=None):
+def _fetch_asset_d_data(client, asset_d):
+    adam_id = asset_d["adamId"]
+    pricing_param = asset_d["pricingParam"]
+    metadata = client.get_asset_metadata(adam_id)
+    all_serial_numbers = set(client.iter_asset_device_assignments(adam_id, pricing_param))
+    return metadata, all_serial_numbers
+
+
+def _apply_asset_d(location, asset_d, metadata, all_serial_numbers, notification_id=None):
     adam_id = asset_d["adamId"]
     pricing_param = asset_d["pricingParam"]
 
@@ -526,7 +561,6 @@ def _sync_asset_d(location, client, asset_d, notification_id=None):
         "revocable": asset_d["revocable"],
         "supported_platforms": asset_d["supportedPlatforms"],
     }
-    metadata = client.get_asset_metadata(adam_id)
     if metadata:
         asset_defaults["metadata"] = metadata
         asset_defaults["name"] = metadata.get("name")
@@ -539,8 +573,6 @@ def _sync_asset_d(location, client, asset_d, notification_id=None):
         "total_count": asset_d["totalCount"],
     }
 
-    all_serial_numbers = set(client.iter_asset_device_assignments(adam_id, pricing_param))
-
     with transaction.atomic():
         collected_objects = {}
 
@@ -568,6 +600,11 @@ def _sync_asset_d(location, client, asset_d, notification_id=None):
         )
 
 
+def _sync_asset_d(location, client, asset_d, notification_id=None):
+    metadata, all_serial_numbers = _fetch_asset_d_data(client, asset_d)
+    yield from _apply_asset_d(location, asset_d, metadata, all_serial_numbers, notification_id)
+
+
 def sync_asset(location, client, adam_id, pricing_param, notification_id):
     asset_d = client.get_asset(adam_id, pricing_param)
     if not asset_d:
@@ -576,11 +613,141 @@ def sync_asset(location, client, adam_id, pricing_param, notification_id):
     yield from _sync_asset_d(location, client, asset_d, notification_id)
 
 
-def sync_assets(location):
-    client = AppsBooksClient.from_location(location)
-    for asset_d in client.iter_assets():
-        for event in _sync_asset_d(location, client, asset_d):
-            event.post()
+class AppsBooksAssetsSync:
+    """Sync the assets and device assignments of a location
+
+    The asset pages are iterated in the calling thread, while the asset metadata and device assignments
+    are fetched by a bounded pool of worker threads, each one with its own API client.
+    All the API requests share the same rate limit.
+    The fetched data is applied in the asset order, in the calling thread, and the progress is
+    checkpointed in the Django cache, to be able to resume an interrupted sync.
+    """
+    default_max_workers = 4
+    default_rate = 10
+    default_checkpoint_ttl = 86400
+    checkpoint_interval = 10  # seconds between two checkpoint saves
+
+    def __init__(self, location, resume=True):
+        self.location = location
+        self.resume = resume
+        sync_conf = settings["apps"]["zentral.contrib.mdm"].get("apps_books", {}).get("sync", {})
+        try:
+            # 4 workers by default (min 1, max 32)
+            self.max_workers = min(max(1, int(sync_conf.get("max_workers", self.default_max_workers))), 32)
+            # 10 requests/s by default (min 0.1/s, max 1000/s)
+            self.rate = min(max(0.1, float(sync_conf.get("rate", self.default_rate))), 1000)
+            # 1d by default (min 0 → no checkpoints, max 7d)
+            self.checkpoint_ttl = min(max(0, int(sync_conf.get("checkpoint_ttl", self.default_checkpoint_ttl))),
+                                      604800)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Apps & books sync max workers, rate and checkpoint TTL must be numbers")
+        # per location rate limit, with a 1 second burst
+        self.leaky_bucket = LeakyBucket(self.rate, self.rate)
+        self._client = None
+        self._done = set()
+        self._last_checkpoint_save = None
+
+    # checkpoint
+
+    @property
+    def checkpoint_key(self):
+        return f"mdm-apps-books-sync_{self.location.pk}"
+
+    @staticmethod
+    def _get_asset_key(asset_d):
+        return f"{asset_d['adamId']}/{asset_d['pricingParam']}"
+
+    def _load_checkpoint(self):
+        if not self.checkpoint_ttl:
+            return
+        if not self.resume:
+            cache.delete(self.checkpoint_key)
+            return
+        self._done = set(cache.get(self.checkpoint_key) or [])
+        if self._done:
+            logger.info("Location %s: resume sync, %s asset(s) already synced", self.location.name, len(self._done))
+
+    def _save_checkpoint(self):
+        if not self.checkpoint_ttl:
+            return
+        cache.set(self.checkpoint_key, sorted(self._done), self.checkpoint_ttl)
+        self._last_checkpoint_save = time.monotonic()
+
+    def _mark_done(self, asset_key):
+        self._done.add(asset_key)
+        if (
+            self._last_checkpoint_save is None
+            or time.monotonic() - self._last_checkpoint_save >= self.checkpoint_interval
+        ):
+            self._save_checkpoint()
+
+    def _clear_checkpoint(self):
+        if self.checkpoint_ttl:
+            cache.delete(self.checkpoint_key)
+
+    # fetch
+
+    def _fetch(self, clients, asset_d):
+        client = clients.get()
+        try:
+            return _fetch_asset_d_data(client, asset_d)
+        finally:
+            clients.put(client)
+            # the client can reload the location to refresh its token
+            connection.close()
+
+    def _iter_fetched_assets(self, executor, clients, stats):
+        pending = deque()
+        try:
+            for asset_d in self._client.iter_assets():
+                stats["total"] += 1
+                if self._get_asset_key(asset_d) in self._done:
+                    stats["skipped"] += 1
+                    continue
+                pending.append((asset_d, executor.submit(self._fetch, clients, asset_d)))
+                # bounded read-ahead, to keep the memory usage in check
+                if len(pending) >= 2 * self.max_workers:
+                    asset_d, future = pending.popleft()
+                    yield asset_d, future.result()
+            while pending:
+                asset_d, future = pending.popleft()
+                yield asset_d, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    # sync
+
+    def run(self):
+        """Sync the location assets, post the events, and return the asset stats"""
+        stats = {"total": 0, "skipped": 0, "synced": 0}
+        self._load_checkpoint()
+        self._client = AppsBooksClient.from_location(self.location, self.leaky_bucket)
+        clients = queue.Queue()
+        for _ in range(self.max_workers):
+            clients.put(AppsBooksClient.from_location(self.location, self.leaky_bucket))
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                for asset_d, (metadata, all_serial_numbers) in self._iter_fetched_assets(executor, clients, stats):
+                    for event in _apply_asset_d(self.location, asset_d, metadata, all_serial_numbers):
+                        event.post()
+                    stats["synced"] += 1
+                    self._mark_done(self._get_asset_key(asset_d))
+        except Exception:
+            logger.error("Location %s: sync interrupted after %s asset(s)", self.location.name, len(self._done))
+            self._save_checkpoint()
+            raise
+        else:
+            self._clear_checkpoint()
+        finally:
+            self._client.close()
+            while not clients.empty():
+                clients.get().close()
+        return stats
+
+
+def sync_assets(location, resume=True):
+    return AppsBooksAssetsSync(location, resume).run()
 
 
 def _update_location_asset_counts(location_asset, updates, notification_id):
@@ -655,6 +822,7 @@ def associate_location_asset(
             if notification_id:
                 payload["notification_id"] = notification_id
             assigned_count_delta = 0
+            created_serial_numbers = []
             for serial_number in serial_numbers:
                 _, created = DeviceAssignment.objects.get_or_create(
                     location_asset=location_asset,
@@ -662,6 +830,7 @@ def associate_location_asset(
                 )
                 if created:
                     assigned_count_delta += 1
+                    created_serial_numbers.append(serial_number)
                     yield DeviceAssignmentCreatedEvent(
                         EventMetadata(machine_serial_number=serial_number),
                         payload
@@ -670,6 +839,7 @@ def associate_location_asset(
                     queue_install_application_command_if_necessary(
                         location, serial_number, adam_id, pricing_param
                     )
+            next_action_cache.bump_serial_numbers(created_serial_numbers)
             try:
                 yield from _update_location_asset_counts(
                     location_asset,
@@ -708,6 +878,7 @@ def disassociate_location_asset(
             if notification_id:
                 payload["notification_id"] = notification_id
             assigned_count_delta = 0
+            deleted_serial_numbers = []
             for serial_number in serial_numbers:
                 deleted = DeviceAssignment.objects.filter(
                     location_asset=location_asset,
@@ -715,6 +886,7 @@ def disassociate_location_asset(
                 ).delete()
                 if deleted:
                     assigned_count_delta -= 1
+                    deleted_serial_numbers.append(serial_number)
                     yield DeviceAssignmentDeletedEvent(
                         EventMetadata(machine_serial_number=serial_number),
                         payload
@@ -723,6 +895,7 @@ def disassociate_location_asset(
                 clear_on_the_fly_assignment(
                     location, serial_number, adam_id, pricing_param, "disassociate success"
                 )
+            next_action_cache.bump_serial_numbers(deleted_serial_numbers)
             try:
                 yield from _update_location_asset_counts(
                     location_asset,
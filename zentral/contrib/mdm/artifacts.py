@@ -2,9 +2,12 @@ import copy
 from datetime import datetime, timedelta
 from functools import cached_property, lru_cache
 import hashlib
+import json
 import logging
-from graphlib import TopologicalSorter
+from graphlib import CycleError
+import threading
 from django.db import transaction
+from zentral.conf import settings
 from zentral.contrib.inventory.models import MetaMachine
 from zentral.utils.os_version import make_comparable_os_version
 from zentral.utils.text import shard as compute_shard
@@ -15,6 +18,7 @@ from .declarations import (build_specific_software_update_enforcement,
                            get_legacy_profile_identifier,
                            get_legacy_profile_server_token,
                            get_software_update_enforcement_specific_identifier)
+from .declarations_cache import declarations_cache
 from .models import (Artifact, ArtifactVersion,
                      Blueprint, BlueprintArtifact,
                      Channel,
@@ -92,10 +96,28 @@ def _serialize_artifact_version(artifact_version):
     return d
 
 
+def _dumps_for_comparison(artifact):
+    # the os versions are tuples before, and lists after the JSON serialization
+    return json.dumps(artifact, sort_keys=True)
+
+
+def _schedule_blueprint_notifications_fan_out(blueprint, previous_artifacts, artifacts):
+    if not settings["apps"]["zentral.contrib.mdm"].get("apns", {}).get("fan_out", {}).get("on_blueprint_change"):
+        return
+    if previous_artifacts.keys() - artifacts.keys():
+        # removed artifacts → all the devices
+        artifact_pks = None
+    else:
+        artifact_pks = [pk for pk, artifact in artifacts.items()
+                        if _dumps_for_comparison(previous_artifacts.get(pk)) != _dumps_for_comparison(artifact)]
+    from .tasks import fan_out_blueprint_notifications_task  # circular dependency
+    transaction.on_commit(lambda: fan_out_blueprint_notifications_task.apply_async((blueprint.pk, artifact_pks)))
+
+
 def update_blueprint_serialized_artifacts(blueprint, commit=True):
     artifacts = {}
     # lock the blueprint
-    Blueprint.objects.select_for_update().get(pk=blueprint.pk)
+    previous_artifacts = Blueprint.objects.select_for_update().get(pk=blueprint.pk).serialized_artifacts
     # update the blueprint
     for bpa in (BlueprintArtifact.objects.prefetch_related("item_tags__tag",
                                                            "excluded_tags",
@@ -109,6 +131,152 @@ def update_blueprint_serialized_artifacts(blueprint, commit=True):
     blueprint.serialized_artifacts = artifacts
     if commit:
         blueprint.save()
+        if _dumps_for_comparison(artifacts) != _dumps_for_comparison(previous_artifacts):
+            _schedule_blueprint_notifications_fan_out(blueprint, previous_artifacts, artifacts)
+
+
+# compiled blueprint plans
+
+
+class BlueprintItemScope:
+    """Pre-parsed scope of a serialized blueprint artifact or artifact version"""
+
+    platform_keys = ("ios", "ipados", "macos", "tvos")
+
+    def __init__(self, item):
+        self.pk = str(item["pk"])
+        self.platforms = {}
+        for platform_key in self.platform_keys:
+            if not item.get(platform_key):
+                continue
+            min_os_version = item.get(f"{platform_key}_min_version")
+            max_os_version = item.get(f"{platform_key}_max_version")
+            self.platforms[platform_key] = (tuple(min_os_version) if min_os_version else None,
+                                            tuple(max_os_version) if max_os_version else None)
+        self.excluded_tag_ids = frozenset(item["excluded_tags"])
+        self.shard_modulo = item["shard_modulo"]
+        self.default_shard = item["default_shard"]
+        # pk in str form in the serialized item because of the JSON serialization
+        self.tag_shards = {int(tag_id): shard for tag_id, shard in item["tag_shards"].items()}
+
+    def test(self, target):
+        # platform
+        try:
+            min_os_version, max_os_version = self.platforms[target.platform.lower()]
+        except KeyError:
+            return False
+
+        # OS version
+        if min_os_version and target.comparable_os_version < min_os_version:
+            return False
+        if max_os_version and target.comparable_os_version >= max_os_version:
+            return False
+
+        # excluded tags
+        if self.excluded_tag_ids and not self.excluded_tag_ids.isdisjoint(target.tag_ids):
+            return False
+
+        # shards
+        if self.shard_modulo == self.default_shard:
+            return True
+
+        shard = compute_shard(self.pk + target.serial_number, modulo=self.shard_modulo)
+        if shard < self.default_shard:
+            return True
+
+        for tag_id in target.tag_ids:
+            tag_shard = self.tag_shards.get(tag_id)
+            if tag_shard is not None and shard < tag_shard:
+                return True
+
+        return False
+
+
+class PlannedArtifact:
+    def __init__(self, artifact):
+        self.artifact = artifact
+        self.channel = Channel(artifact["channel"])
+        self.requires = tuple(artifact["requires"])
+        # only the artifacts directly included in the blueprint have the blueprint item scope keys
+        self.scope = BlueprintItemScope(artifact) if artifact["_depth"] == 0 else None
+        self.versions = [(artifact_version, BlueprintItemScope(artifact_version))
+                         for artifact_version in artifact["versions"]]
+        # the artifact and all its direct and indirect requirements
+        self.required_closure = frozenset()
+        # length of the longest requirement chain
+        self.level = None
+
+
+class BlueprintPlan:
+    """Blueprint artifacts compiled for the per-target evaluation
+
+    The artifacts are sorted once, so that the required artifacts always come first.
+    The artifacts are sorted by level (length of the longest requirement chain), which is the
+    order in which a topological sorter would make them ready. The scopes are pre-parsed.
+    """
+
+    def __init__(self, serialized_artifacts):
+        self.artifacts = {}
+        # same insertion order as the original topological sorter
+        for artifact in serialized_artifacts.values():
+            if artifact["_depth"] == 0:
+                self._add_artifact(artifact, serialized_artifacts)
+        for planned_artifact in self.artifacts.values():
+            self._compute_level_and_closure(planned_artifact, set())
+        self.ordered_artifacts = sorted(self.artifacts.values(), key=lambda pa: pa.level)  # stable sort
+        self.channel_roots = {channel: [] for channel in Channel}
+        for planned_artifact in self.artifacts.values():
+            if planned_artifact.artifact["_depth"] == 0:
+                self.channel_roots[planned_artifact.channel].append(planned_artifact)
+
+    def _add_artifact(self, artifact, serialized_artifacts):
+        if artifact["pk"] in self.artifacts:
+            return
+        self.artifacts[artifact["pk"]] = PlannedArtifact(artifact)
+        for r_pk in artifact["requires"]:
+            self._add_artifact(serialized_artifacts[r_pk], serialized_artifacts)
+
+    def _compute_level_and_closure(self, planned_artifact, visiting):
+        if planned_artifact.level is not None:
+            return
+        artifact_pk = planned_artifact.artifact["pk"]
+        if artifact_pk in visiting:
+            raise CycleError("Artifact requirement cycle", artifact_pk)
+        visiting.add(artifact_pk)
+        level = 0
+        required_closure = {artifact_pk}
+        for r_pk in planned_artifact.requires:
+            required_artifact = self.artifacts[r_pk]
+            self._compute_level_and_closure(required_artifact, visiting)
+            level = max(level, required_artifact.level + 1)
+            required_closure.update(required_artifact.required_closure)
+        visiting.remove(artifact_pk)
+        planned_artifact.level = level
+        planned_artifact.required_closure = frozenset(required_closure)
+
+
+class BlueprintPlanCache:
+    """In-process cache of the compiled blueprint plans, one per blueprint version"""
+
+    def __init__(self):
+        self._plans = {}
+        self._lock = threading.Lock()
+
+    def get(self, blueprint):
+        version = blueprint.updated_at
+        if blueprint.pk is None or version is None:
+            # unsaved blueprint
+            return BlueprintPlan(blueprint.serialized_artifacts)
+        with self._lock:
+            cached_version, plan = self._plans.get(blueprint.pk, (None, None))
+        if plan is None or cached_version != version:
+            plan = BlueprintPlan(blueprint.serialized_artifacts)
+            with self._lock:
+                self._plans[blueprint.pk] = (version, plan)
+        return plan
+
+
+blueprint_plan_cache = BlueprintPlanCache()
 
 
 # Target
@@ -191,106 +359,50 @@ class Target:
     # blueprint filtering method
 
     def _test_filtered_blueprint_item(self, item):
-        # platform
-        platform_key = self.platform.lower()
-        if not item.get(platform_key):
-            return False
-
-        # OS version
-        min_os_version = item.get(f"{platform_key}_min_version")
-        max_os_version = item.get(f"{platform_key}_max_version")
-        if min_os_version or max_os_version:
-            if min_os_version and self.comparable_os_version < tuple(min_os_version):
-                return False
-            if max_os_version and self.comparable_os_version >= tuple(max_os_version):
-                return False
-
-        # excluded tags
-        if set(item["excluded_tags"]).intersection(self.tag_ids):
-            return False
-
-        # shards
-        shard_modulo = item["shard_modulo"]
-        default_shard = item["default_shard"]
-        if shard_modulo == default_shard:
-            return True
-
-        shard = compute_shard(str(item["pk"]) + self.serial_number, modulo=shard_modulo)
-        if shard < default_shard:
-            return True
-
-        for tag_id in self.tag_ids:
-            try:
-                tag_shard = item["tag_shards"][str(tag_id)]  # pk in str form because of the JSON serialization
-            except KeyError:
-                pass
-            else:
-                if shard < tag_shard:
-                    return True
-
-        return False
-
-    def _build_topological_sorter(self):
-
-        def _add_artifact_to_topological_sorter(artifact, ts, seen_artifacts):
-            requires = artifact["requires"]
-            ts.add(artifact["pk"], *requires)
-            seen_artifacts.add(artifact["pk"])
-            for r_pk in requires:
-                if r_pk not in seen_artifacts:
-                    r_artifact = self.blueprint.serialized_artifacts[r_pk]
-                    _add_artifact_to_topological_sorter(r_artifact, ts, seen_artifacts)
-
-        # prepare the dependency tree
-        ts = TopologicalSorter()
-        seen_artifacts = set()
-        for artifact in self.blueprint.serialized_artifacts.values():
-            # depth
-            if artifact["_depth"] != 0:
-                continue
-            # channel
-            if Channel(artifact["channel"]) != self.channel:
-                continue
-            # awaiting configuration
-            if self.awaiting_configuration and not artifact["install_during_setup_assistant"]:
-                continue
-            # common blueprint item scoping
-            if self._test_filtered_blueprint_item(artifact):
-                _add_artifact_to_topological_sorter(artifact, ts, seen_artifacts)
-        ts.prepare()
-        return ts
+        return BlueprintItemScope(item).test(self)
 
     def _walk_artifact_versions(self, callback):
         if self.blueprint is None:
             return
+        blueprint_plan = blueprint_plan_cache.get(self.blueprint)
 
-        # iterate other the tree
-        ts = self._build_topological_sorter()
-        iterate = True
-        while iterate:
-            artifact_pks = ts.get_ready()
-            if not artifact_pks:
-                break
-            for artifact_pk in artifact_pks:
-                artifact = self.blueprint.serialized_artifacts[artifact_pk]
-                if Channel(artifact["channel"]) != self.channel:
-                    # should never happen
-                    continue
-                # we have an artifact in scope
-                stop, done = False, False
-                for artifact_version in artifact["versions"]:
-                    if self._test_filtered_blueprint_item(artifact_version):
-                        # the artifact version is in scope, call the callback
-                        stop, done = callback(artifact, artifact_version)
-                        break
-                else:
-                    logger.error("No artifact version candidate found for artifact %s, enrolled device %s",
-                                 artifact["pk"], self.serial_number)
-                if stop:
-                    iterate = False
+        # artifacts in scope, with their requirements
+        in_scope_artifact_pks = set()
+        for planned_artifact in blueprint_plan.channel_roots[self.channel]:
+            # awaiting configuration
+            if self.awaiting_configuration and not planned_artifact.artifact["install_during_setup_assistant"]:
+                continue
+            # common blueprint item scoping
+            if planned_artifact.scope.test(self):
+                in_scope_artifact_pks.update(planned_artifact.required_closure)
+
+        # linear pass over the pre-sorted artifacts
+        done_artifact_pks = set()
+        for planned_artifact in blueprint_plan.ordered_artifacts:
+            artifact = planned_artifact.artifact
+            artifact_pk = artifact["pk"]
+            if artifact_pk not in in_scope_artifact_pks:
+                continue
+            if not done_artifact_pks.issuperset(planned_artifact.requires):
+                # at least one of the required artifacts is not done
+                continue
+            if planned_artifact.channel != self.channel:
+                # should never happen
+                continue
+            # we have an artifact in scope
+            stop, done = False, False
+            for artifact_version, scope in planned_artifact.versions:
+                if scope.test(self):
+                    # the artifact version is in scope, call the callback
+                    stop, done = callback(artifact, artifact_version)
                     break
-                if done:
-                    ts.done(artifact_pk)
+            else:
+                logger.error("No artifact version candidate found for artifact %s, enrolled device %s",
+                             artifact_pk, self.serial_number)
+            if stop:
+                break
+            if done:
+                done_artifact_pks.add(artifact_pk)
 
     @cached_property
     def _serialized_target_artifacts(self):
@@ -418,6 +530,26 @@ class Target:
         self._walk_artifact_versions(all_in_scope_callback)
         return artifacts_in_scope
 
+    def get_next_reinstall_due_date(self, included_types=None):
+        """Return the earliest reinstall interval due date of the artifact versions present in scope, or None"""
+        due_dates = []
+        for artifact, artifact_version in self.all_in_scope_serialized():
+            if included_types and artifact["type"] not in included_types:
+                continue
+            reinstall_interval = artifact["reinstall_interval"]
+            if not reinstall_interval:
+                continue
+            target_artifact = self._serialized_target_artifacts.get(artifact["pk"])
+            if not target_artifact:
+                continue
+            av_status, av_installed_at, _ = target_artifact["versions"].get(
+                artifact_version["pk"],
+                (TargetArtifact.Status.UNINSTALLED, None, None)
+            )
+            if av_status.present and av_installed_at:
+                due_dates.append(av_installed_at + timedelta(days=reinstall_interval))
+        return min(due_dates, default=None)
+
     def next_to_remove(self, included_types=None):
         target_artifacts = copy.deepcopy(self._serialized_target_artifacts)
         for artifact, _ in self.all_in_scope_serialized():
@@ -607,8 +739,7 @@ class Target:
         return selected_sue
 
     # https://developer.apple.com/documentation/devicemanagement/activationsimple
-    @cached_property
-    def activation(self):
+    def _build_activation(self):
         payload = {
             "StandardConfigurations": [
                 get_declaration_identifier(self.blueprint, "management-status-subscriptions"),
@@ -631,13 +762,12 @@ class Target:
         }
 
     # https://developer.apple.com/documentation/devicemanagement/declarationitemsresponse/manifestdeclarationitems
-    @cached_property
-    def declaration_items(self):
+    def _build_declaration_items(self, activation):
         management_status_subscriptions = build_target_management_status_subscriptions(self)
         declarations = {
             "Activations": [
-                {"Identifier": self.activation["Identifier"],
-                 "ServerToken": self.activation["ServerToken"]},
+                {"Identifier": activation["Identifier"],
+                 "ServerToken": activation["ServerToken"]},
             ],
             "Assets": [],
             "Configurations": [
@@ -668,6 +798,23 @@ class Target:
             "DeclarationsToken": h.hexdigest()
         }
 
+    def _build_declarations(self):
+        activation = self._build_activation()
+        return {"activation": activation,
+                "declaration_items": self._build_declaration_items(activation)}
+
+    @cached_property
+    def _declarations(self):
+        return declarations_cache.get(self, self._build_declarations)
+
+    @property
+    def activation(self):
+        return self._declarations["activation"]
+
+    @property
+    def declaration_items(self):
+        return self._declarations["declaration_items"]
+
     # https://developer.apple.com/documentation/devicemanagement/synchronizationtokens
     @cached_property
     def sync_tokens(self):
@@ -1,6 +1,6 @@
 from datetime import datetime, timedelta
 import logging
-from django.db.models import Q
+from django.db.models import Min, Q
 from django.http import HttpResponse
 from django.utils import timezone
 from zentral.contrib.mdm.apps_books import ensure_enrolled_device_location_asset_association
@@ -8,6 +8,8 @@ from zentral.contrib.mdm.models import (Artifact,
                                         Blueprint, Command,
                                         RequestStatus, Platform,
                                         DeviceCommand, ReEnrollmentSession)
+from zentral.contrib.mdm.declarations_cache import declarations_cache
+from zentral.contrib.mdm.next_action import next_action_cache
 from .account_configuration import AccountConfiguration
 from .base import registered_commands, load_command
 from .certificate_list import CertificateList
@@ -32,88 +34,133 @@ from .setup_filevault import SetupFileVault
 logger = logging.getLogger("zentral.contrib.mdm.commands.scheduling")
 
 
-# Next command
+# Time based rules, shared by the scheduling functions and the idle state TTL
 
 
-def _update_base_inventory(target, enrollment_session, status):
-    if status == RequestStatus.NOT_NOW:
+# TODO configuration for the 90 days
+REENROLLMENT_CERT_EXPIRY_MARGIN = timedelta(days=90)
+
+
+def _is_due(due_date, now):
+    return due_date is not None and due_date < now
+
+
+def _get_inventory_due_date(updated_at, blueprint):
+    """Return when an inventory item must be collected again, None if only once"""
+    if updated_at is None:
+        return datetime.min
+    if not blueprint:
         return
-    if not target.is_device:
+    return updated_at + timedelta(seconds=blueprint.inventory_interval)
+
+
+def _iter_base_inventory_items(target):
+    """Yield the (updated at, command class) tuples of the base inventory items"""
+    enrolled_device = target.enrolled_device
+    yield enrolled_device.device_information_updated_at, DeviceInformation
+    yield enrolled_device.security_info_updated_at, SecurityInfo
+
+
+def _iter_extra_inventory_items(target):
+    """Yield the (updated at, command class, managed only) tuples of the extra inventory items to collect"""
+    blueprint = target.blueprint
+    if not blueprint:
         return
-    try:
-        min_date = datetime.utcnow() - timedelta(seconds=target.blueprint.inventory_interval)
-    except Exception:
-        min_date = None
     enrolled_device = target.enrolled_device
-    # device information
-    if (
-        enrolled_device.device_information_updated_at is None
-        or (min_date and enrolled_device.device_information_updated_at < min_date)
+    for collect_option, updated_at, command_class in (
+        (blueprint.collect_apps, enrolled_device.apps_updated_at, InstalledApplicationList),
+        (blueprint.collect_certificates, enrolled_device.certificates_updated_at, CertificateList),
+        (blueprint.collect_profiles, enrolled_device.profiles_updated_at, ProfileList),
     ):
-        return DeviceInformation.create_for_target(target)
-    # security info
+        if collect_option > Blueprint.InventoryItemCollectionOption.NO:
+            yield (updated_at, command_class,
+                   collect_option == Blueprint.InventoryItemCollectionOption.MANAGED_ONLY)
+
+
+def _get_reenrollment_due_date(enrolled_device):
+    if enrolled_device.cert_not_valid_after is None:
+        return datetime.min
+    return enrolled_device.cert_not_valid_after - REENROLLMENT_CERT_EXPIRY_MARGIN
+
+
+def _filevault_config_needs_setup(target):
+    return (
+        SetupFileVault.verify_target(target)
+        and target.enrolled_device.filevault_config_uuid != target.blueprint.filevault_config.uuid
+    )
+
+
+def _get_filevault_prk_rotation_due_date(target):
+    if not RotateFileVaultKey.verify_target(target):
+        return
+    try:
+        prk_rotation_interval_days = target.blueprint.filevault_config.prk_rotation_interval_days
+    except AttributeError:
+        return
+    prk_updated_at = target.enrolled_device.filevault_prk_updated_at
+    if prk_rotation_interval_days > 0 and prk_updated_at:
+        return prk_updated_at + timedelta(days=prk_rotation_interval_days)
+
+
+def _get_recovery_password_config_and_command_class(target):
+    if not target.platform == Platform.MACOS:
+        return None, None
+    if not target.is_device:
+        return None, None
+    try:
+        recovery_password_config = target.blueprint.recovery_password_config
+    except AttributeError:
+        return None, None
+    if not recovery_password_config:
+        return None, None
+    for cmd_class in (SetRecoveryLock, SetFirmwarePassword):
+        if cmd_class.verify_target(target):
+            return recovery_password_config, cmd_class
+    return None, None
+
+
+def _get_recovery_password_due_date(enrolled_device, recovery_password_config):
+    if not enrolled_device.recovery_password:
+        return datetime.min
     if (
-        enrolled_device.security_info_updated_at is None
-        or (min_date and enrolled_device.security_info_updated_at < min_date)
+        recovery_password_config.rotation_interval_days
+        and (enrolled_device.apple_silicon or recovery_password_config.rotate_firmware_password)
     ):
-        return SecurityInfo.create_for_target(target)
+        if not enrolled_device.recovery_password_updated_at:
+            return datetime.min
+        return (enrolled_device.recovery_password_updated_at
+                + timedelta(days=recovery_password_config.rotation_interval_days))
 
 
-def _update_extra_inventory(target, enrollment_session, status):
+# Next command
+
+
+def _update_base_inventory(target, enrollment_session, status):
     if status == RequestStatus.NOT_NOW:
         return
     if not target.is_device:
         return
-    blueprint = target.blueprint
-    if not blueprint:
+    now = datetime.utcnow()
+    for updated_at, command_class in _iter_base_inventory_items(target):
+        if _is_due(_get_inventory_due_date(updated_at, target.blueprint), now):
+            return command_class.create_for_target(target)
+
+
+def _update_extra_inventory(target, enrollment_session, status):
+    if status == RequestStatus.NOT_NOW:
         return
-    enrolled_device = target.enrolled_device
-    min_date = datetime.utcnow() - timedelta(seconds=blueprint.inventory_interval)
-    # apps
-    if (
-        blueprint.collect_apps > Blueprint.InventoryItemCollectionOption.NO
-        and (
-            enrolled_device.apps_updated_at is None
-            or enrolled_device.apps_updated_at < min_date
-        )
-    ):
-        return InstalledApplicationList.create_for_target(
-            target,
-            kwargs={
-                "managed_only": blueprint.collect_apps == Blueprint.InventoryItemCollectionOption.MANAGED_ONLY,
-                "update_inventory": True
-            }
-        )
-    # certificates
-    if (
-        blueprint.collect_certificates > Blueprint.InventoryItemCollectionOption.NO
-        and (
-            enrolled_device.certificates_updated_at is None
-            or enrolled_device.certificates_updated_at < min_date
-        )
-    ):
-        return CertificateList.create_for_target(
-            target,
-            kwargs={
-                "managed_only": blueprint.collect_certificates == Blueprint.InventoryItemCollectionOption.MANAGED_ONLY,
-                "update_inventory": True
-            }
-        )
-    # profiles
-    if (
-        blueprint.collect_profiles > Blueprint.InventoryItemCollectionOption.NO
-        and (
-            enrolled_device.profiles_updated_at is None
-            or enrolled_device.profiles_updated_at < min_date
-        )
-    ):
-        return ProfileList.create_for_target(
-            target,
-            kwargs={
-                "managed_only": blueprint.collect_profiles == Blueprint.InventoryItemCollectionOption.MANAGED_ONLY,
-                "update_inventory": True
-            }
-        )
+    if not target.is_device:
+        return
+    now = datetime.utcnow()
+    for updated_at, command_class, managed_only in _iter_extra_inventory_items(target):
+        if _is_due(_get_inventory_due_date(updated_at, target.blueprint), now):
+            return command_class.create_for_target(
+                target,
+                kwargs={
+                    "managed_only": managed_only,
+                    "update_inventory": True
+                }
+            )
 
 
 def _get_next_queued_command(target, enrollment_session, status):
@@ -143,12 +190,9 @@ def _reenroll(target, enrollment_session, status):
     if not target.is_device:
         return
     enrolled_device = target.enrolled_device
-    # TODO configuration for the 90 days and 4 hours
+    # TODO configuration for the 4 hours
     # no certificate expiry or certificate expiry within the next 90 days
-    if (
-        enrolled_device.cert_not_valid_after is None
-        or enrolled_device.cert_not_valid_after - datetime.utcnow() < timedelta(days=90)
-    ):
+    if _is_due(_get_reenrollment_due_date(enrolled_device), datetime.utcnow()):
         # no other re-enrollment session for this enrolled device in the last 4 hours
         if ReEnrollmentSession.objects.filter(enrolled_device=enrolled_device,
                                               created_at__gt=datetime.utcnow() - timedelta(hours=4)).count() == 0:
@@ -222,41 +266,30 @@ def _remove_artifacts(target, enrollment_session, status):
 def _setup_filevault(target, enrollment_session, status):
     if status == RequestStatus.NOT_NOW:
         return
-    if not SetupFileVault.verify_target(target):
+    if not _filevault_config_needs_setup(target):
         # TODO: remove current FileVault config?
         return
     enrolled_device = target.enrolled_device
-    if enrolled_device.filevault_config_uuid != target.blueprint.filevault_config.uuid:
-        latest_cmd = (
-            DeviceCommand.objects.filter(name=SetupFileVault.get_db_name(),
-                                         enrolled_device=enrolled_device,
-                                         time__gte=datetime.utcnow() - timedelta(hours=4))
-                                 .order_by("-time")
-                                 .first()
-        )
-        if latest_cmd and latest_cmd.status != Command.Status.ACKNOWLEDGED:
-            # Backoff: the lastest SetupFileVault command sent in the last 4 hours has a bad status
-            # TODO: 4 hours hard-coded
-            return
-        return SetupFileVault.create_for_target(target)
+    latest_cmd = (
+        DeviceCommand.objects.filter(name=SetupFileVault.get_db_name(),
+                                     enrolled_device=enrolled_device,
+                                     time__gte=datetime.utcnow() - timedelta(hours=4))
+                             .order_by("-time")
+                             .first()
+    )
+    if latest_cmd and latest_cmd.status != Command.Status.ACKNOWLEDGED:
+        # Backoff: the lastest SetupFileVault command sent in the last 4 hours has a bad status
+        # TODO: 4 hours hard-coded
+        return
+    return SetupFileVault.create_for_target(target)
 
 
 def _rotate_filevault_key(target, enrollment_session, status):
     if status == RequestStatus.NOT_NOW:
         return
-    if not RotateFileVaultKey.verify_target(target):
-        return
-    try:
-        prk_rotation_interval_days = target.blueprint.filevault_config.prk_rotation_interval_days
-    except AttributeError:
-        return
     enrolled_device = target.enrolled_device
     now = datetime.utcnow()
-    if (
-        prk_rotation_interval_days > 0
-        and enrolled_device.filevault_prk_updated_at
-        and now - enrolled_device.filevault_prk_updated_at > timedelta(days=prk_rotation_interval_days)
-    ):
+    if _is_due(_get_filevault_prk_rotation_due_date(target), now):
         latest_cmd = (
             DeviceCommand.objects.filter(name=RotateFileVaultKey.get_db_name(),
                                          enrolled_device=enrolled_device,
@@ -274,38 +307,11 @@ def _rotate_filevault_key(target, enrollment_session, status):
 def _manage_recovery_password(target, enrollment_session, status):
     if status == RequestStatus.NOT_NOW:
         return
-    if not target.platform == Platform.MACOS:
-        return
-    if not target.is_device:
-        return
-    try:
-        recovery_password_config = target.blueprint.recovery_password_config
-    except AttributeError:
-        return
-    if not recovery_password_config:
-        return
-    for cmd_class in (SetRecoveryLock, SetFirmwarePassword):
-        if cmd_class.verify_target(target):
-            break
-    else:
+    recovery_password_config, cmd_class = _get_recovery_password_config_and_command_class(target)
+    if not cmd_class:
         return
     enrolled_device = target.enrolled_device
-    if (
-        enrolled_device.recovery_password
-        and (
-            not (
-                recovery_password_config.rotation_interval_days
-                and (
-                    enrolled_device.apple_silicon
-                    or recovery_password_config.rotate_firmware_password
-                )
-            )
-            or (enrolled_device.recovery_password_updated_at
-                and (datetime.utcnow() - enrolled_device.recovery_password_updated_at
-                     < timedelta(days=recovery_password_config.rotation_interval_days))
-                )
-        )
-    ):
+    if not _is_due(_get_recovery_password_due_date(enrolled_device, recovery_password_config), datetime.utcnow()):
         # recovery password set and recent enough
         return
     latest_cmd = (
@@ -352,7 +358,61 @@ def _finish_dep_enrollment_configuration(target, enrollment_session, status):
     return DeviceConfigured.create_for_target(target)
 
 
+def _get_idle_state_ttl(target, status):
+    """Return the number of seconds the target can be considered idle, if nothing else changes
+
+    Uses the same time based rules as the scheduling functions. None means no time based rule applies.
+    """
+    now = datetime.utcnow()
+    due_dates = []
+    # delayed queued commands
+    command_model, kwargs = target.get_db_command_model_and_kwargs()
+    due_dates.append(
+        command_model.objects.filter(time__isnull=True, not_before__gt=timezone.now(), **kwargs)
+                             .aggregate(min_not_before=Min("not_before"))["min_not_before"]
+    )
+    if status != RequestStatus.NOT_NOW:
+        # artifact reinstall intervals
+        included_types = None
+        if target.declarative_management:
+            # device profiles managed using declarative management
+            included_types = (Artifact.Type.ENTERPRISE_APP, Artifact.Type.STORE_APP)
+        due_dates.append(target.get_next_reinstall_due_date(included_types))
+        # declarations token
+        if target.declarative_management and DeclarativeManagement.verify_target(target):
+            declarations_token_ttl = declarations_cache.get_declarations_token_ttl(target)
+            if declarations_token_ttl is not None:
+                due_dates.append(now + timedelta(seconds=declarations_token_ttl))
+    if status != RequestStatus.NOT_NOW and target.is_device:
+        enrolled_device = target.enrolled_device
+        blueprint = target.blueprint
+        # inventory
+        for updated_at, _ in _iter_base_inventory_items(target):
+            due_dates.append(_get_inventory_due_date(updated_at, blueprint))
+        for updated_at, _, _ in _iter_extra_inventory_items(target):
+            due_dates.append(_get_inventory_due_date(updated_at, blueprint))
+        # re-enrollment
+        due_dates.append(_get_reenrollment_due_date(enrolled_device))
+        # FileVault
+        if _filevault_config_needs_setup(target):
+            # setup or backoff
+            due_dates.append(now)
+        due_dates.append(_get_filevault_prk_rotation_due_date(target))
+        # recovery password
+        recovery_password_config, cmd_class = _get_recovery_password_config_and_command_class(target)
+        if cmd_class:
+            due_dates.append(_get_recovery_password_due_date(enrolled_device, recovery_password_config))
+    due_dates = [due_date for due_date in due_dates if due_date is not None]
+    if not due_dates:
+        return
+    return (min(due_dates) - now).total_seconds()
+
+
 def get_next_command_response(target, enrollment_session, status):
+    # shortcut for the idle targets, the vast majority
+    idle, idle_token = next_action_cache.check(target, status)
+    if idle:
+        return HttpResponse()
     for next_command_func in (
         # first, take care of all the pending commands
         _get_next_queued_command,
@@ -372,4 +432,6 @@ def get_next_command_response(target, enrollment_session, status):
         command = next_command_func(target, enrollment_session, status)
         if command:
             return command.build_http_response(enrollment_session)
+    if idle_token:
+        next_action_cache.record_idle(idle_token, _get_idle_state_ttl(target, status))
     return HttpResponse()
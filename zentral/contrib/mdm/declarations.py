@@ -83,6 +83,16 @@ def get_legacy_profile_server_token(target, artifact, artifact_version):
     return ".".join(elements)
 
 
+def get_legacy_profile_server_token_ttl(target, artifact):
+    """Return the number of seconds before the legacy profile server token changes, or None"""
+    reinstall_interval = artifact["reinstall_interval"]
+    if not reinstall_interval:
+        return
+    interval = timedelta(seconds=reinstall_interval)
+    elapsed = datetime.utcnow() - target.target.created_at
+    return ((int(elapsed / interval) + 1) * interval - elapsed).total_seconds()
+
+
 def dump_legacy_profile_token(enrollment_session, target, artifact_version_pk):
     if not isinstance(artifact_version_pk, str):
         artifact_version_pk = str(artifact_version_pk)
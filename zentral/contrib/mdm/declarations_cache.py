@@ -0,0 +1,115 @@
+from datetime import datetime, timedelta
+import logging
+import math
+import time
+from django.core.cache import cache
+from django.utils.functional import SimpleLazyObject
+from prometheus_client import Counter
+from zentral.conf import settings
+from zentral.core.exceptions import ImproperlyConfigured
+from .declarations import get_legacy_profile_server_token_ttl
+from .models import Artifact
+from .next_action import next_action_cache
+from .software_updates import software_update_index
+
+
+logger = logging.getLogger("zentral.contrib.mdm.declarations_cache")
+
+
+declarations_cache_requests = Counter(
+    "zentral_mdm_declarations_cache_requests",
+    "MDM declarations cache requests",
+    ["channel", "result"]
+)
+
+
+class DeclarationsCache:
+    """Cache of the declarative management activation and declaration items of the MDM targets
+
+    The activation and declaration items depend on the blueprint, on the artifacts in scope,
+    on the target artifacts, and on some target attributes (OS version, client capabilities, …).
+    They are cached per target, with the target versions of the next action cache,
+    the software update index generation, and a fingerprint of the target attributes.
+
+    The TTL is bounded by the time based rules: the profile reinstall intervals,
+    and the end of the day for the software update enforcements.
+    """
+    default_max_ttl = 3600
+    # attributes updated by the declarative management, without effect on the declarations
+    fingerprint_extra_excluded_fields = {"declarative_management", "declarations_token"}
+
+    def __init__(self):
+        options = settings["apps"]["zentral.contrib.mdm"].get("declarations_cache", {})
+        try:
+            # 1h by default (min 0 → disabled, max 1d)
+            self.max_ttl = min(max(0, int(options.get("max_ttl", self.default_max_ttl))), 86400)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("MDM declarations cache max TTL must be an integer")
+
+    @staticmethod
+    def _state_key(target):
+        return "mdm-ddm_{}{}".format("d" if target.is_device else "u", target.target.pk)
+
+    @staticmethod
+    def get_declarations_token_ttl(target):
+        """Return the number of seconds before a time based rule changes the declarations token, or None"""
+        ttls = []
+        for artifact, _ in target.all_installed_or_to_install_serialized((Artifact.Type.PROFILE,)):
+            artifact_ttl = get_legacy_profile_server_token_ttl(target, artifact)
+            if artifact_ttl is not None:
+                ttls.append(artifact_ttl)
+        if target.software_update_enforcement:
+            # the available software updates depend on the date
+            now = datetime.now()
+            tomorrow = datetime.combine(now.date() + timedelta(days=1), datetime.min.time())
+            ttls.append((tomorrow - now).total_seconds())
+        return min(ttls, default=None)
+
+    def _get_ttl(self, target):
+        ttl = self.get_declarations_token_ttl(target)
+        if ttl is None:
+            return self.max_ttl
+        return min(self.max_ttl, ttl)
+
+    def get(self, target, build):
+        """Return the declarations of the target
+
+        build is called to build the declarations dict if no valid cached value is found.
+        """
+        if not self.max_ttl or target.blueprint is None or next_action_cache.has_pending_bump(target):
+            return build()
+        state_key = self._state_key(target)
+        values = cache.get_many([state_key,
+                                 software_update_index.generation_key,
+                                 *next_action_cache.get_target_version_keys(target)])
+        # the versions are read before the build, to detect the concurrent changes
+        versions = (software_update_index.get_generation(values),
+                    *next_action_cache.get_target_versions(target, values))
+        fingerprint = next_action_cache.get_target_fingerprint(
+            target,
+            extra_excluded_fields=self.fingerprint_extra_excluded_fields
+        )
+        state = values.get(state_key)
+        channel = target.channel.value
+        if (
+            state is not None
+            and state["versions"] == versions
+            and state["fingerprint"] == fingerprint
+            and state["expires_at"] > time.time()
+        ):
+            declarations_cache_requests.labels(channel, "hit").inc()
+            return state["declarations"]
+        declarations_cache_requests.labels(channel, "miss").inc()
+        declarations = build()
+        ttl = self._get_ttl(target)
+        if ttl >= 1:
+            cache.set(state_key,
+                      {"versions": versions,
+                       "fingerprint": fingerprint,
+                       "expires_at": time.time() + ttl,
+                       "declarations": declarations},
+                      math.ceil(ttl))
+        return declarations
+
+
+declarations_cache = SimpleLazyObject(lambda: DeclarationsCache())
@@ -1,4 +1,5 @@
 import base64
+import copy
 import datetime
 import json
 import logging
@@ -8,8 +9,10 @@ from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.x509.oid import NameOID
 from dateutil import parser
+from django.db import connection
 from django.urls import reverse
 from django.utils import timezone
+import psycopg2.extras
 from zentral.conf import settings
 from zentral.utils.certificates import split_certificate_chain
 from .crypto import decrypt_cms_payload_with_pem_privkey
@@ -167,6 +170,8 @@ def dep_device_update_dict(device, known_enrollments=None):
                         enrollment = DEPEnrollment.objects.get(uuid=val)
                     except DEPEnrollment.DoesNotExist:
                         logger.error("Unknown DEP profile %s", val)
+                    # also remember the unknown profiles
+                    known_enrollments[val] = enrollment
                 update_d["enrollment"] = enrollment
             update_d[attr] = val
 
@@ -185,7 +190,132 @@ def dep_device_update_dict(device, known_enrollments=None):
     return update_d
 
 
-def sync_dep_virtual_server_devices(dep_virtual_server, force_fetch=False):
+DEP_DEVICE_SYNC_PAGE_SIZE = 1000
+
+
+def _upsert_dep_devices(devices_defaults):
+    """Insert or update the DEP devices, with one query per set of attributes
+
+    Like update_or_create, only the attributes present in the defaults are updated,
+    and the missing attributes of the new devices are set to their default values.
+    Returns a serial number → (DEP device, created) dict.
+    """
+    fields = [DEPDevice._meta.get_field(attr)
+              for attr in ("serial_number", "virtual_server", "asset_tag", "color", "description",
+                           "device_family", "model", "os", "device_assigned_by", "device_assigned_date",
+                           "last_op_type", "last_op_date", "profile_status", "profile_uuid",
+                           "profile_assign_time", "profile_push_time", "enrollment",
+                           "created_at", "updated_at")]
+    skipped_update_attrs = {"serial_number", "created_at"}
+    now = datetime.datetime.utcnow()
+    # the devices are grouped by set of attributes, for example with or without the operations
+    grouped_rows = {}
+    for serial_number, defaults in devices_defaults.items():
+        values = {"serial_number": serial_number, "created_at": now, "updated_at": now}
+        values.update(defaults)
+        row = []
+        for field in fields:
+            value = values[field.name] if field.name in values else field.get_default()
+            if field.is_relation and value is not None:
+                value = value.pk
+            row.append(field.get_db_prep_save(value, connection))
+        grouped_rows.setdefault(frozenset(values.keys()), []).append(tuple(row))
+    table = DEPDevice._meta.db_table
+    columns = ", ".join(field.column for field in fields)
+    returned_fields = DEPDevice._meta.concrete_fields
+    returned_columns = ", ".join(field.column for field in returned_fields)
+    results = {}
+    with connection.cursor() as cursor:
+        for attrs, rows in grouped_rows.items():
+            updates = ", ".join(f"{field.column} = excluded.{field.column}"
+                                for field in fields
+                                if field.name in attrs and field.name not in skipped_update_attrs)
+            template = None
+            if all(field.name in attrs for field in fields):
+                query = (
+                    f"insert into {table} ({columns}) values %s "
+                    f"on conflict (serial_number) do update set {updates} "
+                    f"returning {returned_columns}, (xmax = 0) as created"
+                )
+            else:
+                # the inserted rows must pass the not null constraints, even if they conflict.
+                # the missing attributes are taken from the existing devices.
+                selected_columns = ", ".join(
+                    f"v.{field.column}" if field.name in attrs
+                    else f"case when e.serial_number is null then v.{field.column} else e.{field.column} end"
+                    for field in fields
+                )
+                query = (
+                    f"insert into {table} ({columns}) "
+                    f"select {selected_columns} from (values %s) as v ({columns}) "
+                    f"left join {table} e on (e.serial_number = v.serial_number) where true "
+                    f"on conflict (serial_number) do update set {updates} "
+                    f"returning {returned_columns}, (xmax = 0) as created"
+                )
+                # explicit types, for the values not directly inserted
+                template = "({})".format(", ".join(f"%s::{field.db_type(connection)}" for field in fields))
+            for row in psycopg2.extras.execute_values(cursor, query, rows, template=template,
+                                                      page_size=len(rows), fetch=True):
+                dep_device = DEPDevice.from_db(connection.alias,
+                                               [field.attname for field in returned_fields],
+                                               row[:-1])
+                results[dep_device.serial_number] = (dep_device, row[-1])
+    return results
+
+
+def _sync_dep_devices_page(dep_virtual_server, devices, fetch, known_enrollments):
+    last_op_dates = {}
+    if not fetch:
+        # one query to get the last operations of the existing devices
+        last_op_dates = dict(
+            DEPDevice.objects.filter(serial_number__in=set(device["serial_number"] for device in devices))
+                             .values_list("serial_number", "last_op_date")
+        )
+
+    # resolve the operations in memory
+    applied_ops = []
+    devices_defaults = {}
+    for device in devices:
+        serial_number = device["serial_number"]
+        defaults = {"virtual_server": dep_virtual_server}
+        if not fetch:
+            op_type = device["op_type"]
+            op_date = parser.parse(device["op_date"])
+            if timezone.is_aware(op_date):
+                op_date = timezone.make_naive(op_date)
+            last_op_date = last_op_dates.get(serial_number)
+            if last_op_date and last_op_date > op_date:
+                # already applied a newer operation. skip stalled one.
+                continue
+            last_op_dates[serial_number] = op_date
+            defaults["last_op_type"] = op_type
+            defaults["last_op_date"] = op_date
+        defaults.update(dep_device_update_dict(device, known_enrollments))
+        # the operations of a device are merged, like the successive updates they replace
+        device_defaults = devices_defaults.setdefault(serial_number, {})
+        device_defaults.update(defaults)
+        applied_ops.append((serial_number, dict(device_defaults)))
+
+    if not devices_defaults:
+        return
+
+    # one upsert per set of attributes for the whole page
+    results = _upsert_dep_devices(devices_defaults)
+
+    # same results as the previous per-device update_or_create
+    seen_serial_numbers = set()
+    for serial_number, op_defaults in applied_ops:
+        dep_device, created = results[serial_number]
+        if op_defaults != devices_defaults[serial_number]:
+            # not the last operation of the device in the page → device as updated by this operation
+            dep_device = copy.copy(dep_device)
+            for attr, value in op_defaults.items():
+                setattr(dep_device, attr, value)
+        yield dep_device, created and serial_number not in seen_serial_numbers
+        seen_serial_numbers.add(serial_number)
+
+
+def sync_dep_virtual_server_devices(dep_virtual_server, force_fetch=False, page_size=DEP_DEVICE_SYNC_PAGE_SIZE):
     dep_token = dep_virtual_server.token
     client = DEPClient.from_dep_token(dep_token)
     if force_fetch or not dep_token.sync_cursor:
@@ -200,10 +330,10 @@ def sync_dep_virtual_server_devices(dep_virtual_server, force_fetch=False):
     found_serial_numbers = []
     unassigned_serial_numbers = []
 
+    page = []
     for device in devices:
         serial_number = device["serial_number"]
         found_serial_numbers.append(serial_number)
-        defaults = {"virtual_server": dep_virtual_server}
 
         # default assignment
         if (
@@ -213,26 +343,12 @@ def sync_dep_virtual_server_devices(dep_virtual_server, force_fetch=False):
         ):
             unassigned_serial_numbers.append(serial_number)
 
-        # sync
-        if not fetch:
-            op_type = device["op_type"]
-            op_date = parser.parse(device["op_date"])
-            if timezone.is_aware(op_date):
-                op_date = timezone.make_naive(op_date)
-            try:
-                dep_device = DEPDevice.objects.get(serial_number=serial_number)
-            except DEPDevice.DoesNotExist:
-                dep_device = None
-            if dep_device and dep_device.last_op_date and dep_device.last_op_date > op_date:
-                # already applied a newer operation. skip stalled one.
-                continue
-            else:
-                defaults["last_op_type"] = op_type
-                defaults["last_op_date"] = op_date
-
-        defaults.update(dep_device_update_dict(device, known_enrollments))
-
-        yield DEPDevice.objects.update_or_create(serial_number=serial_number, defaults=defaults)
+        page.append(device)
+        if len(page) >= page_size:
+            yield from _sync_dep_devices_page(dep_virtual_server, page, fetch, known_enrollments)
+            page = []
+    if page:
+        yield from _sync_dep_devices_page(dep_virtual_server, page, fetch, known_enrollments)
     dep_token.sync_cursor = devices.cursor
     dep_token.last_synced_at = timezone.now()
     dep_token.save()
@@ -0,0 +1,244 @@
+from datetime import datetime
+import logging
+import math
+import random
+import uuid
+from django.core.cache import cache
+from django.db import connection
+from zentral.conf import settings
+from zentral.core.exceptions import ImproperlyConfigured
+from .apns import send_enrolled_device_notifications
+from .artifacts import Target, blueprint_plan_cache
+from .models import Channel, EnrolledDevice
+
+
+logger = logging.getLogger("zentral.contrib.mdm.fan_out")
+
+
+def get_serial_numbers_tag_ids(serial_numbers):
+    """Bulk version of the MetaMachine tags lookup, for the blueprint item scoping"""
+    tag_ids = {serial_number: set() for serial_number in serial_numbers}
+    if not serial_numbers:
+        return tag_ids
+    query = (
+        "select mt.serial_number, mt.tag_id "
+        "from inventory_machinetag as mt "
+        "where mt.serial_number = any(%(serial_numbers)s) "
+        "union "
+        "select cms.serial_number, mbut.tag_id "
+        "from inventory_currentmachinesnapshot as cms "
+        "join inventory_machinesnapshot as ms on (ms.id = cms.machine_snapshot_id) "
+        "join inventory_businessunit as bu on (bu.id = ms.business_unit_id) "
+        "join inventory_metabusinessunittag as mbut on (mbut.meta_business_unit_id = bu.meta_business_unit_id) "
+        "where cms.serial_number = any(%(serial_numbers)s)"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(query, {"serial_numbers": list(serial_numbers)})
+        for serial_number, tag_id in cursor.fetchall():
+            tag_ids[serial_number].add(tag_id)
+    return tag_ids
+
+
+class BlueprintNotificationFanOut:
+    """Notify the enrolled devices affected by a blueprint change
+
+    The notifications are spread over a time window, in waves of devices, with some jitter,
+    to avoid having all the devices checking in at the same time. The waves are planned once,
+    and each wave is sent by its own delayed task. The state of the fan out is kept in the Django cache.
+    A newer fan out for the same blueprint replaces the pending one, and includes its devices.
+    """
+    default_window = 1800
+    default_wave_size = 1000
+    default_jitter = 0.5
+    tag_lookup_batch_size = 1000
+    state_ttl_margin = 3600
+
+    def __init__(self, blueprint, artifact_pks=None, window=None, dry_run=False):
+        self.blueprint = blueprint
+        self.artifact_pks = sorted(set(str(pk) for pk in artifact_pks)) if artifact_pks else None
+        fan_out_conf = settings["apps"]["zentral.contrib.mdm"].get("apns", {}).get("fan_out", {})
+        try:
+            # 30 min by default (min 0, max 1d)
+            self.window = min(max(0, int(window if window is not None
+                                         else fan_out_conf.get("window", self.default_window))), 86400)
+            # waves of 1000 devices by default (min 1, max 100000)
+            self.wave_size = min(max(1, int(fan_out_conf.get("wave_size", self.default_wave_size))), 100000)
+            # random delay of up to 50% of the interval between two waves (min 0, max 1)
+            self.jitter = min(max(0, float(fan_out_conf.get("jitter", self.default_jitter))), 1)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("APNS fan out window, wave size and jitter must be numbers")
+        self.dry_run = dry_run
+        self._scoped_artifacts = None
+
+    # state
+
+    @staticmethod
+    def _get_state_key(blueprint_pk):
+        return f"mdm-bp-fo_{blueprint_pk}"
+
+    @staticmethod
+    def _get_counter_key(fan_out_id, counter):
+        return f"mdm-bp-fo-c_{fan_out_id}_{counter}"
+
+    @classmethod
+    def get_progress(cls, blueprint_pk):
+        """Return the state of the last fan out of a blueprint, with its counters, or None"""
+        state = cache.get(cls._get_state_key(blueprint_pk))
+        if state is None:
+            return
+        counter_keys = {counter: cls._get_counter_key(state["id"], counter)
+                        for counter in ("success", "failure", "waves")}
+        counters = cache.get_many(counter_keys.values())
+        state["devices"]["success"] = counters.get(counter_keys["success"], 0)
+        state["devices"]["failure"] = counters.get(counter_keys["failure"], 0)
+        state["sent_waves"] = counters.get(counter_keys["waves"], 0)
+        return state
+
+    @classmethod
+    def _incr_counter(cls, fan_out_id, counter, value, ttl):
+        key = cls._get_counter_key(fan_out_id, counter)
+        cache.add(key, 0, ttl)
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            # expired in the meantime
+            cache.set(key, value, ttl)
+
+    def _include_pending_fan_out(self):
+        progress = self.get_progress(self.blueprint.pk)
+        if progress is None or progress["sent_waves"] >= progress["waves"]:
+            return
+        # the pending fan out will be replaced → its devices must be included
+        if self.artifact_pks is not None:
+            if progress["artifact_pks"] is None:
+                self.artifact_pks = None
+            else:
+                self.artifact_pks = sorted(set(self.artifact_pks).union(progress["artifact_pks"]))
+
+    # scoping
+
+    def _get_scoped_artifacts(self):
+        if self._scoped_artifacts is None:
+            self._scoped_artifacts = []
+            blueprint_plan = blueprint_plan_cache.get(self.blueprint)
+            device_roots = blueprint_plan.channel_roots[Channel.DEVICE]
+            for artifact_pk in self.artifact_pks:
+                planned_artifact = blueprint_plan.artifacts.get(artifact_pk)
+                if planned_artifact is None or planned_artifact.channel != Channel.DEVICE:
+                    continue
+                # the blueprint artifacts through which the artifact is included, itself or the ones requiring it
+                roots = [root for root in device_roots if artifact_pk in root.required_closure]
+                self._scoped_artifacts.append((planned_artifact, roots))
+        return self._scoped_artifacts
+
+    def _is_in_scope(self, target):
+        if self.artifact_pks is None:
+            return True
+        for planned_artifact, roots in self._get_scoped_artifacts():
+            if not any(scope.test(target) for _, scope in planned_artifact.versions):
+                continue
+            if any(
+                root.scope.test(target)
+                and any(scope.test(target) for _, scope in root.versions)
+                for root in roots
+            ):
+                return True
+        return False
+
+    def _iter_enrolled_device_batch(self, enrolled_devices):
+        tag_ids = {}
+        if self.artifact_pks is not None:
+            tag_ids = get_serial_numbers_tag_ids(set(ed.serial_number for ed in enrolled_devices))
+        for enrolled_device in enrolled_devices:
+            target = Target(enrolled_device)
+            if self.artifact_pks is not None:
+                target.tag_ids = tag_ids.get(enrolled_device.serial_number, set())
+            if self._is_in_scope(target):
+                yield enrolled_device
+
+    def iter_enrolled_devices(self):
+        qs = (EnrolledDevice.objects.select_related("push_certificate")
+                                    .filter(blueprint=self.blueprint, checkout_at__isnull=True)
+                                    .order_by("pk"))
+        batch = []
+        for enrolled_device in qs.iterator():
+            # the blueprint is shared
+            enrolled_device.blueprint = self.blueprint
+            batch.append(enrolled_device)
+            if len(batch) >= self.tag_lookup_batch_size:
+                yield from self._iter_enrolled_device_batch(batch)
+                batch = []
+        if batch:
+            yield from self._iter_enrolled_device_batch(batch)
+
+    # scheduling
+
+    def plan(self):
+        """Return the list of (delay in seconds, [enrolled devices]) waves"""
+        enrolled_devices = [ed for ed in self.iter_enrolled_devices() if ed.can_be_poked()]
+        random.shuffle(enrolled_devices)
+        wave_count = math.ceil(len(enrolled_devices) / self.wave_size)
+        if not wave_count:
+            return []
+        interval = self.window / wave_count
+        waves = []
+        for i in range(wave_count):
+            delay = i * interval
+            if i > 0:
+                delay += random.uniform(-1, 1) * self.jitter * interval / 2
+            waves.append((delay, enrolled_devices[i * self.wave_size:(i + 1) * self.wave_size]))
+        return waves
+
+    def start(self):
+        """Plan the waves, schedule one task per wave, and return the state of the fan out"""
+        if not self.dry_run:
+            self._include_pending_fan_out()
+        waves = self.plan()
+        ttl = self.window + self.state_ttl_margin
+        state = {"id": uuid.uuid4().hex,
+                 "blueprint": {"pk": self.blueprint.pk, "name": self.blueprint.name},
+                 "artifact_pks": self.artifact_pks,
+                 "dry_run": self.dry_run,
+                 "window": self.window,
+                 "ttl": ttl,
+                 "created_at": datetime.utcnow().isoformat(),
+                 "waves": len(waves),
+                 "devices": {"total": sum(len(eds) for _, eds in waves),
+                             "success": 0,
+                             "failure": 0}}
+        if self.dry_run or not waves:
+            return state
+        # replace the pending fan out, if any
+        cache.set(self._get_state_key(self.blueprint.pk), state, ttl)
+        from .tasks import fan_out_blueprint_notifications_wave_task  # circular dependency
+        for wave_num, (delay, enrolled_devices) in enumerate(waves, 1):
+            fan_out_blueprint_notifications_wave_task.apply_async(
+                (self.blueprint.pk, state["id"], wave_num, [ed.pk for ed in enrolled_devices]),
+                countdown=delay
+            )
+        return state
+
+    @classmethod
+    def run_wave(cls, blueprint_pk, fan_out_id, wave_num, enrolled_device_pks):
+        """Send the notifications of a wave, if its fan out has not been replaced"""
+        state = cache.get(cls._get_state_key(blueprint_pk))
+        if state is None or state["id"] != fan_out_id:
+            logger.info("Blueprint %s fan out %s: skip replaced or expired wave %s",
+                        blueprint_pk, fan_out_id, wave_num)
+            return
+        devices = {"success": 0, "failure": 0}
+        enrolled_devices = (EnrolledDevice.objects.select_related("push_certificate")
+                                                  .filter(pk__in=enrolled_device_pks,
+                                                          blueprint__pk=blueprint_pk,
+                                                          checkout_at__isnull=True))
+        for _, success in send_enrolled_device_notifications(enrolled_devices):
+            devices["success" if success else "failure"] += 1
+        for counter, value in (("success", devices["success"]),
+                               ("failure", devices["failure"]),
+                               ("waves", 1)):
+            if value:
+                cls._incr_counter(fan_out_id, counter, value, state["ttl"])
+        return {"blueprint": state["blueprint"],
+                "fan_out": fan_out_id,
+                "wave": wave_num,
+                "devices": devices}
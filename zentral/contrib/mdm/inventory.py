@@ -1,5 +1,6 @@
 import logging
 from django.db import connection
+from zentral.contrib.inventory.cache import machine_info_cache
 from zentral.contrib.inventory.models import PrincipalUserSource
 from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
 from zentral.contrib.mdm.models import Blueprint, Command, DeviceCommand, Platform
@@ -214,8 +215,9 @@ def update_realm_tags(realm):
     cursor = connection.cursor()
     cursor.execute(query, {"realm_pk": realm.pk})
     columns = [col[0] for col in cursor.description]
-    for result in cursor.fetchall():
-        yield dict(zip(columns, result))
+    results = [dict(zip(columns, result)) for result in cursor.fetchall()]
+    machine_info_cache.bump_machines(result["serial_number"] for result in results)
+    yield from results
 
 
 def realm_tagging_change_receiver(sender, **kwargs):
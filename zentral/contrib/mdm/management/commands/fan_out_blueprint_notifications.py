@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from zentral.contrib.mdm.fan_out import BlueprintNotificationFanOut
+from zentral.contrib.mdm.models import Blueprint
+
+
+class Command(BaseCommand):
+    help = 'Notify the devices affected by a blueprint change, in jittered waves'
+
+    def add_arguments(self, parser):
+        parser.add_argument('blueprint_pk', type=int)
+        parser.add_argument('--artifact', action='append', dest='artifact_pks', default=None,
+                            help='only the devices in scope for this artifact (can be repeated)')
+        parser.add_argument('--window', type=int, default=None,
+                            help='time window in seconds to spread the notifications')
+        parser.add_argument('--dry-run', action='store_true', help='only display the number of devices')
+
+    def handle(self, *args, **kwargs):
+        try:
+            blueprint = Blueprint.objects.get(pk=kwargs["blueprint_pk"])
+        except Blueprint.DoesNotExist:
+            raise CommandError("Unknown blueprint")
+        result = BlueprintNotificationFanOut(
+            blueprint, kwargs["artifact_pks"],
+            window=kwargs["window"], dry_run=kwargs["dry_run"]
+        ).start()
+        self.stdout.write(f"{result['devices']['total']} device(s), {result['waves']} wave(s) "
+                          f"over {result['window']}s")
+        if result["waves"] and not result["dry_run"]:
+            self.stdout.write(f"Fan out {result['id']} scheduled")
@@ -1,6 +1,6 @@
 from django.core.management.base import BaseCommand
 from zentral.contrib.mdm.models import EnrolledDevice
-from zentral.contrib.mdm.apns import send_enrolled_device_notification
+from zentral.contrib.mdm.apns import send_enrolled_device_notifications
 from zentral.core.queues import queues
 
 
@@ -10,19 +10,14 @@ class Command(BaseCommand):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-    def handle(self, *args, **kwargs):
-        for d in EnrolledDevice.objects.select_related("push_certificate").all():
-            self.stdout.write(f"Device {d.serial_number} {d.udid}", ending=" ")
+    def iter_enrolled_devices(self):
+        for d in EnrolledDevice.objects.select_related("push_certificate").iterator():
             if not d.can_be_poked():
-                self.stdout.write("Skipped")
+                self.stdout.write(f"Device {d.serial_number} {d.udid} Skipped")
                 continue
-            success = False
-            try:
-                success = send_enrolled_device_notification(d)
-            except Exception:
-                pass
-            if success:
-                self.stdout.write("OK")
-            else:
-                self.stdout.write("Failure")
+            yield d
+
+    def handle(self, *args, **kwargs):
+        for d, success in send_enrolled_device_notifications(self.iter_enrolled_devices()):
+            self.stdout.write(f"Device {d.serial_number} {d.udid} {'OK' if success else 'Failure'}")
         queues.stop()
@@ -11,6 +11,8 @@ class Command(BaseCommand):
                             help='list existing apps & books locations')
         parser.add_argument('--location', dest='location_ids', type=int, nargs=1,
                             help='sync apps & books locations assets')
+        parser.add_argument('--restart', action='store_true', dest='restart', default=False,
+                            help='ignore the checkpoints of the interrupted syncs')
 
     def handle(self, *args, **kwargs):
         location_qs = Location.objects.all().order_by("name")
@@ -24,4 +26,4 @@ class Command(BaseCommand):
             location_qs = location_qs.filter(pk__in=location_ids)
         for location in location_qs:
             self.stdout.write(f"Sync apps & books for location {location.pk} {location}")
-            sync_assets(location)
+            sync_assets(location, resume=not kwargs.get('restart'))
@@ -0,0 +1,313 @@
+import hashlib
+import json
+import logging
+import math
+import time
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+from prometheus_client import Counter
+from zentral.conf import settings
+from zentral.contrib.inventory.cache import machine_info_cache
+from zentral.core.exceptions import ImproperlyConfigured
+from .models import EnrolledDevice
+
+
+logger = logging.getLogger("zentral.contrib.mdm.next_action")
+
+
+next_action_cache_requests = Counter(
+    "zentral_mdm_next_action_cache_requests",
+    "MDM next action cache requests",
+    ["channel", "result"]
+)
+
+
+class _PendingBump:
+    """Versions to bump once the current transaction is committed"""
+
+    def __init__(self, next_action_cache):
+        self.next_action_cache = next_action_cache
+        self.target_ids = set()
+        self.all = False
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        if self.all:
+            self.next_action_cache._bump_all()
+        if self.target_ids:
+            self.next_action_cache._bump_targets(self.target_ids)
+
+
+class NextActionCache:
+    """Cache of the MDM targets idle state
+
+    When a full pass of the command scheduling returns nothing, the target is recorded as idle,
+    with a fingerprint of the target scheduling attributes, and an expiry computed from
+    the time based scheduling rules (inventory intervals, certificate expiry, key rotations, …).
+
+    The idle state is only valid for the versions it was recorded with:
+    - the per-target version, bumped when the commands, artifacts or asset associations of the target change,
+    - the global version, bumped when the blueprints, artifacts or configurations change,
+    - the machine info cache versions, for the tag changes.
+
+    An idle Connect request with a valid state costs a single cache round trip.
+    """
+    global_version_key = "mdm-na-gv"
+    pending_bumps_attr = "_mdm_next_action_pending_bumps"
+    # the target versions are shared with the declarations cache, and kept even if this cache is disabled
+    target_version_ttl = 86400
+    default_max_ttl = 900
+    fingerprint_excluded_fields = {
+        # notifications and timestamps
+        "token", "push_magic",
+        "last_seen_at", "last_notified_at", "notification_queued_at",
+        "updated_at",
+        # big blobs, the *_updated_at attributes are enough
+        "device_information", "security_info",
+    }
+
+    def __init__(self):
+        options = settings["apps"]["zentral.contrib.mdm"].get("next_action_cache", {})
+        try:
+            # 15 min by default (min 0 → disabled, max 1d)
+            self.max_ttl = min(max(0, int(options.get("max_ttl", self.default_max_ttl))), 86400)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("MDM next action cache max TTL must be an integer")
+
+    # keys & versions
+
+    @staticmethod
+    def _target_id(channel_prefix, pk):
+        return f"{channel_prefix}{pk}"
+
+    def _get_target_id(self, target):
+        return self._target_id("d" if target.is_device else "u", target.target.pk)
+
+    @staticmethod
+    def _target_version_key(target_id):
+        return f"mdm-na-v_{target_id}"
+
+    @staticmethod
+    def _state_key(target_id):
+        return f"mdm-na_{target_id}"
+
+    @staticmethod
+    def _new_version():
+        return uuid.uuid4().hex
+
+    def _get_or_create_version(self, key, versions, timeout):
+        version = versions.get(key)
+        if version is None:
+            # new random version, so that states recorded with an evicted version are never used
+            cache.add(key, self._new_version(), timeout)
+            version = cache.get(key)
+        return version
+
+    def _bump_targets(self, target_ids):
+        cache.set_many({self._target_version_key(target_id): self._new_version()
+                        for target_id in target_ids},
+                       self.target_version_ttl)
+
+    def _get_pending_bumps(self, connection):
+        run_on_commit, pending_bumps = getattr(connection, self.pending_bumps_attr, (None, []))
+        if run_on_commit is not connection.run_on_commit:
+            # new transaction, or rolled back savepoint → only keep the bumps still registered
+            pending_bumps = [(savepoint_ids, pending_bump)
+                             for savepoint_ids, pending_bump in pending_bumps
+                             if any(func is pending_bump for _, func, _ in connection.run_on_commit)]
+            setattr(connection, self.pending_bumps_attr, (connection.run_on_commit, pending_bumps))
+        return pending_bumps
+
+    def _get_pending_bump(self):
+        """Return the bump to run once the current transaction is committed, None in autocommit mode
+
+        A single deduplicated bump is registered per transaction and savepoint,
+        so that it is discarded with the changes if the savepoint is rolled back.
+        """
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            return
+        pending_bumps = self._get_pending_bumps(connection)
+        savepoint_ids = tuple(connection.savepoint_ids)
+        for pending_bump_savepoint_ids, pending_bump in reversed(pending_bumps):
+            if pending_bump_savepoint_ids == savepoint_ids and not pending_bump.done:
+                return pending_bump
+        pending_bump = _PendingBump(self)
+        transaction.on_commit(pending_bump)
+        pending_bumps.append((savepoint_ids, pending_bump))
+        return pending_bump
+
+    def bump_targets(self, target_ids):
+        """Invalidate the idle state of the targets
+
+        In a transaction, the versions are bumped once it is committed, because a concurrent request
+        could record an idle state with the previous data until then. The targets with a pending bump
+        are never idle in the transaction.
+        """
+        target_ids = set(target_ids)
+        if not target_ids:
+            return
+        pending_bump = self._get_pending_bump()
+        if pending_bump is None:
+            self._bump_targets(target_ids)
+        else:
+            pending_bump.target_ids.update(target_ids)
+
+    def has_pending_bump(self, target):
+        """Return True if the target versions will be bumped when the current transaction is committed"""
+        connection = transaction.get_connection()
+        if not connection.in_atomic_block:
+            return False
+        target_id = None
+        for _, pending_bump in self._get_pending_bumps(connection):
+            if pending_bump.done:
+                continue
+            if pending_bump.all:
+                return True
+            if target_id is None:
+                target_id = self._get_target_id(target)
+            if target_id in pending_bump.target_ids:
+                return True
+        return False
+
+    def bump_device(self, enrolled_device_pk):
+        self.bump_targets([self._target_id("d", enrolled_device_pk)])
+
+    def bump_user(self, enrolled_user_pk):
+        self.bump_targets([self._target_id("u", enrolled_user_pk)])
+
+    def bump_serial_numbers(self, serial_numbers):
+        """Invalidate the idle state of the enrolled devices with these serial numbers"""
+        serial_numbers = set(serial_numbers)
+        if serial_numbers:
+            self.bump_targets(
+                self._target_id("d", enrolled_device_pk)
+                for enrolled_device_pk in (EnrolledDevice.objects.filter(serial_number__in=serial_numbers)
+                                                                 .values_list("pk", flat=True))
+            )
+
+    def _bump_all(self):
+        cache.set(self.global_version_key, self._new_version(), None)
+
+    def bump_all(self):
+        """Invalidate the idle state of all the targets"""
+        pending_bump = self._get_pending_bump()
+        if pending_bump is None:
+            self._bump_all()
+        else:
+            pending_bump.all = True
+
+    def get_target_version_keys(self, target):
+        """Return the list of the cache keys of the target versions
+
+        Used to fetch the versions with the other cache keys in a single round trip.
+        """
+        target_id = self._get_target_id(target)
+        return [self.global_version_key,
+                self._target_version_key(target_id),
+                *machine_info_cache.get_version_keys(target.serial_number)]
+
+    def get_target_versions(self, target, values):
+        """Return the tuple of the target versions, using the values fetched with the version keys"""
+        target_version_key = self._target_version_key(self._get_target_id(target))
+        return (
+            self._get_or_create_version(self.global_version_key, values, None),
+            self._get_or_create_version(target_version_key, values, self.target_version_ttl),
+            *machine_info_cache.get_versions(target.serial_number, values),
+        )
+
+    # fingerprint
+
+    def _iter_fingerprint_items(self, obj, excluded_fields):
+        for field in obj._meta.concrete_fields:
+            if field.attname not in excluded_fields:
+                yield field.attname, field.value_from_object(obj)
+
+    @staticmethod
+    def _json_default(value):
+        if isinstance(value, (bytes, memoryview)):
+            # the default str() of a memoryview includes its memory address
+            return bytes(value).hex()
+        return str(value)
+
+    def get_target_fingerprint(self, target, extra_items=None, extra_excluded_fields=None):
+        """Return a fingerprint of the target scheduling attributes"""
+        excluded_fields = self.fingerprint_excluded_fields
+        if extra_excluded_fields:
+            excluded_fields = excluded_fields | set(extra_excluded_fields)
+        items = {"device": dict(self._iter_fingerprint_items(target.enrolled_device, excluded_fields))}
+        if not target.is_device:
+            items["user"] = dict(self._iter_fingerprint_items(target.enrolled_user, excluded_fields))
+        if extra_items:
+            items.update(extra_items)
+        data = json.dumps(items, sort_keys=True, default=self._json_default)
+        return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+    # idle state
+
+    def check(self, target, status):
+        """Return a (idle, token) tuple
+
+        The token must be used to record the idle state of the target after a full scheduling pass.
+        """
+        if not self.max_ttl or target.awaiting_configuration:
+            return False, None
+        if self.has_pending_bump(target):
+            # changed in the current transaction
+            next_action_cache_requests.labels(target.channel.value, "miss").inc()
+            return False, None
+        state_key = self._state_key(self._get_target_id(target))
+        values = cache.get_many([state_key, *self.get_target_version_keys(target)])
+        versions = self.get_target_versions(target, values)
+        fingerprint = self.get_target_fingerprint(target, {"status": status.value})
+        state = values.get(state_key)
+        channel = target.channel.value
+        if (
+            state is not None
+            and state["versions"] == versions
+            and state["fingerprint"] == fingerprint
+            and state["expires_at"] > time.time()
+        ):
+            next_action_cache_requests.labels(channel, "idle").inc()
+            return True, None
+        next_action_cache_requests.labels(channel, "miss").inc()
+        # the versions are read before the full pass, to detect the concurrent changes
+        return False, (state_key, versions, fingerprint)
+
+    def record_idle(self, token, ttl):
+        """Record the idle state of a target
+
+        ttl is the number of seconds until the next time based scheduling rule is due (None → max TTL).
+        """
+        if token is None:
+            return
+        ttl = self.max_ttl if ttl is None else min(ttl, self.max_ttl)
+        if ttl < 1:
+            return
+        state_key, versions, fingerprint = token
+        cache.set(state_key,
+                  {"versions": versions,
+                   "fingerprint": fingerprint,
+                   "expires_at": time.time() + ttl},
+                  math.ceil(ttl))
+
+
+next_action_cache = SimpleLazyObject(lambda: NextActionCache())
+
+
+# receivers
+
+
+def device_target_change_receiver(sender, instance, **kwargs):
+    next_action_cache.bump_device(instance.enrolled_device_id)
+
+
+def user_target_change_receiver(sender, instance, **kwargs):
+    next_action_cache.bump_user(instance.enrolled_user_id)
+
+
+def configuration_change_receiver(sender, instance, **kwargs):
+    next_action_cache.bump_all()
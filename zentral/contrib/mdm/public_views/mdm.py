@@ -13,6 +13,7 @@ from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirec
 from django.shortcuts import get_object_or_404
 from django.utils.functional import cached_property
 from django.views.generic import View
+from zentral.contrib.inventory.cache import machine_info_cache
 from zentral.contrib.inventory.models import MachineTag, MetaBusinessUnit
 from zentral.contrib.mdm.artifacts import Target
 from zentral.contrib.mdm.commands.install_profile import build_payload
@@ -283,6 +284,8 @@ class CheckinView(MDMView):
                     MachineTag(serial_number=self.serial_number, tag=tag_to_add)
                     for tag_to_add in tags_to_add
                 ), ignore_conflicts=True)
+                # no signals with bulk_create
+                machine_info_cache.bump_machines([self.serial_number])
             # remove the other ones that are automatically managed
             if tags_to_remove:
                 MachineTag.objects.filter(serial_number=self.serial_number, tag__in=tags_to_remove).delete()
@@ -1,9 +1,11 @@
+import bisect
 import datetime
 import logging
 import math
+import threading
 import uuid
+from django.core.cache import cache
 from django.db import transaction
-from django.db.models import Q
 import requests
 from zentral.core.events.base import AuditEvent
 from zentral.utils.os_version import make_comparable_os_version
@@ -90,11 +92,114 @@ def sync_software_updates():
             event_index += 1
             su.delete()
             result["deleted"] += 1
+        software_update_index.bump()
     for event in events:
         event.post()
     return result
 
 
+class SoftwareUpdateIndex:
+    """In-memory index of the available software updates
+
+    Built from the software updates and their device IDs, and rebuilt when the generation
+    stored in the Django cache changes. The generation is bumped after each sync,
+    and each time a software update is saved or deleted.
+
+    For each (device ID, build), the candidates are sorted by OS version,
+    to find the best ones below a max OS version with a binary search.
+    """
+    generation_key = "mdm-su-gen"
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._generation = None
+        self._device_id_software_updates = {}
+        self._candidates = {}
+
+    # generation
+
+    def _bump(self):
+        cache.set(self.generation_key, uuid.uuid4().hex, None)
+
+    def bump(self):
+        """Invalidate the index in all the processes
+
+        The generation is bumped again once the transaction is committed, in case a concurrent process
+        has rebuilt its index in the meantime.
+        """
+        self._bump()
+        transaction.on_commit(self._bump)
+
+    def get_generation(self, values=None):
+        """Return the current generation
+
+        values can be a dict of pre-fetched cache values, to avoid an extra cache round trip.
+        """
+        if values is not None:
+            generation = values.get(self.generation_key)
+        else:
+            generation = cache.get(self.generation_key)
+        if generation is None:
+            # new random generation, so that the indexes built with an evicted generation are never used
+            cache.add(self.generation_key, uuid.uuid4().hex, None)
+            generation = cache.get(self.generation_key)
+        return generation
+
+    # index
+
+    def _build(self, generation):
+        software_updates = {
+            software_update.pk: software_update
+            # only the non-public or RSR software updates are available
+            for software_update in SoftwareUpdate.objects.exclude(public=True, extra="")
+        }
+        device_id_software_updates = {}
+        for software_update_id, device_id in SoftwareUpdateDeviceID.objects.filter(
+            software_update__in=software_updates.keys()
+        ).values_list("software_update_id", "device_id"):
+            device_id_software_updates.setdefault(device_id, []).append(software_updates[software_update_id])
+        for device_software_updates in device_id_software_updates.values():
+            device_software_updates.sort(key=lambda su: (su.major, su.minor, su.patch, su.extra))
+        self._device_id_software_updates = device_id_software_updates
+        self._candidates = {}
+        self._generation = generation
+        logger.debug("Software update index built: %s software update(s), %s device ID(s)",
+                     len(software_updates), len(device_id_software_updates))
+
+    def _get_candidates(self, device_id, build):
+        generation = self.get_generation()
+        with self._lock:
+            if generation != self._generation:
+                self._build(generation)
+            key = (device_id, build)
+            candidates = self._candidates.get(key)
+            if candidates is None:
+                software_updates = [
+                    software_update
+                    for software_update in self._device_id_software_updates.get(device_id, [])
+                    if not software_update.prerequisite_build or software_update.prerequisite_build == build
+                ]
+                candidates = ([software_update.comparable_os_version for software_update in software_updates],
+                              software_updates)
+                self._candidates[key] = candidates
+            return candidates
+
+    def iter_available(self, device_id, build, date, max_comparable_os_version):
+        """Yield the software updates available on the date, below the max OS version, best first"""
+        comparable_os_versions, software_updates = self._get_candidates(device_id, build)
+        idx = bisect.bisect_left(comparable_os_versions, max_comparable_os_version)
+        for software_update in reversed(software_updates[:idx]):
+            if date in software_update.availability:
+                yield software_update
+
+
+software_update_index = SoftwareUpdateIndex()
+
+
+def software_update_change_receiver(sender, instance, **kwargs):
+    software_update_index.bump()
+
+
 def iter_available_software_updates_for_device_id_and_build(device_id, build, date=None, max_os_version=None):
     if date is None:
         date = datetime.date.today()
@@ -102,20 +207,7 @@ def iter_available_software_updates_for_device_id_and_build(device_id, build, da
         max_comparable_os_version = make_comparable_os_version(max_os_version)
     else:
         max_comparable_os_version = (math.inf,)
-    for software_update in SoftwareUpdate.objects.filter(
-        Q(public=False) | Q(extra__gt=""),
-        Q(prerequisite_build="") | Q(prerequisite_build=build),
-        availability__contains=date,
-        softwareupdatedeviceid__device_id=device_id
-    ).order_by(
-        "-major",
-        "-minor",
-        "-patch",
-        "-extra",
-    ):
-        if software_update.comparable_os_version >= max_comparable_os_version:
-            continue
-        yield software_update
+    yield from software_update_index.iter_available(device_id, build, date, max_comparable_os_version)
 
 
 def best_available_software_update_for_device_id_and_build(device_id, build, date=None, max_os_version=None):
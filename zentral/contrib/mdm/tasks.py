@@ -1,7 +1,8 @@
 import logging
 from celery import shared_task
 from .dep import sync_dep_virtual_server_devices, DEPClientError
-from .models import DEPVirtualServer
+from .fan_out import BlueprintNotificationFanOut
+from .models import Blueprint, DEPVirtualServer
 from .software_updates import sync_software_updates
 
 
@@ -48,3 +49,18 @@ def sync_dep_virtual_server_devices_task(dep_virtual_server_pk):
 @shared_task
 def sync_software_updates_task():
     return sync_software_updates()
+
+
+#
+# Notifications fan out
+#
+
+@shared_task
+def fan_out_blueprint_notifications_task(blueprint_pk, artifact_pks=None, dry_run=False):
+    blueprint = Blueprint.objects.get(pk=blueprint_pk)
+    return BlueprintNotificationFanOut(blueprint, artifact_pks, dry_run=dry_run).start()
+
+
+@shared_task
+def fan_out_blueprint_notifications_wave_task(blueprint_pk, fan_out_id, wave_num, enrolled_device_pks):
+    return BlueprintNotificationFanOut.run_wave(blueprint_pk, fan_out_id, wave_num, enrolled_device_pks)
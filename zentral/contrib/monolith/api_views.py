@@ -92,7 +92,8 @@ class SyncRepository(APIView):
         post_monolith_sync_catalogs_request(request, self.db_repository)
         repository = load_repository_backend(self.db_repository)
         self.initialize_events(request)
-        repository.sync_catalogs(self.audit_callback)
+        force = isinstance(request.data, dict) and request.data.get("force") is True
+        repository.sync_catalogs(self.audit_callback, force=force)
         transaction.on_commit(lambda: self.post_events())
         return Response({"status": 0})
 
@@ -0,0 +1,175 @@
+import logging
+import time
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+from prometheus_client import Counter
+from zentral.conf import settings
+from zentral.contrib.inventory.models import Tag
+from zentral.core.exceptions import ImproperlyConfigured
+from .utils import serialize_catalog_fragments
+
+
+logger = logging.getLogger("zentral.contrib.monolith.manifest_cache")
+
+
+manifest_cache_requests = Counter(
+    "zentral_monolith_manifest_cache_requests",
+    "Monolith manifest cache requests",
+    ["model", "result"]
+)
+
+
+class ManifestCache:
+    """Stampede-protected cache of the manifest catalogs and manifests
+
+    The entries are stored with the manifest version, under a key that only depends on
+    the manifest, the machine tags and the requested object. When the manifest version is bumped,
+    a single request – or the pre-warm task – rebuilds the entry, while the other requests
+    keep getting the previous version. The first build of an entry is single-flight too,
+    the other requests wait for it.
+
+    The tag sets seen by the views are recorded per manifest, to be able to pre-warm
+    the new manifest versions in a background task.
+    """
+    lock_poll_interval = 0.1
+    max_tag_sets = 100
+
+    def __init__(self):
+        options = settings["apps"]["zentral.contrib.monolith"].get("manifest_cache", {})
+        try:
+            # 60s by default (min 1, max 10min)
+            self.lock_timeout = min(max(1, int(options.get("lock_timeout", 60))), 600)
+            # 10s by default (min 0 → no wait, max 1min)
+            self.lock_wait = min(max(0, float(options.get("lock_wait", 10))), 60)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Monolith manifest cache lock timeout and lock wait must be numbers")
+        self.prewarm = bool(options.get("prewarm", False))
+
+    # keys
+
+    @staticmethod
+    def get_cache_key(manifest_pk, tag_ids, model, key):
+        return ".".join(str(i) for i in ["monolith-mc", manifest_pk, *tag_ids, model, key])
+
+    @staticmethod
+    def _tag_sets_key(manifest_pk):
+        return f"monolith-mc.{manifest_pk}.tag-sets"
+
+    # entries
+
+    @staticmethod
+    def _get_entry(cache_key):
+        try:
+            version, data = cache.get(cache_key)
+        except (TypeError, ValueError):
+            return None, None
+        return version, data
+
+    def _acquire(self, cache_key):
+        token = uuid.uuid4().hex
+        if cache.add(f"{cache_key}.lock", token, timeout=self.lock_timeout):
+            return token
+
+    @staticmethod
+    def _release(cache_key, token):
+        lock_key = f"{cache_key}.lock"
+        if cache.get(lock_key) == token:
+            cache.delete(lock_key)
+
+    def _record_tag_ids(self, manifest_pk, tag_ids):
+        tag_sets_key = self._tag_sets_key(manifest_pk)
+        tag_sets = cache.get(tag_sets_key) or []
+        if tag_ids in tag_sets:
+            return
+        tag_sets.append(tag_ids)
+        cache.set(tag_sets_key, tag_sets[-self.max_tag_sets:], timeout=None)
+
+    def _get(self, manifest, tags, model, key, build_func):
+        tag_ids = sorted(t.id for t in tags)
+        cache_key = self.get_cache_key(manifest.pk, tag_ids, model, key)
+        version = manifest.version
+        cached_version, data = self._get_entry(cache_key)
+        if cached_version is not None and cached_version >= version:
+            manifest_cache_requests.labels(model, "hit").inc()
+            return cache_key, data, True
+        token = self._acquire(cache_key)
+        if token:
+            try:
+                data = build_func()
+                cache.set(cache_key, (version, data), timeout=None)
+            finally:
+                self._release(cache_key, token)
+            self._record_tag_ids(manifest.pk, tag_ids)
+            manifest_cache_requests.labels(model, "miss").inc()
+            return cache_key, data, False
+        if cached_version is not None:
+            # new version being built → previous version
+            manifest_cache_requests.labels(model, "stale").inc()
+            return cache_key, data, True
+        # first build in progress → wait for it
+        deadline = time.monotonic() + self.lock_wait
+        while time.monotonic() < deadline:
+            time.sleep(self.lock_poll_interval)
+            cached_version, data = self._get_entry(cache_key)
+            if cached_version is not None:
+                manifest_cache_requests.labels(model, "wait").inc()
+                return cache_key, data, True
+        logger.warning("Manifest %s %s build: lock wait timeout", manifest.pk, model)
+        manifest_cache_requests.labels(model, "miss").inc()
+        return cache_key, build_func(), False
+
+    # public API
+
+    def get_catalog(self, manifest, tags):
+        """Return the cache key, the pre-serialized catalog fragments, and True if they were found in the cache"""
+        return self._get(manifest, tags, "manifest_catalog", manifest.pk,
+                         lambda: serialize_catalog_fragments(manifest.build_catalog(tags)))
+
+    def get_manifest(self, manifest, tags):
+        """Return the cache key, the serialized manifest, and True if it was found in the cache"""
+        return self._get(manifest, tags, "manifest", manifest.pk,
+                         lambda: manifest.serialize(tags))
+
+    def schedule_refresh(self, manifest):
+        """Refresh the pkginfo closure of the new manifest version in a background task
+
+        The cache entries are pre-warmed in the same task if enabled.
+        """
+        # circular dependency
+        from .tasks import prewarm_manifest_cache_task, refresh_manifest_pkginfo_closure_task
+        task = prewarm_manifest_cache_task if self.prewarm else refresh_manifest_pkginfo_closure_task
+        manifest_pk = manifest.pk
+        transaction.on_commit(lambda: task.apply_async((manifest_pk,)))
+
+    def schedule_stale_closure_refresh(self, manifest):
+        """Schedule the refresh of a stale pkginfo closure, once per manifest version and lock timeout"""
+        if cache.add(f"monolith-mc.{manifest.pk}.{manifest.version}.closure-refresh", True, timeout=self.lock_timeout):
+            from .tasks import refresh_manifest_pkginfo_closure_task  # circular dependency
+            manifest_pk = manifest.pk
+            transaction.on_commit(lambda: refresh_manifest_pkginfo_closure_task.apply_async((manifest_pk,)))
+
+    def prewarm_manifest(self, manifest):
+        """Build the pkginfo closure, and the catalog and manifest entries of the current manifest version
+        for the known tag sets"""
+        tag_sets = cache.get(self._tag_sets_key(manifest.pk)) or []
+        tags = {tag.pk: tag for tag in Tag.objects.filter(pk__in=set(i for tag_ids in tag_sets for i in tag_ids))}
+        result = {"manifest": {"pk": manifest.pk, "version": manifest.version},
+                  "pkginfo_closure": manifest.refresh_pkginfo_closure(),
+                  "tag_sets": 0,
+                  "built": 0}
+        for tag_ids in tag_sets:
+            if any(tag_id not in tags for tag_id in tag_ids):
+                # deleted tag
+                continue
+            result["tag_sets"] += 1
+            tag_list = [tags[tag_id] for tag_id in tag_ids]
+            for get_func in (self.get_catalog, self.get_manifest):
+                _, _, hit = get_func(manifest, tag_list)
+                if not hit:
+                    result["built"] += 1
+        return result
+
+
+manifest_cache = SimpleLazyObject(lambda: ManifestCache())
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.11 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monolith', '0055_alter_catalog_options_alter_manifestcatalog_options_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='repository',
+            name='fingerprint',
+            field=models.CharField(editable=False, max_length=64, null=True),
+        ),
+    ]
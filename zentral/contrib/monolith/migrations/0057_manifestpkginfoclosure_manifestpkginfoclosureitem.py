@@ -0,0 +1,36 @@
+# Generated by Django 4.2.11 on 2026-10-19 10:27
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('monolith', '0056_repository_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ManifestPkgInfoClosure',
+            fields=[
+                ('manifest', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE,
+                                                  primary_key=True, serialize=False, to='monolith.manifest')),
+                ('manifest_version', models.PositiveIntegerField()),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ManifestPkgInfoClosureItem',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('manifest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='monolith.manifest')),
+                ('manifest_sub_manifest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                            to='monolith.manifestsubmanifest')),
+                ('pkg_info', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='monolith.pkginfo')),
+            ],
+            options={
+                'unique_together': {('manifest_sub_manifest', 'pkg_info')},
+            },
+        ),
+    ]
@@ -7,18 +7,21 @@ import logging
 import os.path
 import plistlib
 import re
+import time
 import unicodedata
 import urllib.parse
 from django.core.exceptions import ObjectDoesNotExist
-from django.db import models, connection
+from django.db import models, connection, transaction
 from django.db.models import Count, F, Q
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.functional import cached_property
 from django.utils.text import slugify
+from prometheus_client import Histogram
 from zentral.contrib.inventory.models import BaseEnrollment, MetaBusinessUnit, Tag
 from zentral.utils.text import get_version_sort_key
 from .conf import monolith_conf
+from .manifest_cache import manifest_cache
 from .repository_backends import RepositoryBackend, get_repository_backend, load_repository_backend
 from .utils import build_manifest_enrollment_package
 
@@ -26,6 +29,12 @@ from .utils import build_manifest_enrollment_package
 logger = logging.getLogger("zentral.contrib.monolith.models")
 
 
+manifest_pkginfo_closure_build_seconds = Histogram(
+    "zentral_monolith_manifest_pkginfo_closure_build_seconds",
+    "Monolith manifest pkginfo closure build time, for each manifest version",
+)
+
+
 # PkgInfo / Catalog / Manifest
 
 
@@ -92,6 +101,7 @@ class Repository(models.Model):
     icon_hashes = models.JSONField(editable=False, default=dict)
     client_resources = models.JSONField(editable=False, default=list)
     last_synced_at = models.DateTimeField(editable=False, null=True)
+    fingerprint = models.CharField(max_length=64, editable=False, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
@@ -805,6 +815,7 @@ class Manifest(models.Model):
     def bump_version(self):
         self.version = F("version") + 1
         self.save()
+        manifest_cache.schedule_refresh(self)
 
     def catalogs(self, tags=None):
         if tags is None:
@@ -863,67 +874,120 @@ class Manifest(models.Model):
                     d[ep.builder] = ep
         return d
 
-    def _pkginfos_with_deps_and_updates(self, tags):
+    # the pkginfos closure - materialized for each manifest version
+
+    # same columns as the materialized closure items
+    pkginfo_closure_cte = (
+        "WITH RECURSIVE pkginfo_closure AS ( "
+
+        "SELECT ms.manifest_id manifest_id,"
+        "ms.id manifest_sub_manifest_id,"
+        "pi.id pkg_info_id,"
+        "pi.name_id name_pk "
+        "FROM monolith_pkginfo pi "
+        "JOIN monolith_submanifestpkginfo sm ON (pi.name_id=sm.pkg_info_name_id) "
+        "JOIN monolith_manifestsubmanifest ms ON (sm.sub_manifest_id=ms.sub_manifest_id) "
+        "WHERE ms.manifest_id = %(manifest_pk)s "
+
+        "UNION "
+
+        "SELECT rec.manifest_id,"
+        "rec.manifest_sub_manifest_id,"
+        "pi.id,"
+        "pi.name_id "
+        "FROM monolith_pkginfo pi "
+        "LEFT JOIN monolith_pkginfo_requires pr ON (pr.pkginfoname_id=pi.name_id) "
+        "LEFT JOIN monolith_pkginfo_update_for pu ON (pu.pkginfo_id=pi.id) "
+        "JOIN pkginfo_closure rec ON (pr.pkginfo_id=rec.pkg_info_id OR pu.pkginfoname_id=rec.name_pk) "
+
+        ") "
+    )
+
+    def refresh_pkginfo_closure(self, force=False):
+        """Materialize the pkginfos linked to the manifest sub manifests, with their dependencies and updates
+
+        The pkginfos are stored for each manifest sub manifest, to be able to apply the tag filters
+        when reading them. Return True if the closure was rebuilt.
+        """
+        with transaction.atomic():
+            # lock the manifest row → one build at a time
+            version = Manifest.objects.select_for_update().values_list("version", flat=True).get(pk=self.pk)
+            closure = ManifestPkgInfoClosure.objects.filter(manifest=self).first()
+            if not force and closure and closure.manifest_version >= version:
+                return False
+            t0 = time.monotonic()
+            cursor = connection.cursor()
+            cursor.execute(
+                "DELETE FROM monolith_manifestpkginfoclosureitem WHERE manifest_id = %(manifest_pk)s",
+                {"manifest_pk": self.pk}
+            )
+            cursor.execute(
+                f"{self.pkginfo_closure_cte}"
+                "INSERT INTO monolith_manifestpkginfoclosureitem (manifest_id, manifest_sub_manifest_id, pkg_info_id) "
+                "SELECT DISTINCT manifest_id, manifest_sub_manifest_id, pkg_info_id "
+                "FROM pkginfo_closure;",
+                {"manifest_pk": self.pk}
+            )
+            item_count = cursor.rowcount
+            if closure:
+                closure.manifest_version = version
+                closure.save()
+            else:
+                ManifestPkgInfoClosure.objects.create(manifest=self, manifest_version=version)
+            duration = time.monotonic() - t0
+        manifest_pkginfo_closure_build_seconds.observe(duration)
+        logger.info("Manifest %s version %s: pkginfo closure built in %.3fs, %s item(s)",
+                    self.pk, version, duration, item_count)
+        return True
+
+    def _pkginfos_with_deps_and_updates(self, tags, pk=None):
         """PkgInfos linked to a manifest for a given set of tags"""
+        if not isinstance(self.version, int):
+            # version was updated with a CombinedExpression
+            self.refresh_from_db()
+        if ManifestPkgInfoClosure.objects.filter(manifest=self, manifest_version__gte=self.version).exists():
+            cte = ""
+            closure_table = "monolith_manifestpkginfoclosureitem"
+        else:
+            # the closure is refreshed in a background task → live recursive query until then
+            manifest_cache.schedule_stale_closure_refresh(self)
+            cte = self.pkginfo_closure_cte
+            closure_table = "pkginfo_closure"
         kwargs = {"manifest_pk": self.pk}
         if tags:
-            m2mt_filter = "OR m2mt.tag_id in %(tag_pks)s"
+            msmt_filter = "OR msmt.tag_id in %(tag_pks)s"
+            mct_filter = "OR mct.tag_id in %(tag_pks)s"
             kwargs["tag_pks"] = tuple(t.pk for t in tags)
         else:
-            m2mt_filter = ""
+            msmt_filter = mct_filter = ""
+        if pk is not None:
+            pk_filter = "AND pi.id = %(pkginfo_pk)s "
+            kwargs["pkginfo_pk"] = pk
+        else:
+            pk_filter = ""
         query = (
-            "WITH RECURSIVE pkginfos_with_deps_and_updates AS ( "
-
-            "SELECT pi.id pk,"
-            "pi.repository_id repository_pk,"
-            "pi.version version,"
-            "pi.file file_name,"
-            "pi.data->>'installer_item_location' installer_item_location,"
-            "pi.data->>'uninstaller_item_location' uninstaller_item_location,"
-            "pi.data->>'icon_name' icon_name,"
-            "pn.id name_pk,"
-            "pn.name name "
-            "FROM monolith_pkginfo pi "
-            "JOIN monolith_pkginfoname pn ON (pi.name_id=pn.id) "
-            "JOIN monolith_submanifestpkginfo sm ON (pn.id=sm.pkg_info_name_id) "
-            "JOIN monolith_manifestsubmanifest ms ON (sm.sub_manifest_id=ms.sub_manifest_id) "
-            "LEFT JOIN monolith_manifestsubmanifest_tags m2mt ON (ms.id=m2mt.manifestsubmanifest_id) "
-            "WHERE ms.manifest_id = %(manifest_pk)s "
-            f"AND (m2mt.tag_id IS NULL {m2mt_filter}) "
-
-            "UNION "
-
-            "SELECT pi.id,"
+            f"{cte}"
+            "SELECT DISTINCT pi.id,"
             "pi.repository_id,"
             "pi.version,"
             "pi.file,"
             "pi.data->>'installer_item_location',"
             "pi.data->>'uninstaller_item_location',"
             "pi.data->>'icon_name',"
-            "pn.id,"
             "pn.name "
-            "FROM monolith_pkginfo pi "
+            f"FROM {closure_table} ci "
+            "JOIN monolith_pkginfo pi ON (ci.pkg_info_id=pi.id) "
             "JOIN monolith_pkginfoname pn ON (pi.name_id=pn.id) "
-            "LEFT JOIN monolith_pkginfo_requires pr ON (pr.pkginfoname_id=pn.id) "
-            "LEFT JOIN monolith_pkginfo_update_for pu ON (pu.pkginfo_id=pi.id) "
-            "JOIN pkginfos_with_deps_and_updates rec ON (pr.pkginfo_id=rec.pk OR pu.pkginfoname_id=rec.name_pk) "
-
-            ") "
-
-            "SELECT pk,"
-            "repository_pk,"
-            "version,"
-            "file_name,"
-            "installer_item_location,"
-            "uninstaller_item_location,"
-            "icon_name,"
-            "name "
-            "from pkginfos_with_deps_and_updates "
-            "JOIN monolith_pkginfo_catalogs pc ON (pk=pc.pkginfo_id) "
+            "LEFT JOIN monolith_manifestsubmanifest_tags msmt "
+            "ON (ci.manifest_sub_manifest_id=msmt.manifestsubmanifest_id) "
+            "JOIN monolith_pkginfo_catalogs pc ON (pi.id=pc.pkginfo_id) "
             "JOIN monolith_manifestcatalog mc ON (pc.catalog_id=mc.catalog_id) "
-            "LEFT JOIN monolith_manifestcatalog_tags m2mt ON (mc.id=m2mt.manifestcatalog_id) "
-            "WHERE mc.manifest_id = %(manifest_pk)s "
-            f"AND (m2mt.tag_id IS NULL {m2mt_filter});"
+            "LEFT JOIN monolith_manifestcatalog_tags mct ON (mc.id=mct.manifestcatalog_id) "
+            "WHERE ci.manifest_id = %(manifest_pk)s "
+            "AND mc.manifest_id = %(manifest_pk)s "
+            f"{pk_filter}"
+            f"AND (msmt.tag_id IS NULL {msmt_filter}) "
+            f"AND (mct.tag_id IS NULL {mct_filter});"
         )
         cursor = connection.cursor()
         cursor.execute(query, kwargs)
@@ -994,7 +1058,7 @@ class Manifest(models.Model):
             "JOIN monolith_pkginfo_catalogs pc ON (pk=pc.pkginfo_id) "
             "JOIN monolith_manifestcatalog mc ON (pc.catalog_id=mc.catalog_id) "
             "LEFT JOIN monolith_manifestcatalog_tags m2mt ON (mc.id=m2mt.manifestcatalog_id) "
-            "WHERE mc.manifest_id = &(manifest_pk)s "
+            "WHERE mc.manifest_id = %(manifest_pk)s "
             f"AND (m2mt.tag_id IS NULL {m2mt_filter});"
         )
         cursor = connection.cursor()
@@ -1003,7 +1067,7 @@ class Manifest(models.Model):
             yield CachedPkgInfo(*row)
 
     def get_pkginfo_for_cache(self, tags, pk):
-        for cached_pkginfo in chain(self._pkginfos_with_deps_and_updates(tags),
+        for cached_pkginfo in chain(self._pkginfos_with_deps_and_updates(tags, pk),
                                     self._enrollment_packages_pkginfo_deps(tags)):
             if cached_pkginfo.pk == pk:
                 return cached_pkginfo
@@ -1117,6 +1181,23 @@ class ManifestSubManifest(models.Model):
     tags = models.ManyToManyField(Tag)
 
 
+class ManifestPkgInfoClosure(models.Model):
+    """Version of the materialized manifest pkginfo closure"""
+    manifest = models.OneToOneField(Manifest, on_delete=models.CASCADE, primary_key=True)
+    manifest_version = models.PositiveIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+
+class ManifestPkgInfoClosureItem(models.Model):
+    """PkgInfo linked to a manifest via a sub manifest, directly or as a dependency or an update"""
+    manifest = models.ForeignKey(Manifest, on_delete=models.CASCADE)
+    manifest_sub_manifest = models.ForeignKey(ManifestSubManifest, on_delete=models.CASCADE)
+    pkg_info = models.ForeignKey(PkgInfo, on_delete=models.CASCADE)
+
+    class Meta:
+        unique_together = (("manifest_sub_manifest", "pkg_info"),)
+
+
 def enrollment_package_path(instance, filename):
     # TODO overflow ?
     return 'monolith/manifests/{0:08d}/enrollment_packages/{1}'.format(
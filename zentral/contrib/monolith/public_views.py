@@ -14,8 +14,9 @@ from zentral.utils.http import user_agent_and_ip_address_from_request
 from zentral.utils.storage import file_storage_has_signed_urls
 from .conf import monolith_conf
 from .events import post_monolith_enrollment_event, post_monolith_munki_request
+from .manifest_cache import manifest_cache
 from .models import MunkiNameError, parse_munki_name, CacheServer, EnrolledMachine, ManifestEnrollmentPackage
-from .utils import filter_catalog_data, filter_sub_manifest_data
+from .utils import build_filtered_catalog, filter_sub_manifest_data
 
 
 logger = logging.getLogger('zentral.contrib.monolith.public_views')
@@ -150,19 +151,13 @@ class MRCatalogView(MRNameView):
 
     def do_get(self, model, key, cache_key, event_payload):
         if model == "manifest_catalog" and key == self.manifest.pk:
-            catalog_data = cache.get(cache_key)
-            if not isinstance(catalog_data, list):
-                catalog_data = self.manifest.build_catalog(self.tags)
-                cache.set(cache_key, catalog_data, timeout=None)
-            else:
-                event_payload["cache"]["hit"] = True
+            cache_key, catalog_fragments, hit = manifest_cache.get_catalog(self.manifest, self.tags)
+            event_payload["cache"] = {"key": cache_key, "hit": hit}
             return HttpResponse(
-                plistlib.dumps(
-                    filter_catalog_data(
-                        catalog_data,
-                        self.machine_serial_number,
-                        [t.name for t in self.tags]
-                    )
+                build_filtered_catalog(
+                    catalog_fragments,
+                    self.machine_serial_number,
+                    [t.name for t in self.tags]
                 ),
                 content_type="application/xml"
             )
@@ -183,12 +178,8 @@ class MRManifestView(MRNameView):
     def do_get(self, model, key, cache_key, event_payload):
         manifest_data = None
         if model == "manifest":
-            manifest_data = cache.get(cache_key)
-            if manifest_data is None:
-                manifest_data = self.manifest.serialize(self.tags)
-                cache.set(cache_key, manifest_data, timeout=None)
-            else:
-                event_payload["cache"]["hit"] = True
+            cache_key, manifest_data, hit = manifest_cache.get_manifest(self.manifest, self.tags)
+            event_payload["cache"] = {"key": cache_key, "hit": hit}
         elif model == "sub_manifest":
             sm_id = key
             event_payload["sub_manifest"] = {"id": sm_id}
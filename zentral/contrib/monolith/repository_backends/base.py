@@ -3,6 +3,7 @@ import hashlib
 import logging
 import plistlib
 from django.db.models import Count, Q
+from django.utils import timezone
 from zentral.contrib.monolith.models import Catalog, Manifest, PkgInfo, PkgInfoCategory, PkgInfoName
 from zentral.core.events.base import AuditEvent
 from zentral.core.secret_engines import decrypt, decrypt_str, encrypt_str, rewrap
@@ -11,6 +12,292 @@ from zentral.core.secret_engines import decrypt, decrypt_str, encrypt_str, rewra
 logger = logging.getLogger('zentral.contrib.monolith.repository_backends.base')
 
 
+class CatalogsSync:
+    """Diff-based import of the repository catalogs
+
+    The current state of the repository is loaded in a few queries. The changes are computed in memory,
+    and applied with bulk queries. The audit events are emitted per changed object, once the changes are applied.
+    Only the manifests connected to the catalogs with changed pkginfos are bumped.
+    """
+    batch_size = 1000
+    m2m_attrs = ("catalogs", "requires", "update_for")
+
+    def __init__(self, repository, audit_callback=None):
+        self.repository = repository
+        self.audit_callback = audit_callback
+        self.events = []
+        self.new_catalogs = []
+        self.unarchived_catalogs = []
+        self.new_names = []
+        self.new_categories = []
+        self.new_pkg_infos = []
+        self.updated_pkg_infos = []
+        self.pkg_infos_m2m_values = []
+        self.changed_catalogs = []
+
+    # audit
+
+    def _add_event(self, *args):
+        if self.audit_callback:
+            self.events.append(args)
+
+    def _serialize_for_event(self, instance):
+        if self.audit_callback:
+            return instance.serialize_for_event()
+
+    # load
+
+    def _parse_pkg_infos_data(self, pkg_infos_data):
+        entries = {}
+        for pkg_info_data in pkg_infos_data:
+            name = pkg_info_data['name']
+            version = pkg_info_data['version']
+            catalog_names = list(dict.fromkeys(n.strip() for n in pkg_info_data.get("catalogs", [])))
+            if not catalog_names:
+                logger.warning('PKGINFO %s %s w/o catalogs', name, version)
+                continue
+            # serialize pkg_info_data
+            for key, val in pkg_info_data.items():
+                if isinstance(val, datetime):
+                    pkg_info_data[key] = val.isoformat()
+            # last one wins, like with the successive updates
+            entries[(name, version)] = {
+                "name": name,
+                "version": version,
+                "catalogs": catalog_names,
+                "category": pkg_info_data.get("category"),
+                "requires": set(pkg_info_data.get("requires", [])),
+                "update_for": set(pkg_info_data.get("update_for", [])),
+                "data": pkg_info_data,
+            }
+        return list(entries.values())
+
+    def _load_current_state(self, entries):
+        names = set()
+        category_names = set()
+        for entry in entries:
+            names.add(entry["name"])
+            names.update(entry["requires"])
+            names.update(entry["update_for"])
+            if entry["category"]:
+                category_names.add(entry["category"])
+        self.catalogs = {}
+        for catalog in Catalog.objects.filter(repository=self.repository):
+            catalog.repository = self.repository
+            self.catalogs[catalog.name] = catalog
+        self.names = {pin.name: pin for pin in PkgInfoName.objects.filter(name__in=names)}
+        self.categories = {}
+        for category in PkgInfoCategory.objects.filter(repository=self.repository, name__in=category_names):
+            category.repository = self.repository
+            self.categories[category.name] = category
+        self.pkg_infos = {}
+        for pkg_info in PkgInfo.objects.select_related("name").filter(repository=self.repository):
+            pkg_info.repository = self.repository
+            self.pkg_infos[(pkg_info.name.name, pkg_info.version)] = pkg_info
+        # {attr: {pkg info pk: {related object pk: through pk}}}
+        self.m2m = {}
+        for attr in self.m2m_attrs:
+            field = PkgInfo._meta.get_field(attr)
+            pkg_infos_m2m = self.m2m[attr] = {}
+            for through_pk, pkg_info_pk, related_pk in (
+                field.remote_field.through.objects.filter(pkginfo__repository=self.repository)
+                                                  .values_list("pk", field.m2m_column_name(), field.m2m_reverse_name())
+            ):
+                pkg_infos_m2m.setdefault(pkg_info_pk, {})[related_pk] = through_pk
+
+    # diff
+
+    def _get_catalog(self, name):
+        catalog = self.catalogs.get(name)
+        if catalog is None:
+            catalog = self.catalogs[name] = Catalog(repository=self.repository, name=name)
+            self.new_catalogs.append(catalog)
+            self._add_event(catalog, AuditEvent.Action.CREATED)
+        elif catalog.archived_at:
+            prev_value = self._serialize_for_event(catalog)
+            catalog.archived_at = None
+            self.unarchived_catalogs.append(catalog)
+            self._add_event(catalog, AuditEvent.Action.UPDATED, prev_value)
+        return catalog
+
+    def _get_name(self, name):
+        pin = self.names.get(name)
+        if pin is None:
+            pin = self.names[name] = PkgInfoName(name=name)
+            self.new_names.append(pin)
+            self._add_event(pin, AuditEvent.Action.CREATED)
+        return pin
+
+    def _get_category(self, name):
+        pic = self.categories.get(name)
+        if pic is None:
+            pic = self.categories[name] = PkgInfoCategory(repository=self.repository, name=name)
+            self.new_categories.append(pic)
+            self._add_event(pic, AuditEvent.Action.CREATED)
+        return pic
+
+    def _m2m_updated(self, pkg_info, m2m_values):
+        for attr, values in m2m_values.items():
+            if set(self.m2m[attr].get(pkg_info.pk, {})) != set(v.pk for v in values):
+                return True
+        return False
+
+    def _import_pkg_info(self, entry):
+        catalogs = [self._get_catalog(catalog_name) for catalog_name in entry["catalogs"]]
+        name = self._get_name(entry["name"])
+        category = self._get_category(entry["category"]) if entry["category"] else None
+        m2m_values = {
+            "catalogs": catalogs,
+            "requires": [self._get_name(n) for n in entry["requires"]],
+            "update_for": [self._get_name(n) for n in entry["update_for"]],
+        }
+        key = (entry["name"], entry["version"])
+        pkg_info = self.pkg_infos.get(key)
+        if pkg_info is None:
+            pkg_info = self.pkg_infos[key] = PkgInfo(repository=self.repository,
+                                                     name=name,
+                                                     version=entry["version"],
+                                                     category=category,
+                                                     data=entry["data"])
+            self.new_pkg_infos.append(pkg_info)
+            self._add_event(pkg_info, AuditEvent.Action.CREATED)
+        elif (
+            pkg_info.archived_at
+            or pkg_info.local
+            or category is None and pkg_info.category_id is not None
+            or category is not None and (category.pk is None or category.pk != pkg_info.category_id)
+            or pkg_info.data != entry["data"]
+            or self._m2m_updated(pkg_info, m2m_values)
+        ):
+            prev_value = self._serialize_for_event(pkg_info)
+            self.changed_catalogs.extend(self.m2m["catalogs"].get(pkg_info.pk, {}))
+            pkg_info.archived_at = None
+            pkg_info.local = False
+            pkg_info.category = category
+            pkg_info.data = entry["data"]
+            pkg_info.updated_at = timezone.now()  # even if only the m2m attributes were updated
+            self.updated_pkg_infos.append(pkg_info)
+            self._add_event(pkg_info, AuditEvent.Action.UPDATED, prev_value)
+        else:
+            return pkg_info
+        self.changed_catalogs.extend(catalogs)
+        self.pkg_infos_m2m_values.append((pkg_info, m2m_values))
+        return pkg_info
+
+    # apply
+
+    def _apply_m2m_changes(self):
+        for attr in self.m2m_attrs:
+            field = PkgInfo._meta.get_field(attr)
+            through = field.remote_field.through
+            through_pks_to_delete = []
+            throughs_to_create = []
+            for pkg_info, m2m_values in self.pkg_infos_m2m_values:
+                current_values = self.m2m[attr].get(pkg_info.pk, {})
+                values = set(v.pk for v in m2m_values[attr])
+                through_pks_to_delete.extend(through_pk for related_pk, through_pk in current_values.items()
+                                             if related_pk not in values)
+                throughs_to_create.extend(
+                    through(**{field.m2m_column_name(): pkg_info.pk, field.m2m_reverse_name(): related_pk})
+                    for related_pk in values - set(current_values)
+                )
+            if through_pks_to_delete:
+                through.objects.filter(pk__in=through_pks_to_delete).delete()
+            if throughs_to_create:
+                through.objects.bulk_create(throughs_to_create, batch_size=self.batch_size)
+
+    def _archive_pkg_infos(self, found_pkg_infos):
+        pkg_infos = [pkg_info for pkg_info in self.pkg_infos.values()
+                     if pkg_info.pk not in found_pkg_infos and not pkg_info.local and not pkg_info.archived_at]
+        if not pkg_infos:
+            return
+        prev_values = [self._serialize_for_event(pkg_info) for pkg_info in pkg_infos]
+        archived_at = datetime.utcnow()
+        updated_at = timezone.now()
+        PkgInfo.objects.filter(pk__in=[pkg_info.pk for pkg_info in pkg_infos]).update(archived_at=archived_at,
+                                                                                      updated_at=updated_at)
+        for pkg_info, prev_value in zip(pkg_infos, prev_values):
+            pkg_info.archived_at = archived_at
+            pkg_info.updated_at = updated_at
+            self.changed_catalogs.extend(self.m2m["catalogs"].get(pkg_info.pk, {}))
+            self._add_event(pkg_info, AuditEvent.Action.UPDATED, prev_value)
+
+    def _archive_catalogs(self, found_catalog_pks):
+        catalogs = list(
+            Catalog.objects.annotate(pkginfo_count=Count("pkginfo", filter=Q(pkginfo__archived_at__isnull=True)))
+                           .filter(repository=self.repository, archived_at__isnull=True, pkginfo_count=0)
+                           .exclude(pk__in=found_catalog_pks)
+        )
+        if not catalogs:
+            return
+        archived_at = datetime.utcnow()
+        updated_at = timezone.now()
+        for catalog in catalogs:
+            catalog.repository = self.repository
+            prev_value = self._serialize_for_event(catalog)
+            catalog.archived_at = archived_at
+            catalog.updated_at = updated_at
+            self._add_event(catalog, AuditEvent.Action.UPDATED, prev_value)
+        Catalog.objects.bulk_update(catalogs, ["archived_at", "updated_at"], batch_size=self.batch_size)
+
+    def _bump_manifest(self, manifest):
+        prev_value = self._serialize_for_event(manifest)
+        manifest.bump_version()
+        self._add_event(manifest, AuditEvent.Action.UPDATED, prev_value)
+
+    def run(self, pkg_infos_data, icon_hashes, client_resources):
+        entries = self._parse_pkg_infos_data(pkg_infos_data)
+        self._load_current_state(entries)
+        # diff
+        found_pkg_infos = []
+        for entry in entries:
+            found_pkg_infos.append(self._import_pkg_info(entry))
+        # apply the changes
+        Catalog.objects.bulk_create(self.new_catalogs, batch_size=self.batch_size)
+        if self.unarchived_catalogs:
+            updated_at = timezone.now()
+            for catalog in self.unarchived_catalogs:
+                catalog.updated_at = updated_at
+            Catalog.objects.bulk_update(self.unarchived_catalogs, ["archived_at", "updated_at"],
+                                        batch_size=self.batch_size)
+        PkgInfoName.objects.bulk_create(self.new_names, batch_size=self.batch_size)
+        PkgInfoCategory.objects.bulk_create(self.new_categories, batch_size=self.batch_size)
+        PkgInfo.objects.bulk_create(self.new_pkg_infos, batch_size=self.batch_size)
+        if self.updated_pkg_infos:
+            PkgInfo.objects.bulk_update(self.updated_pkg_infos,
+                                        ["archived_at", "local", "category", "data", "updated_at"],
+                                        batch_size=self.batch_size)
+        self._apply_m2m_changes()
+        # archive unknown non-local pkg_infos
+        self._archive_pkg_infos(set(pkg_info.pk for pkg_info in found_pkg_infos))
+        # archive old catalogs
+        found_catalog_pks = set(self.catalogs[catalog_name].pk
+                                for entry in entries
+                                for catalog_name in entry["catalogs"])
+        self._archive_catalogs(found_catalog_pks)
+        # update repository
+        repo_icon_hashes = {}
+        for pkg_info in found_pkg_infos:
+            icon_hash = icon_hashes.get(pkg_info.get_original_icon_name())
+            if icon_hash:
+                repo_icon_hashes[pkg_info.get_monolith_icon_name()] = icon_hash
+        changed_catalog_pks = set(c if isinstance(c, int) else c.pk for c in self.changed_catalogs)
+        if self.repository.icon_hashes != repo_icon_hashes or self.repository.client_resources != client_resources:
+            # the icon hashes and client resources are served with the manifests of the found catalogs
+            changed_catalog_pks.update(found_catalog_pks)
+        self.repository.icon_hashes = repo_icon_hashes
+        self.repository.client_resources = client_resources
+        self.repository.last_synced_at = datetime.utcnow()
+        self.repository.save()
+        # bump versions of manifests connected to catalogs with changed pkg infos
+        if changed_catalog_pks:
+            for manifest in Manifest.objects.distinct().filter(manifestcatalog__catalog__pk__in=changed_catalog_pks):
+                self._bump_manifest(manifest)
+        # audit events
+        for args in self.events:
+            self.audit_callback(*args)
+
+
 class BaseRepository:
     kwargs_keys = ()
     encrypted_kwargs_keys = ()
@@ -70,189 +357,34 @@ class BaseRepository:
 
     # sync
 
-    def _import_category(self, name, audit_callback):
-        pic, created = PkgInfoCategory.objects.get_or_create(repository=self.repository, name=name)
-        if created and audit_callback:
-            audit_callback(pic, AuditEvent.Action.CREATED)
-        return pic
-
-    def _import_name(self, name, audit_callback):
-        pin, created = PkgInfoName.objects.get_or_create(name=name)
-        if created and audit_callback:
-            audit_callback(pin, AuditEvent.Action.CREATED)
-        return pin
-
-    def _import_catalogs(self, pkg_info_data, audit_callback):
-        catalogs = []
-        pkg_info_catalogs = pkg_info_data.get("catalogs", [])
-        for catalog_name in pkg_info_catalogs:
-            catalog_name = catalog_name.strip()
-            try:
-                catalog = Catalog.objects.get(repository=self.repository, name=catalog_name)
-            except Catalog.DoesNotExist:
-                catalog = Catalog.objects.create(repository=self.repository, name=catalog_name)
-                if audit_callback:
-                    audit_callback(catalog, AuditEvent.Action.CREATED)
-            else:
-                if catalog.archived_at:
-                    if audit_callback:
-                        prev_value = catalog.serialize_for_event()
-                    catalog.archived_at = None
-                    catalog.save()
-                    if audit_callback:
-                        audit_callback(catalog, AuditEvent.Action.UPDATED, prev_value)
-            catalogs.append(catalog)
-        return catalogs
-
-    def _import_pkg_info(self, pkg_info_data, audit_callback):
-        name = pkg_info_data['name']
-        version = pkg_info_data['version']
-        # catalogs
-        catalogs = self._import_catalogs(pkg_info_data, audit_callback)
-        if not catalogs:
-            logger.warning('PKGINFO %s %s w/o catalogs', name, version)
-            return catalogs, None
-        # name
-        pkg_info_name = self._import_name(name, audit_callback)
-        # category
-        pkg_info_category = None
-        category_name = pkg_info_data.get('category', None)
-        if category_name:
-            pkg_info_category = self._import_category(category_name, audit_callback)
-        # requires
-        requires = [self._import_name(n, audit_callback)
-                    for n in set(pkg_info_data.get('requires', []))]
-        # update_for
-        update_for = [self._import_name(n, audit_callback)
-                      for n in set(pkg_info_data.get('update_for', []))]
-        # serialize pkg_info_data
-        for key, val in pkg_info_data.items():
-            if isinstance(val, datetime):
-                pkg_info_data[key] = val.isoformat()
-        # save PkgInfo in db
-        try:
-            pkg_info = (PkgInfo.objects.prefetch_related("catalogs", "requires", "update_for")
-                                       .select_related("repository", "name", "category")
-                                       .get(repository=self.repository,
-                                            name=pkg_info_name,
-                                            version=version))
-        except PkgInfo.DoesNotExist:
-            pkg_info = PkgInfo.objects.create(repository=self.repository,
-                                              name=pkg_info_name,
-                                              version=version,
-                                              category=pkg_info_category,
-                                              data=pkg_info_data)
-            pkg_info.catalogs.set(catalogs)
-            pkg_info.requires.set(requires)
-            pkg_info.update_for.set(update_for)
-            if audit_callback:
-                audit_callback(pkg_info, AuditEvent.Action.CREATED)
-        else:
-            updated = False
-            if audit_callback:
-                prev_value = pkg_info.serialize_for_event()
-            # unarchive if necessary
-            if pkg_info.archived_at:
-                pkg_info.archived_at = None
-                updated = True
-            # update the local attribute
-            if pkg_info.local:
-                pkg_info.local = False
-                updated = True
-            # update category if necessary
-            pkg_info_old_category = pkg_info.category
-            if pkg_info_old_category != pkg_info_category:
-                pkg_info.category = pkg_info_category
-                updated = True
-            # update data if necessary
-            pkg_info_old_data = pkg_info.data
-            if pkg_info_old_data != pkg_info_data:
-                pkg_info.data = pkg_info_data
-                updated = True
-            # update m2m attributes
-            for pkg_info_attr, pkg_info_values in (
-                ("requires", requires),
-                ("update_for", update_for),
-                ("catalogs", catalogs)
-            ):
-                pkg_info_old_values = set(getattr(pkg_info, pkg_info_attr).all())
-                pkg_info_values = set(pkg_info_values)
-                if pkg_info_old_values != pkg_info_values:
-                    getattr(pkg_info, pkg_info_attr).set(pkg_info_values)
-                    updated = True
-            # save updates
-            if updated:
-                pkg_info.save()  # even if only the m2m attributes were updated, for updated_at
-                if audit_callback:
-                    audit_callback(pkg_info, AuditEvent.Action.UPDATED, prev_value)
-
-        return catalogs, pkg_info
-
-    def _archive_catalog(self, catalog, audit_callback):
-        if audit_callback:
-            prev_value = catalog.serialize_for_event()
-        catalog.archived_at = datetime.utcnow()
-        catalog.save()
-        if audit_callback:
-            audit_callback(catalog, AuditEvent.Action.UPDATED, prev_value)
-
-    def _archive_pkg_info(self, pkg_info, audit_callback):
-        if audit_callback:
-            prev_value = pkg_info.serialize_for_event()
-        pkg_info.archived_at = datetime.utcnow()
-        pkg_info.save()
-        if audit_callback:
-            audit_callback(pkg_info, AuditEvent.Action.UPDATED, prev_value)
-
-    def _bump_manifest(self, manifest, audit_callback):
-        if audit_callback:
-            prev_value = manifest.serialize_for_event()
-        manifest.bump_version()
-        if audit_callback:
-            audit_callback(manifest, AuditEvent.Action.UPDATED, prev_value)
-
-    def sync_catalogs(self, audit_callback=None):
-        found_pkg_info_pks = set([])
-        found_catalog_pks = set([])
-        # initialize repository icon hashes
-        repo_icon_hashes = {}
+    def sync_catalogs(self, audit_callback=None, force=False):
+        """Sync the repository catalogs, return False if skipped because the repository content hasn't changed"""
+        fingerprint = self.get_fingerprint()
+        if not force and fingerprint and fingerprint == self.repository.fingerprint:
+            logger.info("Repository %s: content unchanged, skip sync", self.repository.pk)
+            self.repository.last_synced_at = datetime.utcnow()
+            self.repository.save()
+            return False
         icon_hashes_content = self.get_icon_hashes_content()
         if icon_hashes_content:
             icon_hashes = plistlib.loads(icon_hashes_content)
         else:
             icon_hashes = {}
-        # update or create current pkg_infos
-        for pkg_info_data in plistlib.loads(self.get_all_catalog_content()):
-            catalogs, pkg_info = self._import_pkg_info(pkg_info_data, audit_callback)
-            found_catalog_pks.update(c.pk for c in catalogs)
-            if pkg_info:
-                found_pkg_info_pks.add(pkg_info.pk)
-                icon_hash = icon_hashes.get(pkg_info.get_original_icon_name())
-                if icon_hash:
-                    repo_icon_hashes[pkg_info.get_monolith_icon_name()] = icon_hash
-        # archive unknown non-local pkg_infos
-        for pkg_info in (PkgInfo.objects.prefetch_related("catalogs", "requires", "update_for")
-                                        .select_related("category", "name")
-                                        .filter(archived_at__isnull=True)
-                                        .exclude(Q(local=True) | Q(pk__in=found_pkg_info_pks))):
-            self._archive_pkg_info(pkg_info, audit_callback)
-        # archive old catalogs
-        for c in (Catalog.objects.annotate(pkginfo_count=Count("pkginfo",
-                                                               filter=Q(pkginfo__archived_at__isnull=True)))
-                                 .filter(archived_at__isnull=True, pkginfo_count=0)
-                                 .exclude(pk__in=found_catalog_pks)):
-            self._archive_catalog(c, audit_callback)
-        # update repository
-        self.repository.icon_hashes = repo_icon_hashes
-        self.repository.client_resources = list(self.iter_client_resources())
-        self.repository.last_synced_at = datetime.utcnow()
-        self.repository.save()
-        # bump versions of manifests connected to found catalogs
-        for manifest in Manifest.objects.distinct().filter(manifestcatalog__catalog__pk__in=found_catalog_pks):
-            self._bump_manifest(manifest, audit_callback)
+        # fingerprint computed before fetching the content, saved with the sync results
+        self.repository.fingerprint = fingerprint
+        CatalogsSync(self.repository, audit_callback).run(
+            plistlib.loads(self.get_all_catalog_content()),
+            icon_hashes,
+            list(self.iter_client_resources())
+        )
+        return True
 
     # to implement in the subclasses
 
+    def get_fingerprint(self):
+        """Return a cheap fingerprint of the repository content, or None if not available"""
+        return None
+
     def get_all_catalog_content(self):
         raise NotImplementedError
 
@@ -1,8 +1,10 @@
 from datetime import datetime, timedelta
+import hashlib
 import logging
 import os.path
 import boto3
 from botocore.client import Config
+from botocore.exceptions import ClientError
 from botocore.signers import CloudFrontSigner
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import serialization
@@ -203,23 +205,55 @@ class S3Repository(BaseRepository):
             logger.exception("Could not download all catalog from repository %s", self.repository)
             raise RepositoryError
 
+    def _get_resource_etag(self, key, missing_ok=False):
+        try:
+            return self._client.head_object(
+                Bucket=self.bucket,
+                Key=os.path.join(self.prefix, key)
+            )['ETag']
+        except Exception as e:
+            # HEAD requests have no response body → no NoSuchKey, only a 404 client error
+            if (
+                missing_ok
+                and isinstance(e, ClientError)
+                and e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey")
+            ):
+                logger.info("Could not find key %s in repository %s", key, self.repository)
+                return None
+            logger.exception("Could not get key %s metadata in repository %s", key, self.repository)
+            raise RepositoryError
+
+    def get_fingerprint(self):
+        # ETags of the all catalog and icon hashes, keys and ETags of the client resources
+        h = hashlib.sha256()
+        h.update(self._get_resource_etag("catalogs/all").encode("utf-8"))
+        h.update((self._get_resource_etag("icons/_icon_hashes.plist", missing_ok=True) or "").encode("utf-8"))
+        for key, etag in sorted(self._iter_client_resources_with_etags()):
+            h.update(key.encode("utf-8"))
+            h.update(etag.encode("utf-8"))
+        return h.hexdigest()
+
     def get_all_catalog_content(self):
         return self._get_resource("catalogs/all")
 
     def get_icon_hashes_content(self):
         return self._get_resource("icons/_icon_hashes.plist", missing_ok=True)
 
-    def iter_client_resources(self):
+    def _iter_client_resources_with_etags(self):
         prefix = os.path.join(self.prefix, "client_resources/")
         try:
             paginator = self._client.get_paginator('list_objects_v2')
             for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
                 for obj in page.get("Contents", []):
-                    yield obj["Key"].removeprefix(prefix)
+                    yield obj["Key"].removeprefix(prefix), obj.get("ETag", "")
         except Exception:
             logger.exception("Could not list client resources keys in repository %s", self.repository)
             raise RepositoryError
 
+    def iter_client_resources(self):
+        for key, _ in self._iter_client_resources_with_etags():
+            yield key
+
     def make_munki_repository_response(self, section, name, cache_server=None):
         expires_in = 180  # 3 minutes TODO: hardcoded
         key = os.path.join(self.prefix, section, name)
@@ -10,9 +10,9 @@ logger = logging.getLogger("zentral.contrib.monolith.repository_backends.virtual
 
 
 class VirtualRepository(BaseRepository):
-    def sync_catalogs(self, audit_callback=None):
+    def sync_catalogs(self, audit_callback=None, force=False):
         # NOOP
-        return
+        return False
 
     @cached_property
     def _redirect_to_files(self):
@@ -0,0 +1,28 @@
+import logging
+from celery import shared_task
+from .manifest_cache import manifest_cache
+from .models import Manifest
+
+
+logger = logging.getLogger("zentral.contrib.monolith.tasks")
+
+
+@shared_task
+def prewarm_manifest_cache_task(manifest_pk):
+    try:
+        manifest = Manifest.objects.get(pk=manifest_pk)
+    except Manifest.DoesNotExist:
+        logger.warning("Could not pre-warm the cache of unknown manifest %s", manifest_pk)
+        return
+    return manifest_cache.prewarm_manifest(manifest)
+
+
+@shared_task
+def refresh_manifest_pkginfo_closure_task(manifest_pk):
+    try:
+        manifest = Manifest.objects.get(pk=manifest_pk)
+    except Manifest.DoesNotExist:
+        logger.warning("Could not refresh the pkginfo closure of unknown manifest %s", manifest_pk)
+        return
+    return {"manifest": {"pk": manifest.pk, "version": manifest.version},
+            "pkginfo_closure": manifest.refresh_pkginfo_closure()}
@@ -141,12 +141,57 @@ def test_pkginfo_catalog_inclusion(pkginfo, serial_number, tag_names):
     )
 
 
-def filter_catalog_data(catalog_data, serial_number, tag_names):
-    filtered_catalog_data = []
+# pre-serialized catalogs
+# the pkginfos without excluded tags or shards are always included in the catalogs,
+# and are pre-serialized together. The other ones are pre-serialized individually,
+# and included or not for each machine. The plist is assembled by byte concatenation.
+
+
+CATALOG_HEADER = plistlib.dumps([]).split(b"<array/>")[0] + b"<array>\n"
+CATALOG_FOOTER = b"</array>\n</plist>\n"
+
+
+def _serialize_catalog_pkginfo(pkginfo):
+    # the array item, as serialized by plistlib in a list
+    return plistlib.dumps([pkginfo])[len(CATALOG_HEADER):-len(CATALOG_FOOTER)]
+
+
+def serialize_catalog_fragments(catalog_data):
+    """Return the list of the pre-serialized catalog fragments
+
+    The invariant pkginfos are merged in bytes fragments,
+    and the other ones are stored as (inclusion key, options, bytes) tuples.
+    """
+    fragments = []
+    invariant_items = []
     for pkginfo in catalog_data:
-        if test_pkginfo_catalog_inclusion(pkginfo, serial_number, tag_names):
-            filtered_catalog_data.append(pkginfo)
-    return filtered_catalog_data
+        options = pkginfo.get("zentral_monolith")
+        serialized_pkginfo = _serialize_catalog_pkginfo(pkginfo)
+        if options and (options.get("excluded_tags") or options.get("shards")):
+            if invariant_items:
+                fragments.append(b"".join(invariant_items))
+                invariant_items = []
+            fragments.append((pkginfo["name"] + pkginfo["version"], options, serialized_pkginfo))
+        else:
+            invariant_items.append(serialized_pkginfo)
+    if invariant_items:
+        fragments.append(b"".join(invariant_items))
+    return fragments
+
+
+def build_filtered_catalog(catalog_fragments, serial_number, tag_names):
+    """Return the catalog plist for a machine, built from the pre-serialized catalog fragments"""
+    items = []
+    for fragment in catalog_fragments:
+        if isinstance(fragment, bytes):
+            items.append(fragment)
+        else:
+            key, options, serialized_pkginfo = fragment
+            if test_monolith_object_inclusion(key, options, serial_number, tag_names):
+                items.append(serialized_pkginfo)
+    if not items:
+        return plistlib.dumps([])
+    return b"".join([CATALOG_HEADER, *items, CATALOG_FOOTER])
 
 
 def filter_sub_manifest_data_dict(smd, serial_number, tag_names):
@@ -6,3 +6,19 @@ class ZentralMunkiAppConfig(ZentralAppConfig):
     default = True
     verbose_name = "Zentral Munki contrib app"
     permission_models = ("configuration", "enrollment", "scriptcheck")
+
+    def ready(self):
+        super().ready()
+        # job details cache invalidation
+        from django.db.models.signals import m2m_changed, post_delete, post_save
+        from zentral.contrib.inventory.models import Tag
+        from zentral.core.compliance_checks.models import ComplianceCheck
+        from .job_details_cache import script_check_change_receiver
+        from .models import ScriptCheck
+        for model in (ScriptCheck, ComplianceCheck):
+            post_save.connect(script_check_change_receiver, sender=model)
+            post_delete.connect(script_check_change_receiver, sender=model)
+        for through_model in (ScriptCheck.tags.through, ScriptCheck.excluded_tags.through):
+            m2m_changed.connect(script_check_change_receiver, sender=through_model)
+        # the deleted tags are removed from the script check scopes
+        post_delete.connect(script_check_change_receiver, sender=Tag)
@@ -130,22 +130,27 @@ def update_machine_munki_script_check_statuses(serial_number, results, status_ti
 
 
 def prune_out_of_scope_machine_statuses(serial_number, in_scope_cc_ids):
+    """Delete the machine script check statuses not in scope, and return the number of deleted statuses"""
+    machine_status_pks = []
     events = []
+    status_time = datetime.utcnow()
     for machine_status in (MachineStatus.objects.select_related("compliance_check__script_check")
                                                 .filter(serial_number=serial_number,
                                                         compliance_check__script_check__isnull=False)
                                                 .exclude(compliance_check__pk__in=in_scope_cc_ids)):
+        machine_status_pks.append(machine_status.pk)
         events.append(MunkiScriptCheckStatusUpdated.build_update(
             machine_status.compliance_check.script_check,
             serial_number,
-            Status.OUT_OF_SCOPE, datetime.utcnow(),
+            Status.OUT_OF_SCOPE, status_time,
             Status(machine_status.status)
         ))
-        machine_status.delete()
-    if events:
+    if machine_status_pks:
+        MachineStatus.objects.filter(pk__in=machine_status_pks).delete()
 
         def post_events():
             for event in events:
                 event.post()
 
         transaction.on_commit(lambda: post_events())
+    return len(machine_status_pks)
@@ -0,0 +1,141 @@
+import hashlib
+import logging
+import urllib.parse
+import uuid
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+from prometheus_client import Counter
+from zentral.conf import settings
+from zentral.contrib.inventory.cache import machine_info_cache
+from zentral.contrib.inventory.models import MetaMachine
+from zentral.core.exceptions import ImproperlyConfigured
+from .compliance_checks import serialize_script_check_for_job
+from .models import ScriptCheck
+
+
+logger = logging.getLogger("zentral.contrib.munki.job_details_cache")
+
+
+job_details_cache_requests = Counter(
+    "zentral_munki_job_details_cache_requests",
+    "Munki job details cache requests",
+    ["info", "result"]
+)
+
+
+class JobDetailsCache:
+    """Cache of the machine dependent parts of the Munki job details
+
+    The machine tags and open incidents are cached with the versions of the inventory machine info cache,
+    bumped when the machine tags, the current machine snapshots or the machine incidents change.
+
+    The script checks in scope are shared by the machines with the same tags, OS version and architecture.
+    They are cached with a generation, bumped each time a script check or a compliance check changes,
+    and with a TTL, to bound the effect of a concurrent request caching the previous version.
+
+    The out of scope machine statuses are pruned in a background task, only when the set
+    of script checks in scope for a machine changes.
+    """
+    generation_key = "munki-jd-scg"
+    default_ttl = 3600
+    pruned_scope_ttl = 604800
+
+    def __init__(self):
+        options = settings["apps"]["zentral.contrib.munki"].get("job_details_cache", {})
+        try:
+            # 1h by default (min 0 → disabled, max 1d)
+            self.ttl = min(max(0, int(options.get("ttl", self.default_ttl))), 86400)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Munki job details cache TTL must be an integer")
+
+    # script checks generation
+
+    def bump(self):
+        """Invalidate the cached script checks"""
+        cache.set(self.generation_key, uuid.uuid4().hex, None)
+
+    def get_generation(self):
+        generation = cache.get(self.generation_key)
+        if generation is None:
+            # new random generation, so that the values cached with an evicted generation are never used
+            cache.add(self.generation_key, uuid.uuid4().hex, None)
+            generation = cache.get(self.generation_key)
+        return generation
+
+    # machine info
+
+    @staticmethod
+    def _build_machine_info(serial_number):
+        machine = MetaMachine(serial_number)
+        return {"incidents": [mi.incident.name for mi in machine.open_incidents()],
+                "tag_pks_and_names": machine.tag_pks_and_names}
+
+    def get_machine_info(self, serial_number):
+        """Return the open incident names and the tag pks and names of a machine"""
+        if not self.ttl:
+            return self._build_machine_info(serial_number)
+        return machine_info_cache.get("munki-jd", serial_number,
+                                      lambda: self._build_machine_info(serial_number))
+
+    # script checks
+
+    @staticmethod
+    def _build_script_checks(comparable_os_version, arch_amd64, arch_arm64, tag_pks):
+        in_scope_cc_ids = []
+        script_checks = []
+        for script_check in ScriptCheck.objects.iter_in_scope(comparable_os_version, arch_amd64, arch_arm64, tag_pks):
+            in_scope_cc_ids.append(script_check.compliance_check.pk)
+            script_checks.append(serialize_script_check_for_job(script_check))
+        return in_scope_cc_ids, script_checks
+
+    def get_script_checks(self, comparable_os_version, arch_amd64, arch_arm64, tag_pks):
+        """Return the compliance check IDs and the serialized script checks in scope"""
+        if not self.ttl:
+            return self._build_script_checks(comparable_os_version, arch_amd64, arch_arm64, tag_pks)
+        scope = ".".join(str(i) for i in [*comparable_os_version, int(arch_amd64), int(arch_arm64),
+                                          *sorted(tag_pks)])
+        cache_key = "munki-jd-sc_{}_{}".format(self.get_generation(),
+                                               hashlib.sha1(scope.encode("utf-8")).hexdigest())
+        value = cache.get(cache_key)
+        if value is None:
+            job_details_cache_requests.labels("script_checks", "miss").inc()
+            value = self._build_script_checks(comparable_os_version, arch_amd64, arch_arm64, tag_pks)
+            cache.set(cache_key, value, self.ttl)
+        else:
+            job_details_cache_requests.labels("script_checks", "hit").inc()
+        return value
+
+    # out of scope machine statuses
+
+    @staticmethod
+    def _pruned_scope_key(serial_number):
+        return "munki-jd-ps_{}".format(urllib.parse.quote(serial_number, safe=""))
+
+    @staticmethod
+    def _get_scope_fingerprint(in_scope_cc_ids):
+        return hashlib.sha1(",".join(str(i) for i in sorted(in_scope_cc_ids)).encode("utf-8")).hexdigest()
+
+    def schedule_pruning(self, serial_number, in_scope_cc_ids):
+        """Schedule the pruning of the out of scope machine statuses, if the scope has changed"""
+        if cache.get(self._pruned_scope_key(serial_number)) == self._get_scope_fingerprint(in_scope_cc_ids):
+            return
+        from .tasks import prune_out_of_scope_machine_statuses_task  # circular dependency
+        transaction.on_commit(lambda: prune_out_of_scope_machine_statuses_task.apply_async(
+            (serial_number, in_scope_cc_ids)
+        ))
+
+    def set_pruned_scope(self, serial_number, in_scope_cc_ids):
+        cache.set(self._pruned_scope_key(serial_number),
+                  self._get_scope_fingerprint(in_scope_cc_ids),
+                  self.pruned_scope_ttl)
+
+
+job_details_cache = SimpleLazyObject(lambda: JobDetailsCache())
+
+
+def script_check_change_receiver(sender, **kwargs):
+    if kwargs.get("action", "post_").startswith("pre_"):
+        # m2m_changed, wait for the change
+        return
+    job_details_cache.bump()
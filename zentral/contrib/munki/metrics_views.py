@@ -3,6 +3,7 @@ from django.db.models import Count
 from prometheus_client import Gauge
 from zentral.utils.prometheus import BasePrometheusMetricsView
 from .models import ManagedInstall
+from .postflight import postflight_queue
 
 
 class MetricsView(BasePrometheusMetricsView):
@@ -89,7 +90,18 @@ class MetricsView(BasePrometheusMetricsView):
                 managed_install["count"]
             )
 
+    def add_postflight_queue(self):
+        depth, lag = postflight_queue.get_depth_and_lag()
+        g = Gauge('zentral_munki_postflight_queue_depth', 'Zentral Munki postflight queue depth',
+                  registry=self.registry)
+        g.set(depth)
+        g = Gauge('zentral_munki_postflight_queue_lag_seconds', 'Zentral Munki postflight queue lag in seconds',
+                  registry=self.registry)
+        g.set(lag)
+
     def populate_registry(self):
         self.add_active_machines()
         self.add_installed_pkginfos_buckets()
         self.add_failed_pkginfos()
+        if postflight_queue.enabled:
+            self.add_postflight_queue()
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.11 on 2026-10-19 04:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('munki', '0013_scriptcheck_excluded_tags_alter_scriptcheck_tags'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostflightPayload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial_number', models.TextField()),
+                ('user_agent', models.TextField()),
+                ('ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('data', models.TextField()),
+                ('received_at', models.DateTimeField()),
+                ('enrollment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='munki.enrollment')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['serial_number', 'id'], name='munki_postf_serial__a4f3bc_idx')],
+            },
+        ),
+    ]
@@ -153,6 +153,21 @@ class MunkiState(models.Model):
     last_seen = models.DateTimeField(auto_now=True)
 
 
+# postflight queue
+
+
+class PostflightPayload(models.Model):
+    serial_number = models.TextField()
+    enrollment = models.ForeignKey(Enrollment, on_delete=models.CASCADE)
+    user_agent = models.TextField()
+    ip = models.GenericIPAddressField(blank=True, null=True)
+    data = models.TextField()  # JSON text, because the reports can contain null characters
+    received_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=["serial_number", "id"])]
+
+
 # managed install
 
 
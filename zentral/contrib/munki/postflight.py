@@ -0,0 +1,234 @@
+from datetime import datetime
+import json
+import logging
+from dateutil import parser
+from django.core.exceptions import SuspiciousOperation
+from django.db import connection
+from django.utils.functional import SimpleLazyObject
+from django.utils.timezone import is_aware, make_naive
+from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
+from zentral.utils.db_queues import BaseDBQueue
+from zentral.utils.json import remove_null_character
+from .compliance_checks import update_machine_munki_script_check_statuses
+from .events import post_munki_events, post_munki_request_event
+from .models import EnrolledMachine, ManagedInstall, MunkiState, PostflightPayload
+from .utils import ManagedInstallReconciliation, prepare_ms_tree_certificates
+
+
+logger = logging.getLogger("zentral.contrib.munki.postflight")
+
+
+def process_postflight(enrollment, business_unit, serial_number, user_agent, ip, data, request_time):
+    # lock enrolled machine
+    EnrolledMachine.objects.select_for_update().filter(serial_number=serial_number)
+
+    # commit machine snapshot
+    ms_tree = data['machine_snapshot']
+    ms_tree['source'] = {'module': 'zentral.contrib.munki',
+                         'name': 'Munki'}
+    ms_tree['reference'] = ms_tree['serial_number']
+    ms_tree['public_ip_address'] = ip
+    if business_unit:
+        ms_tree['business_unit'] = business_unit.serialize()
+    prepare_ms_tree_certificates(ms_tree)
+    extra_facts = ms_tree.pop("extra_facts", None)
+    if isinstance(extra_facts, dict):
+        ms_tree["extra_facts"] = remove_null_character(extra_facts)
+    # cleanup profiles
+    reported_profiles = ms_tree.pop("profiles", None)
+    if reported_profiles:
+        profiles = []
+        for profile in reported_profiles:
+            if profile not in profiles:
+                profiles.append(profile)
+            else:
+                logger.error("Duplicated profile %s for machine %s.",
+                             profile.get("uuid", "UNKNOWN UUID"), serial_number)
+        ms_tree["profiles"] = profiles
+    # cleanup OS version
+    if "os_version" in ms_tree:
+        if ms_tree["os_version"].get("patch") is None:
+            ms_tree["os_version"]["patch"] = 0
+    ms = commit_machine_snapshot_and_trigger_events(ms_tree)
+    if not ms:
+        raise RuntimeError(f"Could not commit machine {serial_number} snapshot")
+
+    # delete all managed installs if last seen report not found
+    # which is a good indicator that the machine has been wiped
+    last_seen_report_found = data.get("last_seen_report_found")
+    if last_seen_report_found is not None and not last_seen_report_found:
+        ManagedInstall.objects.filter(machine_serial_number=serial_number).delete()
+
+    # prepare reports
+    reports = []
+    report_count = event_count = 0
+    for r in data.pop('reports'):
+        report_count += 1
+        event_count += len(r.get("events", []))
+        reports.append((
+            parser.parse(r.pop('start_time')),
+            parser.parse(r.pop('end_time')),
+            r
+        ))
+    reports.sort()
+
+    munki_request_event_kwargs = {
+        "request_type": "postflight",
+        "enrollment": {"pk": enrollment.pk},
+        "report_count": report_count,
+        "event_count": event_count,
+    }
+    if last_seen_report_found is not None:
+        munki_request_event_kwargs["last_seen_report_found"] = last_seen_report_found
+
+    # update machine managed installs
+    managed_install_reconciliation = ManagedInstallReconciliation(serial_number, enrollment.configuration)
+    managed_installs = data.get("managed_installs")
+    if managed_installs is not None:
+        munki_request_event_kwargs["managed_installs"] = True
+        munki_request_event_kwargs["managed_install_count"] = len(managed_installs)
+        # update managed installs using the complete list
+        incident_updates = managed_install_reconciliation.apply_managed_installs(managed_installs)
+        # incident updates are attached to the munki request event
+        if incident_updates:
+            munki_request_event_kwargs["incident_updates"] = incident_updates
+    else:
+        munki_request_event_kwargs["managed_installs"] = False
+        # update managed installs using the install and removal events in the reports
+        for _, _, report in reports:
+            for created_at, event in report.get("events", []):
+                # time
+                event_time = parser.parse(created_at)
+                if is_aware(event_time):
+                    event_time = make_naive(event_time)
+                for incident_update in managed_install_reconciliation.apply_event(event, event_time):
+                    # incident updates are attached to each munki event
+                    event.setdefault("incident_updates", []).append(incident_update)
+    managed_install_reconciliation.commit()
+
+    # script checks
+    script_check_results = data.get("script_check_results")
+    if script_check_results:
+        munki_request_event_kwargs["script_check_results"] = True
+        munki_request_event_kwargs["script_check_result_count"] = len(script_check_results)
+        update_machine_munki_script_check_statuses(
+            serial_number,
+            script_check_results,
+            request_time
+        )
+    else:
+        munki_request_event_kwargs["script_check_results"] = False
+
+    # update machine munki state
+    update_dict = {'user_agent': user_agent,
+                   'ip': ip}
+    if managed_installs is not None:
+        update_dict["last_managed_installs_sync"] = request_time
+    if script_check_results is not None:
+        update_dict["last_script_checks_run"] = request_time
+    if reports:
+        start_time, end_time, report = reports[-1]
+        update_dict.update({'munki_version': report.get('munki_version', None),
+                            'sha1sum': report['sha1sum'],
+                            'run_type': report['run_type'],
+                            'start_time': start_time,
+                            'end_time': end_time})
+    MunkiState.objects.update_or_create(machine_serial_number=serial_number,
+                                        defaults=update_dict)
+
+    # events
+    post_munki_request_event(
+        serial_number,
+        user_agent, ip,
+        **munki_request_event_kwargs
+    )
+
+    post_munki_events(
+        serial_number,
+        user_agent, ip,
+        (r for _, _, r in reports)
+    )
+
+
+def validate_postflight_payload(data):
+    """Check the structure of a postflight payload before queuing it"""
+    if not isinstance(data, dict):
+        raise SuspiciousOperation("Postflight payload is not an object")
+    ms_tree = data.get("machine_snapshot")
+    if not isinstance(ms_tree, dict) or not ms_tree.get("serial_number"):
+        raise SuspiciousOperation("Missing or invalid postflight machine snapshot")
+    reports = data.get("reports")
+    if not isinstance(reports, list):
+        raise SuspiciousOperation("Missing or invalid postflight reports")
+    for report in reports:
+        if not isinstance(report, dict) or not isinstance(report.get("events", []), list):
+            raise SuspiciousOperation("Invalid postflight report")
+        for attr in ("start_time", "end_time"):
+            try:
+                parser.parse(report[attr])
+            except (KeyError, TypeError, ValueError, OverflowError):
+                raise SuspiciousOperation(f"Missing or invalid postflight report {attr}")
+    for attr in ("managed_installs", "script_check_results"):
+        if not isinstance(data.get(attr, []), (list, type(None))):
+            raise SuspiciousOperation(f"Invalid postflight {attr}")
+
+
+class PostflightQueue(BaseDBQueue):
+    """Durable queue of the Munki postflight payloads
+
+    When enabled, the postflight payloads are validated, stored in the database and acknowledged
+    immediately. The pending payloads of a machine are processed in the order they were received.
+    """
+    app = "zentral.contrib.munki"
+    options_key = "postflight_queue"
+    name = "Munki postflight queue"
+    default_celery_queue = "munki_postflight"
+    model = PostflightPayload
+    group_field = "serial_number"
+    logger = logger
+    error_message = "Could not process machine %s postflight payload %s"
+
+    def get_task(self):
+        from .tasks import process_postflight_payloads_task  # circular dependency
+        return process_postflight_payloads_task
+
+    def get_queryset(self):
+        return super().get_queryset().select_related("enrollment__configuration",
+                                                     "enrollment__secret__meta_business_unit")
+
+    def enqueue(self, enrollment, serial_number, user_agent, ip, data, request_time):
+        validate_postflight_payload(data)
+        self._enqueue(
+            serial_number,
+            serial_number=serial_number,
+            enrollment=enrollment,
+            user_agent=user_agent,
+            ip=ip,
+            data=json.dumps(data),
+            received_at=request_time,
+        )
+
+    def process_payload(self, serial_number, payload):
+        process_postflight(
+            payload.enrollment,
+            payload.enrollment.secret.get_api_enrollment_business_unit(),
+            serial_number,
+            payload.user_agent, payload.ip,
+            json.loads(payload.data),
+            payload.received_at,
+        )
+
+    @staticmethod
+    def get_depth_and_lag():
+        """Return the number of pending payloads, and the age in seconds of the oldest one"""
+        query = (
+            "select count(*), extract(epoch from (%s - min(received_at))) "
+            "from munki_postflightpayload"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(query, [datetime.utcnow()])
+            depth, lag = cursor.fetchone()
+        return depth, float(lag or 0)
+
+
+postflight_queue = SimpleLazyObject(lambda: PostflightQueue())
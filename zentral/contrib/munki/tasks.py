@@ -0,0 +1,23 @@
+from celery import shared_task
+from zentral.utils.db_queues import TRANSIENT_DB_ERRORS
+from .compliance_checks import prune_out_of_scope_machine_statuses
+from .job_details_cache import job_details_cache
+from .postflight import postflight_queue
+
+
+@shared_task
+def prune_out_of_scope_machine_statuses_task(serial_number, in_scope_cc_ids):
+    pruned_count = prune_out_of_scope_machine_statuses(serial_number, in_scope_cc_ids)
+    job_details_cache.set_pruned_scope(serial_number, in_scope_cc_ids)
+    return {"serial_number": serial_number, "pruned": pruned_count}
+
+
+@shared_task(autoretry_for=TRANSIENT_DB_ERRORS, retry_backoff=True)
+def process_postflight_payloads_task(serial_number):
+    return {"serial_number": serial_number,
+            "processed": postflight_queue.process_group(serial_number)}
+
+
+@shared_task
+def sweep_postflight_queue_task():
+    return {"scheduled": postflight_queue.sweep()}
@@ -30,288 +30,296 @@ def prepare_ms_tree_certificates(ms_tree):
 
 
 # managed install updates
-# WARNING all this functions must be protected with a lock at the enrolled machine level
-
-
-def create_managed_install_with_failed_install(
-    serial_number,
-    name, display_name, version,
-    event_time,
-    auto_failed_install_incidents
-):
-    mi, created = ManagedInstall.objects.get_or_create(
-        machine_serial_number=serial_number,
-        name=name,
-        defaults={
-            "display_name": display_name or name,
-            "failed_at": event_time,
-            "failed_version": version
-        }
-    )
-    if created and auto_failed_install_incidents:
-        yield MunkiInstallFailedIncident.build_incident_update(mi.name, mi.failed_version)
-
-
-def create_managed_install_with_successful_install(
-    serial_number,
-    name, display_name, version,
-    event_time
-):
-    ManagedInstall.objects.get_or_create(
-        machine_serial_number=serial_number,
-        name=name,
-        defaults={
-            "display_name": display_name or name,
-            "installed_at": event_time,
-            "installed_version": version
-        }
-    )
-
-
-def delete_managed_install_with_successful_removal(
-    mi,
-    event_time,
-    auto_failed_install_incidents,
-    auto_reinstall_incidents
-):
-    if (
-        auto_failed_install_incidents
-        and mi.failed_at is not None
-        and mi.failed_at < event_time
-    ):
-        yield MunkiInstallFailedIncident.build_incident_update(
-            mi.name, mi.failed_version, Severity.NONE
-        )
-    if (
-        auto_reinstall_incidents
-        and mi.installed_at is not None
-        and mi.installed_at < event_time
-    ):
-        yield MunkiReinstallIncident.build_incident_update(
-            mi.name, mi.installed_version, Severity.NONE
-        )
-    mi.delete()
-
-
-def update_managed_install_with_failed_install(
-    mi,
-    version,
-    display_name,
-    event_time,
-    auto_failed_install_incidents
-):
-    if mi.failed_at is None or mi.failed_at < event_time:
-        if auto_failed_install_incidents and mi.failed_at is not None and mi.failed_version != version:
-            yield MunkiInstallFailedIncident.build_incident_update(
-                mi.name, mi.failed_version, Severity.NONE
-            )
-        mi.failed_at = event_time
-        mi.failed_version = version
-        if isinstance(display_name, str) and mi.display_name != display_name:
-            mi.display_name = display_name
-        mi.save()
-        if auto_failed_install_incidents:
-            yield MunkiInstallFailedIncident.build_incident_update(
-                mi.name, mi.failed_version
-            )
+# WARNING all this must be protected with a lock at the enrolled machine level
 
 
-def update_managed_install_with_successful_install(
-    mi,
-    version,
-    display_name,
-    event_time,
-    auto_failed_install_incidents,
-    auto_reinstall_incidents
-):
-    updated = False
-
-    if isinstance(display_name, str) and mi.display_name != display_name:
-        mi.display_name = display_name
-        updated = True
-
-    if mi.installed_at is None:
-        mi.installed_at = event_time
-        mi.installed_version = version
-        updated = True
-    elif mi.installed_at < event_time:
-        mi.installed_at = event_time
-        if mi.installed_version != version:
-            # update installed version
-            if mi.reinstall:
-                # clear reinstall flag
-                mi.reinstall = False
-                if auto_reinstall_incidents:
-                    yield MunkiReinstallIncident.build_incident_update(
-                        mi.name, mi.installed_version, Severity.NONE
-                    )
-            mi.installed_version = version
-            updated = True
-        else:
-            if not mi.reinstall:
-                # set reinstall flage
-                mi.reinstall = True
-                updated = True
-                if auto_reinstall_incidents:
-                    yield MunkiReinstallIncident.build_incident_update(
-                        mi.name, mi.installed_version
-                    )
-
-    if mi.failed_at is not None and mi.failed_at < event_time:
-        # clear failed install
-        if auto_failed_install_incidents:
+class ManagedInstallReconciliation:
+    """Reconcile the managed installs of a machine in memory
+
+    The managed installs of the machine are loaded once, the install and removal events
+    and the reported managed installs are applied in memory, and the final state is written
+    with one delete and one upsert. The incident updates are returned by the apply methods.
+    """
+    upsert_fields = ("display_name",
+                     "installed_version", "installed_at", "reinstall",
+                     "failed_version", "failed_at",
+                     "updated_at")
+
+    def __init__(self, serial_number, configuration):
+        self.serial_number = serial_number
+        self.configuration = configuration
+        self._managed_installs = None
+        self._updated_names = set()
+        self._deleted_pks = set()
+
+    @property
+    def managed_installs(self):
+        if self._managed_installs is None:
+            self._managed_installs = {
+                mi.name: mi
+                for mi in ManagedInstall.objects.select_for_update()
+                                                .filter(machine_serial_number=self.serial_number)
+            }
+        return self._managed_installs
+
+    # in memory updates
+
+    def _create(self, name, display_name, **kwargs):
+        mi = ManagedInstall(machine_serial_number=self.serial_number,
+                            name=name,
+                            display_name=display_name or name,
+                            **kwargs)
+        self.managed_installs[name] = mi
+        self._updated_names.add(name)
+        return mi
+
+    def _update(self, mi):
+        self._updated_names.add(mi.name)
+
+    def _delete(self, mi):
+        del self.managed_installs[mi.name]
+        self._updated_names.discard(mi.name)
+        if mi.pk:
+            self._deleted_pks.add(mi.pk)
+
+    def _remove_with_successful_removal(self, mi, event_time):
+        if (
+            self.configuration.auto_failed_install_incidents
+            and mi.failed_at is not None
+            and mi.failed_at < event_time
+        ):
             yield MunkiInstallFailedIncident.build_incident_update(
                 mi.name, mi.failed_version, Severity.NONE
             )
-        mi.failed_at = None
-        mi.failed_version = None
-        updated = True
-
-    if updated:
-        mi.save()
-
-
-def update_managed_install_with_event(serial_number, event, event_time, configuration):
-    # type
-    event_type = event.get("type")
-    if event_type not in ("install", "removal"):
-        return
-    name = event["name"]
-    display_name = event.get("display_name")
-    failed = int(event.get("status", "-1")) != 0
-
-    try:
-        mi = ManagedInstall.objects.get(machine_serial_number=serial_number, name=name)
-    except ManagedInstall.DoesNotExist:
-        # removal
-        if event_type == "removal":
-            # nothing to do
-            return
-
-        # install
-        version = event["version"]
-        if failed:
-            yield from create_managed_install_with_failed_install(
-                serial_number, name, display_name, version, event_time,
-                configuration.auto_failed_install_incidents
-            )
-        else:
-            create_managed_install_with_successful_install(
-                serial_number, name, display_name, version, event_time
-            )
-    else:
-        # update
         if (
-            (mi.installed_at is not None and mi.installed_at > event_time)
-            or (mi.failed_at is not None and mi.failed_at > event_time)
+            self.configuration.auto_reinstall_incidents
+            and mi.installed_at is not None
+            and mi.installed_at < event_time
         ):
-            # stalled event, nothing to update
-            return
-
-        # removal
-        if event_type == "removal":
-            if not failed:
-                yield from delete_managed_install_with_successful_removal(
-                    mi, event_time,
-                    configuration.auto_failed_install_incidents,
-                    configuration.auto_reinstall_incidents
-                )
-            return
-
-        # install
-        version = event["version"]
-        if failed:
-            yield from update_managed_install_with_failed_install(
-                mi, version, display_name, event_time,
-                configuration.auto_failed_install_incidents
-            )
-        else:
-            yield from update_managed_install_with_successful_install(
-                mi, version, display_name, event_time,
-                configuration.auto_failed_install_incidents,
-                configuration.auto_reinstall_incidents
-            )
-
-
-def apply_managed_installs(serial_number, managed_installs, configuration):
-    existing_managed_installs = {
-        mi.name: mi
-        for mi in ManagedInstall.objects.select_for_update()
-                                        .filter(machine_serial_number=serial_number)
-    }
-
-    # create or update existing managed installs
-    for name, version, display_name, installed_at in managed_installs:
-        # cleanup installed_at
-        if isinstance(installed_at, str):
-            installed_at = parser.parse(installed_at)
-            if is_aware(installed_at):
-                installed_at = make_naive(installed_at)
-
-        try:
-            mi = existing_managed_installs.pop(name)
-        except KeyError:
-            # create new managed install for this pkg
-            ManagedInstall.objects.create(
-                machine_serial_number=serial_number,
-                name=name,
-                display_name=display_name or name,
-                installed_version=version,
-                installed_at=installed_at
+            yield MunkiReinstallIncident.build_incident_update(
+                mi.name, mi.installed_version, Severity.NONE
             )
-        else:
-            if installed_at is None:
-                # we cannot do an update
-                continue
-
-            if mi.installed_at is not None and mi.installed_at >= installed_at:
-                # stalled update, nothing to do
-                continue
-
+        self._delete(mi)
+
+    def _update_with_failed_install(self, mi, version, display_name, event_time):
+        auto_failed_install_incidents = self.configuration.auto_failed_install_incidents
+        if mi.failed_at is None or mi.failed_at < event_time:
+            if auto_failed_install_incidents and mi.failed_at is not None and mi.failed_version != version:
+                yield MunkiInstallFailedIncident.build_incident_update(
+                    mi.name, mi.failed_version, Severity.NONE
+                )
+            mi.failed_at = event_time
+            mi.failed_version = version
             if isinstance(display_name, str) and mi.display_name != display_name:
-                # update display name
                 mi.display_name = display_name
+            self._update(mi)
+            if auto_failed_install_incidents:
+                yield MunkiInstallFailedIncident.build_incident_update(
+                    mi.name, mi.failed_version
+                )
 
-            if mi.failed_at is not None and mi.failed_at < installed_at:
-                # clear failed install
-                if configuration.auto_failed_install_incidents:
-                    yield MunkiInstallFailedIncident.build_incident_update(
-                        mi.name, mi.failed_version, Severity.NONE
-                    )
-                mi.failed_at = None
-                mi.failed_version = None
+    def _update_with_successful_install(self, mi, version, display_name, event_time):
+        updated = False
+
+        if isinstance(display_name, str) and mi.display_name != display_name:
+            mi.display_name = display_name
+            updated = True
 
-            if version != mi.installed_version:
+        if mi.installed_at is None:
+            mi.installed_at = event_time
+            mi.installed_version = version
+            updated = True
+        elif mi.installed_at < event_time:
+            mi.installed_at = event_time
+            if mi.installed_version != version:
+                # update installed version
                 if mi.reinstall:
                     # clear reinstall flag
                     mi.reinstall = False
-                    if configuration.auto_reinstall_incidents:
+                    if self.configuration.auto_reinstall_incidents:
                         yield MunkiReinstallIncident.build_incident_update(
                             mi.name, mi.installed_version, Severity.NONE
                         )
                 mi.installed_version = version
+                updated = True
             else:
-                if mi.installed_at is not None and not mi.reinstall:
-                    # set reinstall flag
+                if not mi.reinstall:
+                    # set reinstall flage
                     mi.reinstall = True
-                    if configuration.auto_reinstall_incidents:
+                    updated = True
+                    if self.configuration.auto_reinstall_incidents:
                         yield MunkiReinstallIncident.build_incident_update(
                             mi.name, mi.installed_version
                         )
 
-            # mi installed at is None or < installed at, we can update
-            mi.installed_at = installed_at
+        if mi.failed_at is not None and mi.failed_at < event_time:
+            # clear failed install
+            if self.configuration.auto_failed_install_incidents:
+                yield MunkiInstallFailedIncident.build_incident_update(
+                    mi.name, mi.failed_version, Severity.NONE
+                )
+            mi.failed_at = None
+            mi.failed_version = None
+            updated = True
 
-            mi.save()
+        if updated:
+            self._update(mi)
 
-    # delete not found stored managed installs
-    for mi in existing_managed_installs.values():
-        if mi.failed_at is not None and configuration.auto_failed_install_incidents:
-            yield MunkiInstallFailedIncident.build_incident_update(
-                mi.name, mi.failed_version, Severity.NONE
-            )
-        if mi.reinstall and configuration.auto_reinstall_incidents:
-            yield MunkiReinstallIncident.build_incident_update(
-                mi.name, mi.installed_version, Severity.NONE
+    def _iter_event_incident_updates(self, event, event_time):
+        # type
+        event_type = event.get("type")
+        if event_type not in ("install", "removal"):
+            return
+        name = event["name"]
+        display_name = event.get("display_name")
+        failed = int(event.get("status", "-1")) != 0
+
+        mi = self.managed_installs.get(name)
+        if mi is None:
+            # removal
+            if event_type == "removal":
+                # nothing to do
+                return
+
+            # install
+            version = event["version"]
+            if failed:
+                self._create(name, display_name, failed_at=event_time, failed_version=version)
+                if self.configuration.auto_failed_install_incidents:
+                    yield MunkiInstallFailedIncident.build_incident_update(name, version)
+            else:
+                self._create(name, display_name, installed_at=event_time, installed_version=version)
+        else:
+            # update
+            if (
+                (mi.installed_at is not None and mi.installed_at > event_time)
+                or (mi.failed_at is not None and mi.failed_at > event_time)
+            ):
+                # stalled event, nothing to update
+                return
+
+            # removal
+            if event_type == "removal":
+                if not failed:
+                    yield from self._remove_with_successful_removal(mi, event_time)
+                return
+
+            # install
+            version = event["version"]
+            if failed:
+                yield from self._update_with_failed_install(mi, version, display_name, event_time)
+            else:
+                yield from self._update_with_successful_install(mi, version, display_name, event_time)
+
+    def _iter_managed_installs_incident_updates(self, managed_installs):
+        existing_managed_installs = dict(self.managed_installs)
+
+        # create or update existing managed installs
+        for name, version, display_name, installed_at in managed_installs:
+            # cleanup installed_at
+            if isinstance(installed_at, str):
+                installed_at = parser.parse(installed_at)
+                if is_aware(installed_at):
+                    installed_at = make_naive(installed_at)
+
+            try:
+                mi = existing_managed_installs.pop(name)
+            except KeyError:
+                # create new managed install for this pkg
+                self._create(name, display_name, installed_version=version, installed_at=installed_at)
+            else:
+                if installed_at is None:
+                    # we cannot do an update
+                    continue
+
+                if mi.installed_at is not None and mi.installed_at >= installed_at:
+                    # stalled update, nothing to do
+                    continue
+
+                if isinstance(display_name, str) and mi.display_name != display_name:
+                    # update display name
+                    mi.display_name = display_name
+
+                if mi.failed_at is not None and mi.failed_at < installed_at:
+                    # clear failed install
+                    if self.configuration.auto_failed_install_incidents:
+                        yield MunkiInstallFailedIncident.build_incident_update(
+                            mi.name, mi.failed_version, Severity.NONE
+                        )
+                    mi.failed_at = None
+                    mi.failed_version = None
+
+                if version != mi.installed_version:
+                    if mi.reinstall:
+                        # clear reinstall flag
+                        mi.reinstall = False
+                        if self.configuration.auto_reinstall_incidents:
+                            yield MunkiReinstallIncident.build_incident_update(
+                                mi.name, mi.installed_version, Severity.NONE
+                            )
+                    mi.installed_version = version
+                else:
+                    if mi.installed_at is not None and not mi.reinstall:
+                        # set reinstall flag
+                        mi.reinstall = True
+                        if self.configuration.auto_reinstall_incidents:
+                            yield MunkiReinstallIncident.build_incident_update(
+                                mi.name, mi.installed_version
+                            )
+
+                # mi installed at is None or < installed at, we can update
+                mi.installed_at = installed_at
+
+                self._update(mi)
+
+        # delete not found stored managed installs
+        for mi in existing_managed_installs.values():
+            if mi.failed_at is not None and self.configuration.auto_failed_install_incidents:
+                yield MunkiInstallFailedIncident.build_incident_update(
+                    mi.name, mi.failed_version, Severity.NONE
+                )
+            if mi.reinstall and self.configuration.auto_reinstall_incidents:
+                yield MunkiReinstallIncident.build_incident_update(
+                    mi.name, mi.installed_version, Severity.NONE
+                )
+            self._delete(mi)
+
+    # public API
+
+    def apply_event(self, event, event_time):
+        """Apply a Munki install or removal event, and return the incident updates"""
+        return list(self._iter_event_incident_updates(event, event_time))
+
+    def apply_managed_installs(self, managed_installs):
+        """Apply the complete list of the managed installs of the machine, and return the incident updates"""
+        return list(self._iter_managed_installs_incident_updates(managed_installs))
+
+    def commit(self):
+        """Write the final state, with at most one delete and one upsert"""
+        if self._deleted_pks:
+            ManagedInstall.objects.filter(pk__in=self._deleted_pks).delete()
+            self._deleted_pks = set()
+        if self._updated_names:
+            ManagedInstall.objects.bulk_create(
+                [ManagedInstall(machine_serial_number=self.serial_number,
+                                name=name,
+                                **{attr: getattr(self.managed_installs[name], attr)
+                                   for attr in self.upsert_fields})
+                 for name in sorted(self._updated_names)],
+                update_conflicts=True,
+                unique_fields=("machine_serial_number", "name"),
+                update_fields=self.upsert_fields,
             )
-        mi.delete()
+            self._updated_names = set()
+
+
+def update_managed_install_with_event(serial_number, event, event_time, configuration):
+    reconciliation = ManagedInstallReconciliation(serial_number, configuration)
+    yield from reconciliation.apply_event(event, event_time)
+    reconciliation.commit()
+
+
+def apply_managed_installs(serial_number, managed_installs, configuration):
+    reconciliation = ManagedInstallReconciliation(serial_number, configuration)
+    yield from reconciliation.apply_managed_installs(managed_installs)
+    reconciliation.commit()
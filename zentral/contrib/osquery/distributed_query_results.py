@@ -0,0 +1,58 @@
+from datetime import datetime
+import json
+import logging
+from django.utils.functional import SimpleLazyObject
+from zentral.conf import settings
+from zentral.core.exceptions import ImproperlyConfigured
+from zentral.utils.db_queues import BaseDBQueue
+from .models import DistributedQueryResult, DistributedQueryResultBatch
+
+
+logger = logging.getLogger("zentral.contrib.osquery.distributed_query_results")
+
+
+class DistributedQueryResultQueue(BaseDBQueue):
+    """Durable queue of the distributed query results saved in the background
+
+    When the deferred threshold is set, the results of the distributed_write requests
+    with at least this number of rows are stored in a batch, and saved by a Celery task.
+    """
+    app = "zentral.contrib.osquery"
+    options_key = "distributed_query_results"
+    name = "Osquery distributed query results queue"
+    default_celery_queue = "celery"
+    model = DistributedQueryResultBatch
+    group_field = "serial_number"
+    logger = logger
+    error_message = "Could not save machine %s distributed query result batch %s"
+
+    def __init__(self):
+        super().__init__()
+        options = settings["apps"][self.app].get(self.options_key, {})
+        try:
+            # 0 by default → the results are always saved during the request
+            self.deferred_threshold = max(0, int(options.get("deferred_threshold", 0)))
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Osquery distributed query results deferred threshold must be an integer")
+        self.enabled = self.deferred_threshold > 0
+
+    def get_task(self):
+        from .tasks import save_distributed_query_results  # circular dependency
+        return save_distributed_query_results
+
+    def should_defer(self, result_count):
+        return bool(self.deferred_threshold) and result_count >= self.deferred_threshold
+
+    def enqueue(self, serial_number, dq_results):
+        self._enqueue(
+            serial_number,
+            serial_number=serial_number,
+            data=json.dumps(dq_results),
+            received_at=datetime.utcnow(),
+        )
+
+    def process_payload(self, serial_number, batch):
+        DistributedQueryResult.objects.bulk_create_from_results(serial_number, json.loads(batch.data))
+
+
+distributed_query_result_queue = SimpleLazyObject(lambda: DistributedQueryResultQueue())
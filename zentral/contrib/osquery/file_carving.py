@@ -0,0 +1,110 @@
+import logging
+import os
+import tempfile
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from .models import FileCarvingBlock, file_carving_session_archive_path
+
+
+logger = logging.getLogger("zentral.contrib.osquery.file_carving")
+
+
+# The received blocks are tracked in the session row, with a bitmap and a counter.
+# The bitmap is padded to the block count on the fly, and the update is only applied
+# if the block bit is not already set, to count each block only once, without
+# having to lock the session row before writing the block.
+PADDED_RECEIVED_BLOCKS = (
+    "(received_blocks || decode(repeat('00', "
+    "greatest(0, (block_count + 7) / 8 - length(received_blocks))), 'hex'))"
+)
+RECORD_RECEIVED_BLOCK_QUERY = (
+    "update osquery_filecarvingsession "
+    f"set received_blocks = set_bit({PADDED_RECEIVED_BLOCKS}, %(block_id)s, 1), "
+    "received_block_count = received_block_count + 1 "
+    "where id = %(pk)s "
+    "and %(block_id)s >= 0 and %(block_id)s < block_count "
+    f"and get_bit({PADDED_RECEIVED_BLOCKS}, %(block_id)s) = 0 "
+    "returning received_block_count = block_count"
+)
+
+
+def get_local_archive_path(file_carving_session):
+    """Return the archive name and local path, or None if the default storage is not local"""
+    name = file_carving_session_archive_path(file_carving_session, None)
+    try:
+        return name, default_storage.path(name)
+    except NotImplementedError:
+        return None
+
+
+def _write_local_block(path, offset, block_data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o666)
+    try:
+        os.pwrite(fd, block_data, offset)
+    finally:
+        os.close(fd)
+
+
+def write_file_carving_block(file_carving_session, block_id, block_data):
+    """Store a file carving block
+
+    With a local storage, the block is written at its offset in the archive file.
+    Otherwise, the block is stored as a separate file, and the archive is assembled
+    when all the blocks have been received.
+    """
+    local_archive_path = get_local_archive_path(file_carving_session)
+    if local_archive_path:
+        _, path = local_archive_path
+        _write_local_block(path, block_id * file_carving_session.block_size, block_data)
+    else:
+        block_filename = str(block_id)
+        cb, _ = FileCarvingBlock.objects.get_or_create(file_carving_session=file_carving_session, block_id=block_id)
+        cb.file.save(block_filename, SimpleUploadedFile(block_filename, block_data))
+
+
+def record_received_file_carving_block(file_carving_session, block_id):
+    """Mark a block as received
+
+    Returns True if the block was not already received and was the last missing one.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(RECORD_RECEIVED_BLOCK_QUERY, {"pk": file_carving_session.pk, "block_id": block_id})
+        result = cursor.fetchone()
+    if result is None:
+        logger.info("File carving session %s: block %s already received", file_carving_session.pk, block_id)
+        return False
+    return result[0]
+
+
+def finalize_file_carving_session_archive(file_carving_session):
+    """Set the session archive, and return its size
+
+    The local archive files are already complete, and are only attached to the session.
+    The archives of the sessions with separate block files are assembled.
+    """
+    file_carving_blocks = file_carving_session.filecarvingblock_set.all().order_by("block_id")
+    local_archive_path = get_local_archive_path(file_carving_session)
+    if local_archive_path:
+        name, path = local_archive_path
+        # blocks stored as separate files before the switch to the local archive files
+        for file_carving_block in file_carving_blocks:
+            with file_carving_block.file.open("rb") as f:
+                _write_local_block(path, file_carving_block.block_id * file_carving_session.block_size, f.read())
+        file_carving_session.archive.name = name
+        file_carving_session.save(update_fields=["archive"])
+        return os.path.getsize(path)
+    archive_size = 0
+    tmp_fh, tmp_path = tempfile.mkstemp(suffix="_osquery_file_carving_archive.tar")
+    logger.info("Start building archive %s %s", file_carving_session.pk, tmp_path)
+    with os.fdopen(tmp_fh, "wb") as f:
+        for file_carving_block in file_carving_blocks:
+            for chunk in file_carving_block.file.chunks():
+                f.write(chunk)
+                archive_size += len(chunk)
+    with open(tmp_path, "rb") as f:
+        file_carving_session.archive.save("archive.tar", File(f))
+    os.unlink(tmp_path)
+    return archive_size
@@ -0,0 +1,41 @@
+# Generated by Django 4.2.11 on 2026-10-19 09:12
+
+from django.db import migrations, models
+
+
+def set_received_blocks(apps, schema_editor):
+    FileCarvingSession = apps.get_model("osquery", "FileCarvingSession")
+    FileCarvingBlock = apps.get_model("osquery", "FileCarvingBlock")
+    received_block_ids = {}
+    for session_id, block_id in FileCarvingBlock.objects.values_list("file_carving_session_id", "block_id"):
+        received_block_ids.setdefault(session_id, []).append(block_id)
+    for session in FileCarvingSession.objects.filter(pk__in=received_block_ids.keys()):
+        block_ids = received_block_ids[session.pk]
+        received_blocks = bytearray((max(session.block_count, max(block_ids) + 1) + 7) // 8)
+        for block_id in block_ids:
+            # same bit numbering as the PostgreSQL get_bit and set_bit functions
+            received_blocks[block_id // 8] |= 1 << (block_id % 8)
+        session.received_blocks = bytes(received_blocks)
+        session.received_block_count = len(block_ids)
+        session.save(update_fields=["received_blocks", "received_block_count"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osquery', '0020_alter_configuration_inventory_interval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filecarvingsession',
+            name='received_block_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='filecarvingsession',
+            name='received_blocks',
+            field=models.BinaryField(default=b''),
+        ),
+        migrations.RunPython(set_received_blocks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 4.2.11 on 2026-10-19 10:05
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osquery', '0021_filecarvingsession_received_blocks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ResultLogBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_agent', models.TextField()),
+                ('ip', models.GenericIPAddressField(blank=True, null=True)),
+                ('data', models.TextField()),
+                ('received_at', models.DateTimeField()),
+                ('enrolled_machine', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE,
+                                                       to='osquery.enrolledmachine')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['enrolled_machine', 'id'], name='osquery_res_enrolle_2b0f50_idx')],
+            },
+        ),
+    ]
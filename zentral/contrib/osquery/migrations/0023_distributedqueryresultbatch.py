@@ -0,0 +1,25 @@
+# Generated by Django 4.2.11 on 2026-10-19 08:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('osquery', '0022_resultlogbatch'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DistributedQueryResultBatch',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('serial_number', models.TextField()),
+                ('data', models.TextField()),
+                ('received_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['serial_number', 'id'], name='osquery_dis_serial__6d53d2_idx')],
+            },
+        ),
+    ]
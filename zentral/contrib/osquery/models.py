@@ -665,11 +665,27 @@ class DistributedQueryMachine(models.Model):
         unique_together = (("distributed_query", "serial_number"),)
 
 
+class DistributedQueryResultManager(models.Manager):
+    def bulk_create_from_results(self, serial_number, dq_results, batch_size=1000):
+        """Insert the result rows of a machine with multi-row inserts
+
+        dq_results is an iterable of (distributed query pk, rows) tuples.
+        """
+        return self.bulk_create(
+            (self.model(distributed_query_id=dq_pk, serial_number=serial_number, row=row)
+             for dq_pk, rows in dq_results
+             for row in rows),
+            batch_size=batch_size
+        )
+
+
 class DistributedQueryResult(models.Model):
     distributed_query = models.ForeignKey(DistributedQuery, on_delete=models.CASCADE)
     serial_number = models.TextField()
     row = models.JSONField()
 
+    objects = DistributedQueryResultManager()
+
     class Meta:
         indexes = [
             models.Index(fields=["distributed_query", "serial_number"])
@@ -682,6 +698,15 @@ class DistributedQueryResult(models.Model):
             yield k, self.row.get(k)
 
 
+class DistributedQueryResultBatch(models.Model):
+    serial_number = models.TextField()
+    data = models.TextField()  # JSON text of the (distributed query pk, rows) tuples
+    received_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=["serial_number", "id"])]
+
+
 # File carving
 
 
@@ -712,6 +737,8 @@ class FileCarvingSession(models.Model):
     carve_size = models.BigIntegerField()
     block_size = models.IntegerField()
     block_count = models.IntegerField()
+    received_blocks = models.BinaryField(default=b"")  # bitmap, see file_carving.py
+    received_block_count = models.IntegerField(default=0)
     archive = models.FileField(upload_to=file_carving_session_archive_path, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -721,6 +748,10 @@ class FileCarvingSession(models.Model):
     def get_archive_name(self):
         return f"{self}.tar"
 
+    def get_archive_url(self):
+        return "{}{}".format(settings["api"]["tls_hostname"],
+                             reverse("osquery:download_file_carving_session_archive", args=(self.pk,)))
+
 
 def file_carving_block_path(instance, filename):
     return os.path.join(file_carving_session_dir_path(instance.file_carving_session), str(instance.block_id))
@@ -734,3 +765,17 @@ class FileCarvingBlock(models.Model):
 
     class Meta:
         unique_together = (("file_carving_session", "block_id"),)
+
+
+# Result log queue
+
+
+class ResultLogBatch(models.Model):
+    enrolled_machine = models.ForeignKey(EnrolledMachine, on_delete=models.CASCADE)
+    user_agent = models.TextField()
+    ip = models.GenericIPAddressField(blank=True, null=True)
+    data = models.TextField()  # JSON text, because the records can contain null characters
+    received_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [models.Index(fields=["enrolled_machine", "id"])]
@@ -5,9 +5,9 @@ from itertools import chain, islice
 import json
 import logging
 from django.core.exceptions import SuspiciousOperation, PermissionDenied
-from django.core.files.uploadedfile import SimpleUploadedFile
 from django.db import transaction
 from django.http import Http404, JsonResponse
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 from django.views.generic import View
 from zentral.contrib.inventory.exceptions import EnrollmentSecretVerificationFailed
@@ -15,21 +15,21 @@ from zentral.contrib.inventory.models import MachineSnapshot, MetaMachine, Machi
 from zentral.contrib.inventory.utils import (commit_machine_snapshot_and_trigger_events,
                                              verify_enrollment_secret)
 from zentral.contrib.osquery.compliance_checks import ComplianceCheckStatusAggregator
-from zentral.contrib.osquery.conf import build_osquery_conf, INVENTORY_QUERY_NAME
+from zentral.contrib.osquery.conf import build_osquery_conf
+from zentral.contrib.osquery.distributed_query_results import distributed_query_result_queue
 from zentral.contrib.osquery.events import (post_enrollment_event,
                                             post_file_carve_events,
-                                            post_request_event, post_results, post_status_logs)
+                                            post_request_event, post_status_logs)
+from zentral.contrib.osquery.file_carving import record_received_file_carving_block, write_file_carving_block
 from zentral.contrib.osquery.models import (DistributedQuery, DistributedQueryMachine, DistributedQueryResult,
-                                            EnrolledMachine,
-                                            FileCarvingBlock, FileCarvingSession,
-                                            PackQuery, parse_result_name)
+                                            EnrolledMachine, FileCarvingSession)
+from zentral.contrib.osquery.result_logs import process_result_logs, result_log_queue
 from zentral.contrib.osquery.tags import TagUpdateAggregator
 from zentral.contrib.osquery.tasks import build_file_carving_session_archive
 from zentral.core.events.base import post_machine_conflict_event
 from zentral.utils.http import user_agent_and_ip_address_from_request
 from zentral.utils.json import remove_null_character
-from .views.utils import (prepare_file_carving_session_if_necessary,
-                          update_tree_with_enrollment_host_details, update_tree_with_inventory_query_snapshot)
+from .views.utils import prepare_file_carving_session_if_necessary, update_tree_with_enrollment_host_details
 
 
 logger = logging.getLogger('zentral.contrib.osquery.views.api')
@@ -202,7 +202,7 @@ class StartFileCarvingView(BaseNodeView):
         except FileCarvingSession.DoesNotExist:
             raise Http404("Unknown carve_id")
 
-        if fcs.filecarvingblock_set.count():
+        if fcs.received_block_count:
             raise SuspiciousOperation("File carving session already has blocks")
 
         fcs_updated = False
@@ -232,7 +232,8 @@ class ContinueFileCarvingView(BaseNodeView):
         except KeyError:
             raise SuspiciousOperation("Missing session_id")
         try:
-            self.session = FileCarvingSession.objects.select_for_update().get(pk=session_id)
+            # no lock, the received blocks are recorded with an atomic update, see file_carving.py
+            self.session = FileCarvingSession.objects.defer("received_blocks").get(pk=session_id)
         except FileCarvingSession.DoesNotExist:
             raise PermissionDenied("Unknown session_id")
         # TODO: better. "There can be only one"
@@ -254,20 +255,20 @@ class ContinueFileCarvingView(BaseNodeView):
             raise SuspiciousOperation("Missing block_id")
         except ValueError:
             raise SuspiciousOperation("Invalid block_id")
-        else:
-            block_filename = str(block_id)
+        if block_id < 0 or block_id >= self.session.block_count:
+            raise SuspiciousOperation("Invalid block_id")
         try:
             block_data = b64decode(self.data["data"])
         except KeyError:
             raise SuspiciousOperation("Missing block data")
         except Exception:
             raise SuspiciousOperation("Could not read block data")
+        if len(block_data) > self.session.block_size:
+            raise SuspiciousOperation("Block data too large")
 
-        cb = FileCarvingBlock.objects.create(file_carving_session=self.session, block_id=block_id)
-        cb.file.save(block_filename, SimpleUploadedFile(block_filename, block_data))
+        write_file_carving_block(self.session, block_id, block_data)
+        session_finished = record_received_file_carving_block(self.session, block_id)
 
-        session_finished = (FileCarvingBlock.objects.filter(file_carving_session=self.session).count()
-                            == self.session.block_count)
         post_file_carve_events(self.machine.serial_number, self.user_agent, self.ip,
                                [{"action": "continue",
                                  "block_id": block_id,
@@ -304,7 +305,18 @@ class DistributedReadView(BaseNodeView):
 
 class DistributedWriteView(BaseNodeView):
     request_type = "distributed_write"
-    batch_size = 100  # TODO hard coded
+    dqm_update_fields = ("status", "error_message",
+                         "memory", "system_time", "user_time", "wall_time_ms",
+                         "updated_at")
+
+    def save_results(self, dq_results):
+        result_count = sum(len(rows) for _, rows in dq_results)
+        if not result_count:
+            return
+        if distributed_query_result_queue.should_defer(result_count):
+            distributed_query_result_queue.enqueue(self.machine.serial_number, dq_results)
+        else:
+            DistributedQueryResult.objects.bulk_create_from_results(self.machine.serial_number, dq_results)
 
     def do_node_post(self):
         results = self.data.get("queries", {})
@@ -321,6 +333,7 @@ class DistributedWriteView(BaseNodeView):
                                                        .filter(pk__in=dqm_pk_set)}
 
         # update distributed query machines
+        updated_at = timezone.now()
         for dqm_pk, dqm in dqm_cache.items():
             # status
             dqm_status = statuses.get(dqm_pk)
@@ -342,23 +355,15 @@ class DistributedWriteView(BaseNodeView):
                             pass
                         else:
                             setattr(dqm, stat_attr, val)
-            dqm.save()
+            # bulk_update does not set the auto_now fields
+            dqm.updated_at = updated_at
+        DistributedQueryMachine.objects.bulk_update(dqm_cache.values(), self.dqm_update_fields)
 
         # save_results
-        dq_results = (
-            DistributedQueryResult(
-                distributed_query=dqm.distributed_query,
-                serial_number=self.machine.serial_number,
-                row=remove_null_character(row)
-            )
+        self.save_results([
+            (dqm.distributed_query_id, [remove_null_character(row) for row in results.get(dqm_pk) or []])
             for dqm_pk, dqm in dqm_cache.items()
-            for row in results.get(dqm_pk, [])
-        )
-        while True:
-            batch = list(islice(dq_results, self.batch_size))
-            if not batch:
-                break
-            DistributedQueryResult.objects.bulk_create(batch, self.batch_size)
+        ])
 
         # process file carving
         for dqm_pk, dqm_results in results.items():
@@ -443,49 +448,10 @@ class LogView(BaseNodeView):
 
         log_type = self.data.get("log_type")
         if log_type == "result":
-            results = []
-            last_inventory_snapshot = None
-            for record in records:
-                if record.get("name") == INVENTORY_QUERY_NAME:
-                    last_inventory_snapshot = record.get("snapshot")
-                else:
-                    results.append(record)
-                    # file carving ?
-                    columns = None
-                    if "columns" in record:
-                        columns = record["columns"]
-                    elif "snapshot" in record:
-                        try:
-                            columns = record["snapshot"][0]
-                        except IndexError:
-                            pass
-                    if columns:
-                        file_carving_session = prepare_file_carving_session_if_necessary(columns)
-                        if file_carving_session:
-                            try:
-                                pack_pk, _, query_pk, _, _ = parse_result_name(record["name"])
-                                pack_query = PackQuery.objects.get(pack__pk=pack_pk, query__pk=query_pk)
-                            except Exception:
-                                logger.exception("could not find file carving result pack query")
-                            else:
-                                file_carving_session.serial_number = self.machine.serial_number
-                                file_carving_session.pack_query = pack_query
-                                file_carving_session.save()
-                                post_file_carve_events(self.machine.serial_number, self.user_agent, self.ip,
-                                                       [{"action": "schedule",
-                                                         "session_id": str(file_carving_session.pk)}])
-            if last_inventory_snapshot:
-                tree = {"source": {"module": "zentral.contrib.osquery",
-                                   "name": "osquery"},
-                        "serial_number": self.machine.serial_number,
-                        "reference": self.enrolled_machine.node_key,
-                        "public_ip_address": self.ip}
-                business_unit = self.enrollment.secret.get_api_enrollment_business_unit()
-                if business_unit:
-                    tree["business_unit"] = business_unit.serialize()
-                update_tree_with_inventory_query_snapshot(tree, last_inventory_snapshot)
-                commit_machine_snapshot_and_trigger_events(tree)
-            post_results(self.machine.serial_number, self.user_agent, self.ip, results)
+            if result_log_queue.enabled:
+                result_log_queue.enqueue(self.enrolled_machine, self.user_agent, self.ip, records)
+            else:
+                process_result_logs(self.enrolled_machine, self.user_agent, self.ip, records)
         elif log_type == "status":
             # TODO: configuration option to filter some of those (severity) or maybe simply ignore them
             post_status_logs(self.machine.serial_number, self.user_agent, self.ip, records)
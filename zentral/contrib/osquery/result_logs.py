@@ -0,0 +1,203 @@
+from datetime import datetime
+import hashlib
+import json
+import logging
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.functional import SimpleLazyObject
+from prometheus_client import Counter
+from zentral.conf import settings
+from zentral.contrib.inventory.models import CurrentMachineSnapshot
+from zentral.contrib.inventory.utils import commit_machine_snapshot_and_trigger_events
+from zentral.core.exceptions import ImproperlyConfigured
+from zentral.utils.db_queues import BaseDBQueue
+from .conf import INVENTORY_QUERY_NAME
+from .events import post_file_carve_events, post_results
+from .models import EnrolledMachine, PackQuery, ResultLogBatch, parse_result_name
+from .views.utils import prepare_file_carving_session_if_necessary, update_tree_with_inventory_query_snapshot
+
+
+logger = logging.getLogger("zentral.contrib.osquery.result_logs")
+
+
+inventory_snapshots = Counter(
+    "zentral_osquery_inventory_snapshots",
+    "Osquery inventory snapshots",
+    ["result"]
+)
+
+
+class InventorySnapshotDedup:
+    """Skip the commits of the unchanged osquery inventory snapshots
+
+    osquery sends the full inventory snapshot at each inventory interval. The hash of the last
+    committed snapshot of each node is cached, and an identical snapshot is not committed again
+    before the TTL expires. The uptime rows are not hashed, because they always change.
+    The TTL is derived from the inventory interval of the osquery configuration, with a margin
+    of half an interval for the schedule splay, so that at most max_skipped_snapshots consecutive
+    identical snapshots are skipped. The last seen of the current osquery machine snapshot is still
+    updated when a snapshot is skipped. The TTL bounds the delay of the uptime updates.
+    """
+    default_max_skipped_snapshots = 1
+    source_module = "zentral.contrib.osquery"
+    source_name = "osquery"
+
+    def __init__(self):
+        options = settings["apps"]["zentral.contrib.osquery"].get("inventory_snapshot_dedup", {})
+        try:
+            # 1 by default (min 0 → disabled, max 24)
+            self.max_skipped_snapshots = min(max(0, int(options.get("max_skipped_snapshots",
+                                                                    self.default_max_skipped_snapshots))),
+                                             24)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Osquery inventory snapshot dedup max skipped snapshots must be an integer")
+
+    def get_ttl(self, configuration):
+        if not self.max_skipped_snapshots:
+            return 0
+        return int(configuration.inventory_interval * (self.max_skipped_snapshots + 0.5))
+
+    @staticmethod
+    def _cache_key(node_key):
+        return f"osquery-iss_{node_key}"
+
+    @staticmethod
+    def get_hash(business_unit, ip, snapshot):
+        rows = [row for row in snapshot if not isinstance(row, dict) or row.get("table_name") != "uptime"]
+        data = [business_unit.pk if business_unit else None, ip, rows]
+        return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def commit(self, enrolled_machine, ip, snapshot):
+        """Commit the inventory snapshot if it has changed, and return True if it was committed"""
+        business_unit = enrolled_machine.enrollment.secret.get_api_enrollment_business_unit()
+        cache_key = snapshot_hash = None
+        ttl = self.get_ttl(enrolled_machine.enrollment.configuration)
+        if ttl:
+            cache_key = self._cache_key(enrolled_machine.node_key)
+            snapshot_hash = self.get_hash(business_unit, ip, snapshot)
+            if cache.get(cache_key) == snapshot_hash:
+                # cheap last seen refresh, without a new commit
+                CurrentMachineSnapshot.objects.filter(
+                    serial_number=enrolled_machine.serial_number,
+                    source__module=self.source_module,
+                    source__name=self.source_name,
+                ).update(last_seen=datetime.utcnow())
+                inventory_snapshots.labels("skipped").inc()
+                return False
+        tree = {"source": {"module": self.source_module,
+                           "name": self.source_name},
+                "serial_number": enrolled_machine.serial_number,
+                "reference": enrolled_machine.node_key,
+                "public_ip_address": ip}
+        if business_unit:
+            tree["business_unit"] = business_unit.serialize()
+        update_tree_with_inventory_query_snapshot(tree, snapshot)
+        if commit_machine_snapshot_and_trigger_events(tree) is None:
+            # commit error
+            return False
+        inventory_snapshots.labels("committed").inc()
+        if cache_key:
+            transaction.on_commit(lambda: cache.set(cache_key, snapshot_hash, ttl))
+        return True
+
+
+inventory_snapshot_dedup = SimpleLazyObject(lambda: InventorySnapshotDedup())
+
+
+def _save_file_carving_sessions(serial_number, user_agent, ip, file_carving_sessions):
+    pack_queries = {
+        (pack_query.pack_id, pack_query.query_id): pack_query
+        for pack_query in PackQuery.objects.filter(query__pk__in=set(t[1] for t in file_carving_sessions))
+    }
+    payloads = []
+    for pack_pk, query_pk, file_carving_session in file_carving_sessions:
+        pack_query = pack_queries.get((pack_pk, query_pk))
+        if pack_query is None:
+            logger.error("could not find file carving result pack query")
+            continue
+        file_carving_session.serial_number = serial_number
+        file_carving_session.pack_query = pack_query
+        file_carving_session.save()
+        payloads.append({"action": "schedule",
+                         "session_id": str(file_carving_session.pk)})
+    if payloads:
+        post_file_carve_events(serial_number, user_agent, ip, payloads)
+
+
+def process_result_logs(enrolled_machine, user_agent, ip, records):
+    serial_number = enrolled_machine.serial_number
+    results = []
+    last_inventory_snapshot = None
+    file_carving_sessions = []
+    for record in records:
+        if record.get("name") == INVENTORY_QUERY_NAME:
+            last_inventory_snapshot = record.get("snapshot")
+            continue
+        results.append(record)
+        # file carving ?
+        columns = None
+        if "columns" in record:
+            columns = record["columns"]
+        elif "snapshot" in record:
+            try:
+                columns = record["snapshot"][0]
+            except IndexError:
+                pass
+        if columns:
+            file_carving_session = prepare_file_carving_session_if_necessary(columns)
+            if file_carving_session:
+                try:
+                    pack_pk, _, query_pk, _, _ = parse_result_name(record["name"])
+                except Exception:
+                    logger.exception("could not parse file carving result name")
+                else:
+                    file_carving_sessions.append((pack_pk, query_pk, file_carving_session))
+    if file_carving_sessions:
+        _save_file_carving_sessions(serial_number, user_agent, ip, file_carving_sessions)
+    if last_inventory_snapshot:
+        inventory_snapshot_dedup.commit(enrolled_machine, ip, last_inventory_snapshot)
+    post_results(serial_number, user_agent, ip, results)
+
+
+class ResultLogQueue(BaseDBQueue):
+    """Durable queue of the osquery result logs
+
+    When enabled, the result logs are stored in the database and acknowledged immediately.
+    The pending result logs of a node are processed in the order they were received.
+    """
+    app = "zentral.contrib.osquery"
+    options_key = "result_log_queue"
+    name = "Osquery result log queue"
+    default_celery_queue = "osquery_result_logs"
+    model = ResultLogBatch
+    group_field = "enrolled_machine_id"
+    logger = logger
+    error_message = "Could not process enrolled machine %s result log batch %s"
+
+    def get_task(self):
+        from .tasks import process_result_log_batches_task  # circular dependency
+        return process_result_log_batches_task
+
+    def get_group(self, enrolled_machine_pk):
+        try:
+            return (EnrolledMachine.objects.select_related("enrollment__configuration",
+                                                           "enrollment__secret__meta_business_unit")
+                                           .get(pk=enrolled_machine_pk))
+        except EnrolledMachine.DoesNotExist:
+            logger.error("Unknown enrolled machine %s", enrolled_machine_pk)
+
+    def enqueue(self, enrolled_machine, user_agent, ip, records):
+        self._enqueue(
+            enrolled_machine.pk,
+            enrolled_machine=enrolled_machine,
+            user_agent=user_agent,
+            ip=ip,
+            data=json.dumps(records),
+            received_at=datetime.utcnow(),
+        )
+
+    def process_payload(self, enrolled_machine, batch):
+        process_result_logs(enrolled_machine, batch.user_agent, batch.ip, json.loads(batch.data))
+
+
+result_log_queue = SimpleLazyObject(lambda: ResultLogQueue())
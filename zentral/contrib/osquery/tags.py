@@ -1,4 +1,5 @@
 import logging
+from zentral.contrib.inventory.cache import machine_info_cache
 from zentral.contrib.inventory.models import MachineTag
 from .models import Query
 
@@ -50,3 +51,5 @@ class TagUpdateAggregator:
                 [MachineTag(serial_number=self.serial_number, tag=tag) for tag in tags_to_add],
                 ignore_conflicts=True
             )
+            # no signals with bulk_create
+            machine_info_cache.bump_machines([self.serial_number])
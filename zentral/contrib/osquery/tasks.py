@@ -5,12 +5,15 @@ import logging
 import os
 import tempfile
 from celery import shared_task
-from django.core.files import File
 from django.core.files.storage import default_storage
 from django.utils.text import slugify
 import xlsxwriter
 from zentral.core.events import event_cls_from_type
-from .models import DistributedQuery, FileCarvingSession
+from zentral.utils.db_queues import TRANSIENT_DB_ERRORS
+from .distributed_query_results import distributed_query_result_queue
+from .file_carving import finalize_file_carving_session_archive
+from .models import DistributedQuery, DistributedQueryResult, FileCarvingSession
+from .result_logs import result_log_queue
 
 
 logger = logging.getLogger("zentral.contrib.osquery.tasks")
@@ -25,18 +28,8 @@ def build_file_carving_session_archive(session_id):
         logger.error("Archive already exists for session %s", session_id)
         return
 
-    # build archive file from carve blocks
-    archive_size = 0
-    tmp_fh, tmp_path = tempfile.mkstemp(suffix="_osquery_file_carving_archive.tar")
-    logger.info("Start building archive %s %s", session_id, tmp_path)
-    with os.fdopen(tmp_fh, "wb") as f:
-        for file_carving_block in file_carving_session.filecarvingblock_set.all().order_by("block_id"):
-            for chunk in file_carving_block.file.chunks():
-                f.write(chunk)
-                archive_size += len(chunk)
-    with open(tmp_path, "rb") as f:
-        file_carving_session.archive.save("archive.tar", File(f))
-    os.unlink(tmp_path)
+    # attach or assemble the archive
+    archive_size = finalize_file_carving_session_archive(file_carving_session)
 
     # post osquery file carve event
     event_cls = event_cls_from_type("osquery_file_carving")
@@ -50,6 +43,17 @@ def build_file_carving_session_archive(session_id):
                       "url": file_carving_session.get_archive_url()}}])
 
 
+@shared_task(autoretry_for=TRANSIENT_DB_ERRORS, retry_backoff=True)
+def process_result_log_batches_task(enrolled_machine_pk):
+    return {"enrolled_machine": enrolled_machine_pk,
+            "processed": result_log_queue.process_group(enrolled_machine_pk)}
+
+
+@shared_task
+def sweep_result_log_queue_task():
+    return {"scheduled": result_log_queue.sweep()}
+
+
 # distributed query result exports
 
 
@@ -155,3 +159,18 @@ def _export_distributed_query_results(distributed_query, extension):
 def export_distributed_query_results(distributed_query_pk, extension):
     distributed_query = DistributedQuery.objects.get(pk=distributed_query_pk)
     return _export_distributed_query_results(distributed_query, extension)
+
+
+@shared_task(autoretry_for=TRANSIENT_DB_ERRORS, retry_backoff=True)
+def save_distributed_query_results(serial_number, dq_results=None):
+    if dq_results is not None:
+        # task queued before the results were stored in the database
+        dq_results_count = len(DistributedQueryResult.objects.bulk_create_from_results(serial_number, dq_results))
+        return {"serial_number": serial_number, "results": dq_results_count}
+    return {"serial_number": serial_number,
+            "processed": distributed_query_result_queue.process_group(serial_number)}
+
+
+@shared_task
+def sweep_distributed_query_result_queue_task():
+    return {"scheduled": distributed_query_result_queue.sweep()}
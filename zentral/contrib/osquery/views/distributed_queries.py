@@ -4,7 +4,7 @@ import math
 from urllib.parse import urlencode
 from django.contrib.auth.mixins import PermissionRequiredMixin
 from django.db import connection
-from django.db.models import Count, Q
+from django.db.models import Q
 from django.shortcuts import get_object_or_404
 from django.urls import reverse, reverse_lazy
 from zentral.utils.sql import tables_in_query
@@ -248,7 +248,7 @@ class DistributedQueryFileCarvingSessionListView(PermissionRequiredMixin, UserPa
         return (
             super().get_queryset()
                    .filter(distributed_query=self.distributed_query)
-                   .annotate(block_seen=Count("filecarvingblock"))
+                   .defer("received_blocks")
                    .order_by("-created_at", "-pk")
         )
 
@@ -33,6 +33,41 @@ def update_machine_statuses(serial_number, compliance_check_statuses):
         return result
 
 
+def refresh_machine_status_times(serial_number, compliance_check_statuses):
+    """Only move the status times of the unchanged machine statuses forward
+
+    Returns the number of refreshed statuses. A status is only refreshed if it has the same
+    compliance check version and status value, so a smaller number means that the stored
+    statuses are out of sync, and that update_machine_statuses must be used.
+    """
+    query = (
+        'update compliance_checks_machinestatus as ms '
+        'set status_time = v.status_time, previous_status = ms.status '
+        'from (values %s) as v(compliance_check_id, compliance_check_version, serial_number, status, status_time) '
+        'where ms.compliance_check_id = v.compliance_check_id '
+        'and ms.serial_number = v.serial_number '
+        'and ms.compliance_check_version = v.compliance_check_version '
+        'and ms.status = v.status '
+        'and ms.status_time <= v.status_time '
+        'returning ms.compliance_check_id'
+    )
+    with connection.cursor() as cursor:
+        now = datetime.utcnow()  # default status time
+        result = psycopg2.extras.execute_values(
+            cursor, query,
+            ((compliance_check.pk,
+              compliance_check.version,
+              serial_number,
+              status.value,
+              status_time or now)
+             for compliance_check, status, status_time in compliance_check_statuses),
+            template="(%s, %s, %s, %s, %s::timestamp)",
+            page_size=max(1, len(compliance_check_statuses)),
+            fetch=True
+        )
+        return len(result)
+
+
 def get_machine_compliance_check_statuses(serial_number, tags):
     compliance_check_statuses = []
     non_default_compliance_check_classes = [
@@ -1,11 +1,10 @@
-import base64
 import boto3
 from botocore.config import Config
 from django.utils.functional import cached_property
-from .base import BaseSecretEngine
+from .base import BaseKMSSecretEngine
 
 
-class SecretEngine(BaseSecretEngine):
+class SecretEngine(BaseKMSSecretEngine):
     def __init__(self, config_d):
         super().__init__(config_d)
         # key
@@ -41,19 +40,19 @@ class SecretEngine(BaseSecretEngine):
             prepared_context[k] = v
         return prepared_context
 
-    def encrypt(self, data, **context):
+    def kms_encrypt(self, data, **context):
         response = self.kms_client.encrypt(
             KeyId=self.key_id,
             Plaintext=data,
             EncryptionContext=self._prepared_context(context),
             EncryptionAlgorithm='SYMMETRIC_DEFAULT'
         )
-        return base64.urlsafe_b64encode(response['CiphertextBlob']).decode("utf-8")
+        return response['CiphertextBlob']
 
-    def decrypt(self, data, **context):
+    def kms_decrypt(self, ciphertext, **context):
         response = self.kms_client.decrypt(
             KeyId=self.key_id,
-            CiphertextBlob=base64.urlsafe_b64decode(data.encode("utf-8")),
+            CiphertextBlob=ciphertext,
             EncryptionContext=self._prepared_context(context),
             EncryptionAlgorithm='SYMMETRIC_DEFAULT'
         )
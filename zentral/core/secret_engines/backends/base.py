@@ -1,3 +1,21 @@
+import base64
+from collections import OrderedDict
+import json
+import os
+import threading
+import time
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from prometheus_client import Counter
+from zentral.core.exceptions import ImproperlyConfigured
+
+
+data_key_cache_requests = Counter(
+    "zentral_secret_engine_data_key_cache_requests",
+    "Secret engine data key cache requests",
+    ["engine", "result"]
+)
+
+
 class BaseSecretEngine:
     def __init__(self, config_d):
         self.name = config_d['secret_engine_name']
@@ -8,3 +26,134 @@ class BaseSecretEngine:
 
     def decrypt(self, data, **context):
         raise NotImplementedError
+
+
+class BaseKMSSecretEngine(BaseSecretEngine):
+    """Base class for the secret engines using a KMS symmetric key
+
+    By default, the secrets are encrypted and decrypted by the KMS. With envelope encryption,
+    the KMS only wraps random data keys, and the secrets are encrypted locally with AES-GCM,
+    the context being used as associated data. A data key is used to encrypt the new secrets
+    until its TTL expires. The unwrapped data keys are kept in a bounded in-memory cache,
+    with the same TTL.
+
+    The direct and envelope tokens can always be decrypted. The rewrap function converts them
+    to the current mode.
+    """
+    envelope_prefix = "e1."
+    data_key_context = {"zentral": "data_key"}
+    nonce_length = 12
+    # random 96-bit nonces → stay far below 2**32 encryptions per data key
+    max_data_key_encryptions = 2 ** 20
+
+    def __init__(self, config_d):
+        super().__init__(config_d)
+        self.envelope_encryption = bool(config_d.get("envelope_encryption", False))
+        try:
+            # 1h by default (min 0 → no reuse, max 1d)
+            self.data_key_ttl = min(max(0, int(config_d.get("data_key_ttl", 3600))), 86400)
+            # 256 by default (min 1, max 10000)
+            self.data_key_cache_size = min(max(1, int(config_d.get("data_key_cache_size", 256))), 10000)
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured("Secret engine data key TTL and cache size must be integers")
+        self._lock = threading.Lock()
+        self._encryption_data_key = None
+        self._data_keys = OrderedDict()
+
+    # KMS
+
+    def kms_encrypt(self, data, **context):
+        """Encrypt the data with the KMS, and return the ciphertext bytes"""
+        raise NotImplementedError
+
+    def kms_decrypt(self, ciphertext, **context):
+        """Decrypt the ciphertext bytes with the KMS, and return the data"""
+        raise NotImplementedError
+
+    # data keys
+
+    def _cache_data_key(self, wrapped_data_key, data_key, expires_at):
+        # must be called with the lock held
+        if not self.data_key_ttl:
+            return
+        self._data_keys[wrapped_data_key] = (data_key, expires_at)
+        self._data_keys.move_to_end(wrapped_data_key)
+        while len(self._data_keys) > self.data_key_cache_size:
+            self._data_keys.popitem(last=False)
+
+    def _get_encryption_data_key(self):
+        now = time.monotonic()
+        with self._lock:
+            if self._encryption_data_key:
+                data_key, wrapped_data_key, expires_at, count = self._encryption_data_key
+                if now < expires_at and count < self.max_data_key_encryptions:
+                    self._encryption_data_key = (data_key, wrapped_data_key, expires_at, count + 1)
+                    return data_key, wrapped_data_key
+        data_key = AESGCM.generate_key(bit_length=256)
+        wrapped_data_key = self.kms_encrypt(data_key, **self.data_key_context)
+        expires_at = now + self.data_key_ttl
+        with self._lock:
+            self._encryption_data_key = (data_key, wrapped_data_key, expires_at, 1)
+            self._cache_data_key(wrapped_data_key, data_key, expires_at)
+        return data_key, wrapped_data_key
+
+    def _get_decryption_data_key(self, wrapped_data_key):
+        now = time.monotonic()
+        with self._lock:
+            try:
+                data_key, expires_at = self._data_keys[wrapped_data_key]
+            except KeyError:
+                pass
+            else:
+                if now < expires_at:
+                    self._data_keys.move_to_end(wrapped_data_key)
+                    data_key_cache_requests.labels(self.name, "hit").inc()
+                    return data_key
+        data_key_cache_requests.labels(self.name, "miss").inc()
+        data_key = self.kms_decrypt(wrapped_data_key, **self.data_key_context)
+        with self._lock:
+            self._cache_data_key(wrapped_data_key, data_key, now + self.data_key_ttl)
+        return data_key
+
+    # secrets
+
+    @staticmethod
+    def _associated_data(context):
+        prepared_context = {}
+        for k, v in context.items():
+            if not isinstance(v, str):
+                v = str(v)
+            prepared_context[k] = v
+        return json.dumps(prepared_context, ensure_ascii=False, sort_keys=True).encode("utf-8")
+
+    @staticmethod
+    def _b64encode(data):
+        return base64.urlsafe_b64encode(data).decode("utf-8")
+
+    @staticmethod
+    def _b64decode(data):
+        return base64.urlsafe_b64decode(data.encode("utf-8"))
+
+    def encrypt(self, data, **context):
+        if not self.envelope_encryption:
+            return self._b64encode(self.kms_encrypt(data, **context))
+        data_key, wrapped_data_key = self._get_encryption_data_key()
+        nonce = os.urandom(self.nonce_length)
+        ciphertext = AESGCM(data_key).encrypt(nonce, data, self._associated_data(context))
+        return "{}{}.{}".format(self.envelope_prefix,
+                                self._b64encode(wrapped_data_key),
+                                self._b64encode(nonce + ciphertext))
+
+    def decrypt(self, data, **context):
+        if not data.startswith(self.envelope_prefix):
+            # direct KMS encryption
+            return self.kms_decrypt(self._b64decode(data), **context)
+        try:
+            encoded_wrapped_data_key, encoded_ciphertext = data[len(self.envelope_prefix):].split(".")
+        except ValueError:
+            raise ValueError("Bad envelope structure")
+        data_key = self._get_decryption_data_key(self._b64decode(encoded_wrapped_data_key))
+        ciphertext = self._b64decode(encoded_ciphertext)
+        return AESGCM(data_key).decrypt(ciphertext[:self.nonce_length],
+                                        ciphertext[self.nonce_length:],
+                                        self._associated_data(context))
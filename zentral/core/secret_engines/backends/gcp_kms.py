@@ -1,13 +1,12 @@
-import base64
 import json
 from django.utils.functional import cached_property
 from google.cloud import kms
 from google.oauth2 import service_account
 import google_crc32c
-from .base import BaseSecretEngine
+from .base import BaseKMSSecretEngine
 
 
-class SecretEngine(BaseSecretEngine):
+class SecretEngine(BaseKMSSecretEngine):
     def __init__(self, config_d):
         super().__init__(config_d)
         self.key_name = kms.KeyManagementServiceClient.crypto_key_path(
@@ -40,7 +39,7 @@ class SecretEngine(BaseSecretEngine):
             prepared_context[k] = v
         return json.dumps(prepared_context, ensure_ascii=False, sort_keys=True).encode("utf-8")
 
-    def encrypt(self, data, **context):
+    def kms_encrypt(self, data, **context):
         additional_authenticated_data = self._prepared_context(context)
         response = self.kms_client.encrypt(request={
             "name": self.key_name,
@@ -53,10 +52,9 @@ class SecretEngine(BaseSecretEngine):
             raise Exception("The request sent to the server was corrupted in-transit.")
         if not response.ciphertext_crc32c == self._crc32c(response.ciphertext):
             raise Exception("The response received from the server was corrupted in-transit.")
-        return base64.urlsafe_b64encode(response.ciphertext).decode("utf-8")
+        return response.ciphertext
 
-    def decrypt(self, data, **context):
-        ciphertext = base64.urlsafe_b64decode(data.encode("utf-8"))
+    def kms_decrypt(self, ciphertext, **context):
         additional_authenticated_data = self._prepared_context(context)
         response = self.kms_client.decrypt(request={
             "name": self.key_name,
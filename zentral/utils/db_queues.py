@@ -0,0 +1,118 @@
+from datetime import datetime, timedelta
+from django.db import InterfaceError, OperationalError, transaction
+from zentral.conf import settings
+from zentral.core.exceptions import ImproperlyConfigured
+
+
+# the payloads are left in the queues, and the tasks retried
+TRANSIENT_DB_ERRORS = (InterfaceError, OperationalError)
+
+
+class BaseDBQueue:
+    """Base class for the durable queues of payloads stored in the database
+
+    When enabled, the payloads are stored in the database and acknowledged immediately.
+    A Celery task, routed to a dedicated queue, processes the pending payloads of a group
+    (a machine for example) in the order they were received. The payloads are locked with
+    SKIP LOCKED, and a worker stops if an older payload of the group is locked by another one.
+
+    In that case, the group is re-scheduled with a short countdown, in case the other worker
+    has already left. The sweep method re-schedules the groups with payloads older than
+    sweep_min_age seconds, for the tasks that were lost (failed apply_async, worker crash, …).
+
+    A payload that cannot be processed is logged and dropped, not to block the queue of its group.
+    On a transient database error, the payload is left in the queue and the error is raised.
+    """
+    app = None
+    options_key = None
+    name = None
+    default_celery_queue = None
+    model = None
+    group_field = None
+    time_field = "received_at"
+    logger = None
+    error_message = None  # with the group key and payload pk args
+    retry_countdown = 5  # seconds
+    default_sweep_min_age = 300  # seconds
+    min_sweep_min_age = 30
+    max_sweep_min_age = 86400
+
+    def __init__(self):
+        options = settings["apps"][self.app].get(self.options_key, {})
+        self.enabled = bool(options.get("enabled", False))
+        self.celery_queue = options.get("celery_queue", self.default_celery_queue)
+        if not isinstance(self.celery_queue, str) or not self.celery_queue:
+            raise ImproperlyConfigured(f"{self.name} Celery queue must be a non-empty string")
+        try:
+            self.sweep_min_age = min(self.max_sweep_min_age,
+                                     max(self.min_sweep_min_age,
+                                         int(options.get("sweep_min_age", self.default_sweep_min_age))))
+        except (TypeError, ValueError):
+            raise ImproperlyConfigured(f"{self.name} sweep min age must be an integer")
+
+    def get_task(self):
+        """Return the Celery task processing the payloads of a group"""
+        raise NotImplementedError
+
+    def get_group(self, group_key):
+        """Return the object passed to process_payload, or None if the group is unknown"""
+        return group_key
+
+    def get_queryset(self):
+        return self.model.objects.all()
+
+    def process_payload(self, group, payload):
+        raise NotImplementedError
+
+    def schedule_group(self, group_key, countdown=None):
+        self.get_task().apply_async((group_key,), queue=self.celery_queue, countdown=countdown)
+
+    def _enqueue(self, group_key, **payload_kwargs):
+        self.model.objects.create(**payload_kwargs)
+        transaction.on_commit(lambda: self.schedule_group(group_key))
+
+    def process_group(self, group_key):
+        """Process the pending payloads of a group, and return the number of processed payloads"""
+        group = self.get_group(group_key)
+        if group is None:
+            return 0
+        group_filter = {self.group_field: group_key}
+        processed = 0
+        while True:
+            with transaction.atomic():
+                payload = (self.get_queryset().select_for_update(skip_locked=True, of=("self",))
+                                              .filter(**group_filter)
+                                              .order_by("pk")
+                                              .first())
+                if payload is None:
+                    break
+                if self.model.objects.filter(pk__lt=payload.pk, **group_filter).exists():
+                    # an older payload is being processed by another worker, that should also process this one.
+                    # re-schedule the group, in case the other worker has already left.
+                    transaction.on_commit(lambda: self.schedule_group(group_key, countdown=self.retry_countdown))
+                    break
+                try:
+                    with transaction.atomic():
+                        self.process_payload(group, payload)
+                except TRANSIENT_DB_ERRORS:
+                    # rollback, the payload stays in the queue
+                    raise
+                except Exception:
+                    # do not block the queue of the group
+                    self.logger.exception(self.error_message, group_key, payload.pk)
+                payload.delete()
+                processed += 1
+        return processed
+
+    def sweep(self):
+        """Re-schedule the groups with payloads older than sweep_min_age seconds, and return their number"""
+        min_time = datetime.utcnow() - timedelta(seconds=self.sweep_min_age)
+        group_keys = list(
+            self.model.objects.filter(**{f"{self.time_field}__lt": min_time})
+                              .order_by()
+                              .values_list(self.group_field, flat=True)
+                              .distinct()
+        )
+        for group_key in group_keys:
+            self.schedule_group(group_key)
+        return len(group_keys)
@@ -1,3 +1,4 @@
+import asyncio
 import threading
 import time
 
@@ -39,3 +40,10 @@ class LeakyBucket:
                 time.sleep(delay)
             else:
                 return False
+
+    async def async_consume(self):
+        while True:
+            delay = self._take_one()
+            if delay == 0:
+                return True
+            await asyncio.sleep(delay)
@@ -1,7 +1,8 @@
 import logging
 from django.http import HttpResponse, HttpResponseForbidden
 from django.views import View
-from prometheus_client import generate_latest, start_http_server, CollectorRegistry, Counter, CONTENT_TYPE_LATEST
+from prometheus_client import (generate_latest, start_http_server,
+                               CollectorRegistry, Counter, Gauge, CONTENT_TYPE_LATEST)
 from zentral.conf import settings
 
 
@@ -12,6 +13,7 @@ class PrometheusMetricsExporter:
     def __init__(self, port):
         self.port = port
         self.counters = {}
+        self.gauges = {}
 
     def start(self):
         logger.info("Starting prometheus http server on port %s", self.port)
@@ -21,12 +23,22 @@ class PrometheusMetricsExporter:
         description = name.replace("_", " ").capitalize()
         self.counters[name] = Counter(name, description, labels)
 
-    def inc(self, counter_name, *label_values):
+    def inc(self, counter_name, *label_values, amount=1):
         try:
-            self.counters[counter_name].labels(*label_values).inc()
+            self.counters[counter_name].labels(*label_values).inc(amount)
         except KeyError:
             logger.error("Missing counter %s", counter_name)
 
+    def add_gauge(self, name, labels):
+        description = name.replace("_", " ").capitalize()
+        self.gauges[name] = Gauge(name, description, labels)
+
+    def set(self, gauge_name, value, *label_values):
+        try:
+            self.gauges[gauge_name].labels(*label_values).set(value)
+        except KeyError:
+            logger.error("Missing gauge %s", gauge_name)
+
 
 class BasePrometheusMetricsView(View):
     def populate_registry(self):